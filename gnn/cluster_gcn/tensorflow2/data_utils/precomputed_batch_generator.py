@@ -0,0 +1,522 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+
+"""
+Batch generation from precomputed cluster subgraphs.
+
+The adjacency is reordered once so that the nodes of each cluster are
+contiguous, and split into blocks holding the edges from the nodes of
+one cluster to the nodes of another (or the same) cluster, with cluster
+local indices. The diagonal blocks are the per-cluster subgraphs, the
+others the inter-cluster edges. The subgraph of a batch of clusters is
+assembled by concatenating the blocks between its clusters and offsetting
+their indices, without slicing the full adjacency.
+
+Batches are assembled by a pool of worker processes, directly into shared
+memory buffers that the main process copies into the `tf.data` pipeline.
+"""
+
+import logging
+import multiprocessing
+import os
+import traceback
+import weakref
+from collections import deque
+from multiprocessing import shared_memory
+from pathlib import Path
+
+import numpy as np
+import tensorflow as tf
+
+from data_utils.dataset_batch_generator import (add_self_edges_with_dummy_values,
+                                                set_self_edges_values_to_zero,
+                                                tf_dataset_generator)
+from utilities.constants import AdjacencyForm, MASKED_LABEL_VALUE
+
+
+def concatenate_ranges(starts, ends):
+    """Returns the concatenation of np.arange(start, end) for all pairs of starts and ends."""
+    lengths = ends - starts
+    total = lengths.sum()
+    if total == 0:
+        return np.zeros((0,), dtype=np.int64)
+    range_starts = np.cumsum(lengths) - lengths
+    return np.arange(total) + np.repeat(starts - range_starts, lengths)
+
+
+class ClusterBlocks:
+    """
+    Adjacency of the clustered nodes split in blocks of edges between
+    pairs of clusters. The blocks are stored in CSR form over the row
+    clusters: the blocks of row cluster `c` are
+    `block_offsets[c]:block_offsets[c + 1]`, and the edges of block `b`
+    are `edge_offsets[b]:edge_offsets[b + 1]`.
+    """
+
+    ARRAYS = ("nodes", "cluster_offsets", "block_offsets", "block_row_clusters",
+              "block_col_clusters", "edge_offsets", "rows", "cols", "values")
+
+    def __init__(self, nodes, cluster_offsets, block_offsets, block_row_clusters,
+                 block_col_clusters, edge_offsets, rows, cols, values):
+        self.nodes = nodes
+        self.cluster_offsets = cluster_offsets
+        self.block_offsets = block_offsets
+        self.block_row_clusters = block_row_clusters
+        self.block_col_clusters = block_col_clusters
+        self.edge_offsets = edge_offsets
+        self.rows = rows
+        self.cols = cols
+        self.values = values
+
+    @property
+    def num_clusters(self):
+        return len(self.cluster_offsets) - 1
+
+    @property
+    def num_blocks(self):
+        return len(self.block_row_clusters)
+
+    @classmethod
+    def from_adjacency(cls, adjacency, clusters):
+        """
+        Precompute the blocks of an adjacency matrix.
+        :param adjacency: Adjacency matrix in CSR representation.
+        :param clusters: List of arrays of the nodes in each cluster.
+        """
+        num_clusters = len(clusters)
+        cluster_sizes = np.array([len(c) for c in clusters], dtype=np.int64)
+        cluster_offsets = np.concatenate([[0], np.cumsum(cluster_sizes)])
+        nodes = np.concatenate(clusters)
+        node_clusters = np.repeat(np.arange(num_clusters), cluster_sizes)
+
+        # Subgraph of the clustered nodes, in cluster order
+        subgraph = adjacency[nodes, :][:, nodes].tocsr()
+        subgraph.sort_indices()
+        subgraph = subgraph.tocoo()
+        row_clusters = node_clusters[subgraph.row]
+        col_clusters = node_clusters[subgraph.col]
+
+        # Group the edges by pair of clusters, keeping them in row-major order within a block
+        block_keys = row_clusters.astype(np.int64) * num_clusters + col_clusters
+        order = np.argsort(block_keys, kind="stable")
+        block_keys = block_keys[order]
+        keys, block_starts = np.unique(block_keys, return_index=True)
+        block_row_clusters = (keys // num_clusters).astype(np.int32)
+        block_col_clusters = (keys % num_clusters).astype(np.int32)
+
+        return cls(
+            nodes=nodes,
+            cluster_offsets=cluster_offsets,
+            block_offsets=np.searchsorted(block_row_clusters, np.arange(num_clusters + 1)),
+            block_row_clusters=block_row_clusters,
+            block_col_clusters=block_col_clusters,
+            edge_offsets=np.concatenate([block_starts, [len(block_keys)]]),
+            rows=(subgraph.row[order] - cluster_offsets[row_clusters[order]]).astype(np.int32),
+            cols=(subgraph.col[order] - cluster_offsets[col_clusters[order]]).astype(np.int32),
+            values=subgraph.data[order])
+
+    def matches(self, clusters):
+        """Whether the blocks were computed for the given clusters."""
+        return (len(clusters) == self.num_clusters and
+                np.array_equal(np.diff(self.cluster_offsets), [len(c) for c in clusters]) and
+                np.array_equal(self.nodes, np.concatenate(clusters)))
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            np.savez(f, **{name: getattr(self, name) for name in self.ARRAYS})
+        # Give user rw, group rw and all r permissions
+        os.chmod(path, 0o664)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(**{name: arrays[name] for name in cls.ARRAYS})
+
+    def subgraph(self, cluster_indices):
+        """
+        Assemble the subgraph of a batch of clusters. Nodes are in the order
+        of the clusters in the batch, and a cluster may appear more than once.
+        :return: The nodes of the batch, and the rows, columns and values of
+            its edges, with indices into the nodes of the batch.
+        """
+        cluster_indices = np.asarray(cluster_indices, dtype=np.int64)
+        cluster_starts = self.cluster_offsets[cluster_indices]
+        cluster_ends = self.cluster_offsets[cluster_indices + 1]
+        nodes = self.nodes[concatenate_ranges(cluster_starts, cluster_ends)]
+        batch_offsets = np.cumsum(cluster_ends - cluster_starts) - (cluster_ends - cluster_starts)
+
+        # Blocks of the row clusters, with the position of their row cluster in the batch
+        block_starts = self.block_offsets[cluster_indices]
+        block_ends = self.block_offsets[cluster_indices + 1]
+        blocks = concatenate_ranges(block_starts, block_ends)
+        row_positions = np.repeat(np.arange(len(cluster_indices)), block_ends - block_starts)
+
+        # Keep the blocks whose column cluster is in the batch, once per position of that cluster
+        positions_by_cluster = np.argsort(cluster_indices, kind="stable")
+        sorted_clusters = cluster_indices[positions_by_cluster]
+        col_clusters = self.block_col_clusters[blocks]
+        first = np.searchsorted(sorted_clusters, col_clusters, side="left")
+        last = np.searchsorted(sorted_clusters, col_clusters, side="right")
+        repeats = last - first
+        blocks = np.repeat(blocks, repeats)
+        row_positions = np.repeat(row_positions, repeats)
+        col_positions = positions_by_cluster[concatenate_ranges(first, last)]
+
+        edge_starts = self.edge_offsets[blocks]
+        edge_ends = self.edge_offsets[blocks + 1]
+        edges = concatenate_ranges(edge_starts, edge_ends)
+        num_edges = edge_ends - edge_starts
+        rows = self.rows[edges] + np.repeat(batch_offsets[row_positions], num_edges)
+        cols = self.cols[edges] + np.repeat(batch_offsets[col_positions], num_edges)
+        return nodes, rows, cols, self.values[edges]
+
+
+def load_or_compute_cluster_blocks(cluster_graph, adjacency, adjacency_form):
+    """
+    Return the blocks of the adjacency for the clusters of `cluster_graph`.
+    The blocks are cached next to the clustering cache, and regenerated
+    with it.
+    """
+    if adjacency_form == AdjacencyForm.SPARSE_TUPLE:
+        # Self-edges with dummy values are set to zero when assembling the batch
+        adjacency = add_self_edges_with_dummy_values(adjacency)
+
+    cache_path = None
+    if cluster_graph.use_cluster_cache:
+        file_name = cluster_graph.get_cache_file_name(f"cluster_blocks-{adjacency_form.name}")
+        cache_path = Path(cluster_graph.cache_dir).absolute().joinpath(file_name).with_suffix(".npz")
+        if not cluster_graph.regenerate_cluster_cache and cache_path.is_file():
+            logging.info(f"Loading cluster blocks from cache {cache_path}...")
+            blocks = ClusterBlocks.load(cache_path)
+            if blocks.matches(cluster_graph.clusters):
+                return blocks
+            logging.info("Cached cluster blocks do not match the clustering, regenerating them.")
+
+    logging.info(f"Precomputing cluster blocks for {cluster_graph.dataset_name}...")
+    blocks = ClusterBlocks.from_adjacency(adjacency, cluster_graph.clusters)
+    logging.info(f"Precomputed {blocks.num_blocks} blocks for {blocks.num_clusters} clusters.")
+    if cache_path is not None and cluster_graph.save_clustering_cache:
+        Path(cluster_graph.cache_dir).mkdir(parents=True, exist_ok=True)
+        logging.info(f"Saving cluster blocks in {cache_path}...")
+        blocks.save(cache_path)
+    return blocks
+
+
+class BatchAssembler:
+    """
+    Assembles padded batches from cluster blocks, with the same content
+    as the batches of `tf_dataset_generator`.
+    """
+
+    def __init__(self,
+                 cluster_blocks,
+                 features,
+                 labels,
+                 mask,
+                 max_nodes_per_batch,
+                 max_edges_per_batch,
+                 adjacency_dtype,
+                 adjacency_form):
+        self.cluster_blocks = cluster_blocks
+        self.features = features
+        # Masked nodes are given the label value the mask is regenerated from in the loss
+        self.labels = labels.copy()
+        self.labels[~np.asarray(mask, dtype=bool), :] = MASKED_LABEL_VALUE
+        self.max_nodes_per_batch = max_nodes_per_batch
+        self.max_edges_per_batch = max_edges_per_batch
+        self.adjacency_dtype = np.dtype(adjacency_dtype)
+        self.adjacency_form = adjacency_form
+
+    def buffer_specs(self):
+        """Name, shape and dtype of the fixed size arrays of a batch."""
+        specs = []
+        if self.adjacency_form == AdjacencyForm.DENSE:
+            specs.append(("adjacency", (self.max_nodes_per_batch, self.max_nodes_per_batch), self.adjacency_dtype))
+        elif self.adjacency_form == AdjacencyForm.SPARSE_TUPLE:
+            specs.append(("indices", (self.max_edges_per_batch, 2), np.dtype(np.int32)))
+            specs.append(("values", (self.max_edges_per_batch,), self.adjacency_dtype))
+        specs.append(("features", (self.max_nodes_per_batch, self.features.shape[1]), self.features.dtype))
+        specs.append(("labels", (self.max_nodes_per_batch, self.labels.shape[1]), self.labels.dtype))
+        return specs
+
+    def assemble(self, cluster_indices, rng, out):
+        """
+        Write the batch of the given clusters into the arrays of `out`.
+        Returns the edges for the sparse tensor form, which has no fixed size.
+        """
+        nodes, rows, cols, values = self.cluster_blocks.subgraph(cluster_indices)
+
+        num_nodes = len(nodes)
+        if num_nodes > self.max_nodes_per_batch:
+            # Keep a random subset of the nodes, and the edges between them
+            keep = rng.choice(num_nodes, size=self.max_nodes_per_batch, replace=False)
+            new_positions = np.full(num_nodes, -1)
+            new_positions[keep] = np.arange(self.max_nodes_per_batch)
+            nodes = nodes[keep]
+            kept_edges = (new_positions[rows] >= 0) & (new_positions[cols] >= 0)
+            rows = new_positions[rows[kept_edges]]
+            cols = new_positions[cols[kept_edges]]
+            values = values[kept_edges]
+            num_nodes = self.max_nodes_per_batch
+
+        np.take(self.features, nodes, axis=0, out=out["features"][:num_nodes])
+        out["features"][num_nodes:] = 0
+        np.take(self.labels, nodes, axis=0, out=out["labels"][:num_nodes])
+        out["labels"][num_nodes:] = MASKED_LABEL_VALUE
+
+        if self.adjacency_form == AdjacencyForm.DENSE:
+            adjacency = out["adjacency"]
+            adjacency[...] = 0
+            adjacency[rows, cols] = values.astype(self.adjacency_dtype)
+            return None
+
+        # Sparse forms list the edges in row-major order
+        order = np.argsort(rows.astype(np.int64) * self.max_nodes_per_batch + cols, kind="stable")
+        rows, cols, values = rows[order], cols[order], values[order]
+
+        if self.adjacency_form == AdjacencyForm.SPARSE_TENSOR:
+            return np.stack([rows, cols], axis=1).astype(np.int32), values.astype(self.adjacency_dtype)
+
+        values = set_self_edges_values_to_zero(values).astype(self.adjacency_dtype)
+        num_edges = len(rows)
+        if num_edges > self.max_edges_per_batch:
+            keep = rng.choice(num_edges, size=self.max_edges_per_batch, replace=False)
+            rows, cols, values = rows[keep], cols[keep], values[keep]
+            num_edges = self.max_edges_per_batch
+        # Pad the edge list with self-edges of zero value on the fake node
+        fake_node_id = self.max_nodes_per_batch - 1
+        out["indices"][:num_edges, 0] = rows
+        out["indices"][:num_edges, 1] = cols
+        out["indices"][num_edges:] = fake_node_id
+        out["values"][:num_edges] = values
+        out["values"][num_edges:] = 0
+        return None
+
+
+def _assemble_batches(assembler, slots, task_queue, result_queue):
+    """Worker loop, assembling the batches of the task queue into the shared memory slots."""
+    while True:
+        task = task_queue.get()
+        if task is None:
+            return
+        generation, batch_index, slot, cluster_indices, seed = task
+        try:
+            edges = assembler.assemble(cluster_indices, np.random.default_rng(seed), slots[slot])
+            result_queue.put((generation, batch_index, slot, edges, None))
+        except Exception:
+            result_queue.put((generation, batch_index, slot, None, traceback.format_exc()))
+
+
+def _release_workers(workers, task_queue, buffers):
+    for _ in workers:
+        task_queue.put(None)
+    for worker in workers:
+        worker.join(timeout=1)
+        if worker.is_alive():
+            worker.terminate()
+    for buffer in buffers:
+        buffer.close()
+        buffer.unlink()
+
+
+class ParallelBatchGenerator:
+    """
+    Generator of batches assembled by worker processes into a ring of
+    shared memory slots. Batches are yielded in a deterministic order,
+    that only depends on the seed.
+
+    Workers are forked when the generator is created, so they share the
+    features, labels and cluster blocks of the main process.
+    """
+
+    def __init__(self,
+                 assembler,
+                 cluster_indices,
+                 clusters_per_batch,
+                 num_workers,
+                 seed=None,
+                 num_slots=None):
+        self.assembler = assembler
+        self.cluster_indices = cluster_indices
+        self.clusters_per_batch = clusters_per_batch
+        self.seed = seed if seed is not None else np.random.SeedSequence().entropy
+        num_slots = num_slots or 2 * num_workers
+
+        self.buffers = []
+        self.slots = [dict() for _ in range(num_slots)]
+        for name, shape, dtype in assembler.buffer_specs():
+            buffer = shared_memory.SharedMemory(create=True, size=max(num_slots * int(np.prod(shape)) * dtype.itemsize, 1))
+            self.buffers.append(buffer)
+            array = np.ndarray((num_slots, *shape), dtype=dtype, buffer=buffer.buf)
+            for slot, slot_arrays in enumerate(self.slots):
+                slot_arrays[name] = array[slot]
+        self.free_slots = deque(range(num_slots))
+
+        context = multiprocessing.get_context("fork")
+        self.task_queue = context.Queue()
+        self.result_queue = context.Queue()
+        self.workers = [
+            context.Process(target=_assemble_batches,
+                            args=(assembler, self.slots, self.task_queue, self.result_queue),
+                            daemon=True)
+            for _ in range(num_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+        self._finalizer = weakref.finalize(self, _release_workers, self.workers, self.task_queue, self.buffers)
+        self.generation = 0
+
+    def close(self):
+        self._finalizer()
+
+    def cluster_batches(self):
+        """Infinite stream of batches of clusters, shuffled every epoch."""
+        rng = np.random.default_rng(self.seed)
+        remainder = np.zeros((0,), dtype=self.cluster_indices.dtype)
+        while True:
+            clusters = np.concatenate([remainder, rng.permutation(self.cluster_indices)])
+            num_batches = len(clusters) // self.clusters_per_batch
+            for batch in np.split(clusters[:num_batches * self.clusters_per_batch], num_batches):
+                yield batch
+            remainder = clusters[num_batches * self.clusters_per_batch:]
+
+    def _submit(self, generation, batch_index, cluster_indices, slot):
+        seed = (self.seed, batch_index)
+        self.task_queue.put((generation, batch_index, slot, cluster_indices, seed))
+
+    def __call__(self):
+        # A new stream for every iterator over the dataset. Batches still in
+        # flight for a previous iterator release their slot when they complete.
+        self.generation += 1
+        generation = self.generation
+        cluster_batches = self.cluster_batches()
+        completed = dict()
+        next_submitted = 0
+        next_yielded = 0
+        try:
+            while True:
+                while self.free_slots:
+                    self._submit(generation, next_submitted, next(cluster_batches), self.free_slots.popleft())
+                    next_submitted += 1
+                while next_yielded not in completed:
+                    result_generation, batch_index, slot, edges, error = self.result_queue.get()
+                    if error is not None:
+                        raise RuntimeError(f"Batch assembly failed in a worker process:\n{error}")
+                    if result_generation != generation:
+                        self.free_slots.append(slot)
+                        continue
+                    completed[batch_index] = (slot, edges)
+                slot, edges = completed.pop(next_yielded)
+                next_yielded += 1
+                slot_arrays = self.slots[slot]
+                if edges is None:
+                    batch = tuple(array.copy() for array in slot_arrays.values())
+                else:
+                    batch = (*edges, slot_arrays["features"].copy(), slot_arrays["labels"].copy())
+                self.free_slots.append(slot)
+                yield batch
+        finally:
+            self.free_slots.extend(slot for slot, _ in completed.values())
+
+
+def tf_parallel_dataset_generator(
+    cluster_blocks,
+    features,
+    labels,
+    mask,
+    num_clusters,
+    clusters_per_batch,
+    max_nodes_per_batch,
+    max_edges_per_batch,
+    adjacency_dtype,
+    adjacency_form,
+    num_workers,
+    micro_batch_size=1,
+    seed=None,
+    deterministic=False,
+    prefetch_depth=10,
+    distributed_worker_count=1,
+    distributed_worker_index=0
+):
+    """
+    Create a tf.data.Dataset of batches with the same elements as
+    `tf_dataset_generator`, assembled from precomputed cluster blocks by
+    `num_workers` worker processes. The order of the batches is always
+    deterministic, so `deterministic` is ignored.
+    """
+    assembler = BatchAssembler(
+        cluster_blocks,
+        features,
+        labels,
+        mask,
+        max_nodes_per_batch,
+        max_edges_per_batch,
+        adjacency_dtype,
+        adjacency_form)
+    cluster_indices = np.arange(num_clusters)[distributed_worker_index::distributed_worker_count]
+    generator = ParallelBatchGenerator(
+        assembler,
+        cluster_indices,
+        clusters_per_batch,
+        num_workers,
+        seed=seed)
+
+    adjacency_dtype = tf.as_dtype(np.dtype(adjacency_dtype))
+    features_spec = tf.TensorSpec((max_nodes_per_batch, features.shape[1]), tf.as_dtype(features.dtype))
+    labels_spec = tf.TensorSpec((max_nodes_per_batch, labels.shape[1]), tf.as_dtype(labels.dtype))
+    if adjacency_form == AdjacencyForm.DENSE:
+        adjacency_spec = (tf.TensorSpec((max_nodes_per_batch, max_nodes_per_batch), adjacency_dtype),)
+    elif adjacency_form == AdjacencyForm.SPARSE_TUPLE:
+        adjacency_spec = (tf.TensorSpec((max_edges_per_batch, 2), tf.int32),
+                          tf.TensorSpec((max_edges_per_batch,), adjacency_dtype))
+    else:
+        adjacency_spec = (tf.TensorSpec((None, 2), tf.int32),
+                          tf.TensorSpec((None,), adjacency_dtype))
+
+    dataset = tf.data.Dataset.from_generator(
+        generator,
+        output_signature=(*adjacency_spec, features_spec, labels_spec))
+
+    if adjacency_form == AdjacencyForm.DENSE:
+        dataset = dataset.map(
+            lambda adj, feats, labels: (dict(adjacency_batch=adj, features_batch=feats), labels))
+    elif adjacency_form == AdjacencyForm.SPARSE_TUPLE:
+        dataset = dataset.map(
+            lambda adj_indices, adj_values, feats, labels:
+                (dict(adjacency_batch=(adj_indices, adj_values), features_batch=feats), labels))
+        assert micro_batch_size == 1, (
+            f"A micro_batch_size of {micro_batch_size} has been provided,"
+            " but only a micro_batch_size of 1 is currently supported.")
+        dataset = dataset.batch(micro_batch_size, drop_remainder=True)
+    else:
+        dataset = dataset.map(
+            lambda adj_indices, adj_values, feats, labels:
+            (
+                dict(
+                    adjacency_batch=tf.sparse.SparseTensor(
+                        indices=tf.cast(adj_indices, tf.int64),
+                        values=adj_values,
+                        dense_shape=tf.cast((max_nodes_per_batch, max_nodes_per_batch), tf.int64)
+                    ),
+                    features_batch=feats
+                ),
+                labels
+            )
+        )
+
+    dataset = dataset.prefetch(prefetch_depth)
+    return dataset
+
+
+def create_dataset_generator(cluster_graph, num_workers=0, **kwargs):
+    """
+    Create the dataset of batches of `cluster_graph`. With `num_workers`
+    greater than 0, batches are assembled from precomputed cluster blocks
+    by worker processes, otherwise they are built by `tf_dataset_generator`.
+    Keyword arguments are those of `tf_dataset_generator`.
+    """
+    if num_workers == 0:
+        return tf_dataset_generator(**kwargs)
+    cluster_blocks = load_or_compute_cluster_blocks(
+        cluster_graph, kwargs.pop("adjacency"), kwargs["adjacency_form"])
+    kwargs.pop("clusters")
+    return tf_parallel_dataset_generator(cluster_blocks=cluster_blocks, num_workers=num_workers, **kwargs)
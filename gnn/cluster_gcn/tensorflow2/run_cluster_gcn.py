@@ -31,8 +31,8 @@ from tensorflow.python.ipu import horovod
 from data_utils.batch_config import BatchConfig
 from data_utils.clustering_utils import ClusterGraph
 from data_utils.clustering_statistics import ClusteringStatistics
-from data_utils.dataset_batch_generator import tf_dataset_generator
 from data_utils.dataset_loader import load_dataset
+from data_utils.precomputed_batch_generator import create_dataset_generator
 from keras_extensions.callbacks.callback_factory import CallbackFactory
 from keras_extensions.optimization import get_optimizer
 from model.loss_accuracy import get_loss_and_metrics
@@ -143,7 +143,9 @@ def run(config):
             clustering_statistics.get_statistics(wandb=config.wandb)
 
         # Create dataset generators for training
-        data_generator_training = tf_dataset_generator(
+        data_generator_training = create_dataset_generator(
+            training_clusters,
+            num_workers=config.training.dataset_num_workers,
             adjacency=dataset.adjacency_train,
             clusters=training_clusters.clusters,
             features=dataset.features_train,
@@ -225,7 +227,9 @@ def run(config):
             live_validation_clusters.cluster_graph()
 
             # Create dataset generator for live validation
-            data_generator_validation = tf_dataset_generator(
+            data_generator_validation = create_dataset_generator(
+                live_validation_clusters,
+                num_workers=config.training.dataset_num_workers,
                 adjacency=dataset.adjacency_full,
                 clusters=live_validation_clusters.clusters,
                 features=dataset.features,
@@ -398,7 +402,9 @@ def run(config):
         end_validation_clusters.cluster_graph()
 
         # Create dataset generator for validation
-        end_data_generator_validation = tf_dataset_generator(
+        end_data_generator_validation = create_dataset_generator(
+            end_validation_clusters,
+            num_workers=config.validation.dataset_num_workers,
             adjacency=dataset.adjacency_full,
             clusters=end_validation_clusters.clusters,
             features=dataset.features,
@@ -546,7 +552,9 @@ def run(config):
         test_clusters.cluster_graph()
 
         # Create dataset generator for test
-        data_generator_test = tf_dataset_generator(
+        data_generator_test = create_dataset_generator(
+            test_clusters,
+            num_workers=config.test.dataset_num_workers,
             adjacency=dataset.adjacency_full,
             clusters=test_clusters.clusters,
             features=dataset.features,
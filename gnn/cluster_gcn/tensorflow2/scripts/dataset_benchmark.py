@@ -9,8 +9,8 @@ import tensorflow as tf
 from tensorflow.python.ipu.dataset_benchmark import dataset_benchmark
 
 from data_utils.clustering_utils import ClusterGraph
-from data_utils.dataset_batch_generator import tf_dataset_generator
 from data_utils.dataset_loader import load_dataset
+from data_utils.precomputed_batch_generator import create_dataset_generator
 from model.precision import Precision
 from utilities.argparser import add_arguments, combine_config_file_with_args
 from utilities.constants import GraphType
@@ -18,8 +18,8 @@ from utilities.options import Options
 from utilities.utils import get_adjacency_dtype, get_adjacency_form, get_method_max
 
 
-def estimate_ds_throughput(config):
-
+def prepare_training_clusters(config):
+    """Load the dataset and cluster the training graph."""
     # Set precision policy for training
     precision = Precision(config.training.precision)
     tf.keras.mixed_precision.set_global_policy(precision.policy)
@@ -65,9 +65,14 @@ def estimate_ds_throughput(config):
         node_edge_imbalance_ratio=config.cluster_node_edge_imbalance_ratio,
     )
     training_clusters.cluster_graph()
+    return dataset, training_clusters, adjacency_form_training, adjacency_dtype_training
+
 
+def measure_ds_throughput(config, dataset, training_clusters, adjacency_form, adjacency_dtype, num_workers):
     # Create dataset generators for training
-    data_generator_training = tf_dataset_generator(
+    data_generator_training = create_dataset_generator(
+        training_clusters,
+        num_workers=num_workers,
         adjacency=dataset.adjacency_train,
         clusters=training_clusters.clusters,
         features=dataset.features_train,
@@ -77,8 +82,8 @@ def estimate_ds_throughput(config):
         clusters_per_batch=training_clusters.clusters_per_batch,
         max_nodes_per_batch=training_clusters.max_nodes_per_batch,
         max_edges_per_batch=training_clusters.max_edges_per_batch,
-        adjacency_dtype=adjacency_dtype_training,
-        adjacency_form=adjacency_form_training,
+        adjacency_dtype=adjacency_dtype,
+        adjacency_form=adjacency_form,
         seed=config.seed
     )
 
@@ -94,6 +99,25 @@ def estimate_ds_throughput(config):
     return mean_throughput, min_throughput, max_throughput, std_throughput
 
 
+def estimate_ds_throughput(config, num_workers=None):
+    if num_workers is None:
+        num_workers = config.training.dataset_num_workers
+    return measure_ds_throughput(config, *prepare_training_clusters(config), num_workers)
+
+
+def compare_ds_throughput(config, num_workers):
+    """
+    Throughput of the batches built on the fly in the tf.data pipeline
+    and of the batches assembled from precomputed cluster subgraphs
+    by `num_workers` worker processes, on the same clustering.
+    """
+    training_data = prepare_training_clusters(config)
+    return {
+        "tf.data pipeline": measure_ds_throughput(config, *training_data, 0),
+        f"precomputed, {num_workers} workers": measure_ds_throughput(config, *training_data, num_workers),
+    }
+
+
 if __name__ == '__main__':
     # Setup logging
     logging.basicConfig(format="%(asctime)s %(levelname)-8s %(message)s",
@@ -102,15 +126,29 @@ if __name__ == '__main__':
     tf.get_logger().propagate = False
 
     parser = argparse.ArgumentParser(description="Dataset benchmark")
+    parser.add_argument("--compare-generators",
+                        action="store_true",
+                        help=("Compare the throughput of batches built in the tf.data pipeline with"
+                              " batches assembled by --training.dataset-num-workers worker processes"
+                              " (8 if not set)."))
     args = add_arguments(parser).parse_args()
     config = combine_config_file_with_args(args, Options)
 
     # Set log level based on config
     logging.getLogger().setLevel(config.logging)
 
-    mean_tput, min_tput, max_tput, std_tput = estimate_ds_throughput(config)
-
-    print(f'Mean throughput = {mean_tput:.1f} samples/sec')
-    print(f'Min throughput = {min_tput:.1f} samples/sec')
-    print(f'Max throughput = {max_tput:.1f} samples/sec')
-    print(f'STD throughput = {std_tput:.1f} samples/sec')
+    if args.compare_generators:
+        num_workers = config.training.dataset_num_workers or 8
+        results = compare_ds_throughput(config, num_workers)
+        baseline = results["tf.data pipeline"][0]
+        for name, (mean_tput, min_tput, max_tput, std_tput) in results.items():
+            print(f'{name}: mean throughput = {mean_tput:.1f} samples/sec'
+                  f' (min {min_tput:.1f}, max {max_tput:.1f}, std {std_tput:.1f}),'
+                  f' {mean_tput / baseline:.2f}x')
+    else:
+        mean_tput, min_tput, max_tput, std_tput = estimate_ds_throughput(config)
+
+        print(f'Mean throughput = {mean_tput:.1f} samples/sec')
+        print(f'Min throughput = {min_tput:.1f} samples/sec')
+        print(f'Max throughput = {max_tput:.1f} samples/sec')
+        print(f'STD throughput = {std_tput:.1f} samples/sec')
@@ -2,7 +2,7 @@
 
 import argparse
 
-from scripts.dataset_benchmark import estimate_ds_throughput
+from scripts.dataset_benchmark import compare_ds_throughput, estimate_ds_throughput
 from tests.utils import get_app_root_dir
 from utilities.argparser import add_arguments, combine_config_file_with_args
 from utilities.options import Options
@@ -18,3 +18,17 @@ def test_benchmark_output():
     assert mean_tput > 0
     assert min_tput > 0
     assert max_tput > 0
+
+
+def test_compare_generators_output():
+    parser = argparse.ArgumentParser(description="Dataset benchmark test")
+    test_dir = get_app_root_dir().joinpath("tests")
+    args = add_arguments(parser).parse_args([f"{test_dir}/train_small_graph_sparse.json"])
+    config = combine_config_file_with_args(args, Options)
+
+    results = compare_ds_throughput(config, num_workers=2)
+    assert len(results) == 2
+    for mean_tput, min_tput, max_tput, _ in results.values():
+        assert mean_tput > 0
+        assert min_tput > 0
+        assert max_tput > 0
@@ -0,0 +1,209 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+import numpy as np
+import pytest
+import scipy.sparse as sp
+
+from data_utils.dataset_batch_generator import add_self_edges_with_dummy_values
+from data_utils.precomputed_batch_generator import (
+    BatchAssembler,
+    ClusterBlocks,
+    ParallelBatchGenerator,
+    concatenate_ranges,
+    tf_parallel_dataset_generator
+)
+from tests.utils import assert_equal_adjacency
+from utilities.constants import AdjacencyForm, MASKED_LABEL_VALUE
+
+
+def random_graph(num_nodes, num_clusters, seed=0):
+    rng = np.random.default_rng(seed)
+    adjacency = sp.random(num_nodes, num_nodes, density=0.05, random_state=seed, format="csr")
+    adjacency = ((adjacency + adjacency.T) > 0).astype(np.float32)
+    adjacency.setdiag(0)
+    adjacency.eliminate_zeros()
+    clusters = [np.sort(c).astype(np.int32)
+                for c in np.array_split(rng.permutation(num_nodes), num_clusters)]
+    return adjacency.tocsr(), clusters
+
+
+def test_concatenate_ranges():
+    np.testing.assert_equal(
+        concatenate_ranges(np.array([2, 7, 0]), np.array([5, 7, 2])),
+        [2, 3, 4, 0, 1])
+
+
+@pytest.mark.parametrize("cluster_indices", [[0, 3, 5], [4, 1, 4], [2]])
+def test_cluster_blocks_subgraph(cluster_indices, tmp_path):
+    adjacency, clusters = random_graph(100, 6)
+    blocks = ClusterBlocks.from_adjacency(adjacency, clusters)
+
+    blocks.save(tmp_path / "blocks.npz")
+    blocks = ClusterBlocks.load(tmp_path / "blocks.npz")
+    assert blocks.matches(clusters)
+
+    nodes, rows, cols, values = blocks.subgraph(cluster_indices)
+    expected_nodes = np.concatenate([clusters[c] for c in cluster_indices])
+    np.testing.assert_equal(nodes, expected_nodes)
+    subgraph = sp.coo_matrix((values, (rows, cols)), shape=(len(nodes), len(nodes)))
+    np.testing.assert_equal(
+        subgraph.toarray(),
+        adjacency[expected_nodes, :][:, expected_nodes].toarray())
+
+
+@pytest.mark.parametrize(
+    "adjacency_form",
+    [
+        AdjacencyForm.DENSE,
+        AdjacencyForm.SPARSE_TENSOR,
+        AdjacencyForm.SPARSE_TUPLE
+    ]
+)
+def test_batch_assembler(adjacency_form):
+    adjacency, clusters = random_graph(100, 6)
+    features = np.random.rand(100, 3).astype(np.float32)
+    labels = np.random.randint(0, 2, (100, 2)).astype(np.int32)
+    mask = np.random.randint(0, 2, 100)
+    max_nodes_per_batch = 60
+    max_edges_per_batch = 1000
+    if adjacency_form == AdjacencyForm.SPARSE_TUPLE:
+        adjacency = add_self_edges_with_dummy_values(adjacency)
+    assembler = BatchAssembler(
+        ClusterBlocks.from_adjacency(adjacency, clusters),
+        features,
+        labels,
+        mask,
+        max_nodes_per_batch,
+        max_edges_per_batch,
+        np.float32,
+        adjacency_form)
+    out = {name: np.empty(shape, dtype) for name, shape, dtype in assembler.buffer_specs()}
+    edges = assembler.assemble([1, 4], np.random.default_rng(0), out)
+
+    nodes = np.concatenate([clusters[1], clusters[4]])
+    num_nodes = len(nodes)
+    expected_adjacency = adjacency[nodes, :][:, nodes].toarray()
+    if adjacency_form == AdjacencyForm.SPARSE_TUPLE:
+        expected_adjacency[np.diag_indices(num_nodes)] = 0
+    padded_adjacency = np.zeros((max_nodes_per_batch, max_nodes_per_batch), dtype=np.float32)
+    padded_adjacency[:num_nodes, :num_nodes] = expected_adjacency
+
+    if adjacency_form == AdjacencyForm.DENSE:
+        np.testing.assert_equal(out["adjacency"], padded_adjacency)
+    elif adjacency_form == AdjacencyForm.SPARSE_TENSOR:
+        indices, values = edges
+        adjacency_batch = sp.coo_matrix((values, (indices[:, 0], indices[:, 1])), shape=padded_adjacency.shape)
+        np.testing.assert_equal(adjacency_batch.toarray(), padded_adjacency)
+    else:
+        indices, values = out["indices"], out["values"]
+        # Self-edges of the batch nodes, then padding edges on the fake node
+        num_edges = adjacency[nodes, :][:, nodes].nnz
+        assert np.all(indices[num_edges:] == max_nodes_per_batch - 1)
+        assert np.all(values[num_edges:] == 0)
+        adjacency_batch = sp.coo_matrix((values, (indices[:, 0], indices[:, 1])), shape=padded_adjacency.shape)
+        np.testing.assert_equal(adjacency_batch.toarray(), padded_adjacency)
+
+    expected_labels = labels[nodes]
+    expected_labels[mask[nodes] == 0] = MASKED_LABEL_VALUE
+    np.testing.assert_equal(out["features"][:num_nodes], features[nodes])
+    np.testing.assert_equal(out["features"][num_nodes:], 0)
+    np.testing.assert_equal(out["labels"][:num_nodes], expected_labels)
+    np.testing.assert_equal(out["labels"][num_nodes:], MASKED_LABEL_VALUE)
+
+
+def test_parallel_batch_generator_deterministic():
+    adjacency, clusters = random_graph(100, 6)
+    assembler = BatchAssembler(
+        ClusterBlocks.from_adjacency(adjacency, clusters),
+        np.random.rand(100, 3).astype(np.float32),
+        np.ones((100, 2), dtype=np.int32),
+        np.ones(100),
+        60,
+        None,
+        np.float32,
+        AdjacencyForm.DENSE)
+    generator = ParallelBatchGenerator(assembler, np.arange(6), 2, num_workers=2, seed=3)
+
+    first_iterator = generator()
+    first_batches = [next(first_iterator) for _ in range(7)]
+    first_iterator.close()
+    second_iterator = generator()
+    second_batches = [next(second_iterator) for _ in range(7)]
+    generator.close()
+
+    for first_batch, second_batch, cluster_indices in zip(first_batches, second_batches,
+                                                          generator.cluster_batches()):
+        for first, second in zip(first_batch, second_batch):
+            np.testing.assert_equal(first, second)
+        nodes = np.concatenate([clusters[c] for c in cluster_indices])
+        np.testing.assert_equal(
+            first_batch[0][:len(nodes), :len(nodes)],
+            adjacency[nodes, :][:, nodes].toarray())
+
+
+@pytest.mark.parametrize(
+    "adjacency_form",
+    [
+        AdjacencyForm.DENSE,
+        AdjacencyForm.SPARSE_TENSOR,
+        AdjacencyForm.SPARSE_TUPLE
+    ]
+)
+def test_tf_parallel_dataset_generator(adjacency_form):
+    clusters = [np.array([0]),
+                np.array([1, 2]),
+                np.array([3])]
+    max_nodes_per_batch = 4
+    max_edges_per_batch = 15
+    features = np.array([[0.01, 0.02],
+                         [0.11, 0.12],
+                         [0.21, 0.22],
+                         [0.31, 0.32]],
+                        dtype=np.float32)
+    labels = np.eye(4, dtype=np.int32)
+    mask = np.array([0, 1, 1, 1])
+    edges = np.array([[0, 1], [1, 0], [1, 2], [2, 1], [2, 3]])
+
+    # Add fake node if needed
+    if adjacency_form == AdjacencyForm.SPARSE_TUPLE:
+        max_nodes_per_batch += 1
+
+    adjacency = sp.csr_matrix(
+        (np.ones((edges.shape[0]), dtype=np.float32), (edges[:, 0], edges[:, 1])),
+        shape=(4, 4))
+    cluster_adjacency = adjacency
+    if adjacency_form == AdjacencyForm.SPARSE_TUPLE:
+        cluster_adjacency = add_self_edges_with_dummy_values(adjacency)
+
+    dataset_generator = tf_parallel_dataset_generator(
+        ClusterBlocks.from_adjacency(cluster_adjacency, clusters),
+        features,
+        labels,
+        mask,
+        num_clusters=len(clusters),
+        clusters_per_batch=3,
+        max_nodes_per_batch=max_nodes_per_batch,
+        max_edges_per_batch=max_edges_per_batch,
+        adjacency_dtype=np.float32,
+        adjacency_form=adjacency_form,
+        num_workers=2,
+        seed=3,
+    )
+
+    first_batch = iter(dataset_generator.take(1)).next()
+    features_batch = first_batch[0]["features_batch"]
+    labels_batch = first_batch[1]
+    if adjacency_form == AdjacencyForm.SPARSE_TUPLE:
+        features_batch = features_batch[0]
+        labels_batch = labels_batch[0]
+
+    # All the clusters are in the batch, in the shuffled order: node i is at positions[i]
+    positions = np.argsort(np.asarray(features_batch)[:4, 0])
+    np.testing.assert_array_almost_equal(np.asarray(features_batch)[positions], features)
+    expected_labels = labels.copy()
+    expected_labels[0] = MASKED_LABEL_VALUE
+    np.testing.assert_array_equal(np.asarray(labels_batch)[positions], expected_labels)
+
+    expected_adjacency = sp.coo_matrix(
+        (np.ones(len(edges), dtype=np.float32), (positions[edges[:, 0]], positions[edges[:, 1]])),
+        shape=(4, 4)).tocsr().tocoo()
+    assert_equal_adjacency(first_batch[0]["adjacency_batch"], expected_adjacency, adjacency_form)
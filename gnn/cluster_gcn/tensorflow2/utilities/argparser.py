@@ -19,6 +19,10 @@ def add_arguments(parser):
     parser.add_argument("--training.replicas",
                         type=int,
                         help="Number of replicas during training.")
+    parser.add_argument("--training.dataset-num-workers",
+                        type=int,
+                        help=("Number of worker processes assembling the training batches from"
+                              " precomputed cluster subgraphs, 0 to build them in the tf.data pipeline."))
     parser.add_argument("--validation.clusters-per-batch",
                         type=int,
                         help="Number of clusters per batch into for validation.")
@@ -155,6 +155,10 @@ class SetOptions(BaseModel):
     gradient_accumulation_steps_per_replica: int
     replicas: PositiveInt = 1
     dataset_prefetch_depth: int = 10
+    # dataset_num_workers: Number of worker processes assembling the batches
+    # from precomputed cluster subgraphs. With 0, batches are built on the fly
+    # by the tf.data pipeline.
+    dataset_num_workers: int = 0
 
     # Clustering
     max_nodes_per_batch: Optional[int]
@@ -0,0 +1,62 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+
+"""Compares the run time of the histogram-packing implementations on generated histograms.
+
+Usage: python3 -m data_utils.packing_benchmark --n-graphs 3700000 --max-nodes-per-graph 50
+"""
+import argparse
+import time
+
+import numpy as np
+
+from data_utils.packing_strategy_finder import pack_using_dlpfhp, pack_using_indexed_dlpfhp
+
+
+def generate_histogram(n_graphs, max_nodes_per_graph, max_edges_per_node=3, seed=0):
+    """Histogram [(n_edges, n_nodes, count)] of random molecule-like graphs."""
+    rng = np.random.default_rng(seed)
+    n_nodes = np.clip(np.round(rng.normal(max_nodes_per_graph / 2, max_nodes_per_graph / 6, n_graphs)),
+                      1, max_nodes_per_graph).astype(np.int64)
+    # about one to `max_edges_per_node` directed edges per node
+    n_edges = np.round(n_nodes * rng.uniform(1, max_edges_per_node, n_graphs)).astype(np.int64)
+    shapes, counts = np.unique(np.stack([n_edges, n_nodes], axis=1), axis=0, return_counts=True)
+    return [(int(e), int(n), int(c)) for (e, n), c in zip(shapes, counts)]
+
+
+def time_packing(packing_function, histogram, max_edges_per_pack, max_nodes_per_pack, max_graphs_per_pack):
+    start = time.perf_counter()
+    result = packing_function(histogram, max_edges_per_pack, max_nodes_per_pack, max_graphs_per_pack)
+    return time.perf_counter() - start, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n-graphs', type=int, default=100000)
+    parser.add_argument('--max-nodes-per-graph', type=int, default=50)
+    parser.add_argument('--max-edges-per-node', type=int, default=3)
+    parser.add_argument('--max-graphs-per-pack', type=int, default=16)
+    parser.add_argument('--max-nodes-per-pack', type=int, default=None,
+                        help="Defaults to 4 times the nodes of the largest graph")
+    parser.add_argument('--max-edges-per-pack', type=int, default=None,
+                        help="Defaults to 4 times the edges of the largest graph")
+    parser.add_argument('--skip-reference', action='store_true',
+                        help="Only time the indexed implementation")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    histogram = generate_histogram(args.n_graphs, args.max_nodes_per_graph, args.max_edges_per_node, args.seed)
+    max_edges_per_pack = args.max_edges_per_pack or 4 * max(e for e, _, _ in histogram)
+    max_nodes_per_pack = args.max_nodes_per_pack or 4 * max(n for _, n, _ in histogram)
+    sizes = (max_edges_per_pack, max_nodes_per_pack, args.max_graphs_per_pack)
+    print(f"{args.n_graphs} graphs, {len(histogram)} (edges, nodes) shapes, "
+          f"packs of {max_edges_per_pack} edges, {max_nodes_per_pack} nodes, {args.max_graphs_per_pack} graphs")
+
+    indexed_time, (strategy_set, repeat_count, efficiency) = time_packing(pack_using_indexed_dlpfhp, histogram, *sizes)
+    print(f"indexed:   {indexed_time:.2f} s, {len(strategy_set)} strategies, {repeat_count.sum()} packs, "
+          f"efficiency (edges, nodes, graphs) {', '.join(f'{e:.2f}%' for e in efficiency)}")
+
+    if not args.skip_reference:
+        reference_time, (reference_set, reference_count, _) = time_packing(pack_using_dlpfhp, histogram, *sizes)
+        assert reference_set == strategy_set and np.array_equal(reference_count, repeat_count), \
+            "the implementations gave different strategies"
+        print(f"reference: {reference_time:.2f} s, speed-up {reference_time / indexed_time:.1f}x")
@@ -1,6 +1,7 @@
 # Copyright (c) 2022 Graphcore Ltd. All rights reserved.
 
 """Longest-pack-first histogram-packing."""
+import bisect
 import copy
 import logging
 from collections import defaultdict
@@ -69,6 +70,158 @@ def pack_using_dlpfhp(data_list, max_edges_per_pack, max_nodes_per_pack, max_gra
                     tmp_strategies_per_length[new_size].append(([edges_length], [nodes_length], n_sequences_to_bin))
                 break
 
+    return _flatten_strategies(strategies_per_length, tmp_strategies_per_length,
+                               max_edges_per_pack, max_nodes_per_pack, max_graphs_per_pack)
+
+
+class _OpenPackIndex:
+    """Open packs grouped by occupancy, with a capacity index over the occupancies.
+
+    The open packs with the same (n_edges, n_nodes, n_graphs) occupancy are kept in a stack, as
+    [sequence_number, len_edges, len_nodes, count] in increasing sequence number. The sequence number
+    records the position of the pack in the list of its key in `pack_using_dlpfhp`. The capacity left
+    and the key of each occupancy are kept in arrays, to find the packs a graph fits in in one pass.
+    """
+
+    def __init__(self, max_edges_per_pack, max_nodes_per_pack, max_graphs_per_pack, heuristic, capacity=1024):
+        self.max_edges_per_pack = max_edges_per_pack
+        self.max_nodes_per_pack = max_nodes_per_pack
+        self.max_graphs_per_pack = max_graphs_per_pack
+        self.heuristic = heuristic
+        self.occupancy_ids = {}
+        self.stacks = []
+        self.keys = []
+        self.sequence_number = 0
+        self.free_edges = np.zeros(capacity, dtype=np.int64)
+        self.free_nodes = np.zeros(capacity, dtype=np.int64)
+        self.n_graphs = np.zeros(capacity, dtype=np.int64)
+        self.key_values = np.zeros(capacity, dtype=np.float64)
+        # sequence number of the last pack of each occupancy, -1 if it has no open packs
+        self.last_sequence_number = np.full(capacity, -1, dtype=np.int64)
+
+    def _occupancy_id(self, len_edges, len_nodes):
+        occupancy = (sum(len_edges), sum(len_nodes), len(len_edges))
+        if occupancy not in self.occupancy_ids:
+            idx = len(self.stacks)
+            if idx == len(self.free_edges):
+                self.free_edges, self.free_nodes, self.n_graphs, self.key_values = (
+                    np.concatenate([array, np.zeros_like(array)])
+                    for array in (self.free_edges, self.free_nodes, self.n_graphs, self.key_values))
+                self.last_sequence_number = np.concatenate(
+                    [self.last_sequence_number, np.full_like(self.last_sequence_number, -1)])
+            self.occupancy_ids[occupancy] = idx
+            self.stacks.append([])
+            self.keys.append(self.heuristic(self.max_edges_per_pack - occupancy[0],
+                                            self.max_nodes_per_pack - occupancy[1]))
+            self.free_edges[idx] = self.max_edges_per_pack - occupancy[0]
+            self.free_nodes[idx] = self.max_nodes_per_pack - occupancy[1]
+            self.n_graphs[idx] = occupancy[2]
+            self.key_values[idx] = self.keys[idx]
+        return self.occupancy_ids[occupancy]
+
+    def push(self, len_edges, len_nodes, count):
+        """Adds an open pack, returns its key."""
+        idx = self._occupancy_id(len_edges, len_nodes)
+        self.stacks[idx].append([self.sequence_number, len_edges, len_nodes, count])
+        self.last_sequence_number[idx] = self.sequence_number
+        self.sequence_number += 1
+        return self.keys[idx]
+
+    def pop(self, idx):
+        _, len_edges, len_nodes, count = self.stacks[idx].pop()
+        self.last_sequence_number[idx] = self.stacks[idx][-1][0] if self.stacks[idx] else -1
+        return len_edges, len_nodes, count
+
+    def find(self, edges_length, nodes_length, min_key):
+        """The occupancy of the last open pack with the smallest key >= `min_key` a graph fits in, or None."""
+        fits = ((self.last_sequence_number >= 0) &
+                (self.free_edges >= edges_length) &
+                (self.free_nodes >= nodes_length) &
+                (self.n_graphs < self.max_graphs_per_pack) &
+                (self.key_values >= min_key))
+        if not fits.any():
+            return None
+        fits &= self.key_values == self.key_values[fits].min()
+        return int(np.argmax(np.where(fits, self.last_sequence_number, -1)))
+
+    def packs_per_key(self, keys):
+        """The open packs of each key, in the order of the lists of `pack_using_dlpfhp`."""
+        packs = defaultdict(list)
+        for key, stack in zip(self.keys, self.stacks):
+            packs[key].extend(stack)
+        return {key: [tuple(pack[1:]) for pack in sorted(packs[key], key=lambda pack: pack[0])] for key in keys}
+
+
+def pack_using_indexed_dlpfhp(data_list, max_edges_per_pack, max_nodes_per_pack, max_graphs_per_pack,
+                              heuristic=np.multiply):
+    """Dual Longest-pack-first histogram-packing, with indexed open packs.
+
+    Gives the same strategies and repeat counts as `pack_using_dlpfhp`, without its linear scans.
+    `pack_using_dlpfhp` walks up the keys (space left in the open packs) from the size of a graph,
+    and scans the packs of every key for the last pack the graph fits in. Here the open packs are
+    indexed by occupancy, so the first key with a pack the graph fits in is found in one pass
+    over the occupancies, and the keys are kept sorted to check the keys skipped by bisection.
+    """
+    assert len(data_list[0]) == 3, "make sure the data-list has three parts per entry"
+
+    data_list = [(e * n, e, n, count) for e, n, count in data_list]
+    data_list.sort(reverse=True)
+
+    max_size = heuristic(max_edges_per_pack, max_nodes_per_pack)
+    open_packs = _OpenPackIndex(max_edges_per_pack, max_nodes_per_pack, max_graphs_per_pack, heuristic)
+    # The number of open packs of each key, in the key order of `pack_using_dlpfhp`
+    tmp_n_packs_per_length = {}
+    sorted_keys = []
+    strategies_per_length = defaultdict(list)
+
+    def add_pack(len_edges, len_nodes, count):
+        key = open_packs.push(len_edges, len_nodes, count)
+        if key not in tmp_n_packs_per_length:
+            tmp_n_packs_per_length[key] = 0
+            bisect.insort(sorted_keys, key)
+        tmp_n_packs_per_length[key] += 1
+
+    def close_pack(key):
+        tmp_n_packs_per_length[key] -= 1
+        if not tmp_n_packs_per_length[key]:
+            tmp_n_packs_per_length.pop(key)
+            sorted_keys.pop(bisect.bisect_left(sorted_keys, key))
+
+    for size, edges_length, nodes_length, n_sequences_to_bin in data_list:
+        offset = 0
+        while n_sequences_to_bin > 0:
+            idx = open_packs.find(edges_length, nodes_length, size + offset)
+            # `pack_using_dlpfhp` opens a new pack if it walks past a key >= max_size
+            # before reaching the key of a pack the graph fits in
+            first_full_key = bisect.bisect_left(sorted_keys, max(size + offset, max_size))
+            fits = idx is not None and (first_full_key == len(sorted_keys) or
+                                        sorted_keys[first_full_key] >= open_packs.keys[idx])
+            if fits:
+                len_edges, len_nodes, n_sequences_to_pack = open_packs.pop(idx)
+                new_count = min(n_sequences_to_pack, n_sequences_to_bin)
+                # adjust strategies, the remaining packs go to the end of the list of the key
+                if n_sequences_to_pack > new_count:
+                    open_packs.push(len_edges, len_nodes, n_sequences_to_pack - new_count)
+                else:
+                    close_pack(open_packs.keys[idx])
+
+                add_pack(len_edges + [edges_length], len_nodes + [nodes_length], new_count)
+                n_sequences_to_bin -= new_count
+                offset = 1
+            if not fits or offset + size > max_size:
+                new_size = heuristic(max_edges_per_pack - edges_length, max_nodes_per_pack - nodes_length)
+                if new_size == 0:
+                    strategies_per_length[0].append(([edges_length], [nodes_length], n_sequences_to_bin))
+                else:
+                    add_pack([edges_length], [nodes_length], n_sequences_to_bin)
+                break
+
+    return _flatten_strategies(strategies_per_length, open_packs.packs_per_key(tmp_n_packs_per_length),
+                               max_edges_per_pack, max_nodes_per_pack, max_graphs_per_pack)
+
+
+def _flatten_strategies(strategies_per_length, tmp_strategies_per_length,
+                        max_edges_per_pack, max_nodes_per_pack, max_graphs_per_pack):
     # merge all strategies
     for key in tmp_strategies_per_length:
         strategies_per_length[key].extend(tmp_strategies_per_length[key])
@@ -129,10 +282,8 @@ class StrategyPlanner:
         self.shape_to_idx_orig = shape_to_idx_orig
         # data list
         data_list = [(e, n, len(shape_to_idx_orig[(e, n)])) for e, n in shape_to_idx_orig]
-        self.strategy_set, self.strategy_repeat_count, self.efficiency = pack_using_dlpfhp(data_list,
-                                                                                           self.max_edges_per_pack,
-                                                                                           self.max_nodes_per_pack,
-                                                                                           self.max_graphs_per_pack)
+        self.strategy_set, self.strategy_repeat_count, self.efficiency = pack_using_indexed_dlpfhp(
+            data_list, self.max_edges_per_pack, self.max_nodes_per_pack, self.max_graphs_per_pack)
         self.packs_per_epoch = sum(self.strategy_repeat_count)
 
     def pack_indices_generator(self):
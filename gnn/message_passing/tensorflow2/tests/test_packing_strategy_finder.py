@@ -0,0 +1,40 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+
+import numpy as np
+import pytest
+
+from data_utils.packing_benchmark import generate_histogram
+from data_utils.packing_strategy_finder import StrategyPlanner, pack_using_dlpfhp, pack_using_indexed_dlpfhp
+
+
+@pytest.mark.parametrize("heuristic", [np.multiply, np.add])
+@pytest.mark.parametrize("n_graphs,max_nodes_per_graph,max_graphs_per_pack,seed",
+                         [(500, 10, 2, 0), (2000, 20, 3, 1), (3000, 30, 8, 2)])
+def test_indexed_packing_matches_reference(n_graphs, max_nodes_per_graph, max_graphs_per_pack, seed, heuristic):
+    histogram = generate_histogram(n_graphs, max_nodes_per_graph, seed=seed)
+    max_edges_per_pack = 2 * max(e for e, _, _ in histogram) + 7
+    max_nodes_per_pack = 2 * max(n for _, n, _ in histogram) + 3
+    sizes = (max_edges_per_pack, max_nodes_per_pack, max_graphs_per_pack)
+
+    reference_set, reference_count, reference_efficiency = pack_using_dlpfhp(histogram, *sizes, heuristic=heuristic)
+    strategy_set, repeat_count, efficiency = pack_using_indexed_dlpfhp(histogram, *sizes, heuristic=heuristic)
+
+    assert strategy_set == reference_set
+    np.testing.assert_equal(repeat_count, reference_count)
+    assert efficiency == reference_efficiency
+
+
+def test_strategy_planner_packs_every_graph():
+    rng = np.random.default_rng(0)
+    n_nodes = rng.integers(1, 30, 1000)
+    n_edges = n_nodes * rng.integers(1, 3, 1000)
+    planner = StrategyPlanner(n_edges=list(n_edges), n_nodes=list(n_nodes), max_edges_per_pack=128,
+                              max_nodes_per_pack=64, max_graphs_per_pack=4, randomize=False)
+
+    pack_indices = next(planner.pack_indices_generator())
+    assert len(pack_indices) == planner.packs_per_epoch
+    assert sorted(idx for pack in pack_indices for idx in pack) == list(range(1000))
+    for pack in pack_indices:
+        assert len(pack) <= 4
+        assert n_edges[pack].sum() <= 128
+        assert n_nodes[pack].sum() <= 64
@@ -82,6 +82,7 @@ def run_training(
     edges_size: int,
     validate_every: Optional[int],
     cache_dataset: bool,
+    event_stream: bool,
     target: utils.Target,
     dtype: np.dtype,
     save: Optional[Path],
@@ -104,6 +105,9 @@ def run_training(
       cache_dataset -- read the dataset once (note: this reduces the diversity of
                        negative samples over training, increasing validation loss)
 
+      event_stream -- build batches from a precomputed event stream in numpy, instead
+                      of PyTorch Geometric's LastNeighborLoader (faster on large graphs)
+
       target -- device type
 
       dtype -- either np.float32 or np.float16, to set the minimum precision used
@@ -125,8 +129,9 @@ def run_training(
        }
     """
 
-    loader = dataloader.Data(data, dtype=dtype, batch_size=batch_size,
-                             nodes_size=nodes_size, edges_size=edges_size)
+    loader_cls = dataloader.EventStreamData if event_stream else dataloader.Data
+    loader = loader_cls(data, dtype=dtype, batch_size=batch_size,
+                        nodes_size=nodes_size, edges_size=edges_size)
     settings = dict(
         n_nodes=loader.data.num_nodes,
         memory_size=100,
@@ -298,6 +303,14 @@ def _main() -> None:
             "specified by choice of --mode."
         )
     )
+    parser.add_argument(
+        "--event-stream",
+        action="store_true",
+        help=(
+            "Build batches from a precomputed event stream with a numpy neighbour "
+            "table, instead of PyTorch Geometric's LastNeighborLoader."
+        )
+    )
     parser.add_argument("--load", type=Path, help="path to load model")
     parser.add_argument("--save", type=Path, help="path to save model")
 
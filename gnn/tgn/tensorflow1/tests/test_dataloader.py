@@ -1,6 +1,10 @@
 # Copyright (c) 2021 Graphcore Ltd. All rights reserved.
 
+from typing import Any, List
+
 import numpy as np
+import torch
+import torch_geometric
 
 import dataloader
 
@@ -10,3 +14,94 @@ def test_most_recent_indices() -> None:
         dataloader.Data.most_recent_indices(np.array([10, 20, 30, 20, 30])),
         np.array([1, 0, 0, 1, 1], np.bool_),
     )
+
+
+def test_most_recent_indices_random() -> None:
+    indices = np.random.default_rng(0).integers(0, 20, 100)
+    expected = np.array(
+        [not np.any(indices[i + 1:] == index) for i, index in enumerate(indices)])
+    np.testing.assert_equal(dataloader.Data.most_recent_indices(indices), expected)
+
+
+def test_neighbour_table() -> None:
+    rng = np.random.default_rng(0)
+    n_nodes, size = 30, 4
+    src = rng.integers(0, n_nodes, 500)
+    dst = rng.integers(0, n_nodes, 500)
+
+    # Insert in batches of varying size, starting with a whole "partition" at once
+    table = dataloader.NeighbourTable(n_nodes, size)
+    boundaries = [0, 200, 201, 230, 300, 500]
+    for begin, end in zip(boundaries[:-1], boundaries[1:]):
+        table.insert(src[begin:end], dst[begin:end], np.arange(begin, end))
+
+    query = np.array([0, 3, 7, 29])
+    neighbours, nodes, event_ids = table(query)
+    actual = sorted(zip(nodes.tolist(), neighbours.tolist(), event_ids.tolist()))
+    expected = []
+    for node in query:
+        events = [(e, int(dst[e] if src[e] == node else src[e]))
+                  for e in range(500) for _ in range(int(src[e] == node) + int(dst[e] == node))]
+        expected.extend((int(node), neighbour, e) for e, neighbour in events[-size:])
+    assert actual == sorted(expected)
+
+
+class ReplayNegatives:
+    """Stands for the random generator, replaying the negative samples drawn by `Data`."""
+
+    def __init__(self, neg_dsts: List[np.ndarray]):
+        self.neg_dsts = iter(neg_dsts)
+
+    def integers(self, low: int, high: int, size: int) -> np.ndarray:
+        neg_dst = next(self.neg_dsts)
+        assert neg_dst.shape == (size, ) and low <= neg_dst.min() and neg_dst.max() < high
+        return neg_dst
+
+
+def sorted_edges(batch: dataloader.Data.Batch) -> np.ndarray:
+    edges = np.concatenate([
+        batch["edge_idx"].T, batch["edge_times"][:, np.newaxis],
+        batch["edge_features"]
+    ], axis=1)
+    return edges[np.lexsort(edges.T[::-1])]
+
+
+def test_event_stream_data(monkeypatch: Any) -> None:
+    # A bipartite stream like JODIE: few users so that their neighbour tables wrap
+    rng = np.random.default_rng(0)
+    n_events, n_users, n_items = 200, 6, 14
+    events = torch_geometric.data.TemporalData(
+        src=torch.tensor(rng.integers(0, n_users, n_events)),
+        dst=torch.tensor(rng.integers(n_users, n_users + n_items, n_events)),
+        t=torch.tensor(np.sort(rng.integers(0, 1000, n_events))),
+        msg=torch.tensor(rng.normal(size=(n_events, 3)), dtype=torch.float32),
+        y=torch.zeros(n_events, dtype=torch.long),
+    )
+    monkeypatch.setattr(dataloader.torch_geometric.datasets, "JODIEDataset",
+                        lambda path, name: [events])
+    batch_size = 7
+    kwargs = dict(path=None, dtype=np.float32, batch_size=batch_size,
+                  nodes_size=n_users + n_items,
+                  edges_size=3 * batch_size * dataloader.NEIGHBOURS_SIZE)
+    data = dataloader.Data(**kwargs)
+    event_data = dataloader.EventStreamData(**kwargs)
+
+    for partition in ["train", "val", "test"]:
+        expected = list(data.batches(partition))
+        if partition == "train":
+            # Padding events point to the padding node, whose ID is -1
+            neg_dsts = [batch["node_ids"][batch["batch_idx"][2]] for batch in expected]
+            event_data.rng = ReplayNegatives([neg_dst[neg_dst >= 0] for neg_dst in neg_dsts])
+        actual = list(event_data.batches(partition))
+        assert len(actual) == len(expected) == data.n_batches(partition)
+        for actual_batch, expected_batch in zip(actual, expected):
+            assert actual_batch.keys() == expected_batch.keys()
+            for key in actual_batch:
+                assert actual_batch[key].dtype == expected_batch[key].dtype, key
+                assert actual_batch[key].shape == expected_batch[key].shape, key
+                if not key.startswith("edge_"):
+                    np.testing.assert_equal(actual_batch[key], expected_batch[key], key)
+            # Only the order of the context edges differs
+            np.testing.assert_equal(sorted_edges(actual_batch),
+                                    sorted_edges(expected_batch))
+        assert any(batch["edge_times"].any() for batch in actual)
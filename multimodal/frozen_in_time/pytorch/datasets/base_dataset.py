@@ -15,6 +15,8 @@ import torch
 from torch.utils.data import Dataset
 from torchvision import transforms
 
+from .frame_shards import FrameShards
+
 
 class TextVideoDataset(Dataset):
     def __init__(self,
@@ -28,7 +30,8 @@ class TextVideoDataset(Dataset):
                  cut=None,
                  subsample=1,
                  sliding_window_stride=-1,
-                 reader='decord'
+                 reader='decord',
+                 frame_shards_dir=None
                  ):
         self.dataset_name = dataset_name
         self.text_params = text_params
@@ -45,6 +48,10 @@ class TextVideoDataset(Dataset):
         self.subsample = subsample
         self.sliding_window_stride = sliding_window_stride
         self.video_reader = video_reader[reader]
+        # frames pre-extracted by frame_shards.py are read instead of decoding the videos
+        self.frame_shards = None
+        if frame_shards_dir is not None:
+            self.frame_shards = FrameShards(os.path.expandvars(frame_shards_dir))
         self.label_type = 'caption'
         self._load_metadata()
         if self.sliding_window_stride != -1:
@@ -70,8 +77,11 @@ class TextVideoDataset(Dataset):
     def _get_video_lens(self):
         vlen_li = []
         for idx, row in self.metadata.iterrows():
-            video_path = self._get_video_path(row)[0]
-            vlen_li.append(get_video_len(video_path))
+            video_path, rel_path = self._get_video_path(row)
+            if self.frame_shards is not None:
+                vlen_li.append(self.frame_shards.num_frames(rel_path))
+            else:
+                vlen_li.append(get_video_len(video_path))
 
         return vlen_li
 
@@ -103,7 +113,11 @@ class TextVideoDataset(Dataset):
             fix_start = sample['fix_start']
 
         try:
-            if os.path.isfile(video_fp):
+            if self.frame_shards is not None:
+                idxs = sample_frames(self.video_params['num_frames'], self.frame_shards.num_frames(rel_fp),
+                                     sample=frame_sample, fix_start=fix_start)
+                imgs = self.frame_shards.read(rel_fp, idxs)
+            elif os.path.isfile(video_fp):
                 imgs, idxs = self.video_reader(video_fp, self.video_params['num_frames'], frame_sample,
                                                fix_start=fix_start)
             else:
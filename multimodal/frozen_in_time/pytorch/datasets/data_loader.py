@@ -64,7 +64,7 @@ class TextVideoDataLoader(poptorch.DataLoader):
                  split='training',
                  tsfm_params=None, tsfm_split=None,
                  subsample=1, sliding_window_stride=-1,
-                 cut=None, reader='decord',
+                 cut=None, reader='decord', frame_shards_dir=None,
                  batch_size=1, num_workers=1, shuffle=True):
         if tsfm_params is None:
             tsfm_params = {}
@@ -85,7 +85,8 @@ class TextVideoDataLoader(poptorch.DataLoader):
             cut=cut,
             subsample=subsample,
             sliding_window_stride=sliding_window_stride,
-            reader=reader
+            reader=reader,
+            frame_shards_dir=frame_shards_dir
         )
 
         if dataset_name == "MSRVTT":
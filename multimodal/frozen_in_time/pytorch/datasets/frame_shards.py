@@ -0,0 +1,167 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+
+"""
+Pre-extracted video frames.
+
+Every video is decoded once, and up to `max_frames` uniformly strided frames are kept,
+resized and JPEG encoded. The frames are concatenated into shard files, and `index.npz` records,
+for every video (by path relative to the video directory), where its frames are:
+    paths: relative video paths, sorted
+    first_frame, num_frames: range of the frames of each video in the frame arrays
+    vlen: number of frames of each original video
+    frame_shard, frame_offset, frame_size: shard and byte range of each JPEG frame
+"""
+
+import argparse
+import os
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+import torch
+from tqdm import tqdm
+
+
+def strided_frame_indices(vlen, max_frames):
+    num_frames = min(max_frames, vlen)
+    return np.arange(num_frames) * vlen // num_frames
+
+
+def decode_strided_frames(video_path, max_frames, frame_size, jpeg_quality=90):
+    """Decode a video once, keeping up to `max_frames` uniformly strided frames.
+
+    Frames are resized so their short side is at most `frame_size`.
+    Returns the JPEG encoded frames and the number of frames of the video.
+    """
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        return [], 0
+    vlen = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    keep = set(strided_frame_indices(vlen, max_frames).tolist()) if vlen > 0 else set()
+    frames = []
+    for index in range(max(keep, default=-1) + 1):
+        # grab() decodes without converting, only the kept frames are retrieved
+        if not cap.grab():
+            break
+        if index not in keep:
+            continue
+        ret, frame = cap.retrieve()
+        if not ret:
+            continue
+        height, width = frame.shape[:2]
+        scale = frame_size / min(height, width)
+        if scale < 1:
+            frame = cv2.resize(frame, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+        ret, jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+        if ret:
+            frames.append(jpeg.tobytes())
+    cap.release()
+    return frames, vlen
+
+
+def write_shard(task):
+    """Write the frames of a list of videos into one shard, returns the index entries of the videos."""
+    shard, shard_path, video_dir, rel_paths, max_frames, frame_size = task
+    entries = []
+    offset = 0
+    with open(shard_path, 'wb') as shard_file:
+        for rel_path in rel_paths:
+            frames, vlen = decode_strided_frames(os.path.join(video_dir, rel_path), max_frames, frame_size)
+            if not frames:
+                print(f"Warning: could not decode {rel_path}.")
+                continue
+            sizes = [len(frame) for frame in frames]
+            entries.append((rel_path, vlen, shard, offset + np.cumsum([0] + sizes[:-1]), sizes))
+            for frame in frames:
+                shard_file.write(frame)
+            offset += sum(sizes)
+    return entries
+
+
+def extract_frame_shards(video_dir, output_dir, max_frames=32, frame_size=256, videos_per_shard=1000,
+                         num_workers=16, extension='.mp4'):
+    rel_paths = sorted(os.path.relpath(os.path.join(root, name), video_dir)
+                       for root, _, names in os.walk(video_dir) for name in names if name.endswith(extension))
+    os.makedirs(output_dir, exist_ok=True)
+    tasks = [(shard, os.path.join(output_dir, f'shard_{shard:05d}.bin'), video_dir,
+              rel_paths[start:start + videos_per_shard], max_frames, frame_size)
+             for shard, start in enumerate(range(0, len(rel_paths), videos_per_shard))]
+
+    entries = []
+    with Pool(num_workers) as pool:
+        for shard_entries in tqdm(pool.imap(write_shard, tasks), total=len(tasks), desc="Extracting frames"):
+            entries.extend(shard_entries)
+
+    num_frames = np.array([len(sizes) for _, _, _, _, sizes in entries], dtype=np.int32)
+    np.savez(os.path.join(output_dir, 'index.npz'),
+             paths=np.array([rel_path for rel_path, _, _, _, _ in entries]),
+             first_frame=np.cumsum(num_frames, dtype=np.int64) - num_frames,
+             num_frames=num_frames,
+             vlen=np.array([vlen for _, vlen, _, _, _ in entries], dtype=np.int32),
+             frame_shard=np.repeat([shard for _, _, shard, _, _ in entries], num_frames).astype(np.int32),
+             frame_offset=np.concatenate([offsets for _, _, _, offsets, _ in entries]).astype(np.int64),
+             frame_size=np.concatenate([sizes for _, _, _, _, sizes in entries]).astype(np.int32))
+    print(f"Extracted {num_frames.sum()} frames of {len(entries)}/{len(rel_paths)} videos into {len(tasks)} shards.")
+
+
+class FrameShards:
+    """Reads the frames of the videos extracted by `extract_frame_shards`.
+
+    The shards are memory-mapped when first read, so in each dataloader worker.
+    """
+
+    def __init__(self, shards_dir):
+        self.shards_dir = shards_dir
+        index = np.load(os.path.join(shards_dir, 'index.npz'))
+        self.paths = index['paths']
+        self.first_frame = index['first_frame']
+        self.video_frames = index['num_frames']
+        self.vlen = index['vlen']
+        self.frame_shard = index['frame_shard']
+        self.frame_offset = index['frame_offset']
+        self.frame_size = index['frame_size']
+        self._shards = {}
+
+    def _video(self, rel_path):
+        video = int(np.searchsorted(self.paths, rel_path))
+        if video == len(self.paths) or self.paths[video] != rel_path:
+            raise KeyError(f"{rel_path} is not in the frame shards of {self.shards_dir}")
+        return video
+
+    def num_frames(self, rel_path):
+        """Number of extracted frames of a video."""
+        return int(self.video_frames[self._video(rel_path)])
+
+    def _shard(self, shard):
+        if shard not in self._shards:
+            self._shards[shard] = np.memmap(os.path.join(self.shards_dir, f'shard_{shard:05d}.bin'), mode='r')
+        return self._shards[shard]
+
+    def read(self, rel_path, frame_idxs):
+        """Decode extracted frames of a video, as a (T x C x H x W) float tensor in [0, 1]."""
+        frames = []
+        for frame in self.first_frame[self._video(rel_path)] + np.asarray(frame_idxs):
+            offset = self.frame_offset[frame]
+            jpeg = self._shard(int(self.frame_shard[frame]))[offset:offset + self.frame_size[frame]]
+            frames.append(cv2.cvtColor(cv2.imdecode(np.asarray(jpeg), cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB))
+        # (T x H x W x C) to (T x C x H x W)
+        return torch.from_numpy(np.stack(frames)).permute(0, 3, 1, 2).float() / 255
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Decode every video once into shards of strided, resized JPEG frames')
+    parser.add_argument('--video_dir', type=str, default='data/WebVid/videos/',
+                        help='Directory of the videos, the paths of the videos are indexed relative to it.')
+    parser.add_argument('--output_dir', type=str, default='data/WebVid/frames/',
+                        help='Directory of the frame shards, to set as "frame_shards_dir" of the data loader.')
+    parser.add_argument('--max_frames', type=int, default=32,
+                        help='Maximum number of uniformly strided frames kept per video.')
+    parser.add_argument('--frame_size', type=int, default=256,
+                        help='Frames are resized so their short side is at most frame_size.')
+    parser.add_argument('--videos_per_shard', type=int, default=1000)
+    parser.add_argument('--num_workers', type=int, default=16)
+    args = parser.parse_args()
+
+    extract_frame_shards(args.video_dir, args.output_dir, args.max_frames, args.frame_size,
+                         args.videos_per_shard, args.num_workers)
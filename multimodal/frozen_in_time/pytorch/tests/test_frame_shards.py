@@ -0,0 +1,70 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+
+"""Tests for the pre-extracted frame shards."""
+import os
+import sys
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+
+frozen_root_path = str(Path(__file__).parent.parent)
+sys.path.append(frozen_root_path)
+
+from datasets import frame_shards
+from datasets.frame_shards import FrameShards, extract_frame_shards, strided_frame_indices
+
+
+def synthetic_frame(video, index):
+    """A small frame of a flat colour, which survives the JPEG encoding almost exactly."""
+    frame = np.zeros((12, 16, 3), dtype=np.uint8)
+    frame[...] = (10 * video, 5 * index, 200)
+    return frame
+
+
+def fake_decode_strided_frames(video_path, max_frames, frame_size, jpeg_quality=90):
+    """Stands for the video decoder: a synthetic video file holds its index and number of frames."""
+    with open(video_path) as video_file:
+        video, vlen = (int(value) for value in video_file.read().split())
+    frames = [cv2.imencode('.jpg', synthetic_frame(video, index), [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])[1].tobytes()
+              for index in (strided_frame_indices(vlen, max_frames) if vlen > 0 else [])]
+    return frames, vlen
+
+
+def test_frame_shards_round_trip(tmp_path, monkeypatch):
+    # the pool workers are forked, so they see the fake decoder too
+    monkeypatch.setattr(frame_shards, 'decode_strided_frames', fake_decode_strided_frames)
+    video_dir = tmp_path / 'videos'
+    vlens = {'a/0.mp4': 3, 'a/1.mp4': 10, 'b/2.mp4': 0, 'b/3.mp4': 5, 'c/4.mp4': 1}
+    for rel_path, vlen in vlens.items():
+        (video_dir / os.path.dirname(rel_path)).mkdir(parents=True, exist_ok=True)
+        (video_dir / rel_path).write_text(f'{int(Path(rel_path).stem)} {vlen}')
+
+    max_frames = 4
+    extract_frame_shards(str(video_dir), str(tmp_path / 'frames'), max_frames=max_frames, videos_per_shard=2,
+                         num_workers=2)
+    assert sorted(os.listdir(tmp_path / 'frames')) == ['index.npz', 'shard_00000.bin', 'shard_00001.bin',
+                                                       'shard_00002.bin']
+
+    shards = FrameShards(str(tmp_path / 'frames'))
+    for rel_path, vlen in vlens.items():
+        if vlen == 0:
+            # videos that could not be decoded are left out of the index
+            with pytest.raises(KeyError):
+                shards.num_frames(rel_path)
+            continue
+        video = int(Path(rel_path).stem)
+        num_frames = shards.num_frames(rel_path)
+        assert num_frames == min(vlen, max_frames)
+        assert shards.vlen[shards._video(rel_path)] == vlen
+
+        # in any order, with repeats
+        frame_idxs = list(reversed(range(num_frames))) + [0]
+        imgs = shards.read(rel_path, frame_idxs)
+        assert imgs.shape == (len(frame_idxs), 3, 12, 16)
+        original_idxs = strided_frame_indices(vlen, max_frames)
+        for img, frame_idx in zip(imgs, frame_idxs):
+            # the shards hold BGR frames as cv2 encodes them, and read them back as RGB in [0, 1]
+            expected = synthetic_frame(video, original_idxs[frame_idx])[..., ::-1].transpose(2, 0, 1) / 255
+            np.testing.assert_allclose(img.numpy(), expected, atol=3 / 255)
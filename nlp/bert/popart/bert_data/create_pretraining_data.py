@@ -128,7 +128,8 @@ def write_instance_to_example_files(instances, tokenizer, max_seq_length,
     formatted_seg = [0] * max_seq_length
     formatted_label = [0] * mask_tokens
     current_mask_idx = 0
-    current_seq_idx = mask_tokens
+    # Unmasked samples keep all their tokens in order from the first slot
+    current_seq_idx = 0 if args.dynamic_masking else mask_tokens
     for idx, input_id in enumerate(input_ids):
       if input_id == 0:
         continue
@@ -339,9 +340,13 @@ def create_instances_from_document(
         tokens.append("[SEP]")
         segment_ids.append(1)
 
-        (tokens, masked_lm_positions,
-         masked_lm_labels) = create_masked_lm_predictions(
-             tokens, mlm_prob, mask_tokens, vocab_words, rng, max_seq_length)
+        if args.dynamic_masking:
+          # The tokens are masked by the data loader
+          masked_lm_positions, masked_lm_labels = [], []
+        else:
+          (tokens, masked_lm_positions,
+           masked_lm_labels) = create_masked_lm_predictions(
+               tokens, mlm_prob, mask_tokens, vocab_words, rng, max_seq_length)
         instance = TrainingInstance(
             tokens=tokens,
             segment_ids=segment_ids,
@@ -506,5 +511,8 @@ if __name__ == "__main__":
                       help="Value in the positional input for [PAD] tokens")
   parser.add_argument("--do-whole-word-mask", type=bool, default=False)
   parser.add_argument("--max-open-files", type=int, default=1)
+  parser.add_argument("--dynamic-masking", action="store_true",
+                      help="Write the samples without masking, to be masked on the fly by the data loader "
+                           "(--dynamic-masking of bert.py). Use with --duplication-factor 1.")
   args = parser.parse_args()
   main(args)
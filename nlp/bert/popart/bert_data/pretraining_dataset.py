@@ -22,10 +22,11 @@ import os
 from tqdm import tqdm
 from logging import getLogger
 from functools import reduce
+from multiprocessing import resource_tracker, shared_memory
 import popdist.popart
 from .dataset import DataSet
 from .data_sampler import DistributedDataSampler, SampleGenerator
-from utils.distributed import distributed_barrier
+from utils.distributed import distributed_barrier, local_comm
 
 logger = getLogger(__name__)
 
@@ -209,14 +210,23 @@ class CachedDataLoader(BinaryDataLoader):
         Specify the number of epochs to keep loaded in memory. This can reduce the number of times the inputs
         are read. It is recommended to make this as large as possible as the dataset files can be very large due to duplication factor.
         Must be greater than 0.
+    :param shared_memory_cache:
+        If True, a single instance per host reads the cached epochs into shared memory segments that the other
+        instances of the host attach to read-only. Each instance shuffles its own view of the samples with indices,
+        so host memory and cache fill time no longer grow with the number of instances per host.
     """
     def __init__(self,
                  *args,
                  epochs_to_cache=1,
+                 shared_memory_cache=False,
                  **kwargs):
         super().__init__(*args, **kwargs)
         self.epochs_to_cache = epochs_to_cache
+        self.shared_memory_cache = shared_memory_cache
         self.data_cache = []
+        self.cache_indices = []
+        self.shared_segments = []
+        self.data_indices = None
         self.cache_index = 0
 
         if self.epochs_to_cache < 1:
@@ -229,20 +239,40 @@ class CachedDataLoader(BinaryDataLoader):
         if self.data_index + batch_size > self.data.shape[0]:
             raise StopIteration
 
-        data = self.data[self.data_index:self.data_index + batch_size, :]
+        if self.data_indices is not None:
+            data = self.data[self.data_indices[self.data_index:self.data_index + batch_size]]
+        else:
+            data = self.data[self.data_index:self.data_index + batch_size, :]
         self.data_index += batch_size
         return data
 
     def load_data(self):
         if self.cache_index >= len(self.data_cache):
-            if self.shuffle or self.duplication_factor > 1:
+            if self.shared_memory_cache and self.duplication_factor == 1:
+                # The cached samples are the same every epoch, only their order changes
+                self.cache_index = 0
+                self.cache_indices = [self.shuffled_indices(data.shape[0]) for data in self.data_cache]
+            elif self.shuffle or self.duplication_factor > 1:
                 self.load_cache()
             else:
                 self.cache_index = 0
         self.data = self.data_cache[self.cache_index]
+        if self.shared_memory_cache:
+            self.data_indices = self.cache_indices[self.cache_index]
         self.cache_index += 1
 
+    def shuffled_indices(self, num_samples):
+        if not self.shuffle:
+            return None
+        indices = np.arange(num_samples)
+        self._rng.shuffle(indices)
+        return indices
+
     def load_cache(self):
+        if self.shared_memory_cache:
+            self.load_shared_cache()
+            return
+
         self.cache_index = 0
         self.data_cache = []
         logger.info("Filling Dataset Cache")
@@ -288,6 +318,71 @@ class CachedDataLoader(BinaryDataLoader):
             self.data_cache.append(data)
             self.file_index = 0
 
+    def load_shared_cache(self):
+        comm = local_comm() if popdist.getNumInstances() > 1 else None
+        is_local_root = comm is None or comm.Get_rank() == 0
+
+        self.release_shared_cache()
+        self.cache_index = 0
+        total_samples_per_epoch = int(sum(self.samples_in_file(f) for f in self.files))
+        shape = (total_samples_per_epoch, self.sample_size)
+        num_bytes = total_samples_per_epoch * self.sample_size * self.dtype().itemsize
+        if is_local_root:
+            logger.info("Filling Shared Dataset Cache")
+        start_time = time.time()
+        for __ in range(self.epochs_to_cache):
+            if is_local_root:
+                segment = shared_memory.SharedMemory(create=True, size=max(num_bytes, 1))
+                data = np.ndarray(shape, self.dtype, buffer=segment.buf)
+                start = 0
+                for __ in tqdm(self.files):
+                    file_data = self.load_file()
+                    data[start:start + file_data.shape[0]] = file_data
+                    start += file_data.shape[0]
+                self.file_index = 0
+                name = segment.name
+            else:
+                name = None
+
+            if comm is not None:
+                name = comm.bcast(name, root=0)
+                if not is_local_root:
+                    segment = attach_shared_memory(name)
+                    data = np.ndarray(shape, self.dtype, buffer=segment.buf)
+                # Once every local instance is attached, the segment is freed with the last of them
+                comm.barrier()
+            if is_local_root:
+                segment.unlink()
+
+            data.flags.writeable = False
+            self.shared_segments.append(segment)
+            self.data_cache.append(data)
+            self.cache_indices.append(self.shuffled_indices(total_samples_per_epoch))
+
+        if is_local_root:
+            logger.info(f"Shared dataset cache filled in {time.time() - start_time:3.2f} seconds.")
+
+        # Wait until all hosts finish filling the dataset cache
+        if popdist.getNumInstances() > 1:
+            distributed_barrier()
+
+    def release_shared_cache(self):
+        # The arrays viewing the segments must be released before closing them
+        self.data = None
+        self.data_indices = None
+        self.data_cache = []
+        self.cache_indices = []
+        for segment in self.shared_segments:
+            segment.close()
+        self.shared_segments = []
+
+
+def attach_shared_memory(name):
+    segment = shared_memory.SharedMemory(name=name)
+    # Only the instance that created the segment is responsible for unlinking it
+    resource_tracker.unregister(segment._name, "shared_memory")
+    return segment
+
 
 class GeneratedDataLoader(BinaryDataLoader):
     """
@@ -320,6 +415,163 @@ class GeneratedDataLoader(BinaryDataLoader):
         return items
 
 
+def select_masked_tokens(rng, candidates, sequence_index, num_to_mask):
+    """
+    Randomly selects num_to_mask[b, s] of the candidate tokens of every sequence s of every sample b.
+    :param candidates: Boolean array [batch_size, sequence_length] of the tokens that can be masked
+    :param sequence_index: Sequence of every token, from 1. 0 is padding
+    :param num_to_mask: Array [batch_size, max_sequences_per_pack + 1], column 0 is ignored
+    """
+    batch_size, sequence_length = candidates.shape
+    slots = np.arange(sequence_length)
+    # Sort the tokens by sequence, then randomly with the candidates first
+    keys = 2 * sequence_index + rng.random(candidates.shape) + ~candidates
+    order = np.argsort(keys, axis=1)
+    sorted_index = np.take_along_axis(sequence_index, order, axis=1)
+    is_first = np.ones_like(candidates)
+    is_first[:, 1:] = sorted_index[:, 1:] != sorted_index[:, :-1]
+    rank = slots - np.maximum.accumulate(np.where(is_first, slots, 0), axis=1)
+    selected = (rank < np.take_along_axis(num_to_mask, sorted_index, axis=1)) \
+        & np.take_along_axis(candidates, order, axis=1) & (sorted_index > 0)
+    masked = np.zeros_like(candidates)
+    np.put_along_axis(masked, order, selected, axis=1)
+    return masked
+
+
+class BertDynamicMaskingTransform(object):
+    '''
+    Applies the masked LM masking on the fly to samples stored without masking, instead of pre-masking
+    `duplication_factor` copies of every sample on disk. Each epoch sees a new masking of the samples.
+    Unmasked samples are created with `create_pretraining_data.py --dynamic-masking` and can be packed.
+    The output has the same format as the pre-masked data.
+
+    Of the selected tokens, 80% are replaced by [MASK], 10% by a random token and 10% are unchanged.
+    '''
+    def __init__(self,
+                 dataloader,
+                 sequence_length,
+                 mask_tokens,
+                 vocab_length,
+                 mlm_prob=0.15,
+                 packed=False,
+                 max_sequences_per_pack=1,
+                 seed=1984,
+                 cls_id=101,
+                 sep_id=102,
+                 mask_id=103):
+        self.dataloader = dataloader
+        self.sequence_length = sequence_length
+        self.mask_tokens = mask_tokens
+        self.vocab_length = vocab_length
+        self.mlm_prob = mlm_prob
+        self.packed = packed
+        self.max_sequences_per_pack = max_sequences_per_pack
+        self.cls_id = cls_id
+        self.sep_id = sep_id
+        self.mask_id = mask_id
+        self._rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        self.dataloader_iterator = iter(self.dataloader)
+        return self
+
+    def __next__(self):
+        items = next(self.dataloader_iterator)
+        if self.packed:
+            return self.mask_packed(*items)
+        return self.mask(*items)
+
+    def candidates(self, input_ids):
+        return (input_ids != 0) & (input_ids != self.cls_id) & (input_ids != self.sep_id)
+
+    def replace_masked_tokens(self, input_ids, masked):
+        choice = self._rng.random(input_ids.shape)
+        random_ids = self._rng.integers(self.mask_id + 1, self.vocab_length, input_ids.shape)
+        output_ids = np.where(masked & (choice < 0.8), self.mask_id, input_ids)
+        return np.where(masked & (choice >= 0.9), random_ids, output_ids).astype(input_ids.dtype)
+
+    def mask(self, input_ids, positions, segment_ids, mask_padding_index, sequence_padding_index,
+             masked_lm_ids, next_sentence_labels):
+        """Unmasked samples have their tokens in order from slot 0 and no masked tokens."""
+        batch_size, sequence_length = input_ids.shape
+        rows = np.arange(batch_size)[:, None]
+        real_tokens = input_ids != 0
+        lengths = real_tokens.sum(axis=1)
+
+        # As in create_pretraining_data, enough tokens are masked for the others to fit after the mask_tokens slots
+        num_to_mask = np.clip(np.rint(lengths * self.mlm_prob), 1, self.mask_tokens)
+        num_to_mask = np.maximum(num_to_mask, lengths - sequence_length + self.mask_tokens).astype(np.int64)
+        masked = select_masked_tokens(self._rng, self.candidates(input_ids), real_tokens.astype(np.int64),
+                                      np.stack([np.zeros_like(num_to_mask), num_to_mask], axis=1))
+        num_masked = masked.sum(axis=1)
+
+        # Masked tokens are moved to the front, in order, the others start after the mask_tokens slots
+        order = np.argsort(np.where(masked, 0, np.where(real_tokens, 1, 2)), axis=1, kind="stable")
+        slots = np.arange(sequence_length)
+        destination = np.where(slots < num_masked[:, None], slots, slots - num_masked[:, None] + self.mask_tokens)
+        is_written = slots < lengths[:, None]
+        target_rows = np.broadcast_to(rows, order.shape)[is_written]
+        destination = destination[is_written]
+        source = (rows, order)
+
+        # Slots that stay empty keep the padding position value of the sample
+        pad_position = np.where(real_tokens, -1, positions).max(axis=1, keepdims=True)
+        output_positions = np.broadcast_to(pad_position, positions.shape).astype(positions.dtype)
+        output_ids = np.zeros_like(input_ids)
+        output_segment_ids = np.zeros_like(segment_ids)
+        output_ids[target_rows, destination] = self.replace_masked_tokens(input_ids, masked)[source][is_written]
+        output_positions[target_rows, destination] = positions[source][is_written]
+        output_segment_ids[target_rows, destination] = segment_ids[source][is_written]
+
+        output_labels = np.where(slots[:self.mask_tokens] < num_masked[:, None],
+                                 input_ids[source][:, :self.mask_tokens], 0).astype(masked_lm_ids.dtype)
+        return [output_ids,
+                output_positions,
+                output_segment_ids,
+                num_masked[:, None].astype(mask_padding_index.dtype),
+                (lengths - num_masked + self.mask_tokens)[:, None].astype(sequence_padding_index.dtype),
+                output_labels,
+                next_sentence_labels]
+
+    def mask_packed(self, input_ids, input_mask, segment_ids, positions, masked_lm_ids, masked_lm_weights,
+                    next_sentence_labels, next_sentence_weights):
+        """Unmasked packs have the tokens of their sequences from slot 0, and the [CLS] tokens at the end."""
+        batch_size, sequence_length = input_ids.shape
+        max_masked_tokens = masked_lm_ids.shape[1]
+        rows = np.arange(batch_size)[:, None]
+        sequence_index = input_mask.astype(np.int64)
+
+        # Each sequence of the pack is masked in proportion to its length
+        lengths = np.zeros((batch_size, self.max_sequences_per_pack + 1), dtype=np.int64)
+        np.add.at(lengths, (np.broadcast_to(rows, sequence_index.shape), sequence_index), 1)
+        num_to_mask = np.maximum(np.rint(lengths * self.mlm_prob), 1).astype(np.int64)
+        masked = select_masked_tokens(self._rng, self.candidates(input_ids), sequence_index, num_to_mask)
+        # Very rarely the sequences together exceed the masked tokens of the pack
+        masked &= np.cumsum(masked, axis=1) <= max_masked_tokens
+        num_masked = masked.sum(axis=1)
+
+        # Masked tokens are moved to the front, the [CLS] tokens stay at the end
+        is_moved = (input_ids != 0) & (input_ids != self.cls_id)
+        order = np.argsort(np.where(masked, 0, np.where(is_moved, 1, 2)), axis=1, kind="stable")
+        is_written = np.arange(sequence_length) < is_moved.sum(axis=1, keepdims=True)
+        source = (rows, order)
+
+        outputs = []
+        for data in (self.replace_masked_tokens(input_ids, masked), input_mask, segment_ids, positions):
+            output = data.copy()
+            output[is_written] = data[source][is_written]
+            outputs.append(output)
+
+        is_label = np.arange(max_masked_tokens) < num_masked[:, None]
+        order = order[:, :max_masked_tokens]
+        output_labels = np.where(is_label, input_ids[rows, order], 0).astype(masked_lm_ids.dtype)
+        output_weights = np.where(is_label, input_mask[rows, order], 0).astype(masked_lm_weights.dtype)
+        return outputs + [output_labels, output_weights, next_sentence_labels, next_sentence_weights]
+
+
 class BertDataTransform(object):
     '''
     Masks the indices that are larger than the vocab_length
@@ -389,6 +641,8 @@ def get_bert_dataset(args, tensor_shapes):
                                  length=length,
                                  generated_ranges=synthetic_data_ranges)
     elif tfrecord_input:
+        if args.dynamic_masking:
+            raise RuntimeError("tfrecord dataset not supported for dynamic masking")
         if args.use_packed_sequence_format:
             raise RuntimeError("tfrecord dataset not supported for packed sequence data format")
 
@@ -399,7 +653,8 @@ def get_bert_dataset(args, tensor_shapes):
                                            samples_per_step)
     elif args.epochs_to_cache > 0:
         dl = CachedDataLoader(**data_loader_args,
-                              epochs_to_cache=args.epochs_to_cache)
+                              epochs_to_cache=args.epochs_to_cache,
+                              shared_memory_cache=args.shared_memory_cache)
     else:
         dl = BinaryDataLoader(**data_loader_args)
 
@@ -413,6 +668,16 @@ def get_bert_dataset(args, tensor_shapes):
     if len(dl) == 0:
         raise ValueError("Insufficient data for training parameters.")
 
+    if args.dynamic_masking and not generated_data:
+        dl = BertDynamicMaskingTransform(dl,
+                                         args.sequence_length,
+                                         args.mask_tokens,
+                                         args.vocab_length,
+                                         mlm_prob=args.mlm_prob,
+                                         packed=args.use_packed_sequence_format,
+                                         max_sequences_per_pack=args.max_sequences_per_pack,
+                                         seed=[args.seed, args.popdist_rank if args.use_popdist else 0])
+
     bert_ds = BertDataTransform(dl, args.vocab_length, args.mask_tokens)
     ds = DataSet(bert_ds,
                  tensor_shapes,
@@ -27,11 +27,15 @@ from bert_model import Bert, BertConfig
 from bert_data.dataset import DataSet
 from bert_data.pretraining_dataset import (
     BinaryDataLoader,
+    CachedDataLoader,
     GeneratedDataLoader,
     BertDataTransform,
+    BertDynamicMaskingTransform,
     data_file_format as pretraining_format,
+    packed_data_file_format,
     data_ranges as pretraining_ranges
 )
+from bert_data.pack_pretraining_data import create_multi_sequence_example
 from bert_data.squad_dataset import (
     SquadDataLoader,
     generate_random_features,
@@ -81,6 +85,48 @@ def test_dataloader():
         assert(np.all(lbl_ == lbl))
 
 
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_shared_memory_cached_dataloader(shuffle):
+    sample_size = 8
+    batch_size = 4
+    samples_per_file = 6
+
+    with tempfile.TemporaryDirectory() as pwd:
+        input_files = []
+        for file_idx in range(3):
+            input_path = os.path.join(pwd, f"input_{file_idx}.bin")
+            data = np.random.randint(0, 1000, (samples_per_file, sample_size)).astype(np.int32)
+            # The first element identifies the sample
+            data[:, 0] = file_idx * samples_per_file + np.arange(samples_per_file)
+            data.tofile(input_path)
+            input_files.append(input_path)
+
+        def load_epochs(shared_memory_cache):
+            dl = CachedDataLoader(input_files,
+                                  [sample_size],
+                                  batch_size,
+                                  shuffle=shuffle,
+                                  epochs_to_cache=2,
+                                  shared_memory_cache=shared_memory_cache)
+            epochs = [np.concatenate([batch[0] for batch in dl]) for _ in range(3)]
+            if shared_memory_cache:
+                dl.release_shared_cache()
+            return epochs
+
+        cached_epochs = load_epochs(False)
+        shared_epochs = load_epochs(True)
+
+    for cached_epoch, shared_epoch in zip(cached_epochs, shared_epochs):
+        # The remainder of the last batch is dropped
+        assert shared_epoch.shape == (16, sample_size)
+        if shuffle:
+            assert len(np.unique(shared_epoch[:, 0])) == 16
+        else:
+            np.testing.assert_equal(shared_epoch, cached_epoch)
+    if shuffle:
+        assert not np.array_equal(shared_epochs[0], shared_epochs[1])
+
+
 def test_generated_data_pretraining():
     sequence_length = 128
     mask_tokens = 20
@@ -129,6 +175,104 @@ def test_generated_data_squad():
         assert(data.shape == (batch_size, size))
 
 
+def unmasked_samples(batch_size, sequence_length, pad_position_value, rng):
+    """Samples as written by create_pretraining_data.py --dynamic-masking"""
+    ids = np.zeros((batch_size, sequence_length), dtype=np.int32)
+    positions = np.full((batch_size, sequence_length), pad_position_value, dtype=np.int32)
+    segments = np.zeros((batch_size, sequence_length), dtype=np.int32)
+    lengths = rng.integers(5, sequence_length + 1, batch_size)
+    lengths[0] = sequence_length
+    for i, length in enumerate(lengths):
+        split = rng.integers(2, length - 2)
+        ids[i, :length] = rng.integers(1000, 2000, length)
+        ids[i, [0, split, length - 1]] = [101, 102, 102]
+        positions[i, :length] = np.arange(length)
+        segments[i, split + 1:length] = 1
+    return [ids, positions, segments,
+            np.zeros((batch_size, 1), dtype=np.int32),
+            lengths[:, None].astype(np.int32),
+            np.zeros((batch_size, 4), dtype=np.int32),
+            rng.integers(0, 2, (batch_size, 1)).astype(np.int32)]
+
+
+def test_dynamic_masking():
+    sequence_length = 32
+    mask_tokens = 8
+    pad_position_value = 40
+    rng = np.random.default_rng(0)
+    samples = unmasked_samples(64, sequence_length, pad_position_value, rng)
+    samples[5] = np.zeros((64, mask_tokens), dtype=np.int32)
+    transform = BertDynamicMaskingTransform([samples, samples], sequence_length, mask_tokens, 2000, seed=3)
+    first, second = list(transform)
+    assert not np.array_equal(first[0], second[0])
+
+    ids, positions, segments, mask_padding, sequence_padding, labels, nsp = first
+    np.testing.assert_equal(nsp, samples[6])
+    for i in range(64):
+        length = samples[4][i, 0]
+        num_masked = mask_padding[i, 0]
+        assert 1 <= num_masked <= mask_tokens
+        assert length - num_masked <= sequence_length - mask_tokens
+        assert sequence_padding[i, 0] == mask_tokens + length - num_masked
+        # Every token is written once, the masked ones at the front in order
+        masked_slots = np.arange(num_masked)
+        sequence_slots = np.arange(mask_tokens, sequence_padding[i, 0])
+        written = np.concatenate([masked_slots, sequence_slots])
+        np.testing.assert_equal(np.sort(positions[i, written]), np.arange(length))
+        assert np.all(np.diff(positions[i, masked_slots]) > 0)
+        np.testing.assert_equal(segments[i, written], samples[2][i, positions[i, written]])
+        np.testing.assert_equal(ids[i, sequence_slots], samples[0][i, positions[i, sequence_slots]])
+        np.testing.assert_equal(labels[i, :num_masked], samples[0][i, positions[i, masked_slots]])
+        np.testing.assert_equal(labels[i, num_masked:], 0)
+        assert not np.isin(labels[i, :num_masked], [101, 102]).any()
+        # Unwritten slots are padding
+        padding = np.setdiff1d(np.arange(sequence_length), written)
+        np.testing.assert_equal(ids[i, padding], 0)
+        np.testing.assert_equal(positions[i, padding], pad_position_value)
+    num_masked = mask_padding.sum()
+    assert np.mean(ids[:, :mask_tokens][np.arange(mask_tokens) < mask_padding] == 103) > 0.6
+    assert 0.1 < num_masked / samples[4].sum() < 0.25
+
+
+def test_dynamic_masking_packed():
+    sequence_length = 32
+    mask_tokens = 8
+    max_sequences_per_pack = 3
+    rng = np.random.default_rng(0)
+    sequences = unmasked_samples(30, 10, 40, rng)
+    sequences = [data if data.shape[1] > 1 else data[:, 0] for data in sequences]
+    packs = [create_multi_sequence_example([[data[i] for data in sequences] for i in range(j, j + 3)],
+                                           mask_tokens, sequence_length, max_sequences_per_pack)[0]
+             for j in range(0, 30, 3)]
+    sizes = packed_data_file_format(sequence_length, mask_tokens, max_sequences_per_pack)
+    packs = np.frombuffer(b"".join(packs), dtype=np.uint32).reshape(len(packs), -1).astype(np.int32)
+    packs = np.split(packs, np.cumsum(sizes)[:-1], axis=1)
+
+    transform = BertDynamicMaskingTransform([packs], sequence_length, mask_tokens, 2000, packed=True,
+                                            max_sequences_per_pack=max_sequences_per_pack, seed=3)
+    ids, input_mask, segments, positions, labels, weights, nsp, nsp_weights = next(iter(transform))
+    np.testing.assert_equal(nsp, packs[6])
+    np.testing.assert_equal(nsp_weights, packs[7])
+    for i in range(len(ids)):
+        num_masked = np.count_nonzero(weights[i])
+        # The same tokens are in the pack, with the masked ones at the front
+        key = np.stack([input_mask[i], positions[i], segments[i]], axis=1)
+        expected_key = np.stack([packs[1][i], packs[3][i], packs[2][i]], axis=1)
+        np.testing.assert_equal(np.unique(key, axis=0), np.unique(expected_key, axis=0))
+        np.testing.assert_equal(weights[i, :num_masked], input_mask[i, :num_masked])
+        # [CLS] tokens stay at the end
+        np.testing.assert_equal(ids[i, -max_sequences_per_pack:], packs[0][i, -max_sequences_per_pack:])
+        for slot in range(sequence_length):
+            original = (packs[1][i] == input_mask[i, slot]) & (packs[3][i] == positions[i, slot]) \
+                & (packs[1][i] != 0)
+            if slot < num_masked:
+                assert labels[i, slot] == packs[0][i][original][0]
+            elif np.any(original):
+                assert ids[i, slot] == packs[0][i][original][0]
+        # Every sequence has masked tokens
+        np.testing.assert_equal(np.unique(weights[i, :num_masked]), np.unique(packs[1][i][packs[1][i] > 0]))
+
+
 def test_transform():
     sequence_length = 128
     mask_tokens = 20
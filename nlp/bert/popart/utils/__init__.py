@@ -325,6 +325,14 @@ def parse_bert_args(args_string=None):
                             " (# of samples in input-files)/duplication-factor")
     group.add_argument("--epochs-to-cache", type=int, default=0,
                        help="Number of epochs of data to load into memory during PRETRAINING. Default is to load input files as needed.")
+    group.add_argument("--dynamic-masking", type=str_to_bool, nargs="?", const=True, default=False,
+                       help="Mask the tokens on the fly during PRETRAINING. The input files must be created with "
+                            "bert_data/create_pretraining_data.py --dynamic-masking, and need no duplication.")
+    group.add_argument("--mlm-prob", type=float, default=0.15,
+                       help="Proportion of the tokens of each sequence that are masked with --dynamic-masking.")
+    group.add_argument("--shared-memory-cache", type=str_to_bool, nargs="?", const=True, default=False,
+                       help="With --epochs-to-cache, load the cached epochs once per host into shared memory that all the "
+                            "instances of the host read from, instead of once per instance.")
 
     group = parser.add_argument_group("Execution Config")
     group.add_argument("--pipeline", type=str_to_bool, nargs="?", const=True, default=None,
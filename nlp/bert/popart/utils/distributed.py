@@ -18,7 +18,7 @@ import numpy as np
 
 __all__ = ["setup_comm", "average_distributed_deques",
            "popdist_root", "distributed_barrier",
-           "broadcast_dict"]
+           "broadcast_dict", "local_comm"]
 
 
 DISTRIBUTED_ROOT = 0
@@ -31,11 +31,13 @@ def popdist_root(args):
 
 
 DISTRIBUTED_COMM = None
+DISTRIBUTED_LOCAL_COMM = None
 
 
 def setup_comm(comm):
-    global DISTRIBUTED_COMM
+    global DISTRIBUTED_COMM, DISTRIBUTED_LOCAL_COMM
     DISTRIBUTED_COMM = comm
+    DISTRIBUTED_LOCAL_COMM = None
 
 
 def _get_comm():
@@ -51,6 +53,18 @@ def distributed_barrier():
     _get_comm().barrier()
 
 
+def local_comm():
+    """
+    Communicator of the instances running on this host, which can share memory.
+    Must first be called by all the instances at the same time.
+    """
+    global DISTRIBUTED_LOCAL_COMM
+    if DISTRIBUTED_LOCAL_COMM is None:
+        from mpi4py import MPI
+        DISTRIBUTED_LOCAL_COMM = _get_comm().Split_type(MPI.COMM_TYPE_SHARED)
+    return DISTRIBUTED_LOCAL_COMM
+
+
 def average_distributed_deques(local_deque: deque, N: int = None) -> deque:
     comm = _get_comm()
     size = comm.Get_size()
@@ -130,7 +130,7 @@ def parse_bert_args(args=None, config_file="configs_pretraining.yml"):
 
     # Dataset
     parser.add_argument("--input-files", type=str, nargs="+", help="Input data files")
-    parser.add_argument("--dataset", type=str, choices=['generated', 'pretraining'],
+    parser.add_argument("--dataset", type=str, choices=['generated', 'pretraining', 'memmap'],
                         help="dataset to use for the training")
     parser.add_argument("--synthetic-data", type=str_to_bool, nargs="?", const=True, default=False,
                         help="No Host/IPU I/O, random data created on device")
@@ -139,7 +139,7 @@ def parse_bert_args(args=None, config_file="configs_pretraining.yml"):
     parser.add_argument("--packed-data", type=str_to_bool, nargs="?", const=True, default=False,
                         help="Use packed data")
     parser.add_argument("--packing-factor", type=dict_arg, help="Packing factor")
-    parser.add_argument("--max-sequences-per-pack", type=int, choices=[2, 3], default=3,
+    parser.add_argument("--max-sequences-per-pack", type=int, default=3,
                         help="The maximum number of sequences per packed example.")
 
     # Misc
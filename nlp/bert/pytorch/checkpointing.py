@@ -27,7 +27,7 @@ def checkpoints_exist(path):
     return False
 
 
-def save_checkpoint(config, model, step, optimizer=None, metrics=None):
+def save_checkpoint(config, model, step, optimizer=None, metrics=None, data_position=None):
     if config.checkpoint_output_dir:
         path = os.path.join(os.path.abspath(config.checkpoint_output_dir), f"step_{step}")
         os.makedirs(path, exist_ok=True)
@@ -38,12 +38,14 @@ def save_checkpoint(config, model, step, optimizer=None, metrics=None):
             torch.save({
                 "step": step,
                 "metrics": metrics,
-                "config": config
+                "config": config,
+                "data_position": data_position
             }, os.path.join(path, "training_state.pt"))
         else:
             torch.save({
                 "step": step,
                 "optimizer_state_dict": optimizer.state_dict(),
                 "metrics": metrics,
-                "config": config
+                "config": config,
+                "data_position": data_position
             }, os.path.join(path, "training_state.pt"))
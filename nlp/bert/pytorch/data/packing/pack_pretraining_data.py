@@ -14,17 +14,19 @@
 
 import collections
 import os
+import shutil
 import time
 import glob
 import random
 import argparse
 import numpy as np
 import psutil
-from scipy import optimize
+import scipy
+from scipy import optimize, sparse
 from itertools import chain, islice, repeat
 from functools import lru_cache, partial
 from collections import defaultdict
-from concurrent.futures import as_completed, ProcessPoolExecutor
+from concurrent.futures import as_completed, wait, FIRST_COMPLETED, ProcessPoolExecutor
 try:
     os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
     import tensorflow as tf
@@ -133,46 +135,114 @@ def get_packing_matrix(strategy_set, sequence_length):
     return A
 
 
-def get_packing_recipe(args, sequence_lengths, drop_unused_strategies=False):
-    """Given program arguments and a list of sequence lengths return the packing recipe.
+def add_pack(pack, count, tmp, final, limit, offset):
+    """Filter out packs that reached the maximum length or number of sequences."""
+    if len(pack) == limit or offset == 0:
+        final[offset].append((count, pack))
+    else:
+        tmp[offset].append((count, pack))
 
-    A "packing recipe" primarily consists of a set of strategies "strategy_set" and the "mixture"
-    which states how many times each one of these strategies should be applied in order to pack
-    the dataset. Additionally, we also return the "padding" vector which states how many sequences
-    of a given sequence length need to be added to our dataset in order use the proposed mixture
-    of strategies.
+
+def pack_using_spfhp(histogram, max_sequence_length, max_sequences_per_pack):
+    """Shortest-pack-first histogram-packing (SPFHP).
+
+    A first-fit-decreasing heuristic that operates on the histogram of sequence
+    lengths rather than on individual sequences. The lengths are processed from
+    longest to shortest and each group of sequences is placed into the packs
+    with the most space left (i.e. the shortest packs) that can still fit it.
+    Unlike the NNLS solver, it never needs to enumerate all packing strategies,
+    so its runtime does not depend on max_sequences_per_pack and it
+    does not introduce any padding sequences or drop sequences.
+    See https://arxiv.org/abs/2107.02027 for details.
 
     Parameters
     ----------
-    args:namedtuple containing the following attributes
-        sequence_length:int
-            The maximum sequence length to which the sequences will be packed. Used to generate the
-            appropriate packing strategies.
-        max_sequences_per_pack:int
-            The maximum number of sequences that can ever be put into a pack. Used to generate the
-            appropriate packing strategies.
-        drop_unpacked_remainder:bool
-            Whether to drop the sequences that could not be packed (usually a very small percentage)
-            If false, then the unpacked sequences will be padded instead.
-    sequence_lengths:list[int]
-        A list containing the sequence length of each example in the un-packed dataset.
-    drop_unused_strategies:bool
-        If True, filter out strategies that are to be used 0 times according to the mixture.
+    histogram:np.array of shape [max_sequence_length]
+        The number of sequences of each length, histogram[i] is the number of
+        sequences of length i + 1.
+    max_sequence_length:int
+        The maximum sequence length of a pack.
+    max_sequences_per_pack:int
+        The maximum number of sequences that can ever be put into a pack.
+
     Returns
     -------
     strategy_set:list[list[int]]
-        The list of unique packing strategies with which the packing problem
-        was solved.
-    mixture:list[int] of shape [len(strategy_set)]
-        States how many times each of the strategies from the strategy set
-        should be repeated to cover the entire dataset.
-    padding:list[int] of shape [sequence_length]
+        The list of unique packing strategies, each strategy is a sorted list of
+        the sequence lengths in the pack, which sum up to at most max_sequence_length.
+    mixture:np.array of shape [len(strategy_set)]
+        States how many times each of the strategies is used.
+    """
+    reversed_histogram = np.flip(histogram)
+    # Initialize main strategy data dictionary.
+    # The key indicates how many tokens are left for full length.
+    # The value is a list of tuples, consisting of counts and respective packs.
+    # A pack is a (sorted) list of sequence length values that get concatenated.
+    tmp_strategies_per_length = defaultdict(list)
+    strategies_per_length = defaultdict(list)
+    # Index i indicates here, how much space is left, due to reversed histogram
+    for i in range(max_sequence_length):
+        n_sequences_to_bin = int(reversed_histogram[i])
+        length_to_bin = max_sequence_length - i
+        offset = i + 1  # largest possible offset
+        while n_sequences_to_bin > 0:
+            if (length_to_bin + offset) in tmp_strategies_per_length:
+                # extract shortest pack that will get modified
+                n_sequences_to_pack, pack = tmp_strategies_per_length[length_to_bin + offset].pop()
+                new_pack = pack + [length_to_bin]
+                count = min(n_sequences_to_pack, n_sequences_to_bin)
+                if n_sequences_to_pack > n_sequences_to_bin:
+                    # old pack gets reduced
+                    n_sequences_to_pack -= n_sequences_to_bin
+                    tmp_strategies_per_length[length_to_bin + offset].append((n_sequences_to_pack, pack))
+                    n_sequences_to_bin = 0
+                else:
+                    n_sequences_to_bin -= n_sequences_to_pack
+                add_pack(new_pack, count, tmp_strategies_per_length, strategies_per_length,
+                         max_sequences_per_pack, offset)
+                # clean up to speed up main key search
+                if not tmp_strategies_per_length[length_to_bin + offset]:
+                    tmp_strategies_per_length.pop(length_to_bin + offset)
+            else:
+                offset -= 1
+            # Does not fit anywhere. Create new pack.
+            if offset < 0:
+                add_pack([length_to_bin], n_sequences_to_bin, tmp_strategies_per_length, strategies_per_length,
+                         max_sequences_per_pack, i)
+                n_sequences_to_bin = 0
+
+    # merge all strategies
+    for key in tmp_strategies_per_length:
+        strategies_per_length[key].extend(tmp_strategies_per_length[key])
+
+    # flatten strategies dictionary
+    strategy_set = []
+    mixture = []
+    for key in strategies_per_length:
+        for count, pack in strategies_per_length[key]:
+            strategy_set.append(sorted(pack))
+            mixture.append(count)
+    return strategy_set, np.array(mixture, dtype=np.int64)
+
+
+def solve_packing_mixture(args, histogram, packing_solver="nnls"):
+    """Find the mixture of all packing strategies which best matches the histogram.
+
+    The strategies are all the ways of filling a pack of exactly "sequence_length"
+    tokens with at most "max_sequences_per_pack" sequences. The mixture is
+    found either in the (weighted) least squares sense with a dense NNLS solver
+    (packing_solver="nnls"), or as the solution of the sparse linear program
+    that minimizes the number of packs while covering the histogram
+    (packing_solver="lp").
+
+    Returns
+    -------
+    strategy_set:list[list[int]]
+    mixture:np.array of shape [len(strategy_set)]
+    padding:np.array of shape [sequence_length]
         For each sequence length how many padding sequence of that length
         need to be created to realize the packing mixture.
     """
-
-    print("Entering packing solver".center(80, "_"))
-
     # List all unique ways of packing to the desired maximum sequence length
     strategy_set = get_packing_strategies(0, 1, args.sequence_length, args.max_sequences_per_pack)
     for strategy in strategy_set:
@@ -184,27 +254,40 @@ def get_packing_recipe(args, sequence_lengths, drop_unused_strategies=False):
     # Get the packing matrix corresponding to this list of packing strategies
     A = get_packing_matrix(strategy_set, args.sequence_length)
 
-    # To achieve more robust convergence of the packing problem we create
-    # weights that penalize the residual on short sequences less.
-    # In other words we allow short sequences (up to length padding_cutoff)
-    # to be over-used to a larger degree than longer sequences
-    padding_cutoff = 8
-    w0 = np.ones([args.sequence_length])
-    w0[:padding_cutoff] = padding_cutoff / (2 * args.sequence_length)
-    w0 = np.sqrt(w0)
-
-    # Histogram of sequence lengths
-    histogram, bins = np.histogram(sequence_lengths, bins=np.arange(1, args.sequence_length + 2))
-
-    # Solve the packing problem
-    # A@mixture = histogram
-    # i.e. find the non-negative "mixture" of strategies such that the
-    # packing matches the distribution of sequences lengths (histogram) as
-    # closely as possbile in the least squares sense
-    print(f"Sequences to pack: ", histogram.sum())
     start = time.time()
-    mixture, rnorm = optimize.nnls(np.expand_dims(w0, -1) * A, w0 * histogram)
-    print(f"Solving non-negative least squares took {time.time() - start:3.2f} seconds.")
+    if packing_solver == "lp":
+        # Minimise the number of packs (equivalently the number of padding tokens)
+        # such that every sequence is covered: min sum(mixture) s.t. A@mixture >= histogram.
+        # The packing matrix has at most max_sequences_per_pack non-zeros per column
+        # so it is passed to the solver as a sparse matrix.
+        A_sparse = sparse.csc_matrix(A)
+        # HiGHS ships with scipy 1.6, older versions have the sparse interior point method
+        if tuple(int(v) for v in scipy.__version__.split(".")[:2]) >= (1, 6):
+            method, options = "highs", None
+        else:
+            method, options = "interior-point", {"sparse": True}
+        result = optimize.linprog(np.ones(num_strategies), A_ub=-A_sparse, b_ub=-histogram,
+                                  bounds=(0, None), method=method, options=options)
+        assert result.success, f"Linear program for the packing mixture failed: {result.message}"
+        mixture = result.x
+        print(f"Solving sparse linear program took {time.time() - start:3.2f} seconds.")
+    else:
+        # To achieve more robust convergence of the packing problem we create
+        # weights that penalize the residual on short sequences less.
+        # In other words we allow short sequences (up to length padding_cutoff)
+        # to be over-used to a larger degree than longer sequences
+        padding_cutoff = 8
+        w0 = np.ones([args.sequence_length])
+        w0[:padding_cutoff] = padding_cutoff / (2 * args.sequence_length)
+        w0 = np.sqrt(w0)
+
+        # Solve the packing problem
+        # A@mixture = histogram
+        # i.e. find the non-negative "mixture" of strategies such that the
+        # packing matches the distribution of sequences lengths (histogram) as
+        # closely as possbile in the least squares sense
+        mixture, rnorm = optimize.nnls(np.expand_dims(w0, -1) * A, w0 * histogram)
+        print(f"Solving non-negative least squares took {time.time() - start:3.2f} seconds.")
 
     # Round the floating point solution to integer).
     # The relative error introduced by this is relatively small since we are
@@ -238,15 +321,83 @@ def get_packing_recipe(args, sequence_lengths, drop_unused_strategies=False):
 
     # Add padding based on deficit (negative residual)
     padding = np.where(residual < 0, -residual, 0)
+    return strategy_set, mixture, padding
+
+
+def get_packing_recipe(args, sequence_lengths, drop_unused_strategies=False):
+    """Given program arguments and a list of sequence lengths return the packing recipe.
 
-    # End of solver, now printing out some properties of the packing mixture
-    samples_dropped = (residual + padding).sum().astype(np.int32)
+    A "packing recipe" primarily consists of a set of strategies "strategy_set" and the "mixture"
+    which states how many times each one of these strategies should be applied in order to pack
+    the dataset. Additionally, we also return the "padding" vector which states how many sequences
+    of a given sequence length need to be added to our dataset in order use the proposed mixture
+    of strategies.
+
+    Parameters
+    ----------
+    args:namedtuple containing the following attributes
+        sequence_length:int
+            The maximum sequence length to which the sequences will be packed. Used to generate the
+            appropriate packing strategies.
+        max_sequences_per_pack:int
+            The maximum number of sequences that can ever be put into a pack. Used to generate the
+            appropriate packing strategies.
+        drop_unpacked_remainder:bool
+            Whether to drop the sequences that could not be packed (usually a very small percentage)
+            If false, then the unpacked sequences will be padded instead.
+        packing_solver:str (optional)
+            Either "nnls" (default), "lp" or "spfhp". The "nnls" and "lp" solvers enumerate all
+            strategies which fill a pack exactly, which becomes intractable beyond 3 sequences per
+            pack at long sequence lengths. The "spfhp" heuristic only works on the histogram
+            and runs in seconds for any max_sequences_per_pack.
+    sequence_lengths:list[int]
+        A list containing the sequence length of each example in the un-packed dataset.
+    drop_unused_strategies:bool
+        If True, filter out strategies that are to be used 0 times according to the mixture.
+    Returns
+    -------
+    strategy_set:list[list[int]]
+        The list of unique packing strategies with which the packing problem
+        was solved.
+    mixture:list[int] of shape [len(strategy_set)]
+        States how many times each of the strategies from the strategy set
+        should be repeated to cover the entire dataset.
+    padding:list[int] of shape [sequence_length]
+        For each sequence length how many padding sequence of that length
+        need to be created to realize the packing mixture.
+    """
+
+    print("Entering packing solver".center(80, "_"))
+
+    # Histogram of sequence lengths
+    histogram, bins = np.histogram(sequence_lengths, bins=np.arange(1, args.sequence_length + 2))
+    print(f"Sequences to pack: ", histogram.sum())
+
+    packing_solver = getattr(args, "packing_solver", "nnls")
+    if packing_solver == "spfhp":
+        start = time.time()
+        strategy_set, mixture = pack_using_spfhp(histogram, args.sequence_length, args.max_sequences_per_pack)
+        padding = np.zeros(args.sequence_length)
+        print(f"Shortest-pack-first histogram-packing took {time.time() - start:3.2f} seconds.")
+    elif packing_solver in ("nnls", "lp"):
+        strategy_set, mixture, padding = solve_packing_mixture(args, histogram, packing_solver)
+    else:
+        raise ValueError(f"Unknown packing solver '{packing_solver}'.")
+
+    # End of solver, now printing out some properties of the packing mixture.
+    # Packs need not be completely filled by their strategy (e.g. with "spfhp"),
+    # so padding is counted as the tokens in the packs not used by real sequences.
+    strategy_tokens = np.array([sum(strategy) for strategy in strategy_set])
+    strategy_sequences = np.array([len(strategy) for strategy in strategy_set])
     new_number_of_samples = int(mixture.sum())
+    num_real_tokens_packed = (strategy_tokens * mixture).sum() - (np.arange(1, args.sequence_length + 1) * padding).sum()
+    num_sequences_packed = (strategy_sequences * mixture).sum() - padding.sum()
+    samples_dropped = int(len(sequence_lengths) - num_sequences_packed)
     compression = 1 - new_number_of_samples / (len(sequence_lengths) - samples_dropped)
     num_padding_tokens_original = (args.sequence_length - sequence_lengths).sum()
-    num_padding_tokens_packed = (np.arange(1, args.sequence_length + 1) * padding).sum()
+    num_padding_tokens_packed = new_number_of_samples * args.sequence_length - num_real_tokens_packed
     speedup_upper_bound = 1.0 / (1 - ((1 - sequence_lengths / args.sequence_length).mean()))
-    avg_sequences_per_sample = ((A.sum(0) * mixture).sum() - padding.sum()) / new_number_of_samples
+    avg_sequences_per_sample = num_sequences_packed / new_number_of_samples
     efficiency = 1 - num_padding_tokens_packed/(new_number_of_samples*args.sequence_length)
     print(f"Done solving for packing mixture".center(80, "_"),
           f"Packing efficiency (fraction of real tokens): {efficiency:3.4f}",
@@ -501,89 +652,192 @@ def create_int_feature(values):
     return feature
 
 
-def get_dataloader(config, opts):
-    dataset = TFRecordPretrainingDataset(config.input_files)
-    loader = DataLoader(opts,
-                        dataset,
-                        batch_size=config.micro_batch_size,
-                        num_workers=config.dataloader_workers,
-                        drop_last=False,
-                        worker_init_fn=_WorkerInit(config.random_seed),
-                        mode=DataLoaderMode.AsyncRebatched if config.async_dataloader else DataLoaderMode.Sync)
-    return loader
+# Set the maximum number of sequences to write per output file.
+SEQUENCES_PER_FILE = 1000000
+PACKS_PER_FILE = SEQUENCES_PER_FILE // 2
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--input-files", help="A glob expression for the input files to read in and pack", required=True, type=str)
-    parser.add_argument("--output-dir", help="The destination folder for the output files", required=True)
-    parser.add_argument("--random-seed", help="For shuffling the data", default=12345)
-    parser.add_argument("--drop-unpacked-remainder", help="Whether to drop sequences that failed to pack", default=False, type=eval)
-    parser.add_argument("--unpacked-dataset-duplication-factor",
-                        help="The duplication factor with which create_pretraining_data.py was run to create the un-packed dataset. " +
-                        "The output dataset will always have duplication factor 1", default=1, type=int)
-    parser.add_argument("--sequence-length", help="The maximum number of tokens in an example", default=128, type=int)
-    parser.add_argument("--mask-tokens", help="The maximum number of masked tokens in an un-packed example", default=20, type=int)
-    parser.add_argument("--max-sequences-per-pack", help="The maximum number of sequences per packed example.", choices=[2, 3], default=3, type=int)
-    parser.add_argument("--load-batch-size", help="The number of sequences to load at a time, set it to 1 to avoid"
-                        " dropping any sequences when loading the dataset (for eval)", default=1, type=int)
-    parser.add_argument("--num-packing-workers", help="Max number of worker subprocesses to be used for packing sequences", default=16, type=int)
-    parser.add_argument("--chunks-per-packing-worker", help="Approximate number of chunks to be packed by each packing subprocess", default=8, type=int)
-    args = parser.parse_args()
-    random.seed(args.random_seed)
+def write_packs(output_dir, file_index, packs):
+    """Write the usable packs out to the file_index-th TFRecord file, return the number of packs."""
+    filename = os.path.join(output_dir, f"wiki_{file_index:03d}.tfrecord")
+    writer = tf.io.TFRecordWriter(filename)
+    for tf_example, is_usable in packs:
+        if is_usable:
+            writer.write(tf_example)
+    writer.close()
+    print(f"\nWrote {len(packs)} packs into {filename}.")
+    print("\nMemory usage:")
+    print(psutil.virtual_memory())
+    return len(packs)
 
-    # Input files
-    input_files = glob.glob(args.input_files)
-    assert len(input_files) > 0
-    print(f"\nInput files: {input_files}")
 
-    # Load un-packed dataset (1 sequence per pack)
-    # We borrow the config for pretrain_base_128 here
-    data_args = """
-    --config pretrain_base_128
-    """.split()
-    config = BertConfig(**(vars(parse_bert_args(data_args))))
-    config.input_files = input_files
-    config.compile_only = True
-    opts = get_options(config)
-    dataset = get_dataloader(config, opts)
+class LengthBuckets:
+    """On-disk storage of un-packed examples, grouped by sequence length.
 
-    # Put examples into bins depending on their sequence lengths and extract the sequence length
-    # as an array.
-    sequence_lengths = []
-    print("Looping through dataset to collect sequence length information...")
-    start = time.time()
-    for data in tqdm(dataset):
-        # Use data[1] because data[0] could contain false "0"s
-        real_tokens = (data[1] != 0).sum(1).tolist()
-        sequence_lengths.extend(real_tokens)
+    Every sequence length gets its own memory-mapped ".npy" file of shape
+    [num_examples, record_width] where each row is one example laid out as
 
-    print(f"Done looping through dataset. Took {time.time() - start:3.3f} seconds to read {len(sequence_lengths)} sequences")
+        input_ids[:length] | segment_ids[:length] | masked_lm_positions | masked_lm_ids | next_sentence_label
 
-    # Use the strategy_set and mixture to pack the dataset
-    print(f"\nPacked dataset will be written to {args.output_dir}.")
-    if not os.path.exists(args.output_dir):
-        os.mkdir(args.output_dir)
+    The input mask is not stored since it is all ones over the first "length"
+    tokens. Because the number of examples per length is known from the
+    histogram of the first pass, the files can be pre-allocated and filled in a
+    single streaming pass over the dataset, after which packing workers read
+    examples by (length, row) without the whole dataset ever being held in RAM.
 
-    start = time.time()
+    Parameters
+    ----------
+    directory:str
+        Folder in which the bucket files are stored.
+    mask_tokens:int
+        The maximum number of masked lm predictions in each unpacked sequence.
+    """
+    def __init__(self, directory, mask_tokens):
+        self.directory = directory
+        self.mask_tokens = mask_tokens
+        self.buckets = {}
+        self.cursors = {}
+
+    def bucket_path(self, length):
+        return os.path.join(self.directory, f"length_{length:04d}.npy")
+
+    def record_width(self, length):
+        return 2 * length + 2 * self.mask_tokens + 1
+
+    def allocate(self, histogram):
+        """Pre-allocate one bucket file per sequence length with a non-zero count."""
+        os.makedirs(self.directory, exist_ok=True)
+        for length, count in enumerate(histogram, start=1):
+            if count > 0:
+                self.buckets[length] = np.lib.format.open_memmap(
+                    self.bucket_path(length), mode="w+", dtype=np.int32,
+                    shape=(int(count), self.record_width(length)))
+                self.cursors[length] = 0
+
+    def append(self, length, input_ids, segment_ids, masked_lm_positions, masked_lm_ids, next_sentence_labels):
+        """Write a batch of examples, all of the same sequence length, to the bucket."""
+        start = self.cursors[length]
+        end = start + len(input_ids)
+        if end > len(self.buckets[length]):
+            raise RuntimeError(f"More examples of length {length} than counted in the first pass. "
+                               "The dataset must yield the same examples in both passes.")
+        bucket = self.buckets[length]
+        bucket[start:end, :length] = input_ids[:, :length]
+        bucket[start:end, length:2 * length] = segment_ids[:, :length]
+        bucket[start:end, 2 * length:2 * length + self.mask_tokens] = masked_lm_positions
+        bucket[start:end, 2 * length + self.mask_tokens:-1] = masked_lm_ids
+        bucket[start:end, -1] = np.reshape(next_sentence_labels, [-1])
+        self.cursors[length] = end
+
+    def close(self):
+        """Flush all buckets to disk and check that they were completely filled."""
+        for length, bucket in self.buckets.items():
+            assert self.cursors[length] == len(bucket), \
+                f"Bucket for length {length} was only partially filled ({self.cursors[length]}/{len(bucket)})."
+            bucket.flush()
+        self.buckets = {}
+
+    def get_sequence(self, length, row):
+        """Read one example back in the format expected by create_multi_sequence_example."""
+        record = _open_bucket(self.bucket_path(length))[row]
+        input_ids = record[:length]
+        input_mask = np.ones(length, dtype=np.int32)
+        segment_ids = record[length:2 * length]
+        masked_lm_positions = record[2 * length:2 * length + self.mask_tokens]
+        masked_lm_ids = record[2 * length + self.mask_tokens:-1]
+        next_sentence_labels = record[-1]
+        return input_ids, input_mask, segment_ids, masked_lm_positions, masked_lm_ids, next_sentence_labels
 
-    # Convert seq len info to np array
-    sequence_lengths = np.array(sequence_lengths)
-    assert len(sequence_lengths) > 1
-    assert max(sequence_lengths) <= args.sequence_length
 
-    # Run the packing algorithm on these sequence lengths
-    strategy_set, mixture, padding = get_packing_recipe(args, sequence_lengths, drop_unused_strategies=True)
-    target_num_sequences = int(mixture.sum())
+@lru_cache(maxsize=None)
+def _open_bucket(path):
+    # Each packing worker maps every bucket file at most once
+    return np.load(path, mmap_mode="r")
+
+
+def slice_bucket_rows(rows_by_length, strategy_set, mixture, max_sequences_per_pack):
+    """Assign bucket rows to strategies in order to fulfill the mixture.
+
+    This is the equivalent of slice_examples for the streaming mode, except that
+    rather than examples, it hands out indices into the LengthBuckets.
+
+    Parameters
+    ----------
+    rows_by_length:dict
+        A dictionary mapping from sequence_length to a (shuffled) np.array of rows
+        in the bucket of that length. Padding sequences are denoted by row -1.
+    strategy_set:list[list[int]]
+        The list of unique packing strategies with which the packing problem
+        was solved.
+    mixture:list[int] of shape [len(strategy_set)]
+        States how many times each of the strategies from the strategy set
+        should be repeated to cover the entire dataset.
+    max_sequences_per_pack:int
+        The maximum number of sequences that a pack may contain.
+
+    Returns
+    -------
+    pack_lengths:np.array of shape [num_packs, max_sequences_per_pack]
+        The sequence length of each component in each pack, 0 for unused slots.
+    pack_rows:np.array of shape [num_packs, max_sequences_per_pack]
+        The bucket row of each component in each pack, -1 for padding sequences.
+    new_mixture:list[int] of shape [len(strategy_set)]
+        States how many times each of the strategies from the strategy set
+        should still be repeated to cover the entire dataset.
+    """
+    cursors = defaultdict(int)
+    num_packs = 0
+    feasible_repeat_counts = []
+    for strategy, target_repeat_count in zip(strategy_set, mixture):
+        feasible_repeat_count = target_repeat_count
+        for k in set(strategy):
+            available = len(rows_by_length[k]) - cursors[k]
+            feasible_repeat_count = min(feasible_repeat_count, available // strategy.count(k))
+        for k in strategy:
+            cursors[k] += feasible_repeat_count
+        feasible_repeat_counts.append(feasible_repeat_count)
+        num_packs += feasible_repeat_count
+
+    pack_lengths = np.zeros([num_packs, max_sequences_per_pack], dtype=np.int16)
+    pack_rows = np.full([num_packs, max_sequences_per_pack], -1, dtype=np.int32)
+    cursors = defaultdict(int)
+    offset = 0
+    for i, (strategy, feasible_repeat_count) in enumerate(zip(strategy_set, feasible_repeat_counts)):
+        if feasible_repeat_count == 0:
+            continue
+        packs = slice(offset, offset + feasible_repeat_count)
+        for j, seq_len in enumerate(strategy):
+            pack_lengths[packs, j] = seq_len
+            pack_rows[packs, j] = rows_by_length[seq_len][cursors[seq_len]:cursors[seq_len] + feasible_repeat_count]
+            cursors[seq_len] += feasible_repeat_count
+        offset += feasible_repeat_count
+        mixture[i] -= feasible_repeat_count
+    return pack_lengths, pack_rows, mixture
+
+
+def create_multi_sequence_examples_from_buckets(bucket_dir, mask_tokens, sequence_length, max_sequences_per_pack,
+                                                pack_lengths, pack_rows):
+    """Packing worker task of the streaming mode: read a chunk of packs from the buckets and combine them."""
+    buckets = LengthBuckets(bucket_dir, mask_tokens)
+    results = []
+    for lengths, rows in zip(pack_lengths, pack_rows):
+        multi_sequence = [None if row < 0 else buckets.get_sequence(int(length), int(row))
+                          for length, row in zip(lengths, rows) if length > 0]
+        results.append(create_multi_sequence_example(multi_sequence, mask_tokens, sequence_length, max_sequences_per_pack))
+    return results
+
+
+def pack_in_memory(args, dataset, sequence_lengths, strategy_set, mixture, padding):
+    """Pack the dataset by loading all examples into RAM, binned by sequence length.
+
+    Returns the remaining mixture (all zeros if the packing was completed) and
+    the number of packs written.
+    """
     examples_by_length = defaultdict(list)
     print("Adding padding sequence to pack the remainder of sequences.")
     for i in range(1, args.sequence_length + 1):
         examples_by_length[i].extend([None] * int(padding[i - 1]))
 
-    # Set the maximum number of sequences to write per output file.
-    SEQUENCES_PER_FILE = 1000000
-    PACKS_PER_FILE = SEQUENCES_PER_FILE // 2
-
     file_index = 0
     count = 0
     count_at_last_slice = 0
@@ -632,23 +886,178 @@ if __name__ == "__main__":
             packs_to_write, packs_buffer = packs_buffer[:PACKS_PER_FILE], packs_buffer[PACKS_PER_FILE:]
             force_write = force_write and len(packs_buffer) > 0
 
-            filename = os.path.join(args.output_dir, f"wiki_{file_index:03d}.tfrecord")
-            write_start = time.time()
-            writer = tf.io.TFRecordWriter(filename)
-            for tf_example, is_usable in packs_to_write:
-                if is_usable:
-                    writer.write(tf_example)
-            writer.close()
+            write_count += write_packs(args.output_dir, file_index, packs_to_write)
             file_index += 1
-            num_packs_written = len(packs_to_write)
-            write_count += num_packs_written
             del packs_to_write
-            print(f"\nWrote {num_packs_written} packs into {filename}.")
-            print("\nMemory usage:")
-            print(psutil.virtual_memory())
 
     assert len(packs_futures) == 0
     packing_executor.shutdown(wait=True)
+    return mixture, write_count
+
+
+def pack_using_length_buckets(args, dataset, sequence_lengths, strategy_set, mixture, padding):
+    """Pack the dataset with bounded memory by spilling examples into on-disk LengthBuckets.
+
+    The examples are streamed from the dataset a second time and written into
+    pre-allocated per-length bucket files. The packs are then described purely
+    by (length, row) indices which are shuffled and handed out in chunks to the
+    packing workers, which read the examples straight from the memory-mapped
+    buckets. Only these indices and a bounded number of in-flight chunks of
+    packs are ever held in RAM.
+
+    Returns the remaining mixture (all zeros if the packing was completed) and
+    the number of packs written.
+    """
+    spill_dir = args.spill_dir or os.path.join(args.output_dir, "length_buckets")
+    histogram = np.bincount(sequence_lengths, minlength=args.sequence_length + 1)[1:]
+    buckets = LengthBuckets(spill_dir, args.mask_tokens)
+    buckets.allocate(histogram)
+
+    print(f"Spilling examples into length buckets in {spill_dir}.")
+    for data in tqdm(dataset):
+        data_as_arrays = [d.detach().numpy() for d in data]
+        input_ids, input_mask, segment_ids, masked_lm_positions, masked_lm_ids, next_sentence_labels = data_as_arrays
+        # Use input_mask because input_ids could contain false "0"s
+        real_tokens = np.sum(input_mask != 0, axis=1)
+        for length in np.unique(real_tokens):
+            idx = np.nonzero(real_tokens == length)[0]
+            buckets.append(int(length), input_ids[idx], segment_ids[idx], masked_lm_positions[idx],
+                           masked_lm_ids[idx], next_sentence_labels[idx])
+    buckets.close()
+
+    # Shuffle the rows of each bucket, together with the padding sequences (row -1)
+    rng = np.random.default_rng(int(args.random_seed))
+    rows_by_length = {}
+    for length in range(1, args.sequence_length + 1):
+        rows = np.concatenate([np.arange(histogram[length - 1], dtype=np.int32),
+                               np.full(int(padding[length - 1]), -1, dtype=np.int32)])
+        rows_by_length[length] = rng.permutation(rows)
+    pack_lengths, pack_rows, mixture = slice_bucket_rows(rows_by_length, strategy_set, mixture, args.max_sequences_per_pack)
+    del rows_by_length
+
+    # Shuffle the packs to make the distribution of lengths across workers and files more uniform
+    order = rng.permutation(len(pack_lengths))
+    chunksize = max(1, PACKS_PER_FILE // (args.num_packing_workers * args.chunks_per_packing_worker))
+    task = partial(create_multi_sequence_examples_from_buckets, spill_dir, args.mask_tokens,
+                   args.sequence_length, args.max_sequences_per_pack)
+
+    file_index = 0
+    write_count = 0
+    packs_buffer = []
+    max_in_flight = 2 * args.num_packing_workers
+    print("Begin packing and writing.")
+    with ProcessPoolExecutor(max_workers=args.num_packing_workers) as packing_executor:
+        pending = set()
+        chunk_starts = iter(range(0, len(order), chunksize))
+        progress = tqdm(total=len(order))
+        while True:
+            for chunk_start in islice(chunk_starts, max_in_flight - len(pending)):
+                chunk = np.sort(order[chunk_start:chunk_start + chunksize])
+                pending.add(packing_executor.submit(task, pack_lengths[chunk], pack_rows[chunk]))
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                packs = future.result()
+                progress.update(len(packs))
+                packs_buffer.extend(packs)
+            while len(packs_buffer) >= PACKS_PER_FILE:
+                write_count += write_packs(args.output_dir, file_index, packs_buffer[:PACKS_PER_FILE])
+                packs_buffer = packs_buffer[PACKS_PER_FILE:]
+                file_index += 1
+        progress.close()
+    if len(packs_buffer) > 0:
+        write_count += write_packs(args.output_dir, file_index, packs_buffer)
+
+    if not args.keep_spill_dir:
+        shutil.rmtree(spill_dir)
+    return mixture, write_count
+
+
+def get_dataloader(config, opts):
+    dataset = TFRecordPretrainingDataset(config.input_files)
+    loader = DataLoader(opts,
+                        dataset,
+                        batch_size=config.micro_batch_size,
+                        num_workers=config.dataloader_workers,
+                        drop_last=False,
+                        worker_init_fn=_WorkerInit(config.random_seed),
+                        mode=DataLoaderMode.AsyncRebatched if config.async_dataloader else DataLoaderMode.Sync)
+    return loader
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input-files", help="A glob expression for the input files to read in and pack", required=True, type=str)
+    parser.add_argument("--output-dir", help="The destination folder for the output files", required=True)
+    parser.add_argument("--random-seed", help="For shuffling the data", default=12345)
+    parser.add_argument("--drop-unpacked-remainder", help="Whether to drop sequences that failed to pack", default=False, type=eval)
+    parser.add_argument("--unpacked-dataset-duplication-factor",
+                        help="The duplication factor with which create_pretraining_data.py was run to create the un-packed dataset. " +
+                        "The output dataset will always have duplication factor 1", default=1, type=int)
+    parser.add_argument("--sequence-length", help="The maximum number of tokens in an example", default=128, type=int)
+    parser.add_argument("--mask-tokens", help="The maximum number of masked tokens in an un-packed example", default=20, type=int)
+    parser.add_argument("--max-sequences-per-pack", help="The maximum number of sequences per packed example. More than 3 is only "
+                        "tractable with --packing-solver spfhp", default=3, type=int)
+    parser.add_argument("--packing-solver", help="The algorithm used to find the packing strategies: non-negative least squares "
+                        "or a sparse linear program over all strategies, or the shortest-pack-first histogram-packing heuristic",
+                        choices=["nnls", "lp", "spfhp"], default="nnls", type=str)
+    parser.add_argument("--load-batch-size", help="The number of sequences to load at a time, set it to 1 to avoid"
+                        " dropping any sequences when loading the dataset (for eval)", default=1, type=int)
+    parser.add_argument("--num-packing-workers", help="Max number of worker subprocesses to be used for packing sequences", default=16, type=int)
+    parser.add_argument("--chunks-per-packing-worker", help="Approximate number of chunks to be packed by each packing subprocess", default=8, type=int)
+    parser.add_argument("--streaming", help="Spill the examples into on-disk buckets per sequence length instead of holding them in RAM,"
+                        " so that memory usage does not grow with the size of the dataset", default=False, type=eval)
+    parser.add_argument("--spill-dir", help="Folder for the length buckets in streaming mode (defaults to <output-dir>/length_buckets)", default=None)
+    parser.add_argument("--keep-spill-dir", help="Do not delete the length buckets after streaming packing", default=False, type=eval)
+    args = parser.parse_args()
+    random.seed(args.random_seed)
+
+    # Input files
+    input_files = glob.glob(args.input_files)
+    assert len(input_files) > 0
+    print(f"\nInput files: {input_files}")
+
+    # Load un-packed dataset (1 sequence per pack)
+    # We borrow the config for pretrain_base_128 here
+    data_args = """
+    --config pretrain_base_128
+    """.split()
+    config = BertConfig(**(vars(parse_bert_args(data_args))))
+    config.input_files = input_files
+    config.compile_only = True
+    opts = get_options(config)
+    dataset = get_dataloader(config, opts)
+
+    # Extract the sequence length of every example as an array.
+    sequence_lengths = []
+    print("Looping through dataset to collect sequence length information...")
+    start = time.time()
+    for data in tqdm(dataset):
+        # Use data[1] because data[0] could contain false "0"s
+        real_tokens = (data[1] != 0).sum(1).numpy().astype(np.int32)
+        sequence_lengths.append(real_tokens)
+    sequence_lengths = np.concatenate(sequence_lengths)
+
+    print(f"Done looping through dataset. Took {time.time() - start:3.3f} seconds to read {len(sequence_lengths)} sequences")
+
+    # Use the strategy_set and mixture to pack the dataset
+    print(f"\nPacked dataset will be written to {args.output_dir}.")
+    if not os.path.exists(args.output_dir):
+        os.mkdir(args.output_dir)
+
+    start = time.time()
+
+    assert len(sequence_lengths) > 1
+    assert max(sequence_lengths) <= args.sequence_length
+
+    # Run the packing algorithm on these sequence lengths
+    strategy_set, mixture, padding = get_packing_recipe(args, sequence_lengths, drop_unused_strategies=True)
+    target_num_sequences = int(mixture.sum())
+    if args.streaming:
+        mixture, write_count = pack_using_length_buckets(args, dataset, sequence_lengths, strategy_set, mixture, padding)
+    else:
+        mixture, write_count = pack_in_memory(args, dataset, sequence_lengths, strategy_set, mixture, padding)
 
     print(f"\n-----------------------------------------------------------")
     print(f"Packing took: {time.time() - start:3.2f} seconds.",
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Convert TFRecord pretraining data into the columnar format of MemmapPretrainingDataset.
+
+Every TFRecord key is written to its own "<key>.npy" array of shape
+[num_samples, feature_width] in the output folder. Integer features are
+stored as int32 and float features as float32.
+"""
+
+import os
+import glob
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from tfrecord.reader import tfrecord_loader
+from pretraining_data import TFRECORD_KEYS, TFRECORD_KEYS_PACKED
+
+
+def samples_per_file(filename):
+    index_filename = filename.replace(".tfrecord", ".index")
+    return sum(1 for _ in open(index_filename))
+
+
+def storage_dtype(value):
+    return np.int32 if np.issubdtype(value.dtype, np.integer) else np.float32
+
+
+def convert_file(filename, output_dir, keys, offset):
+    """Write the samples of one TFRecord file into rows [offset, offset + samples) of the arrays."""
+    columns = [np.load(os.path.join(output_dir, f"{key}.npy"), mmap_mode="r+") for key in keys]
+    row = offset
+    # Without an index file the records are read sequentially from the start of the file
+    for datum in tfrecord_loader(filename, None, list(keys)):
+        for key, column in zip(keys, columns):
+            column[row] = datum[key]
+        row += 1
+    for column in columns:
+        column.flush()
+    return row - offset
+
+
+def convert(input_files, output_dir, keys, num_workers):
+    os.makedirs(output_dir, exist_ok=True)
+    counts = [samples_per_file(filename) for filename in input_files]
+    offsets = np.cumsum([0] + counts)
+    num_samples = int(offsets[-1])
+    print(f"Converting {num_samples} samples from {len(input_files)} files to {output_dir}")
+
+    # Allocate the arrays with the widths and types of the first sample
+    first = next(iter(tfrecord_loader(input_files[0], None, list(keys))))
+    for key in keys:
+        np.lib.format.open_memmap(os.path.join(output_dir, f"{key}.npy"), mode="w+",
+                                  dtype=storage_dtype(first[key]), shape=(num_samples, len(first[key])))
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(convert_file, filename, output_dir, keys, int(offset))
+                   for filename, offset in zip(input_files, offsets)]
+        for filename, count, future in zip(input_files, counts, futures):
+            assert future.result() == count, f"Unexpected number of samples in {filename}"
+    print("Done.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input-files", help="A glob expression for the indexed TFRecord files to convert", required=True, type=str)
+    parser.add_argument("--output-dir", help="The destination folder for the converted arrays", required=True)
+    parser.add_argument("--packed-data", help="Whether the input files contain packed data", default=False, type=eval)
+    parser.add_argument("--num-workers", help="Number of files converted in parallel", default=16, type=int)
+    args = parser.parse_args()
+
+    input_files = sorted(glob.glob(args.input_files))
+    assert len(input_files) > 0, f"No files matching {args.input_files}"
+    convert(input_files, args.output_dir, TFRECORD_KEYS_PACKED if args.packed_data else TFRECORD_KEYS, args.num_workers)
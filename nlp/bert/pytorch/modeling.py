@@ -34,8 +34,7 @@ class OnehotGather(nn.Module):
         Gather the vectors at the specific positions over a batch.
         """
         num_classes = int(sequence.shape[1])
-        one_hot_positions = F.one_hot(positions, num_classes)
-        one_hot_positions = F.one_hot(positions, num_classes).to(dtype=sequence.dtype)
+        one_hot_positions = F.one_hot(positions.long(), num_classes).to(dtype=sequence.dtype)
         return torch.matmul(one_hot_positions.detach(), sequence)
 
 
@@ -225,9 +224,9 @@ class PipelinedBertForPretraining(transformers.BertForPreTraining):
         if masked_lm_labels is not None and next_sentence_label is not None:
             masked_lm_loss = F.cross_entropy(
                 prediction_scores.view(-1, self.config.vocab_size),
-                masked_lm_labels.view(-1),
+                masked_lm_labels.view(-1).long(),
                 ignore_index=0).float()
-            next_sentence_loss = F.cross_entropy(sequential_relationship_score.view(-1, 2), next_sentence_label.view(-1)).float()
+            next_sentence_loss = F.cross_entropy(sequential_relationship_score.view(-1, 2), next_sentence_label.view(-1).long()).float()
             total_loss = poptorch.identity_loss(masked_lm_loss + next_sentence_loss, reduction="none")
 
             next_sentence_acc = accuracy(sequential_relationship_score.view([-1, 2]), next_sentence_label.view(-1))
@@ -268,9 +267,9 @@ class PipelinedPackedBertForPretraining(PipelinedBertForPretraining):
         if packed_masked_lm_ids is not None and packed_next_sentence_labels is not None:
             masked_lm_loss = F.cross_entropy(
                 prediction_scores.view(-1, self.config.vocab_size),
-                packed_masked_lm_ids.view(-1),
+                packed_masked_lm_ids.view(-1).long(),
                 ignore_index=0).float()
-            next_sentence_loss = F.cross_entropy(seq_relationship_scores.transpose(1, 2), packed_next_sentence_labels, reduction='none').float()
+            next_sentence_loss = F.cross_entropy(seq_relationship_scores.transpose(1, 2), packed_next_sentence_labels.long(), reduction='none').float()
             next_sentence_loss *= packed_next_sentence_mask
             next_sentence_loss = next_sentence_loss.sum() / packed_next_sentence_mask.sum()
             total_loss = poptorch.identity_loss(masked_lm_loss + next_sentence_loss, reduction="none")
@@ -15,6 +15,7 @@
 import glob
 import multiprocessing
 import os
+import struct
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 import numpy as np
 import torch
@@ -23,7 +24,9 @@ from poptorch import DataLoader
 from poptorch.enums import DataLoaderMode
 import popdist
 from transformers import BertTokenizerFast
-from tfrecord.reader import tfrecord_loader
+from tfrecord import example_pb2
+from tfrecord.reader import extract_feature_dict
+from tfrecord_manifest import TFRecordManifest
 
 
 TFRECORD_KEYS = (           # Torch Model Keys
@@ -47,6 +50,9 @@ TFRECORD_KEYS_PACKED = (
     'packed_next_sentence_mask'  # : 1 if sequence is present in pack, 0 if not
 )
 
+# Decoding of the TFRecord features, as in tfrecord.reader.example_loader
+TFRECORD_TYPENAME_MAPPING = {"byte": "bytes_list", "float": "float_list", "int": "int64_list"}
+
 
 def expand_glob_files(files):
     result = []
@@ -77,36 +83,94 @@ class TFRecordPretrainingDataset(IterableDataset):
     more workers could support high throughput, and secondly, more workers could
     give us more stochasticity and thus better convergence.
 
+    The order of the files read by each worker is a permutation seeded by
+    (seed, epoch, shard), so the stream of samples of every worker is fully
+    determined by the epoch. This allows `set_position` to resume in the middle
+    of an epoch by seeking each worker directly to its next record, rather
+    than decoding all the samples consumed before the checkpoint.
 
     Parameters
     ----------
     files: List of TFRecord files containing the preprocessed pretraining data
     shuffle: Shuffle the data?
     packed_data: Use packed data?
+    seed: Seed of the permutation of the files at every epoch
     """
     def __init__(self,
                  input_files,
                  shuffle=True,
-                 packed_data=False):
+                 packed_data=False,
+                 seed=0):
         self.files = expand_glob_files(input_files)
         self.shuffle = shuffle
+        self.seed = seed
         if packed_data:
             self.tfrecord_keys = TFRECORD_KEYS_PACKED
         else:
             self.tfrecord_keys = TFRECORD_KEYS
+        # (epoch, resume_samples, worker_batch_size) in shared memory, so that the
+        # DataLoader workers see the position set after they have been started,
+        # with persistent workers or in the asynchronous mode of poptorch
+        self.position = multiprocessing.RawArray('q', [0, 0, 1])
         self.reset()
 
+    @property
+    def epoch(self):
+        return self.position[0]
+
+    @property
+    def resume_samples(self):
+        return self.position[1]
+
+    @property
+    def worker_batch_size(self):
+        return self.position[2]
+
     def reset(self):
         self.file_index = 0
+        self.start_record = 0
         self.reader = iter([])
 
-    def samples_per_file(self, filename):
+    def set_epoch(self, epoch):
+        """Set the epoch of the next iteration, which determines the order of the files."""
+        self.position[0] = epoch
+        self.position[1] = 0
+
+    def set_position(self, epoch, samples, worker_batch_size):
+        """
+        Resume the next iteration after `samples` samples of `epoch` have been consumed.
+
+        The DataLoader takes batches of `worker_batch_size` samples from its
+        workers in turn, so the number of samples consumed from each worker
+        can be computed from the total without replaying the data.
+        """
+        self.position[:] = [epoch, samples, worker_batch_size]
+
+    @staticmethod
+    def samples_per_file(filename):
         index_filename = filename.replace(".tfrecord", ".index")
         count = sum(1 for _ in open(index_filename))
         return count
 
+    def manifest(self):
+        if not hasattr(self, "_manifest"):
+            self._manifest = TFRecordManifest.load(self.files)
+        return self._manifest
+
+    def record_offsets(self, filename):
+        manifest = self.manifest()
+        if manifest is not None:
+            return manifest.offsets[filename]
+        return np.loadtxt(filename.replace(".tfrecord", ".index"), dtype=np.int64, ndmin=2)[:, 0]
+
     def __len__(self):
         if getattr(self, "_len", None) is None:
+            # Use the manifest written at preprocessing time if it is up to date,
+            # otherwise count the lines of every index file
+            manifest = self.manifest()
+            if manifest is not None:
+                self._len = len(manifest)
+                return self._len
             pool = multiprocessing.Pool(
                 min(multiprocessing.cpu_count(), len(self.files)))
             num_samples = pool.map(self.samples_per_file, self.files)
@@ -117,36 +181,142 @@ class TFRecordPretrainingDataset(IterableDataset):
 
     def __iter__(self):
         worker_info = torch.utils.data.get_worker_info()
-        if worker_info is not None:
-            if popdist.isPopdistEnvSet():
-                self.worker_id = worker_info.id + worker_info.num_workers * popdist.getInstanceIndex()
-                self.shard = worker_info.id + worker_info.num_workers * popdist.getInstanceIndex(), worker_info.num_workers * popdist.getNumInstances()
-            else:
-                self.worker_id = worker_info.id
-                self.shard = worker_info.id, worker_info.num_workers
+        local_worker, local_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        worker_batches = 0
+        if self.resume_samples > 0:
+            # The DataLoader always starts taking batches from its first worker, so the roles
+            # of the workers are rotated to continue from the worker whose turn it would have been
+            batches = self.resume_samples // self.worker_batch_size
+            local_worker = (local_worker + batches) % local_workers
+            worker_batches = max(0, (batches - local_worker + local_workers - 1) // local_workers)
+        if popdist.isPopdistEnvSet():
+            self.worker_id = local_worker + local_workers * popdist.getInstanceIndex()
+            self.shard = self.worker_id, local_workers * popdist.getNumInstances()
         else:
-            self.shard = None
+            self.worker_id = local_worker
+            self.shard = local_worker, local_workers
         self.reset()
+        self.epoch_files = list(self.files)
         if self.shuffle:
-            np.random.shuffle(self.files)
+            rng = np.random.default_rng([self.seed, self.epoch, self.worker_id])
+            self.epoch_files = [self.epoch_files[i] for i in rng.permutation(len(self.files))]
+        self.skip(worker_batches * self.worker_batch_size)
         return self
 
-    def __next__(self):
-        try:
-            datum = next(self.reader)
-        except StopIteration:
-            if self.file_index >= len(self.files):
-                raise StopIteration
-            self.reader = tfrecord_loader(self.files[self.file_index],
-                                          self.files[self.file_index].replace(".tfrecord", ".index"),
-                                          list(self.tfrecord_keys),
-                                          self.shard)
+    def shard_range(self, num_records):
+        shard_index, shard_count = self.shard
+        return (num_records * shard_index) // shard_count, (num_records * (shard_index + 1)) // shard_count
+
+    def skip(self, samples):
+        """Move the start of this worker's stream forward by `samples`, in O(number of files skipped)."""
+        manifest = self.manifest()
+        while samples > 0 and self.file_index < len(self.epoch_files):
+            filename = self.epoch_files[self.file_index]
+            num_records = manifest.num_samples(filename) if manifest is not None else self.samples_per_file(filename)
+            start, end = self.shard_range(num_records)
+            if samples < end - start:
+                self.start_record = samples
+                return
+            samples -= end - start
             self.file_index += 1
-            datum = next(self.reader)
+
+    def read_records(self, filename, start_record):
+        """Decode the records of this worker's shard of a file, starting at the given record of the shard."""
+        offsets = self.record_offsets(filename)
+        start, end = self.shard_range(len(offsets))
+        if start + start_record >= end:
+            return
+        start_byte = offsets[start + start_record]
+        end_byte = offsets[end] if end < len(offsets) else os.path.getsize(filename)
+        length_bytes = bytearray(8)
+        crc_bytes = bytearray(4)
+        with open(filename, "rb") as f:
+            f.seek(start_byte)
+            while f.tell() < end_byte:
+                f.readinto(length_bytes)
+                f.readinto(crc_bytes)
+                length, = struct.unpack("<Q", length_bytes)
+                record = f.read(length)
+                f.readinto(crc_bytes)
+                example = example_pb2.Example()
+                example.ParseFromString(record)
+                yield extract_feature_dict(example.features, list(self.tfrecord_keys), TFRECORD_TYPENAME_MAPPING)
+
+    def __next__(self):
+        while True:
+            try:
+                datum = next(self.reader)
+                break
+            except StopIteration:
+                if self.file_index >= len(self.epoch_files):
+                    raise StopIteration
+                self.reader = self.read_records(self.epoch_files[self.file_index], self.start_record)
+                self.file_index += 1
+                self.start_record = 0
         datum = [datum[key] for key in self.tfrecord_keys]
         return datum
 
 
+class MemmapPretrainingDataset(Dataset):
+    """
+    Preprocessed BERT pretraining dataset stored as fixed-width columnar numpy
+    arrays, one ".npy" file per TFRecord key, as written by data/tfrecord_to_memmap.py.
+
+    Unlike TFRecordPretrainingDataset, each item of this Dataset is a complete
+    batch of `batch_size` samples. Without shuffling a batch is a single slice of
+    each memory-mapped array, with shuffling it is a single gather over a
+    (seeded) permutation of the sample indices. The order of the batches is
+    shuffled by the DataLoader sampler at every epoch. When running with popdist,
+    each instance reads its own contiguous range of samples.
+
+    Parameters
+    ----------
+    input_dir: Folder containing the ".npy" file of each TFRecord key
+    batch_size: Number of samples in each item, typically the samples per step
+    shuffle: Shuffle the samples across batches?
+    packed_data: Use packed data?
+    seed: Seed of the permutation of the samples
+    """
+    def __init__(self,
+                 input_dir,
+                 batch_size,
+                 shuffle=True,
+                 packed_data=False,
+                 seed=42):
+        keys = TFRECORD_KEYS_PACKED if packed_data else TFRECORD_KEYS
+        # Copy-on-write mapping so that tensors can be created from the arrays without copies or warnings
+        self.columns = [np.load(os.path.join(input_dir, f"{key}.npy"), mmap_mode="c") for key in keys]
+        num_samples = len(self.columns[0])
+        if popdist.isPopdistEnvSet():
+            shard_index, num_shards = popdist.getInstanceIndex(), popdist.getNumInstances()
+        else:
+            shard_index, num_shards = 0, 1
+        self.start = num_samples * shard_index // num_shards
+        end = num_samples * (shard_index + 1) // num_shards
+        self.batch_size = batch_size
+        self.num_batches = (end - self.start) // batch_size
+        self.indices = None
+        if shuffle:
+            self.indices = self.start + np.random.default_rng(seed).permutation(end - self.start)
+
+    def __len__(self):
+        return self.num_batches
+
+    def __getitem__(self, index):
+        if index >= self.num_batches:
+            raise IndexError(f"Batch index {index} out of range for {self.num_batches} batches")
+        if self.indices is None:
+            start = self.start + index * self.batch_size
+            rows = slice(start, start + self.batch_size)
+        else:
+            # Sorting the gathered rows improves the locality of the reads
+            rows = np.sort(self.indices[index * self.batch_size:(index + 1) * self.batch_size])
+        # Integer features are stored as int32 to halve the size on disk, and are kept as int32:
+        # poptorch feeds integer inputs to the IPU as int32, and the model casts the indices it
+        # needs as long on device
+        return [torch.from_numpy(column[rows]) for column in self.columns]
+
+
 class GeneratedPretrainingDataset(Dataset):
     """
     Dataset that randomly generates mock BERT pretraining data.
@@ -237,7 +407,23 @@ def get_dataloader(config, opts):
                                               config.random_seed,
                                               packed_data=config.packed_data)
     elif config.dataset == 'pretraining':
-        dataset = TFRecordPretrainingDataset(config.input_files, packed_data=config.packed_data)
+        dataset = TFRecordPretrainingDataset(config.input_files, packed_data=config.packed_data, seed=config.random_seed)
+    elif config.dataset == 'memmap':
+        if len(config.input_files) != 1:
+            raise RuntimeError("The memmap dataset expects a single folder as input_files, aborting.")
+        dataset = MemmapPretrainingDataset(config.input_files[0],
+                                           config.samples_per_step,
+                                           packed_data=config.packed_data,
+                                           seed=config.random_seed)
+        # Items are already complete batches for one step, sharded over instances by the dataset
+        return DataLoader(opts,
+                          dataset,
+                          batch_size=None,
+                          shuffle=True,
+                          num_workers=config.dataloader_workers,
+                          worker_init_fn=_WorkerInit(config.random_seed),
+                          auto_distributed_partitioning=False,
+                          mode=DataLoaderMode.Async if config.async_dataloader else DataLoaderMode.Sync)
     else:
         raise RuntimeError(f"Unknown dataset '{config.dataset}', aborting.")
 
@@ -28,7 +28,7 @@ from modeling import PipelinedBertForPretraining, PipelinedPackedBertForPretrain
 from ipu_options import get_options
 from optimization import get_lr_scheduler, get_optimizer
 from checkpointing import save_checkpoint, checkpoints_exist
-from utils import get_sdk_version, cycle, logger, sync_metrics
+from utils import get_sdk_version, ResumableCycle, logger, sync_metrics
 from args import parse_bert_args
 
 
@@ -76,7 +76,7 @@ if __name__ == "__main__":
     start_loading = time.perf_counter()
     loader = get_dataloader(config, opts)
     steps_per_epoch = len(loader)
-    loader = cycle(loader)
+    loader = ResumableCycle(loader, config.samples_per_step)
     if steps_per_epoch < 1:
         raise RuntimeError("Not enough data in input_files for current configuration, "
                            "try reducing deviceIterations or gradientAccumulation.")
@@ -103,8 +103,11 @@ if __name__ == "__main__":
             checkpoint_metrics = training_state["metrics"]
             logger(f"---- Forwarding Data Loader until Checkpoint Step {steps_finished} ----")
             start_data_forward = time.perf_counter()
-            for step in range(steps_finished + 1):
-                next(loader)
+            if training_state.get("data_position") is not None:
+                loader.load_state_dict(training_state["data_position"])
+            else:
+                for step in range(steps_finished + 1):
+                    next(loader)
             duration_data_forward = time.perf_counter() - start_data_forward
             logger(f"Data loader forwarded in {duration_data_forward} secs")
             logger("-----------------------------------------------------------")
@@ -136,7 +139,7 @@ if __name__ == "__main__":
         sys.exit(0)
 
     # Checkpoint model at start of run
-    save_checkpoint(config, model, steps_finished, optimizer)
+    save_checkpoint(config, model, steps_finished, optimizer, data_position=loader.state_dict())
 
     # Training loop
     logger("--------------------- Training Started --------------------")
@@ -192,7 +195,8 @@ if __name__ == "__main__":
                 save_checkpoint(config, model, step, optimizer,
                                 metrics={"Loss": outputs_sync[0],
                                          "Acc/MLM": outputs_sync[3],
-                                         "Acc/NSP": outputs_sync[4]})
+                                         "Acc/NSP": outputs_sync[4]},
+                                data_position=loader.state_dict())
 
         if step + 1 == config.training_steps:
             break  # Training finished mid-epoch
@@ -202,7 +206,8 @@ if __name__ == "__main__":
         save_checkpoint(config, model, step, optimizer,
                         metrics={"Loss": outputs[0].mean().item(),
                                  "Acc/MLM": outputs[3].mean().item(),
-                                 "Acc/NSP": outputs[4].mean().item()})
+                                 "Acc/NSP": outputs[4].mean().item()},
+                        data_position=loader.state_dict())
     logger("-----------------------------------------------------------")
 
     logger("-------------------- Training Metrics ---------------------")
@@ -0,0 +1,59 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+from pathlib import Path
+import numpy as np
+import pytest
+import torch
+# Append bert directory
+bert_root_path = str(Path(__file__).parent.parent)
+sys.path.append(bert_root_path)
+
+from data.tfrecord_to_memmap import convert
+from pretraining_data import MemmapPretrainingDataset, TFRecordPretrainingDataset, TFRECORD_KEYS, TFRECORD_KEYS_PACKED
+
+data_dir = Path(bert_root_path) / "data"
+
+
+@pytest.mark.parametrize("packed_data", [False, True])
+def test_memmap_dataset_matches_tfrecord(tmp_path, packed_data):
+    if packed_data:
+        input_files = [str(data_dir / "packing" / "sample_text_packed.tfrecord")]
+        keys = TFRECORD_KEYS_PACKED
+    else:
+        input_files = [str(data_dir / "sample_text.tfrecord")]
+        keys = TFRECORD_KEYS
+    convert(input_files, str(tmp_path), keys, num_workers=1)
+
+    reference = list(TFRecordPretrainingDataset(input_files, shuffle=False, packed_data=packed_data))
+    batch_size = 4
+    dataset = MemmapPretrainingDataset(str(tmp_path), batch_size, shuffle=False, packed_data=packed_data)
+    assert len(dataset) == len(reference) // batch_size
+
+    for batch_index in range(len(dataset)):
+        batch = dataset[batch_index]
+        assert len(batch) == len(keys)
+        # Zero-copy reads of the stored types
+        assert all(feature.dtype in (torch.int32, torch.float32) for feature in batch)
+        for sample_index in range(batch_size):
+            for feature, expected in zip(batch, reference[batch_index * batch_size + sample_index]):
+                np.testing.assert_array_equal(feature[sample_index].numpy(), expected)
+
+    # Shuffling permutes the samples but yields each of them at most once
+    shuffled = MemmapPretrainingDataset(str(tmp_path), batch_size, shuffle=True, packed_data=packed_data)
+    input_ids = np.concatenate([shuffled[i][0].numpy() for i in range(len(shuffled))])
+    all_input_ids = np.stack([sample[0] for sample in reference])
+    assert len(np.unique(input_ids, axis=0)) == len(input_ids)
+    assert all((all_input_ids == row).all(1).any() for row in input_ids)
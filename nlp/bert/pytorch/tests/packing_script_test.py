@@ -38,14 +38,18 @@ def pack_sample_text(cmd):
 
 
 @pytest.mark.skip_longtest_needs_dataset
-def test_packing_script():
+@pytest.mark.parametrize("streaming", [False, True])
+@pytest.mark.parametrize("packing_solver", ["nnls", "spfhp"])
+def test_packing_script(streaming, packing_solver):
 
     cmd_pack_sample_text = [
         "python3", "data/packing/pack_pretraining_data.py",
         "--input-files", "./data/sample_text.tfrecord",
         "--output-dir", "./data/packed_usample_text",
         "--mask-tokens", "20",
-        "--sequence-length", "128"]
+        "--sequence-length", "128",
+        "--streaming", str(streaming),
+        "--packing-solver", packing_solver]
 
     out = pack_sample_text(cmd_pack_sample_text)
 
@@ -0,0 +1,110 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import sys
+from argparse import Namespace
+from collections import Counter
+from pathlib import Path
+import numpy as np
+import pytest
+# Append bert directory
+bert_root_path = str(Path(__file__).parent.parent)
+sys.path.append(bert_root_path)
+
+# The packing script needs TensorFlow and PopTorch at import
+pytest.importorskip("tensorflow")
+pytest.importorskip("poptorch")
+from data.packing.pack_pretraining_data import LengthBuckets, get_packing_recipe, slice_bucket_rows
+
+
+def test_length_buckets(tmp_path):
+    mask_tokens = 2
+    buckets = LengthBuckets(str(tmp_path), mask_tokens)
+    # No example of length 1 or 3, so those buckets have no file
+    buckets.allocate([0, 2, 0, 1])
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["length_0002.npy", "length_0004.npy"]
+
+    def examples(length, count, start):
+        input_ids = np.arange(start, start + count * 6).reshape(count, 6)
+        segment_ids = np.ones_like(input_ids)
+        masked_lm_positions = np.full([count, mask_tokens], length - 1)
+        masked_lm_ids = input_ids[:, :mask_tokens] + 100
+        next_sentence_labels = np.arange(count).reshape(count, 1) % 2
+        return input_ids, segment_ids, masked_lm_positions, masked_lm_ids, next_sentence_labels
+
+    length_2 = examples(2, 2, 0)
+    length_4 = examples(4, 1, 50)
+    buckets.append(2, *length_2)
+    buckets.append(4, *length_4)
+    with pytest.raises(RuntimeError, match="More examples of length 4"):
+        buckets.append(4, *length_4)
+    buckets.close()
+
+    for length, (input_ids, segment_ids, masked_lm_positions, masked_lm_ids, labels) in [(2, length_2), (4, length_4)]:
+        for row in range(len(input_ids)):
+            sequence = buckets.get_sequence(length, row)
+            np.testing.assert_equal(sequence[0], input_ids[row, :length])
+            np.testing.assert_equal(sequence[1], np.ones(length))
+            np.testing.assert_equal(sequence[2], segment_ids[row, :length])
+            np.testing.assert_equal(sequence[3], masked_lm_positions[row])
+            np.testing.assert_equal(sequence[4], masked_lm_ids[row])
+            assert sequence[5] == labels[row, 0]
+
+
+def test_length_buckets_partially_filled(tmp_path):
+    buckets = LengthBuckets(str(tmp_path), 1)
+    buckets.allocate([2])
+    buckets.append(1, np.ones([1, 1]), np.zeros([1, 1]), np.zeros([1, 1]), np.zeros([1, 1]), np.zeros([1, 1]))
+    with pytest.raises(AssertionError, match="only partially filled"):
+        buckets.close()
+
+
+def test_slice_bucket_rows():
+    rows_by_length = {2: np.array([1, 0, 3]), 3: np.array([0, -1]), 4: np.array([], dtype=np.int64)}
+    strategy_set = [[2, 2], [3], [4], [2, 3]]
+    # The empty bucket of length 4 fulfills nothing, and the last strategy runs out of length 2 rows
+    pack_lengths, pack_rows, mixture = slice_bucket_rows(rows_by_length, strategy_set, [1, 1, 2, 2], 2)
+    np.testing.assert_equal(pack_lengths, [[2, 2], [3, 0], [2, 3]])
+    np.testing.assert_equal(pack_rows, [[1, 0], [0, -1], [3, -1]])
+    assert mixture == [0, 0, 2, 1]
+
+    # The remaining mixture is fulfilled from new rows
+    rows_by_length = {2: np.array([4]), 3: np.array([2]), 4: np.array([0, 1])}
+    pack_lengths, pack_rows, mixture = slice_bucket_rows(rows_by_length, strategy_set, mixture, 2)
+    np.testing.assert_equal(pack_lengths, [[4, 0], [4, 0], [2, 3]])
+    np.testing.assert_equal(pack_rows, [[0, -1], [1, -1], [4, 2]])
+    assert mixture == [0, 0, 0, 0]
+
+
+@pytest.mark.parametrize("packing_solver", ["lp", "spfhp"])
+def test_packing_solver_covers_histogram(packing_solver):
+    sequence_length, max_sequences_per_pack = 32, 3
+    sequence_lengths = np.random.default_rng(0).integers(1, sequence_length + 1, 500)
+    args = Namespace(sequence_length=sequence_length, max_sequences_per_pack=max_sequences_per_pack,
+                     drop_unpacked_remainder=False, packing_solver=packing_solver)
+    strategy_set, mixture, padding = get_packing_recipe(args, sequence_lengths)
+
+    assert (mixture >= 0).all() and (padding >= 0).all()
+    slots = Counter()
+    for strategy, count in zip(strategy_set, mixture):
+        assert sum(strategy) <= sequence_length
+        assert len(strategy) <= max_sequences_per_pack
+        for length in strategy:
+            slots[length] += count
+    # Every sequence gets a slot of its length, the spare slots are filled with padding sequences
+    histogram = np.bincount(sequence_lengths, minlength=sequence_length + 1)[1:]
+    for length in range(1, sequence_length + 1):
+        assert slots[length] - padding[length - 1] == histogram[length - 1]
+    assert mixture.sum() >= sequence_lengths.sum() / sequence_length
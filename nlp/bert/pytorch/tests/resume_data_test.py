@@ -0,0 +1,90 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import shutil
+from pathlib import Path
+import numpy as np
+import pytest
+from torch.utils.data import DataLoader
+# Append bert directory
+bert_root_path = str(Path(__file__).parent.parent)
+sys.path.append(bert_root_path)
+
+from pretraining_data import TFRecordPretrainingDataset
+from utils import ResumableCycle
+
+data_dir = Path(bert_root_path) / "data"
+
+
+def make_loader(files, num_workers, batch_size, persistent_workers=False):
+    dataset = TFRecordPretrainingDataset(files, seed=1234)
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, drop_last=True,
+                        persistent_workers=persistent_workers)
+    return ResumableCycle(loader, batch_size)
+
+
+def copy_sample_files(tmp_path):
+    files = []
+    for i in range(3):
+        shutil.copy(data_dir / "sample_text.tfrecord", tmp_path / f"sample_{i}.tfrecord")
+        shutil.copy(data_dir / "sample_text.index", tmp_path / f"sample_{i}.index")
+        files.append(str(tmp_path / f"sample_{i}.tfrecord"))
+    return files
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+@pytest.mark.parametrize("resume_step", [1, 4, 9])
+def test_resume_matches_uninterrupted_run(tmp_path, num_workers, resume_step):
+    files = copy_sample_files(tmp_path)
+    batch_size = 4
+    num_steps = 40
+
+    loader = make_loader(files, num_workers, batch_size)
+    reference = []
+    for step in range(num_steps):
+        reference.append(next(loader)[0].numpy())
+        if step + 1 == resume_step:
+            position = loader.state_dict()
+    assert loader.state_dict()["epoch"] > 0
+
+    resumed = make_loader(files, num_workers, batch_size)
+    resumed.load_state_dict(position)
+    for step in range(resume_step, num_steps):
+        np.testing.assert_array_equal(next(resumed)[0].numpy(), reference[step])
+
+
+@pytest.mark.parametrize("resume_step", [4, 9])
+def test_persistent_workers(tmp_path, resume_step):
+    """The workers started before a new epoch or a resume must see the new position."""
+    files = copy_sample_files(tmp_path)
+    batch_size = 4
+    num_steps = 40
+
+    loader = make_loader(files, 2, batch_size)
+    reference = [next(loader)[0].numpy() for _ in range(num_steps)]
+    assert loader.state_dict()["epoch"] > 0
+    position = make_loader(files, 2, batch_size)
+    for _ in range(resume_step):
+        next(position)
+    position = position.state_dict()
+
+    persistent = make_loader(files, 2, batch_size, persistent_workers=True)
+    for step in range(num_steps):
+        np.testing.assert_array_equal(next(persistent)[0].numpy(), reference[step])
+
+    # Resume with the workers already started
+    persistent.load_state_dict(position)
+    for step in range(resume_step, num_steps):
+        np.testing.assert_array_equal(next(persistent)[0].numpy(), reference[step])
@@ -0,0 +1,63 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import shutil
+from pathlib import Path
+# Append bert directory
+bert_root_path = str(Path(__file__).parent.parent)
+sys.path.append(bert_root_path)
+
+from tfrecord_manifest import TFRecordManifest, write_manifest
+
+data_dir = Path(bert_root_path) / "data"
+
+
+def copy_sample_files(destination):
+    files = []
+    for name in ["sample_text", "sample_text_copy"]:
+        for source, extension in [(data_dir / "sample_text.tfrecord", ".tfrecord"), (data_dir / "sample_text.index", ".index")]:
+            shutil.copy(source, destination / (name + extension))
+        files.append(str(destination / (name + ".tfrecord")))
+    return files
+
+
+def test_manifest_counts_and_offsets(tmp_path):
+    files = copy_sample_files(tmp_path)
+    assert TFRecordManifest.load(files) is None
+
+    write_manifest(str(tmp_path), num_workers=1)
+    manifest = TFRecordManifest.load(files)
+    assert manifest is not None
+
+    index_lines = [line.split() for line in open(data_dir / "sample_text.index")]
+    assert len(manifest) == 2 * len(index_lines)
+    assert manifest.num_samples(files[1]) == len(index_lines)
+    assert manifest.record_offset(files[0], 3) == int(index_lines[3][0])
+    assert manifest.locate(0) == (files[0], 0)
+    assert manifest.locate(len(index_lines) + 2) == (files[1], 2)
+    assert manifest.verify() == []
+
+
+def test_manifest_detects_modified_files(tmp_path):
+    files = copy_sample_files(tmp_path)
+    write_manifest(str(tmp_path), num_workers=1)
+    with open(files[1], "ab") as f:
+        f.write(b"\0")
+    assert TFRecordManifest.load(files) is None
+    # Files that are still unchanged can be used on their own
+    assert TFRecordManifest.load(files[:1]) is not None
+    os.remove(tmp_path / "tfrecord_manifest.json")
+    assert TFRecordManifest.load(files[:1]) is None
@@ -7,6 +7,7 @@ from multiprocessing import Pool
 import pytest
 from test_utils import log_performance_results, DataGeneratorWrapper
 from triton_server.client import RequestType, task_one_client_one_model, task_one_client_one_model_buffered_data
+from triton_server.load_generator import run_load_benchmark
 from triton_server.utilsTriton import PoolLogExceptions
 from utils import logger
 
@@ -69,3 +70,19 @@ def test_single_model(request, triton_server, configure_bert_model, poptorch_ref
                                 result_data_type, number_of_processes, throughputs, latencies)
 
     assert result
+
+
+@pytest.mark.parametrize('model_name,yml_config', test_configs.items())
+def test_load_generator(request, triton_server, configure_bert_model, model_name, yml_config):
+    if request.config.getoption(benchmark_opt) is False:
+        pytest.skip("Load generator test is available only in benchmark mode.")
+
+    input_names = ("input_ids", "attention_mask", "token_type_ids")
+    number_of_outputs = 2
+    data_generator = DataGeneratorWrapper(
+        configure_bert_model.val_dl, input_names)
+    input_dataset = [input_data for input_data, _ in data_generator]
+
+    results = run_load_benchmark(request.config, triton_server.url, model_name,
+                                 input_dataset, number_of_outputs)
+    assert all(result.inferences > 0 and result.errors == 0 for result in results)
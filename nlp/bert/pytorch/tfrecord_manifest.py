@@ -0,0 +1,155 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cached manifest of the indexed TFRecord files in a folder.
+
+Counting the samples of a dataset requires reading every ".index" file, which
+takes minutes for thousands of files on network storage. The manifest records,
+once at preprocessing time, for each TFRecord file in a folder:
+- the number of samples,
+- the byte offset of each record (in a separate memory-mapped array),
+- the size and modification time of the file, to cheaply detect stale entries,
+- a CRC32 checksum of the file, for an optional full verification.
+
+Usage, after the ".index" files have been generated:
+
+    python3 tfrecord_manifest.py <folder-of-tfrecord-files>
+"""
+
+import os
+import json
+import zlib
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+MANIFEST_FILENAME = "tfrecord_manifest.json"
+OFFSETS_FILENAME = "tfrecord_manifest_offsets.npy"
+MANIFEST_VERSION = 1
+
+
+def file_checksum(filename, chunk_size=1 << 24):
+    checksum = 0
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            checksum = zlib.crc32(chunk, checksum)
+    return checksum
+
+
+def describe_file(filename):
+    """Read the ".index" file of a TFRecord file and return its manifest entry and record offsets."""
+    index_filename = filename.replace(".tfrecord", ".index")
+    offsets = np.loadtxt(index_filename, dtype=np.int64, ndmin=2)[:, 0]
+    stat = os.stat(filename)
+    entry = {"num_samples": len(offsets),
+             "size": stat.st_size,
+             "mtime": stat.st_mtime,
+             "checksum": file_checksum(filename)}
+    return entry, offsets
+
+
+def write_manifest(directory, num_workers=16):
+    """Create the manifest of all the indexed TFRecord files in a folder."""
+    files = sorted(f for f in os.listdir(directory) if f.endswith(".tfrecord"))
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        descriptions = list(executor.map(describe_file, [os.path.join(directory, f) for f in files]))
+
+    entries = {}
+    first_record = 0
+    for filename, (entry, offsets) in zip(files, descriptions):
+        entry["first_record"] = first_record
+        entries[filename] = entry
+        first_record += entry["num_samples"]
+    all_offsets = np.concatenate([offsets for _, offsets in descriptions]) if descriptions else np.zeros([0], np.int64)
+    np.save(os.path.join(directory, OFFSETS_FILENAME), all_offsets)
+    with open(os.path.join(directory, MANIFEST_FILENAME), "w") as f:
+        json.dump({"version": MANIFEST_VERSION, "files": entries}, f)
+    return entries
+
+
+class TFRecordManifest:
+    """
+    Sample counts and record offsets of a list of TFRecord files, read from
+    the manifests of the folders containing them.
+
+    Use `TFRecordManifest.load(files)`, which returns None if any of the files is
+    missing from the manifest of its folder or has changed (by size or
+    modification time) since the manifest was written.
+    """
+    def __init__(self, files, entries, offsets):
+        self.files = list(files)
+        self.entries = entries
+        self.offsets = offsets
+        self.samples_per_file = np.array([entries[f]["num_samples"] for f in self.files], dtype=np.int64)
+        self.cumulative_samples = np.concatenate([[0], np.cumsum(self.samples_per_file)])
+
+    @classmethod
+    def load(cls, files):
+        folders = {}
+        entries, offsets = {}, {}
+        for filename in files:
+            directory = os.path.dirname(os.path.abspath(filename))
+            if directory not in folders:
+                try:
+                    with open(os.path.join(directory, MANIFEST_FILENAME)) as f:
+                        manifest = json.load(f)
+                    folder_offsets = np.load(os.path.join(directory, OFFSETS_FILENAME), mmap_mode="r")
+                except (OSError, ValueError):
+                    return None
+                if manifest.get("version") != MANIFEST_VERSION:
+                    return None
+                folders[directory] = manifest["files"], folder_offsets
+            folder_entries, folder_offsets = folders[directory]
+            entry = folder_entries.get(os.path.basename(filename))
+            if entry is None:
+                return None
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                return None
+            if stat.st_size != entry["size"] or stat.st_mtime != entry["mtime"]:
+                return None
+            entries[filename] = entry
+            offsets[filename] = folder_offsets[entry["first_record"]:entry["first_record"] + entry["num_samples"]]
+        return cls(files, entries, offsets)
+
+    def __len__(self):
+        return int(self.cumulative_samples[-1])
+
+    def num_samples(self, filename):
+        return self.entries[filename]["num_samples"]
+
+    def record_offset(self, filename, record):
+        """Byte offset of the given record in a TFRecord file."""
+        return int(self.offsets[filename][record])
+
+    def locate(self, sample):
+        """Map a global sample index (in the order of the files) to a (filename, record) pair."""
+        file_index = int(np.searchsorted(self.cumulative_samples, sample, side="right")) - 1
+        return self.files[file_index], int(sample - self.cumulative_samples[file_index])
+
+    def verify(self):
+        """Fully re-read every file and compare its checksum, return the list of corrupted files."""
+        return [f for f in self.files if file_checksum(f) != self.entries[f]["checksum"]]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write the manifest of the indexed TFRecord files in each folder.")
+    parser.add_argument("folders", nargs="+", type=str)
+    parser.add_argument("--num-workers", default=16, type=int, help="Number of files read in parallel")
+    args = parser.parse_args()
+    for folder in args.folders:
+        entries = write_manifest(folder, args.num_workers)
+        total = sum(entry["num_samples"] for entry in entries.values())
+        print(f"Wrote manifest of {len(entries)} files with {total} samples to {os.path.join(folder, MANIFEST_FILENAME)}")
@@ -31,6 +31,58 @@ def cycle(iterator):
             yield item
 
 
+class ResumableCycle:
+    """
+    Loop `loader` forever like `cycle`, keeping track of the current epoch and
+    of the number of steps taken within it, so that the position can be saved
+    in a checkpoint and restored.
+
+    If the dataset supports it (`set_epoch` and `set_position`), restoring
+    the position only changes where the dataset starts reading. The dataset
+    must share the position with the DataLoader workers, which may have been
+    started before. Otherwise the loader is fast-forwarded by consuming the
+    batches up to the position.
+    """
+    def __init__(self, loader, samples_per_step):
+        self.loader = loader
+        self.samples_per_step = samples_per_step
+        self.epoch = 0
+        self.step_in_epoch = 0
+        self.iterator = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            if self.iterator is None:
+                if hasattr(self.loader.dataset, "set_epoch") and self.step_in_epoch == 0:
+                    self.loader.dataset.set_epoch(self.epoch)
+                self.iterator = iter(self.loader)
+            try:
+                item = next(self.iterator)
+                self.step_in_epoch += 1
+                return item
+            except StopIteration:
+                self.iterator = None
+                self.epoch += 1
+                self.step_in_epoch = 0
+
+    def state_dict(self):
+        return {"epoch": self.epoch, "step_in_epoch": self.step_in_epoch}
+
+    def load_state_dict(self, state):
+        self.iterator = None
+        if hasattr(self.loader.dataset, "set_position"):
+            self.epoch, self.step_in_epoch = state["epoch"], state["step_in_epoch"]
+            self.loader.dataset.set_position(self.epoch, self.step_in_epoch * self.samples_per_step,
+                                             self.loader.batch_size)
+        else:
+            self.epoch, self.step_in_epoch = 0, 0
+            while (self.epoch, self.step_in_epoch) != (state["epoch"], state["step_in_epoch"]):
+                next(self)
+
+
 def logger(msg):
     if not popdist.isPopdistEnvSet() or popdist.getInstanceIndex() == 0:
         logging.info(msg)
@@ -7,6 +7,7 @@ import numpy as np
 import torch.nn.utils.rnn as rnn_utils
 from torch.utils.data import Dataset, IterableDataset
 from tfrecord.reader import tfrecord_loader
+from data.tfrecord_manifest import TFRecordManifest
 
 TFRECORD_KEYS = ['input_ids']  # Torch Model Keys
 
@@ -52,6 +53,12 @@ class TFRecordPretrainingDataset(IterableDataset):
 
     def __len__(self):
         if getattr(self, "_len", None) is None:
+            # Use the manifest written at preprocessing time if it is up to date,
+            # otherwise count the lines of every index file
+            manifest = TFRecordManifest.load(self.files)
+            if manifest is not None:
+                self._len = len(manifest)
+                return self._len
             pool = multiprocessing.Pool(
                 min(multiprocessing.cpu_count(), len(self.files)))
             num_samples = pool.map(self.samples_per_file, self.files)
@@ -3,12 +3,15 @@
 import logging
 import time
 from functools import partial
+from typing import Optional, Tuple
 
 import numpy as np
 import popdist
+import torch
 
 import popxl
 from popxl import TensorSpec, ops
+from popxl.utils import to_numpy
 from math import ceil
 
 import popxl_addons as addons
@@ -22,10 +25,49 @@ from popxl_addons.task_session import TaskSession
 from config import CONFIG_DIR, GPTJConfig
 from modelling.embedding import GPTJEmbeddingsTP
 from modelling.decoder import GPTJDecoderBlockTP
+from modelling.kv_cache import GPTJCachedDecoderBlockTP
 from modelling.gptj_lm import GPTJLMHeadTP, generate_greedy_tp
 from utils.setup import gptj_config_setup
-
-__all__ = ["inference"]
+from utils.utils import tensor_parallel_input, repeat
+
+__all__ = ["inference", "inference_cached", "KVCachedNextToken"]
+
+
+def create_remote_variables(
+        config: GPTJConfig, embeddings_facts, layer_facts, lm_facts
+) -> Tuple[NamedTensors, Tuple[NamedRemoteBuffers, ...]]:
+    """Create the remote variables of the model, with the same names as `GPTJLMHeadModelTP`."""
+    # Create RemoteBuffers for each variable
+    named_variable_buffers_no_rts = partial(named_variable_buffers,
+                                            sharded_threshold=float('inf'))
+    embeddings_buffers = named_variable_buffers_no_rts(embeddings_facts)
+    layer_buffers = named_variable_buffers_no_rts(
+        layer_facts, entries=config.model.layers)
+    lm_buffers = named_variable_buffers_no_rts(lm_facts)
+
+    variables = NamedTensors()
+    transformer = NamedTensors()
+    transformer.insert(
+        "embeddings",
+        embeddings_facts.init_remote(embeddings_buffers,
+                                     0,
+                                     "embeddings",
+                                     empty=True))
+
+    transformer.insert(
+        "decoder",
+        NamedTensors.from_dict({
+            n: layer_facts.init_remote(layer_buffers,
+                                       n,
+                                       f"decoder.{n}",
+                                       empty=True)
+            for n in range(config.model.layers)
+        }))
+    variables.insert("transformer", transformer)
+    variables.insert(
+        "lm_head",
+        lm_facts.init_remote(lm_buffers, 0, "lm_head", empty=True))
+    return variables, (embeddings_buffers, layer_buffers, lm_buffers)
 
 
 def inference(config: GPTJConfig) -> TaskSession:
@@ -69,37 +111,9 @@ def inference(config: GPTJConfig) -> TaskSession:
                 ir, config.execution.available_memory_proportion)
 
             # ----- Create Variables -----
-
-            # Create RemoteBuffers for each variable
-            named_variable_buffers_no_rts = partial(named_variable_buffers,
-                                                    sharded_threshold=float('inf'))
-            embeddings_buffers = named_variable_buffers_no_rts(embeddings_facts)
-            layer_buffers = named_variable_buffers_no_rts(
-                layer_facts, entries=config.model.layers)
-            lm_buffers = named_variable_buffers_no_rts(lm_facts)
-
-            variables = NamedTensors()
-            transformer = NamedTensors()
-            transformer.insert(
-                "embeddings",
-                embeddings_facts.init_remote(embeddings_buffers,
-                                             0,
-                                             "embeddings",
-                                             empty=True))
-
-            transformer.insert(
-                "decoder",
-                NamedTensors.from_dict({
-                    n: layer_facts.init_remote(layer_buffers,
-                                               n,
-                                               f"decoder.{n}",
-                                               empty=True)
-                    for n in range(config.model.layers)
-                }))
-            variables.insert("transformer", transformer)
-            variables.insert(
-                "lm_head",
-                lm_facts.init_remote(lm_buffers, 0, "lm_head", empty=True))
+            variables, (embeddings_buffers, layer_buffers,
+                        lm_buffers) = create_remote_variables(
+                            config, embeddings_facts, layer_facts, lm_facts)
 
             # ---- Execute ----
             with popxl.in_sequence():
@@ -144,6 +158,223 @@ def inference(config: GPTJConfig) -> TaskSession:
     return session
 
 
+def inference_cached(config: GPTJConfig) -> TaskSession:
+    """
+    Inference with a key/value cache, for incremental decoding.
+
+    The session has the inputs of `inference` plus a `prefill` flag, which selects one of two graphs:
+    - prefill (1): run the whole sequence as `inference` does and store the keys and values of
+      every layer in the cache,
+    - decode (0): run only the token at `last_token_indices` of each row, attending to the cached
+      keys and values of the previous positions and storing its own.
+    The cache is kept in remote memory and persists between runs of the session.
+    Use `KVCachedNextToken` to drive the session from the host.
+    """
+    assert config.model.eval, 'Eval mode must be True'
+    assert config.execution.data_parallel == 1, 'You cant use DP for inference'
+    replicas = config.execution.tensor_parallel
+    ir = popxl.Ir(
+        replication="popdist" if popdist.isPopdistEnvSet() else replicas)
+    assert ir.replication_factor == replicas
+
+    # Options
+    opts = ir._pb_ir.getSessionOptions()
+    opts.partialsTypeMatMuls = "half"
+    opts.engineOptions["target.syncReplicasIndependently"] = "true"
+
+    micro_batch_size = config.execution.micro_batch_size
+    sequence_length = config.model.sequence_length
+
+    with timer('PopXL IR construction'):
+        with ir.main_graph:
+            # -----  Define input and output streams -----
+            input_shape = (micro_batch_size * sequence_length, )
+            input_streams = addons.InputStreams(
+                words=(input_shape, popxl.int32),
+                last_token_indices=((micro_batch_size, ), popxl.int32),
+                prefill=((), popxl.int32))
+            output_streams = addons.OutputStreams(
+                next_token=((micro_batch_size, ), popxl.int32))
+
+            # ----- Build compute graphs -----
+            key_shape, value_shape = GPTJCachedDecoderBlockTP.cache_shapes(config)
+            token_spec = TensorSpec((micro_batch_size, ), popxl.int32)
+
+            # Prefill: whole sequence
+            embeddings_facts, embeddings_graph = GPTJEmbeddingsTP(
+                config).create_graph(input_streams.words.spec)
+            layer_facts, layer_graph = GPTJCachedDecoderBlockTP(config).create_graph(
+                *embeddings_graph.graph.outputs)
+            lm_facts, lm_graph = GPTJLMHeadTP(
+                config).create_graph(layer_graph.graph.outputs[0])
+
+            # Decode: one token per row
+            _, token_embeddings_graph = GPTJEmbeddingsTP(
+                config).create_graph(token_spec)
+            _, token_layer_graph = GPTJCachedDecoderBlockTP(config).create_graph(
+                token_embeddings_graph.graph.outputs[0],
+                TensorSpec(key_shape, config.model.dtype),
+                TensorSpec(value_shape, config.model.dtype),
+                token_spec)
+            _, token_lm_graph = GPTJLMHeadTP(
+                config).create_graph(token_layer_graph.graph.outputs[0])
+            # ---- Transform graphs ----
+
+            addons.set_available_memory_proportion_by_ipu(
+                ir, config.execution.available_memory_proportion)
+
+            # ----- Create Variables -----
+            variables, (embeddings_buffers, layer_buffers,
+                        lm_buffers) = create_remote_variables(
+                            config, embeddings_facts, layer_facts, lm_facts)
+
+            # Key/value cache of every layer, for each shard
+            key_cache = popxl.remote_buffer(key_shape, config.model.dtype,
+                                            entries=config.model.layers)
+            value_cache = popxl.remote_buffer(value_shape, config.model.dtype,
+                                              entries=config.model.layers)
+
+            def prefill(words, last_token_indices):
+                load_graph, names = load_remote_graph(embeddings_buffers)
+                embedding_vars = NamedTensors.pack(names, load_graph.call(0))
+                x, = embeddings_graph.bind(embedding_vars).call(words)
+
+                def layer(x, n):
+                    load_graph, names = load_remote_graph(layer_buffers)
+                    layer_vars = NamedTensors.pack(names, load_graph.call(n))
+                    x, key, value = layer_graph.bind(layer_vars).call(x)
+                    ops.remote_store(key_cache, n, key)
+                    ops.remote_store(value_cache, n, value)
+                    return x, n + 1
+
+                i = popxl.constant(0, name="layer_index")
+                layers_graph = ir.create_graph(layer, x, i)
+                x, _ = ops.repeat(layers_graph, config.model.layers, x, i)
+
+                load_graph, names = load_remote_graph(lm_buffers)
+                lm_vars = NamedTensors.pack(names, load_graph.call(0))
+                logits, = lm_graph.bind(lm_vars).call(x)
+                return generate_greedy_tp(config, logits, last_token_indices)
+
+            def decode(words, last_token_indices):
+                batch_offsets = popxl.constant(
+                    np.arange(micro_batch_size) * sequence_length, popxl.int32)
+                token = words[last_token_indices + batch_offsets]
+
+                load_graph, names = load_remote_graph(embeddings_buffers)
+                embedding_vars = NamedTensors.pack(names, load_graph.call(0))
+                x, = token_embeddings_graph.bind(embedding_vars).call(token)
+
+                def layer(x, positions, n):
+                    load_graph, names = load_remote_graph(layer_buffers)
+                    layer_vars = NamedTensors.pack(names, load_graph.call(n))
+                    past_key = ops.remote_load(key_cache, n)
+                    past_value = ops.remote_load(value_cache, n)
+                    x, key, value = token_layer_graph.bind(layer_vars).call(
+                        x, past_key, past_value, positions)
+                    ops.remote_store(key_cache, n, key)
+                    ops.remote_store(value_cache, n, value)
+                    return x, positions, n + 1
+
+                i = popxl.constant(0, name="layer_index")
+                layers_graph = ir.create_graph(layer, x, last_token_indices, i)
+                x, *_ = ops.repeat(layers_graph, config.model.layers, x,
+                                   last_token_indices, i)
+
+                load_graph, names = load_remote_graph(lm_buffers)
+                lm_vars = NamedTensors.pack(names, load_graph.call(0))
+                logits, = token_lm_graph.bind(lm_vars).call(x)
+                return generate_greedy_tp(config, logits)
+
+            # ---- Execute ----
+            with popxl.in_sequence():
+                word = ops.host_load(input_streams.words)
+                last_token_indices = ops.host_load(
+                    input_streams.last_token_indices)
+                is_prefill = ops.cast(ops.host_load(input_streams.prefill),
+                                      popxl.bool)
+
+                prefill_graph = ir.create_graph(prefill, word, last_token_indices)
+                decode_graph = ir.create_graph(decode, word, last_token_indices)
+                next_token_id, = ops.conditional(
+                    is_prefill, prefill_graph, decode_graph,
+                    then_inputs=[word, last_token_indices],
+                    else_inputs=[word, last_token_indices])
+                ops.host_store(
+                    output_streams.next_token,
+                    next_token_id.reshape_(output_streams.next_token.shape))
+
+        # Run `OpToIdentityPattern` among others part of `PreAliasPatterns`
+        apply_pre_alias_patterns(ir, level='default')
+
+    ir.num_host_transfers = config.execution.device_iterations
+
+    session = TaskSession(input_streams, output_streams, variables, ir,
+                          "ipu_hw")
+    return session
+
+
+class KVCachedNextToken:
+    """
+    `next_token_fn` for `utils.inference`, running a session created by `inference_cached`.
+
+    Each call decodes the last token of every row from the cache if all the tokens before it are
+    already cached, that is they were part of the previous call unchanged. Otherwise, for instance
+    when a new prompt was placed in a row, the whole sequence is prefilled.
+    """
+
+    def __init__(self, config: GPTJConfig, session: TaskSession):
+        self.config = config
+        self.session = session
+        self.tokens: Optional[torch.Tensor] = None
+        self.lengths: Optional[torch.Tensor] = None
+        self.prefill_steps = 0
+        self.decode_steps = 0
+
+    def reset(self):
+        """Invalidate the cache, so that the next call prefills."""
+        self.tokens = None
+        self.lengths = None
+
+    def needs_prefill(self, inputs: torch.Tensor, lengths: torch.Tensor) -> bool:
+        if self.tokens is None:
+            return True
+        positions = torch.arange(inputs.shape[1])
+        before_last = positions[None, :] < (lengths - 1)[:, None]
+        unchanged = ((inputs == self.tokens) | ~before_last).all(dim=1)
+        cached = lengths - 1 <= self.lengths
+        return not bool((unchanged & cached).all())
+
+    def __call__(self, inputs: torch.Tensor, lengths: torch.Tensor) -> torch.Tensor:
+        tp = self.config.execution.tensor_parallel
+        rf = self.config.execution.tensor_parallel * self.config.execution.data_parallel
+        session = self.session
+        prefill = self.needs_prefill(inputs, lengths)
+
+        data_map = {}
+        words = to_numpy(inputs, session.inputs.words.dtype).reshape(
+            -1, *session.inputs.words.shape)
+        data_map[session.inputs.words] = tensor_parallel_input(
+            words, tp, rf, partial(GPTJEmbeddingsTP.offset_input,
+                                   config=self.config)).squeeze()
+        data_map[session.inputs.last_token_indices] = repeat(lengths - 1,
+                                                             tp,
+                                                             axis=0)
+        data_map[session.inputs.prefill] = repeat(np.array(int(prefill), np.int32),
+                                                  tp,
+                                                  axis=0)
+        # identical for all tp, take first
+        next_token_id = session.run(data_map)[session.outputs.next_token][0]
+
+        self.tokens = inputs.clone()
+        self.lengths = lengths.clone()
+        if prefill:
+            self.prefill_steps += 1
+        else:
+            self.decode_steps += 1
+        return torch.LongTensor(next_token_id)
+
+
 def main():
     """Run a benchmark configuration"""
     config, *_ = gptj_config_setup(CONFIG_DIR / "inference.yml", "release",
@@ -1,6 +1,6 @@
 # Copyright (c) 2022 Graphcore Ltd. All rights reserved.
 import numpy as np
-from typing import Dict
+from typing import Dict, Tuple
 import math
 import torch
 
@@ -54,6 +54,19 @@ class GPTJAttentionHeads(addons.Module):
 
     def build(self, x: popxl.Tensor, seed: Optional[popxl.Tensor] = None):
         # x: [batch*seq, hidden]
+        query, key, value = self.split_heads(x)
+        attn_output = self.attention(query, key, value, seed)
+        return self.merge_heads(attn_output)
+
+    def trig_tables(self) -> Tuple[popxl.Tensor, popxl.Tensor]:
+        return trig_table_constants(self.config.model.sequence_length,
+                                    self.rotary_dim,
+                                    self.config.model.attention.rotary_positional_embeddings_base,
+                                    self.config.model.dtype)
+
+    def split_heads(self, x: popxl.Tensor) -> Tuple[popxl.Tensor, popxl.Tensor, popxl.Tensor]:
+        """Project x to query [batch, heads, seq, head_size], key [batch, heads, head_size, seq]
+        and value [batch, heads, seq, head_size], with rotary embeddings applied to query and key."""
         qkv_act = self.qkv(x)
         query, key, value = ops.split(qkv_act, 3, axis=-1)
 
@@ -65,17 +78,18 @@ class GPTJAttentionHeads(addons.Module):
         value = reshape_for_scores(
             value, self.config.model.sequence_length, self.n_heads)
 
-        sin, cos = trig_table_constants(self.config.model.sequence_length,
-                                        self.rotary_dim,
-                                        self.config.model.attention.rotary_positional_embeddings_base,
-                                        self.config.model.dtype)
+        sin, cos = self.trig_tables()
         # Optim: outline below?
         query = rotary_pos_embed(
             query, sin, cos, self.rotary_dim).transpose((0, 2, 1, 3))
         key = rotary_pos_embed(
             key, sin, cos, self.rotary_dim).transpose((0, 2, 3, 1))
         value = value.transpose((0, 2, 1, 3))
+        return query, key, value
 
+    def attention(self, query: popxl.Tensor, key: popxl.Tensor, value: popxl.Tensor,
+                  seed: Optional[popxl.Tensor] = None) -> popxl.Tensor:
+        """Causal attention over the whole sequence, serialised along the query axis if configured."""
         causal_mask = popxl.constant(
             # HF uses 1e9 which is beyond fp16 range
             1e4 * (np.tril(np.ones((self.config.model.sequence_length,
@@ -107,8 +121,11 @@ class GPTJAttentionHeads(addons.Module):
         else:
             attn_output = self.attention_block(
                 query, key, value, causal_mask, seed)
+        return attn_output
 
-        return attn_output.transpose((0, 2, 1, 3)).reshape((self.config.execution.micro_batch_size*self.config.model.sequence_length, -1))
+    def merge_heads(self, attn_output: popxl.Tensor) -> popxl.Tensor:
+        # [batch, heads, seq, head_size] -> [batch*seq, heads*head_size]
+        return attn_output.transpose((0, 2, 1, 3)).reshape((-1, self.n_heads * attn_output.shape[-1]))
 
     def attention_block(self, query: popxl.Tensor, key: popxl.Tensor, value: popxl.Tensor, mask: popxl.Tensor, seed: popxl.Tensor):
         attn_weights = query @ key
@@ -28,26 +28,30 @@ from math import ceil
 
 
 def generate_greedy_tp(config: GPTJConfig, logits: popxl.Tensor,
-                       last_token_index: popxl.Tensor):
+                       last_token_index: Optional[popxl.Tensor] = None):
     """
     Generate a new token based on greedy choice.
     Args:
         logits (popxl.Tensor, int32): Sharded logits for the whole sequence. Shape (seq_len, vocab_shard_size)
         last_token_index (popxl.Tensor, int32): Indices locating the last valid (non-padded) token for each batch. Logits at that indices correspond
                                                 to the logits for the new token. It should be of shape (micro_batch_size,).
+                                                If None, logits are those of the new token only, of shape (micro_batch_size, vocab_shard_size).
     Returns:
         (popxl.Tensor, int32): new token ids, of shape (micro_batch_size,)
     """
     tp = config.execution.tensor_parallel
-    # indices for next token logits in each batch
-    offsetted_batch_indices = popxl.constant(
-        np.arange(0, config.execution.micro_batch_size) *
-        config.model.sequence_length,
-        dtype=popxl.int32)
-    offsetted_batch_indices = last_token_index + offsetted_batch_indices
-    # next token logits, sharded
-    next_token_logits = logits[
-        offsetted_batch_indices]  # (tp, mb_size, vocab_shard_size)
+    if last_token_index is None:
+        next_token_logits = logits
+    else:
+        # indices for next token logits in each batch
+        offsetted_batch_indices = popxl.constant(
+            np.arange(0, config.execution.micro_batch_size) *
+            config.model.sequence_length,
+            dtype=popxl.int32)
+        offsetted_batch_indices = last_token_index + offsetted_batch_indices
+        # next token logits, sharded
+        next_token_logits = logits[
+            offsetted_batch_indices]  # (tp, mb_size, vocab_shard_size)
 
     # gather tensor parallel shards and get full logits: (mb_size, vocab_size)
     next_token_logits = ops.collectives.replicated_all_gather(
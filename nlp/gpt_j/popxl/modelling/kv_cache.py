@@ -0,0 +1,134 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+"""
+Decoder layers for incremental (KV-cached) decoding, following the cached layers of
+`preview/multimodal/rudalle/popxl/modeling/modeling_cached_TP.py`.
+
+Layers run in two modes:
+- prefill: the whole sequence is processed as in `GPTJDecoderBlockTP`, and the key and value
+  of every position are returned, to be stored in the cache,
+- decode: a single new token per batch row is processed, at the position given by `positions`.
+  Its key and value are written into the cache at that position and attention is computed
+  against the cached keys and values, masked past the position.
+
+The variables have the same names as those of `GPTJDecoderBlockTP`, so weights and
+`hf_mapping` are shared with the uncached layers.
+
+Cache layout, per tensor parallel shard:
+    key: [batch, heads_per_shard, head_size, sequence_length]
+    value: [batch, heads_per_shard, sequence_length, head_size]
+"""
+import numpy as np
+from typing import Optional, Tuple
+
+import popxl
+from popxl import ops
+
+from popxl_addons.ops.replicated_all_reduce_TP import (replicated_all_reduce_identical_inputs,
+                                                       replicated_all_reduce_identical_grad_inputs)
+from popxl_addons.ops.rotary_pos_embed import rotary_pos_embed
+
+from config import GPTJConfig
+from .attention import GPTJAttentionHeads, GPTJSelfAttentionTP, reshape_for_scores
+from .decoder import GPTJDecoderBlockTP
+
+
+class GPTJCachedAttentionHeads(GPTJAttentionHeads):
+    def build(self,
+              x: popxl.Tensor,
+              past_key: Optional[popxl.Tensor] = None,
+              past_value: Optional[popxl.Tensor] = None,
+              positions: Optional[popxl.Tensor] = None) -> Tuple[popxl.Tensor, popxl.Tensor, popxl.Tensor]:
+        """
+        Prefill (no past_key): x is [batch*seq, hidden].
+        Decode: x is [batch, hidden], the new token of each row, and `positions` [batch] its position.
+
+        Returns the attention output and the updated key and value caches.
+        """
+        if past_key is None:
+            query, key, value = self.split_heads(x)
+            return self.merge_heads(self.attention(query, key, value)), key, value
+
+        batch = self.config.execution.micro_batch_size
+        seq_len = self.config.model.sequence_length
+        query, key, value = ops.split(self.qkv(x), 3, axis=-1)
+
+        # Rows are laid out along the sequence axis, so that rotary embeddings are applied with
+        # the trig tables gathered at the position of each row: [1, batch, heads, head_size]
+        sin, cos = self.trig_tables()
+        sin = ops.gather(sin, positions)
+        cos = ops.gather(cos, positions)
+        query = rotary_pos_embed(reshape_for_scores(query, batch, self.n_heads), sin, cos, self.rotary_dim)
+        key = rotary_pos_embed(reshape_for_scores(key, batch, self.n_heads), sin, cos, self.rotary_dim)
+
+        #: [batch, heads, 1, head_size] and key [batch, heads, head_size, 1]
+        query = query.reshape((batch, 1, self.n_heads, -1)).transpose((0, 2, 1, 3))
+        key = key.reshape((batch, 1, self.n_heads, -1)).transpose((0, 2, 3, 1))
+        value = reshape_for_scores(value, 1, self.n_heads).transpose((0, 2, 1, 3))
+
+        # Write the new key and value into the cache at `positions`
+        update = ops.onehot(positions,
+                            num_classes=popxl.constant(seq_len, popxl.int32),
+                            values=popxl.constant(np.array([0, 1]), query.dtype),
+                            axis=-1)
+        keep = 1 - update
+        key = past_key * keep.reshape((batch, 1, 1, seq_len)) + key * update.reshape((batch, 1, 1, seq_len))
+        value = past_value * keep.reshape((batch, 1, seq_len, 1)) + value * update.reshape((batch, 1, seq_len, 1))
+
+        # Attend to positions up to and including the new token
+        visible = ops.greater(positions.reshape((batch, 1)) + 1, popxl.constant(np.arange(seq_len), popxl.int32))
+        mask = 1e4 * (ops.cast(visible, query.dtype) - 1)
+
+        attn_output = self.attention_block(query, key, value, mask.reshape((batch, 1, 1, seq_len)), None)
+        return self.merge_heads(attn_output), key, value
+
+
+class GPTJCachedSelfAttentionTP(GPTJSelfAttentionTP):
+    def __init__(self, config: GPTJConfig):
+        super().__init__(config)
+        assert config.model.eval, "Cached attention is only supported for inference"
+        self.heads = GPTJCachedAttentionHeads(config=config, replica_grouping=self.replica_grouping)
+
+    def build(self,
+              x: popxl.Tensor,
+              past_key: Optional[popxl.Tensor] = None,
+              past_value: Optional[popxl.Tensor] = None,
+              positions: Optional[popxl.Tensor] = None) -> Tuple[popxl.Tensor, popxl.Tensor, popxl.Tensor]:
+        """Identical inputs and identical outputs across shards. The caches are sharded by heads."""
+        # ----- Identical computation -----
+        z = replicated_all_reduce_identical_inputs(
+            x, group=self.replica_grouping.transpose())
+
+        # ----- Sharded computation -----
+        z, key, value = self.heads(z, past_key, past_value, positions)
+        z = self.output(z)
+
+        z = replicated_all_reduce_identical_grad_inputs(
+            z, group=self.replica_grouping.transpose())
+        return z, key, value
+
+
+class GPTJCachedDecoderBlockTP(GPTJDecoderBlockTP):
+    def __init__(self, config: GPTJConfig):
+        super().__init__(config)
+        self.attention = GPTJCachedSelfAttentionTP(self.config)
+
+    def build(self,
+              x: popxl.Tensor,
+              past_key: Optional[popxl.Tensor] = None,
+              past_value: Optional[popxl.Tensor] = None,
+              positions: Optional[popxl.Tensor] = None) -> Tuple[popxl.Tensor, popxl.Tensor, popxl.Tensor]:
+        residual = x
+        hidden_states = self.ln_1(x)
+        attn_out, key, value = self.attention(hidden_states, past_key, past_value, positions)
+        ff_out = self.feed_forward(hidden_states)
+        x = attn_out + ff_out + residual
+        return x, key, value
+
+    @staticmethod
+    def cache_shapes(config: GPTJConfig) -> Tuple[Tuple[int, ...], Tuple[int, ...]]:
+        """Shapes of the key and value caches of one layer, on one tensor parallel shard."""
+        heads = config.model.attention.heads // config.execution.tensor_parallel
+        head_size = config.model.hidden_size // config.model.attention.heads
+        batch = config.execution.micro_batch_size
+        seq_len = config.model.sequence_length
+        return (batch, heads, head_size, seq_len), (batch, heads, seq_len, head_size)
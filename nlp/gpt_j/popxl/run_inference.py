@@ -11,13 +11,13 @@ from transformers import AutoTokenizer, GPTJForCausalLM
 import popxl
 from popxl.utils import to_numpy
 
-from inference import inference
+from inference import inference, inference_cached, KVCachedNextToken
 from modelling.embedding import GPTJEmbeddingsTP
 from modelling.hf_mapping import hf_mapping_lm_tp
 from popxl_addons import timer
 from utils.setup import gptj_config_setup
 from utils.utils import tensor_parallel_input, repeat
-from utils.inference import batch_inference
+from utils.inference import ContinuousBatchingEngine
 from data.mnli_data import form_text, prepare_validation_features, split_text
 from config import GPTJConfig
 
@@ -42,27 +42,27 @@ def run_inference_hf(dataset, tokenizer, hf_model, sequence_length,
         return torch.argmax(next_token_logits,
                             dim=-1).reshape(-1)
 
-    answers = batch_inference(unwrap(dataset),
-                              next_token,
-                              sequence_length,
-                              eos_token_id=tokenizer.eos_token_id,
-                              pad_token_id=tokenizer.pad_token_id,
-                              output_length=output_length,
-                              micro_batch_size=micro_batch_size)
+    engine = ContinuousBatchingEngine(next_token,
+                                      sequence_length,
+                                      eos_token_id=tokenizer.eos_token_id,
+                                      pad_token_id=tokenizer.pad_token_id,
+                                      output_length=output_length,
+                                      micro_batch_size=micro_batch_size)
 
     logging.info("HF output")
-    for a in answers:
-        text = tokenizer.decode(a)
-        logging.info(f"detokenized: {text}")
+    for request_id, answer in engine.generate(unwrap(dataset)):
+        text = tokenizer.decode(answer)
+        logging.info(f"detokenized {request_id}: {text}")
+    logging.info(f"Slot occupancy: {engine.occupancy:.2%}")
 
 
 def run_inference_popxl(config: GPTJConfig, dataset, tokenizer, hf_model,
-                        sequence_length, output_length):
+                        sequence_length, output_length, kv_cache=True):
     config.model.sequence_length = sequence_length
     tp = config.execution.tensor_parallel
     rf = config.execution.tensor_parallel * config.execution.data_parallel
 
-    session = inference(config)
+    session = inference_cached(config) if kv_cache else inference(config)
 
     if config.model.dtype == popxl.float16:
         hf_model.half()
@@ -70,7 +70,7 @@ def run_inference_popxl(config: GPTJConfig, dataset, tokenizer, hf_model,
         weights = hf_mapping_lm_tp(config, session, hf_model)
         session.write_variables_data(weights)
 
-    def next_token(inputs, lengths):
+    def full_sequence_next_token(inputs, lengths):
         data_map = {}
         words = to_numpy(inputs, session.inputs.words.dtype).reshape(
             -1, *session.inputs.words.shape)
@@ -84,21 +84,28 @@ def run_inference_popxl(config: GPTJConfig, dataset, tokenizer, hf_model,
         next_token_id = session.run(data_map)[session.outputs.next_token][0]
         return torch.LongTensor(next_token_id)
 
+    if kv_cache:
+        next_token = KVCachedNextToken(config, session)
+    else:
+        next_token = full_sequence_next_token
+
+    engine = ContinuousBatchingEngine(
+        next_token,
+        config.model.sequence_length,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+        output_length=output_length,
+        micro_batch_size=config.execution.micro_batch_size)
+
     logging.info("Attach to IPUs")
     with session:
-        answers = batch_inference(
-            unwrap(dataset),
-            next_token,
-            config.model.sequence_length,
-            eos_token_id=tokenizer.eos_token_id,
-            pad_token_id=tokenizer.pad_token_id,
-            output_length=output_length,
-            micro_batch_size=config.execution.micro_batch_size)
-
-    logging.info("popxl output")
-    for a in answers:
-        text = tokenizer.decode(a)
-        logging.info(f"detokenized: {text}")
+        logging.info("popxl output")
+        for request_id, answer in engine.generate(unwrap(dataset)):
+            text = tokenizer.decode(answer)
+            logging.info(f"detokenized {request_id}: {text}")
+    logging.info(f"Slot occupancy: {engine.occupancy:.2%}")
+    if kv_cache:
+        logging.info(f"Prefill steps: {next_token.prefill_steps}, decode steps: {next_token.decode_steps}")
 
 
 def main():
@@ -0,0 +1,94 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+import numpy as np
+import torch
+
+# HF
+from transformers.models.gptj import GPTJConfig as HFConfig
+from transformers.models.gptj.modeling_gptj import GPTJBlock
+
+import popxl
+
+import popxl_addons as addons
+from popxl_addons.patterns import apply_pre_alias_patterns
+
+from config import GPTJConfig
+from modelling.kv_cache import GPTJCachedDecoderBlockTP
+from utils.utils import repeat
+
+
+def test_cached_decoder_block_TP_cmp_huggingface(test_config: GPTJConfig):
+    """Decoding the token at `positions` from the prefilled cache gives the full sequence output at that position."""
+    torch.manual_seed(42)
+
+    batch_size = test_config.execution.micro_batch_size
+    seq_len = test_config.model.sequence_length
+    hidden_size = test_config.model.hidden_size
+    intermediate_size = hidden_size * 4
+
+    # HuggingFace
+    config = HFConfig(hidden_size=hidden_size,
+                      seq_len=seq_len,
+                      n_inner=intermediate_size,
+                      n_head=test_config.model.attention.heads,
+                      rotary_dim=test_config.model.attention.rotary_dim)
+    hf_model = GPTJBlock(config).eval()
+
+    input_t = torch.rand((batch_size, seq_len, hidden_size))
+    output_HF = hf_model(input_t)[0].detach().numpy()
+    positions = np.random.RandomState(0).randint(0, seq_len, (batch_size, )).astype(np.int32)
+    token_t = input_t[np.arange(batch_size), positions]
+
+    # TP
+    n_shards = 4
+    test_config.execution.tensor_parallel = n_shards
+
+    # popxl
+    ir = popxl.Ir()
+    ir.replication_factor = n_shards
+    with ir.main_graph:
+        inputs_data, inputs_host_steam, inputs_tensors = zip(*[
+            addons.host_load(
+                input_t.reshape(-1, hidden_size), popxl.float32, name="input"),
+            addons.host_load(token_t, popxl.float32, name="token"),
+            addons.host_load(positions, popxl.int32, name="positions"),
+        ])
+        x, token, token_positions = inputs_tensors
+
+        args, graph = GPTJCachedDecoderBlockTP(test_config).create_graph(x)
+        vars = args.init()
+        prefill_out, key, value = graph.bind(vars).call(x)
+
+        _, decode_graph = GPTJCachedDecoderBlockTP(test_config).create_graph(token, key, value, token_positions)
+        decode_out, decode_key, decode_value = decode_graph.bind(vars).call(token, key, value, token_positions)
+
+        prefill_d2h = addons.host_store(prefill_out)
+        decode_d2h = addons.host_store(decode_out)
+        key_d2h = addons.host_store(key)
+        decode_key_d2h = addons.host_store(decode_key)
+
+    # Run `OpToIdentityPattern` among others part of `PreAliasPatterns`
+    apply_pre_alias_patterns(ir, level='default')
+
+    weights = GPTJCachedDecoderBlockTP.hf_mapping(test_config, vars, hf_model)
+
+    inputs = {h2d: repeat(data, n_shards)
+              for h2d, data in zip(inputs_host_steam, inputs_data)}
+
+    with popxl.Session(ir, "ipu_hw") as session:
+        session.write_variables_data(weights)
+        outputs_popxl = session.run(inputs)
+
+    prefill_data = outputs_popxl[prefill_d2h]
+    decode_data = outputs_popxl[decode_d2h]
+
+    # Assert all IPU outputs are identical
+    for i in range(1, n_shards):
+        np.testing.assert_equal(prefill_data[0], prefill_data[i])
+        np.testing.assert_equal(decode_data[0], decode_data[i])
+    # Prefill is the uncached layer
+    np.testing.assert_almost_equal(
+        output_HF, prefill_data[0].reshape(output_HF.shape), 3)
+    # Decoding a token rewrites its own key and gives the output at its position
+    np.testing.assert_almost_equal(outputs_popxl[key_d2h], outputs_popxl[decode_key_d2h], 5)
+    np.testing.assert_almost_equal(
+        output_HF[np.arange(batch_size), positions], decode_data[0], 3)
@@ -0,0 +1,112 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+from itertools import count
+
+import pytest
+import torch
+
+from utils.inference import ContinuousBatchingEngine, batch_inference
+
+EOS = 100
+
+
+def count_up(tokens, lengths):
+    """Fake step function: the next token of every row is its last token plus one."""
+    return tokens[torch.arange(len(lengths)), lengths - 1] + 1
+
+
+def prompt(last_token, length=3):
+    return torch.arange(last_token - length + 1, last_token + 1)
+
+
+def test_slot_admission():
+    engine = ContinuousBatchingEngine(count_up, 16, eos_token_id=EOS, micro_batch_size=2)
+    for last_token in [98, 90, 99]:
+        engine.submit(prompt(last_token))
+
+    assert engine.step() == []
+    assert engine.request_ids.tolist() == [0, 1]
+    assert engine.num_active == 2 and engine.num_queued == 1
+
+    # Request 0 emits 99 then EOS and frees its slot, which request 2 takes at the next step
+    (request_id, tokens), = engine.step()
+    assert request_id == 0
+    assert tokens.tolist() == [99, EOS]
+    assert engine.num_active == 1
+    engine.step()
+    assert engine.request_ids.tolist() == [2, 1]
+    assert engine.num_queued == 0
+
+
+def test_bucket_selection():
+    engine = ContinuousBatchingEngine(count_up, 32, eos_token_id=EOS, output_length=1, micro_batch_size=2,
+                                      prompt_bucket_size=4)
+    # Buckets of the prompt lengths: 0, 2, 0, 2, 0
+    for length in [2, 9, 3, 10, 4]:
+        engine.submit(prompt(50, length))
+
+    # Every request finishes in the step it is admitted in
+    admitted = []
+    while not engine.done():
+        admitted.append(sorted(request_id for request_id, _ in engine.step()))
+    # Free slots are filled from the bucket of the oldest waiting request
+    assert admitted[0] == [0, 2]
+    assert admitted[1] == [1, 3]
+    assert admitted[2] == [4]
+
+
+def test_stop_on_eos():
+    engine = ContinuousBatchingEngine(count_up, 16, eos_token_id=EOS, micro_batch_size=2)
+    engine.submit(prompt(97))
+    engine.submit(prompt(10))
+    results = dict(engine.run())
+    assert results[0].tolist() == [98, 99, EOS]
+    # Request 1 never emits EOS, so it runs to the sequence length
+    assert results[1].tolist() == list(range(11, 11 + 16 - 3))
+
+
+def test_stop_on_output_length():
+    engine = ContinuousBatchingEngine(count_up, 16, eos_token_id=EOS, output_length=4, micro_batch_size=3)
+    for last_token in [10, 98, 20]:
+        engine.submit(prompt(last_token))
+    results = dict(engine.run())
+    assert results[0].tolist() == [11, 12, 13, 14]
+    assert results[1].tolist() == [99, EOS]
+    assert results[2].tolist() == [21, 22, 23, 24]
+
+
+def test_prompt_length_check():
+    engine = ContinuousBatchingEngine(count_up, 8, eos_token_id=EOS)
+    with pytest.raises(ValueError):
+        engine.submit(prompt(50, 8))
+
+
+@pytest.mark.parametrize("lookahead", [1, 3])
+def test_generate_lookahead(lookahead):
+    micro_batch_size = 2
+    engine = ContinuousBatchingEngine(count_up, 16, eos_token_id=EOS, output_length=2,
+                                      micro_batch_size=micro_batch_size)
+    pulled = []
+
+    def requests():
+        for request_id in count():
+            pulled.append(request_id)
+            yield prompt(request_id + 10)
+
+    # Requests are pulled from an unbounded iterable only as the slots free up
+    for num_results, (request_id, tokens) in enumerate(engine.generate(requests(), lookahead=lookahead), 1):
+        assert tokens.tolist() == [request_id + 11, request_id + 12]
+        assert len(pulled) - num_results <= lookahead + micro_batch_size
+        if num_results == 10:
+            break
+
+
+def test_batch_inference_order():
+    dataset = [prompt(last_token) for last_token in [97, 10, 98, 20, 99]]
+    results = batch_inference(dataset, count_up, 16, EOS, output_length=4, micro_batch_size=2)
+    assert [result.tolist() for result in results] == [
+        [98, 99, EOS],
+        [11, 12, 13, 14],
+        [99, EOS],
+        [21, 22, 23, 24],
+        [EOS],
+    ]
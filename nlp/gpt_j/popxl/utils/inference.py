@@ -1,6 +1,204 @@
 # Copyright (c) 2022 Graphcore Ltd. All rights reserved.
-from typing import Callable, Iterable, List, Optional
+from collections import deque
+from itertools import islice
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
 import torch
+from torch.nn.utils.rnn import pad_sequence
+
+
+class ContinuousBatchingEngine:
+    """Continuous batching scheduler for a generation loop on the host.
+
+    The engine owns a fixed micro batch of `micro_batch_size` slots. Each slot holds the state
+    of one request: its tokens, its current length, the number of tokens generated so far and
+    its request id. Every step calls `next_token_fn` once for the whole micro batch, appends the new
+    tokens of the active slots, checks the stop conditions of all slots at once and refills
+    the finished slots from the request queue before the next step.
+
+    Queued requests are grouped in buckets of similar prompt length. Free slots are refilled from
+    the bucket holding the oldest waiting request, so requests admitted together have prompts of
+    similar length while no request waits behind younger ones of another bucket.
+
+    Example:
+        engine = ContinuousBatchingEngine(next_token_fn, sequence_length=256, eos_token_id=50256)
+        for request_id, tokens in engine.generate(prompts):
+            ...
+    """
+
+    def __init__(self,
+                 next_token_fn: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+                 sequence_length: int,
+                 eos_token_id: int,
+                 pad_token_id: int = 0,
+                 output_length: Optional[int] = None,
+                 micro_batch_size: int = 1,
+                 prompt_bucket_size: Optional[int] = None):
+        """
+        Args:
+            next_token_fn (Callable[[torch.Tensor, torch.Tensor], torch.Tensor]): Heuristic for batched next token generation.
+                                See `batch_inference`.
+            sequence_length (int): length of the sequences. Each slot has the same sequence length, but different padding.
+            eos_token_id (int): end of text token
+            pad_token_id (int, optional): token index used for padding. Defaults to 0.
+            output_length (Optional[int], optional): Maximum number of tokens to generate. Defaults to None (no limit).
+            micro_batch_size (int, optional): number of slots. Defaults to 1.
+            prompt_bucket_size (Optional[int], optional): width of the prompt length buckets used for admission.
+                                Defaults to None, a single bucket (first in, first out).
+        """
+        self.next_token_fn = next_token_fn
+        self.sequence_length = sequence_length
+        self.eos_token_id = eos_token_id
+        self.pad_token_id = pad_token_id
+        self.output_length = output_length
+        self.micro_batch_size = micro_batch_size
+        self.prompt_bucket_size = prompt_bucket_size
+
+        # Per-slot state. Free slots hold a single padding token so `next_token_fn` can always
+        # index the last token of every row.
+        self.tokens = torch.full((micro_batch_size, sequence_length), pad_token_id).long()
+        self.lengths = torch.ones((micro_batch_size, )).long()
+        self.generated = torch.zeros((micro_batch_size, )).long()
+        self.request_ids = torch.full((micro_batch_size, ), -1).long()
+        self.active = torch.zeros((micro_batch_size, ), dtype=torch.bool)
+        self._slots = torch.arange(0, micro_batch_size).long()
+
+        # Request queue: bucket -> deque of (request_id, tokens), in order of submission
+        self.queues: Dict[int, Deque[Tuple[int, torch.Tensor]]] = {}
+        self.num_queued = 0
+        self._next_request_id = 0
+
+        # Statistics
+        self.steps = 0
+        self.active_slot_steps = 0
+
+    @property
+    def num_active(self) -> int:
+        return int(self.active.sum())
+
+    @property
+    def occupancy(self) -> float:
+        """Mean fraction of slots that were active across all steps so far."""
+        return self.active_slot_steps / max(self.steps * self.micro_batch_size, 1)
+
+    def done(self) -> bool:
+        return self.num_queued == 0 and not bool(self.active.any())
+
+    def submit(self, tokens: torch.Tensor, request_id: Optional[int] = None) -> int:
+        """Add a prompt to the request queue.
+
+        Args:
+            tokens (torch.Tensor): prompt token ids, of shape [length], with 0 < length < sequence_length.
+            request_id (Optional[int], optional): id returned with the result. Defaults to a new sequential id.
+
+        Returns:
+            int: the request id
+        """
+        length = len(tokens)
+        if not 0 < length < self.sequence_length:
+            raise ValueError(f"Prompt length {length} must be between 1 and sequence_length - 1 ({self.sequence_length - 1}).")
+        if request_id is None:
+            request_id = self._next_request_id
+        self._next_request_id = max(self._next_request_id, request_id + 1)
+        bucket = 0 if self.prompt_bucket_size is None else (length - 1) // self.prompt_bucket_size
+        self.queues.setdefault(bucket, deque()).append((request_id, tokens))
+        self.num_queued += 1
+        return request_id
+
+    def _admit(self):
+        free = self._slots[~self.active]
+        admitted: List[Tuple[int, torch.Tensor]] = []
+        while len(admitted) < len(free) and self.num_queued > 0:
+            # Bucket holding the oldest waiting request
+            bucket = min(self.queues, key=lambda b: self.queues[b][0][0])
+            queue = self.queues[bucket]
+            take = min(len(free) - len(admitted), len(queue))
+            admitted.extend(queue.popleft() for _ in range(take))
+            if not queue:
+                del self.queues[bucket]
+            self.num_queued -= take
+        if not admitted:
+            return
+
+        slots = free[:len(admitted)]
+        prompts = [tokens.long() for _, tokens in admitted]
+        padded = pad_sequence(prompts, batch_first=True, padding_value=self.pad_token_id)
+        self.tokens[slots] = self.pad_token_id
+        self.tokens[slots, :padded.shape[1]] = padded
+        self.lengths[slots] = torch.tensor([len(p) for p in prompts]).long()
+        self.generated[slots] = 0
+        self.request_ids[slots] = torch.tensor([request_id for request_id, _ in admitted]).long()
+        self.active[slots] = True
+
+    def step(self) -> List[Tuple[int, torch.Tensor]]:
+        """Refill the free slots, generate one token for every active slot and release the finished slots.
+
+        Returns:
+            List[Tuple[int, torch.Tensor]]: (request id, generated tokens) for each request finished in this step.
+        """
+        self._admit()
+        if not self.active.any():
+            return []
+        new_token = self.next_token_fn(self.tokens, self.lengths).reshape(-1)
+        self.steps += 1
+        self.active_slot_steps += self.num_active
+
+        slots = self._slots[self.active]
+        lengths = self.lengths[slots]
+        self.tokens[slots, lengths] = new_token[slots]
+        self.lengths[slots] += 1
+        self.generated[slots] += 1
+
+        finished = (new_token == self.eos_token_id) | (self.lengths >= self.sequence_length)
+        if self.output_length:
+            finished |= self.generated >= self.output_length
+        finished &= self.active
+
+        results = []
+        for slot in self._slots[finished].tolist():
+            end = int(self.lengths[slot])
+            start = end - int(self.generated[slot])
+            results.append((int(self.request_ids[slot]), self.tokens[slot, start:end].clone()))
+        self.active[finished] = False
+        self.lengths[finished] = 1
+        self.tokens[finished, 0] = self.pad_token_id
+        return results
+
+    def run(self) -> Iterator[Tuple[int, torch.Tensor]]:
+        """Step until the request queue is empty and all slots are free, yielding results as they finish."""
+        while not self.done():
+            yield from self.step()
+
+    def generate(self, requests: Iterable[torch.Tensor],
+                 lookahead: Optional[int] = None) -> Iterator[Tuple[int, torch.Tensor]]:
+        """Stream the results of a (possibly unbounded) iterable of prompts.
+
+        Prompts are pulled from `requests` only as slots become free, keeping at most `lookahead`
+        requests in the queue. Request ids are positions in `requests`, offset by the number of
+        requests already submitted to the engine. Results are yielded in completion order.
+
+        Args:
+            requests (Iterable[torch.Tensor]): prompts
+            lookahead (Optional[int], optional): maximum number of queued requests, the pool the
+                                prompt length buckets are formed from. Defaults to 4 * micro_batch_size.
+
+        Yields:
+            Tuple[int, torch.Tensor]: request id and generated tokens
+        """
+        lookahead = lookahead or 4 * self.micro_batch_size
+        requests = iter(requests)
+        exhausted = False
+        while True:
+            if not exhausted:
+                pending = max(lookahead + self.micro_batch_size - self.num_active - self.num_queued, 0)
+                for tokens in islice(requests, pending):
+                    self.submit(tokens)
+                    pending -= 1
+                exhausted = pending > 0
+            if self.done():
+                if exhausted:
+                    return
+                continue
+            yield from self.step()
 
 
 def batch_inference(
@@ -10,9 +208,11 @@ def batch_inference(
         eos_token_id: int,
         pad_token_id: int = 0,
         output_length: Optional[int] = None,
-        micro_batch_size: int = 1) -> List[torch.Tensor]:
+        micro_batch_size: int = 1,
+        prompt_bucket_size: Optional[int] = None) -> List[torch.Tensor]:
     """Runs inference with a fixed micro_batch_size and the generation loop on the host.
         Results are returned in the same order as the dataset.
+        Use `ContinuousBatchingEngine.generate` to stream results as they finish instead.
 
     Args:
         dataset (Iterable[torch.Tensor]): data
@@ -29,71 +229,21 @@ def batch_inference(
         pad_token_id (int, optional): token index used for padding. Defaults to 0.
         output_length: Optional[int] = Maximum number of tokens to generate.
         micro_batch_size (int, optional): size of batches. Defaults to 1.
+        prompt_bucket_size (Optional[int], optional): width of the prompt length buckets used to admit
+                                new requests. Defaults to None (first in, first out).
 
     Returns:
         List[torch.Tensor]: new generated tokens for each batch, in the same order as the dataset.
     """
-    # Create buffers
-    batch = torch.full((micro_batch_size, sequence_length),
-                       pad_token_id).long()
-    batch_lens = torch.zeros((micro_batch_size, )).long()
-    batch_ids = torch.zeros((micro_batch_size, )).long()
-    batch_generated = torch.zeros((micro_batch_size, )).long()
-    sample_id = 0
-    samples = 0
-
-    def should_stop(i, token):
-        return (token == eos_token_id or batch_lens[i] >= sequence_length or (output_length and batch_generated[i] >= output_length))
-
-    # Initialise buffers with start
-    dl = iter(dataset)
-    for i in range(micro_batch_size):
-        data = next(dl)
-        b_len = len(data)
-        batch[i, :b_len].copy_(data)
-        batch_lens[i] = b_len
-        batch_ids[i] = sample_id
-        sample_id += 1
-
-    # Used for index_put_
-    axis_0 = torch.arange(0, micro_batch_size).long()
-
-    results = {}
-    rampdown = False
-    dummy_data = [torch.zeros(()).long() for _ in range(micro_batch_size)]
-    dummy_is = set()
-    while True:
-        new_token = next_token_fn(batch, batch_lens)
-        # Update
-        torch.index_put_(batch, (axis_0, batch_lens), new_token)
-        batch_lens += 1
-        batch_generated += 1
-        # Yield result if needed
-        for i, t in enumerate(new_token):
-            # Should stop?
-            if i not in dummy_is and should_stop(i, t):
-                results[int(
-                    batch_ids[i]
-                )] = batch[i, batch_lens[i] -
-                           batch_generated[i]:batch_lens[i]].clone()
-                try:
-                    data = next(dl)
-                except StopIteration as _:
-                    rampdown = True
-                    samples = sample_id
-                    dl = iter(dummy_data)
-                    data = next(dl)
-
-                if rampdown:
-                    dummy_is.add(i)
-                    if len(dummy_is) == micro_batch_size:
-                        return [results[i] for i in range(samples)]
-                b_len = max(sum(data.size()),1)
-                batch[i, :b_len].copy_(data)
-                batch_lens[i] = b_len
-                batch_ids[i] = sample_id
-                batch_generated[i] = 0
-                sample_id += 1
+    engine = ContinuousBatchingEngine(next_token_fn,
+                                      sequence_length,
+                                      eos_token_id,
+                                      pad_token_id=pad_token_id,
+                                      output_length=output_length,
+                                      micro_batch_size=micro_batch_size,
+                                      prompt_bucket_size=prompt_bucket_size)
+    results = dict(engine.generate(dataset))
+    return [results[i] for i in range(len(results))]
 
 
 if __name__ == "__main__":
@@ -109,11 +259,13 @@ if __name__ == "__main__":
     def random_next_token(*_, **__):
         return torch.randint(0, 10, (batch_size, )).long()
 
-    results = batch_inference(dataset,
-                              random_next_token,
-                              max_len + out_tokens,
-                              eos_token_id=1000,
-                              pad_token_id=0,
-                              output_length=out_tokens,
-                              micro_batch_size=batch_size)
-    print(*results, sep='\n')
+    engine = ContinuousBatchingEngine(random_next_token,
+                                      max_len + out_tokens,
+                                      eos_token_id=5,
+                                      pad_token_id=0,
+                                      output_length=out_tokens,
+                                      micro_batch_size=batch_size,
+                                      prompt_bucket_size=8)
+    for request_id, tokens in engine.generate(dataset):
+        print(request_id, tokens)
+    print(f"Steps: {engine.steps}, slot occupancy: {engine.occupancy:.2%}")
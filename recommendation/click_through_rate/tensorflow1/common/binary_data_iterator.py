@@ -0,0 +1,199 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Binary version of the text datasets read by `DataIterator`.
+
+The text lines and the vocabularies are converted once into integer ids, stored in a `.npz` file next to the text file:
+    target, uid, mid, cat: one entry per sample
+    his_offsets: the history of sample i is mid_his[his_offsets[i]:his_offsets[i + 1]] (same for cat_his)
+    mid_his, cat_his: the histories of all the samples, concatenated
+    mid_cat: category of every mid id, used for the negative samples
+    mid_list_for_random: mid ids the negative samples are drawn from
+    n: number of uids, mids and cats
+"""
+
+import argparse
+import os
+
+import numpy as np
+
+from common.data_iterator import load_dict, fopen
+
+
+NEG_SAMPLES = 5
+
+
+def binary_path(source):
+    return source + '.npz'
+
+
+def convert_to_binary(source, uid_voc, mid_voc, cat_voc,
+                      item_info="common/item-info", reviews_info="common/reviews-info"):
+    uid_dict, mid_dict, cat_dict = [load_dict(voc) for voc in (uid_voc, mid_voc, cat_voc)]
+
+    # Same mapping as DataIterator.meta_id_map: the category of the first item-info line of every mid
+    mid_cat = np.zeros(max(mid_dict.values(), default=0) + 1, dtype=np.int32)
+    seen = set()
+    with open(item_info, "r") as f_meta:
+        for line in f_meta:
+            arr = line.strip().split("\t")
+            if arr[0] not in seen:
+                seen.add(arr[0])
+                mid_cat[mid_dict.get(arr[0], 0)] = cat_dict.get(arr[1], 0)
+
+    with open(reviews_info, "r") as f_review:
+        mid_list_for_random = np.array([mid_dict.get(line.strip().split("\t")[1], 0) for line in f_review],
+                                       dtype=np.int32)
+
+    target, uid, mid, cat, his_lengths, mid_his, cat_his = [], [], [], [], [], [], []
+    with fopen(source, 'r') as f_source:
+        for line in f_source:
+            ss = line.strip("\n").split("\t")
+            mids = [mid_dict.get(fea, 0) for fea in ss[4].split("\x02")]
+            cats = [cat_dict.get(fea, 0) for fea in ss[5].split("\x02")]
+            if len(mids) != len(cats):
+                raise ValueError(f"Mid and cat histories of different lengths in {source}: {line}")
+            target.append(float(ss[0]))
+            uid.append(uid_dict.get(ss[1], 0))
+            mid.append(mid_dict.get(ss[2], 0))
+            cat.append(cat_dict.get(ss[3], 0))
+            his_lengths.append(len(mids))
+            mid_his.extend(mids)
+            cat_his.extend(cats)
+
+    output = binary_path(source)
+    np.savez(output,
+             target=np.array(target, dtype=np.float32),
+             uid=np.array(uid, dtype=np.int32),
+             mid=np.array(mid, dtype=np.int32),
+             cat=np.array(cat, dtype=np.int32),
+             his_offsets=np.concatenate([[0], np.cumsum(his_lengths)]).astype(np.int64),
+             mid_his=np.array(mid_his, dtype=np.int32),
+             cat_his=np.array(cat_his, dtype=np.int32),
+             mid_cat=mid_cat,
+             mid_list_for_random=mid_list_for_random,
+             n=np.array([len(uid_dict), len(mid_dict), len(cat_dict)]))
+    return output
+
+
+class BinaryDataIterator:
+    """Iterates over the micro-batches of a binary dataset, with the same batching as `DataIterator`.
+
+    Buffers of `micro_batch_size * max_num_micro_batches` samples are sorted by history length, longest first,
+    and split into micro-batches. The batches are returned as padded numpy arrays, as by `prepare_data`,
+    with the negative samples if `return_neg` is set.
+    Each iteration over the object is one epoch.
+    """
+
+    def __init__(self, source,
+                 micro_batch_size=128,
+                 maxlen=100,
+                 skip_empty=False,
+                 shuffle_each_epoch=False,
+                 sort_by_length=True,
+                 max_num_micro_batches=20,
+                 minlen=None,
+                 return_neg=False):
+        data = np.load(source)
+        self.target = data['target']
+        self.uid = data['uid']
+        self.mid = data['mid']
+        self.cat = data['cat']
+        self.his_offsets = data['his_offsets']
+        self.mid_his = data['mid_his']
+        self.cat_his = data['cat_his']
+        self.mid_cat = data['mid_cat']
+        self.mid_list_for_random = data['mid_list_for_random']
+        self.n_uid, self.n_mid, self.n_cat = data['n'].tolist()
+        self.his_length = np.diff(self.his_offsets)
+
+        self.micro_batch_size = micro_batch_size
+        self.maxlen = maxlen
+        self.minlen = minlen
+        self.skip_empty = skip_empty
+        self.shuffle = shuffle_each_epoch
+        self.sort_by_length = sort_by_length
+        self.k = micro_batch_size * max_num_micro_batches
+        self.return_neg = return_neg
+
+    def get_n(self):
+        return self.n_uid, self.n_mid, self.n_cat
+
+    def __len__(self):
+        return len(self.target)
+
+    def batch_indices(self):
+        """Sample indices of the micro-batches of one epoch."""
+        order = np.random.permutation(len(self)) if self.shuffle else np.arange(len(self))
+        for start in range(0, len(order), self.k):
+            buffer = order[start:start + self.k]
+            if self.sort_by_length:
+                buffer = buffer[self.his_length[buffer].argsort()[::-1]]
+            keep = np.ones(len(buffer), dtype=bool)
+            if self.minlen is not None:
+                keep &= self.his_length[buffer] < self.minlen
+            if self.skip_empty:
+                keep &= self.his_length[buffer] > 0
+            buffer = buffer[keep]
+            for batch_start in range(0, len(buffer), self.micro_batch_size):
+                yield buffer[batch_start:batch_start + self.micro_batch_size]
+
+    def sample_negatives(self, mid_his, mid_mask):
+        """Draw NEG_SAMPLES negative mids for every history item, different from the item."""
+        pool = self.mid_list_for_random
+        noclk_mid_his = pool[np.random.randint(0, len(pool), mid_his.shape + (NEG_SAMPLES,))]
+        redraw = (noclk_mid_his == mid_his[..., None]) & (mid_mask[..., None] > 0)
+        while redraw.any():
+            noclk_mid_his[redraw] = pool[np.random.randint(0, len(pool), redraw.sum())]
+            redraw &= noclk_mid_his == mid_his[..., None]
+        noclk_mid_his[mid_mask == 0] = 0
+        noclk_cat_his = self.mid_cat[noclk_mid_his]
+        noclk_cat_his[mid_mask == 0] = 0
+        return noclk_mid_his.astype(np.int64), noclk_cat_his.astype(np.int64)
+
+    def make_batch(self, indices):
+        # Only the last maxlen items of the histories are kept
+        seqlen = np.minimum(self.his_length[indices], self.maxlen)
+        start = self.his_offsets[indices + 1] - seqlen
+        positions = np.arange(self.maxlen)
+        mask = positions < seqlen[:, None]
+        gather = np.minimum(start[:, None] + positions, len(self.mid_his) - 1)
+        mid_his = np.where(mask, self.mid_his[gather], 0).astype(np.int64)
+        cat_his = np.where(mask, self.cat_his[gather], 0).astype(np.int64)
+        mid_mask = mask.astype('float32')
+        target = self.target[indices].astype(np.float64)
+        batch = [self.uid[indices].astype(np.int64), self.mid[indices].astype(np.int64),
+                 self.cat[indices].astype(np.int64), mid_his, cat_his, mid_mask,
+                 np.stack([target, 1 - target], axis=1), seqlen]
+        if self.return_neg:
+            batch.extend(self.sample_negatives(mid_his, mid_mask))
+        return batch
+
+    def __iter__(self):
+        for indices in self.batch_indices():
+            yield self.make_batch(indices)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert the CTR text datasets into binary datasets read by BinaryDataIterator')
+    parser.add_argument('--data-dir', type=str, default='common', help='Directory of the text datasets and vocabularies')
+    args = parser.parse_args()
+    for name in ['local_train_splitByUser', 'local_test_splitByUser']:
+        output = convert_to_binary(os.path.join(args.data_dir, name),
+                                   os.path.join(args.data_dir, 'uid_voc.pkl'),
+                                   os.path.join(args.data_dir, 'mid_voc.pkl'),
+                                   os.path.join(args.data_dir, 'cat_voc.pkl'),
+                                   item_info=os.path.join(args.data_dir, 'item-info'),
+                                   reviews_info=os.path.join(args.data_dir, 'reviews-info'))
+        print(f"Converted {name} into {output}")
@@ -17,9 +17,11 @@
 # This file has been modified by Graphcore Ltd.
 # This file includes modified code from the file macro_benchmark/DIEN/script/train.py in the AI-matrix repository.
 
+import os
 import numpy as np
 import logging
 from common.data_iterator import DataIterator
+from common.binary_data_iterator import BinaryDataIterator, binary_path
 
 EMBEDDING_DIM = 18
 TRAIN_DATA_SIZE = 1086120
@@ -91,6 +93,20 @@ def prepare_data(opts, input, target, maxlen = None, return_neg = False):
         return uids, mids, cats, mid_his, cat_his, mid_mask, np.array(target), np.array(lengths_x)
 
 
+def get_batches(opts, file, uid_voc, mid_voc, cat_voc, return_neg=False):
+    """
+    Return the data iterator and its micro-batches, in the format of `prepare_data`. The binary dataset
+    written by common/binary_data_iterator.py is read if it exists, else the text dataset is parsed.
+    """
+    micro_batch_size = opts['micro_batch_size']
+    if os.path.exists(binary_path(file)):
+        tf_log.info(f"Reading the binary dataset {binary_path(file)}")
+        data_itr = BinaryDataIterator(binary_path(file), micro_batch_size, opts["max_seq_len"], shuffle_each_epoch=False, return_neg=return_neg)
+        return data_itr, iter(data_itr)
+    data_itr = DataIterator(file, uid_voc, mid_voc, cat_voc, micro_batch_size, opts["max_seq_len"], shuffle_each_epoch=False)
+    return data_itr, (prepare_data(opts, src, tgt, opts["max_seq_len"], return_neg=return_neg) for src, tgt in data_itr)
+
+
 def data_generator(opts, is_training, return_neg=False):
     if is_training:
         file = "./common/local_train_splitByUser"
@@ -103,12 +119,12 @@ def data_generator(opts, is_training, return_neg=False):
     cat_voc = "./common/cat_voc.pkl"
     micro_batch_size = opts['micro_batch_size']
 
-    data_itr = DataIterator(file, uid_voc, mid_voc, cat_voc, micro_batch_size, opts["max_seq_len"], shuffle_each_epoch=False)
+    data_itr, batches = get_batches(opts, file, uid_voc, mid_voc, cat_voc, return_neg=return_neg)
     tf_log.info(f"data n: {data_itr.get_n()}")
     i = 0
-    for src, tgt in data_itr:
+    for batch in batches:
         i += micro_batch_size
-        uids, mids, cats, mid_his, cat_his, mid_mask, target, seqlen = prepare_data(opts, src, tgt, opts["max_seq_len"], return_neg=return_neg)
+        uids, mids, cats, mid_his, cat_his, mid_mask, target, seqlen = batch[:8]
         if i >= data_size:
             raise StopIteration
         if len(uids) < opts['micro_batch_size']:
@@ -126,12 +142,11 @@ def parse_data(opts):
     cat_voc = "./common/cat_voc.pkl"
     micro_batch_size = opts['micro_batch_size']
 
-    data_itr = DataIterator(file, uid_voc, mid_voc, cat_voc, micro_batch_size, opts["max_seq_len"], shuffle_each_epoch=False)
+    _, batches = get_batches(opts, file, uid_voc, mid_voc, cat_voc, return_neg=True)
     tf_log.debug("Start to prepare data.")
     i = 0
-    for src, tgt in data_itr:
+    for items in batches:
         i += micro_batch_size
-        items = prepare_data(opts, src, tgt, opts["max_seq_len"], return_neg=True)
         for j in range(len(items[0])):
             for i, key in enumerate(data.keys()):
                 data[key].append(np.squeeze(np.array(items[i][j])).tolist())
@@ -0,0 +1,82 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests covering the binary dataset, against the text DataIterator.
+"""
+import pickle as pkl
+import sys
+from pathlib import Path
+
+import numpy as np
+
+# Add common module to path
+common_path = Path(Path(__file__).absolute().parent.parent.parent)
+sys.path.append(str(common_path))
+from common.binary_data_iterator import BinaryDataIterator, convert_to_binary, NEG_SAMPLES
+from common.data_generation import prepare_data
+from common.data_iterator import DataIterator
+
+
+def write_text_dataset(data_dir, num_samples=50, num_items=30, num_cats=4, seed=0):
+    rng = np.random.default_rng(seed)
+    items = [f"item{i}" for i in range(num_items)]
+    item_cats = {item: f"cat{rng.integers(num_cats)}" for item in items}
+    vocs = {"uid_voc.pkl": {f"user{i}": i for i in range(10)},
+            "mid_voc.pkl": {item: i for i, item in enumerate(items)},
+            "cat_voc.pkl": {f"cat{i}": i for i in range(num_cats)}}
+    for name, voc in vocs.items():
+        with open(data_dir / name, "wb") as f:
+            pkl.dump(voc, f)
+    with open(data_dir / "item-info", "w") as f:
+        f.writelines(f"{item}\t{cat}\n" for item, cat in item_cats.items())
+    with open(data_dir / "reviews-info", "w") as f:
+        f.writelines(f"user0\t{items[i]}\t5.0\t0\n" for i in rng.integers(num_items, size=200))
+    with open(data_dir / "local_train_splitByUser", "w") as f:
+        for _ in range(num_samples):
+            history = [items[i] for i in rng.integers(num_items, size=rng.integers(1, 15))]
+            item = items[rng.integers(num_items)]
+            f.write("\t".join([str(rng.integers(2)), f"user{rng.integers(10)}", item, item_cats[item],
+                               "\x02".join(history), "\x02".join(item_cats[h] for h in history)]) + "\n")
+    return item_cats
+
+
+def test_binary_data_iterator(tmp_path, monkeypatch):
+    (tmp_path / "common").mkdir()
+    item_cats = write_text_dataset(tmp_path / "common")
+    monkeypatch.chdir(tmp_path)
+    source = "common/local_train_splitByUser"
+    vocs = ["common/uid_voc.pkl", "common/mid_voc.pkl", "common/cat_voc.pkl"]
+    opts = {"micro_batch_size": 8, "max_seq_len": 10}
+
+    text_iterator = DataIterator(source, *vocs, micro_batch_size=8, maxlen=10, max_num_micro_batches=3)
+    binary_iterator = BinaryDataIterator(convert_to_binary(source, *vocs), micro_batch_size=8, maxlen=10,
+                                         max_num_micro_batches=3, return_neg=True)
+    assert binary_iterator.get_n() == text_iterator.get_n()
+
+    num_batches = 0
+    for (src, tgt), binary_batch in zip(text_iterator, binary_iterator):
+        text_batch = prepare_data(opts, src, tgt, opts["max_seq_len"], return_neg=True)
+        # Everything but the negative samples, which are random
+        for text_array, binary_array in zip(text_batch[:8], binary_batch[:8]):
+            np.testing.assert_equal(binary_array, text_array)
+        mid_his, mid_mask = binary_batch[3], binary_batch[5]
+        noclk_mids, noclk_cats = binary_batch[8:]
+        assert noclk_mids.shape == mid_his.shape + (NEG_SAMPLES,)
+        valid = mid_mask > 0
+        assert np.all(noclk_mids[valid] != mid_his[valid][:, None])
+        assert np.all(noclk_mids[~valid] == 0)
+        expected_cats = np.array([int(item_cats[f"item{mid}"][3:]) for mid in noclk_mids[valid].flatten()])
+        np.testing.assert_equal(noclk_cats[valid].flatten(), expected_cats)
+        num_batches += 1
+    assert num_batches == 7
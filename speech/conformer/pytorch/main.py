@@ -29,7 +29,7 @@ from src.utils.initializer import initialize
 from src.trainer import Trainer
 from src.utils.lr_scheduler import WarmupLR
 from src.utils.checkpoint import CheckPoint
-from src.iterator.dataset import Dataset
+from src.iterator.dataset import Dataset, extract_features
 from src.utils.file_utils import read_symbol_table, read_non_lang_symbols
 from src.iterator.dataset import IPUCollateFn
 from src.iterator.generate_data import GenerateDataset
@@ -55,6 +55,7 @@ class Workflow:
         self.ipu_options = None
         self.vocab_size = self.args['decoder']['vocab_size']
         self.train_dataset = None
+        self.length_buckets = None
         self.val_dataset = None
         self.train_iterator = None
         self.val_iterator = None
@@ -230,7 +231,7 @@ class Workflow:
     def build_checkpoints(self):
         self.checkpoint = CheckPoint(0, self.logger)
 
-    def build_dataset(self):
+    def build_data_conf(self):
         self.train_conf = self.args['train_conf']
         self.cv_conf = copy.deepcopy(self.train_conf)
         self.cv_conf['speed_perturb'] = False
@@ -238,11 +239,28 @@ class Workflow:
         self.cv_conf['spec_sub'] = False
         self.cv_conf['shuffle'] = False
 
+    def build_dataset(self):
+        self.build_data_conf()
         if not self.args['train_dataset']['use_generated_data']:
             lang = self.args['vocab']['vocab_path']
             symbol_table = read_symbol_table(lang)
-            self.train_dataset = Dataset(self.args['train_dataset']['data_mode'], self.args['train_dataset']
-                                         ['data_list'], symbol_table, self.train_conf, None, None, True)
+            self.length_buckets = self.args['train_dataset'].get('length_buckets')
+            if self.length_buckets:
+                if self.args['train_dataset']['data_mode'] != 'feature':
+                    # the archive index gives the lengths without decoding, raw/shard data would be
+                    # decoded and fbanked once per bucket
+                    raise ValueError('train_dataset.length_buckets needs train_dataset.data_mode feature, '
+                                     'see `python main.py extract_features`.')
+                # one dataset and one executable per (feature_length, target_length) bucket
+                self.length_buckets = sorted(tuple(bucket) for bucket in self.length_buckets)
+                self.train_dataset = [
+                    Dataset(self.args['train_dataset']['data_mode'], self.args['train_dataset']['data_list'],
+                            symbol_table, self.train_conf, None, None, True, self.length_buckets, bucket)
+                    for bucket in range(len(self.length_buckets))
+                ]
+            else:
+                self.train_dataset = Dataset(self.args['train_dataset']['data_mode'], self.args['train_dataset']
+                                             ['data_list'], symbol_table, self.train_conf, None, None, True)
             self.val_dataset = Dataset(self.args['train_dataset']['data_mode'], self.args['val_dataset']
                                        ['data_list'], symbol_table, self.cv_conf, None, None, partition=False)
         else:
@@ -257,21 +275,17 @@ class Workflow:
         else:
             mode = poptorch.DataLoaderMode.Sync
         if not self.args['train_dataset']['use_generated_data']:
-            self.train_iterator = poptorch.DataLoader(
-                self.ipu_options,
-                self.train_dataset,
-                batch_size=self.args['train_iterator']['batch_size'],
-                num_workers=self.args['train_iterator']['num_workers'],
-                persistent_workers=self.args['train_iterator']['persistent_workers'],
-                async_options=self.args['train_iterator']['async_options'],
-                mode=mode,
-                collate_fn=IPUCollateFn(
+            if self.length_buckets:
+                self.train_iterator = [
+                    self.build_train_loader(dataset, feature_length, target_length, mode)
+                    for dataset, (feature_length, target_length) in zip(self.train_dataset, self.length_buckets)
+                ]
+            else:
+                self.train_iterator = self.build_train_loader(
+                    self.train_dataset,
                     self.train_conf["filter_conf"]["max_length"],
                     self.train_conf["filter_conf"]["token_max_length"],
-                    dtype=self.dtype,
-                    sos_id=self.vocab_size-1,
-                    eos_id=self.vocab_size-1)
-            )
+                    mode)
             self.val_iterator = poptorch.DataLoader(
                 self.ipu_options,
                 self.val_dataset,
@@ -299,6 +313,23 @@ class Workflow:
                 num_workers=self.args['train_iterator']['num_workers'],
             )
 
+    def build_train_loader(self, dataset, max_feature_length, max_target_length, mode):
+        return poptorch.DataLoader(
+            self.ipu_options,
+            dataset,
+            batch_size=self.args['train_iterator']['batch_size'],
+            num_workers=self.args['train_iterator']['num_workers'],
+            persistent_workers=self.args['train_iterator']['persistent_workers'],
+            async_options=self.args['train_iterator']['async_options'],
+            mode=mode,
+            collate_fn=IPUCollateFn(
+                max_feature_length,
+                max_target_length,
+                dtype=self.dtype,
+                sos_id=self.vocab_size-1,
+                eos_id=self.vocab_size-1)
+        )
+
     def build_model(self):
         self.dtype = torch.float16 if self.args['train_dataset']['dtype'] == "FLOAT16" else torch.float32
         encoder = ConformerEncoder(dtype=self.dtype, **self.args['encoder'])
@@ -372,6 +403,24 @@ class Workflow:
         self.build_trainer()
         self.trainer.validate()
 
+    def extract_features(self):
+        """ extract the fbank features of the train and val data lists into archives,
+            to train with '--train_dataset.data_mode feature' """
+        self.print_args()
+        self.build_data_conf()
+        archive_args = self.args['feature_archive']
+        symbol_table = read_symbol_table(self.args['vocab']['vocab_path'])
+        for dataset_name, conf in [('train_dataset', self.train_conf), ('val_dataset', self.cv_conf)]:
+            list_file = extract_features(self.args['train_dataset']['data_mode'],
+                                         self.args[dataset_name]['data_list'],
+                                         symbol_table,
+                                         conf,
+                                         os.path.join(archive_args['output_dir'], dataset_name),
+                                         shard_size=archive_args['shard_size'],
+                                         dtype=archive_args['dtype'],
+                                         num_workers=archive_args['num_workers'])
+            print(f'{dataset_name} features are listed in {list_file}')
+
     def recognize(self):
         self.print_args()
         self.build_logger()
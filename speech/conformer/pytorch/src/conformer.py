@@ -23,12 +23,12 @@ from src.utils.mask import mask_finished_scores
 from src.utils.mask import subsequent_mask
 from src.utils.common import IGNORE_ID
 from src.utils.common import add_sos_eos
-from src.utils.common import log_add
 from src.utils.common import remove_duplicates_and_blank
+from src.utils.ctc_search import batch_prefix_beam_search
+from src.utils.ctc_search import prefix_beam_search
 from src.utils.ipu_pipeline import BasePipelineModel
 
 from typing import List, Optional, Tuple
-from collections import defaultdict
 from torch.nn.utils.rnn import pad_sequence
 
 
@@ -230,12 +230,9 @@ class Conformer(BasePipelineModel):
         speech: torch.Tensor,
         speech_lengths: torch.Tensor,
         beam_size: int,
-        decoding_chunk_size: int = -1,
-        num_decoding_left_chunks: int = -1,
-        simulate_streaming: bool = False,
     ) -> List[int]:
 
-        hyps, tmp, l, en = self._ctc_prefix_beam_search(speech, speech_lengths, beam_size, decoding_chunk_size, num_decoding_left_chunks, simulate_streaming)
+        hyps, _, _ = self._ctc_prefix_beam_search(speech, speech_lengths, beam_size)
         return hyps[0]
 
     def _ctc_prefix_beam_search(
@@ -243,105 +240,79 @@ class Conformer(BasePipelineModel):
         speech: torch.Tensor,
         speech_lengths: torch.Tensor,
         beam_size: int,
-    ) -> Tuple[List[List[int]], torch.Tensor]:
+    ) -> Tuple[List[Tuple[Tuple[int], float]], torch.Tensor, torch.Tensor]:
 
-
-        encoder_out, encoder_mask, feature_length = self._forward_encoder(speech, speech_lengths)  # (B, maxlen, encoder_dim)
-        encoder_out = encoder_out[0]
-
-        maxlen = encoder_out.size(1)
+        encoder_out, encoder_mask, feature_length = self._forward_encoder(speech, speech_lengths)  # (1, maxlen, encoder_dim)
+        encoder_out = encoder_out[0, :feature_length[0]]
         feature_encoder = self.out(encoder_out)
+        ctc_probs = torch.nn.functional.log_softmax(feature_encoder, -1)  # (maxlen, vocab_size)
+        hyps = prefix_beam_search(ctc_probs, beam_size)
+        return hyps, encoder_out, feature_length
 
-        ctc_probs = torch.nn.functional.log_softmax(feature_encoder, -1)
 
-        ctc_probs = ctc_probs.squeeze(0)
-        # cur_hyps: (prefix, (blank_ending_score, none_blank_ending_score))
-        cur_hyps = [(tuple(), (0.0, -float('inf')))]
-        # 2. CTC beam search step by step
-        for t in range(0, maxlen):
-            logp = ctc_probs[t]  # (vocab_size,)
-            # key: prefix, value (pb, pnb), default value(-inf, -inf)
-            next_hyps = defaultdict(lambda: (-float('inf'), -float('inf')))
-            # 2.1 First beam prune: select topk best
-            top_k_logp, top_k_index = logp.topk(beam_size)  # (beam_size,)
-            for s in top_k_index:
-                s = s.item()
-                ps = logp[s].item()
-                for prefix, (pb, pnb) in cur_hyps:
-                    last = prefix[-1] if len(prefix) > 0 else None
-                    if s == 0:  # blank
-                        n_pb, n_pnb = next_hyps[prefix]
-                        n_pb = log_add([n_pb, pb + ps, pnb + ps])
-                        next_hyps[prefix] = (n_pb, n_pnb)
-                    elif s == last:
-                        #  Update *ss -> *s;
-                        n_pb, n_pnb = next_hyps[prefix]
-                        n_pnb = log_add([n_pnb, pnb + ps])
-                        next_hyps[prefix] = (n_pb, n_pnb)
-                        # Update *s-s -> *ss, - is for blank
-                        n_prefix = prefix + (s, )
-                        n_pb, n_pnb = next_hyps[n_prefix]
-                        n_pnb = log_add([n_pnb, pb + ps])
-                        next_hyps[n_prefix] = (n_pb, n_pnb)
-                    else:
-                        n_prefix = prefix + (s, )
-                        n_pb, n_pnb = next_hyps[n_prefix]
-                        n_pnb = log_add([n_pnb, pb + ps, pnb + ps])
-                        next_hyps[n_prefix] = (n_pb, n_pnb)
-
-            next_hyps = sorted(next_hyps.items(),
-                               key=lambda x: log_add(list(x[1])),
-                               reverse=True)
-            cur_hyps = next_hyps[:beam_size]
-        hyps = [(y[0], log_add([y[1][0], y[1][1]])) for y in cur_hyps]
-        return hyps, encoder_out, speech_lengths
+    def attention_rescoring(
+        self,
+        speech: torch.Tensor,
+        speech_lengths: torch.Tensor,
+        beam_size: int,
+        ctc_weight: float = 0.5
+    ) -> Tuple[Tuple[int], float]:
 
+        return self.batch_attention_rescoring(speech, speech_lengths, beam_size, ctc_weight)[0]
 
-    def attention_rescoring(
+
+    def batch_attention_rescoring(
         self,
         speech: torch.Tensor,
         speech_lengths: torch.Tensor,
         beam_size: int,
         ctc_weight: float = 0.5
-    ) -> List[int]:
+    ) -> List[Tuple[Tuple[int], float]]:
+        """ Apply CTC prefix beam search to a batch, and rescore the hyps with the attention decoder
+
+        Args:
+            speech (torch.Tensor): (batch, max_len, feat_dim)
+            speech_length (torch.Tensor): (batch, )
+            beam_size (int): beam size of the CTC prefix beam search
+            ctc_weight (float): weight of the CTC score in the rescoring
 
+        Returns:
+            List[Tuple[Tuple[int], float]]: best hyp and its score, for every utterance
+        """
         device = speech.device
-        hyps, encoder_out, feature_length = self._ctc_prefix_beam_search(
-            speech, speech_lengths, beam_size)
-        assert len(hyps) == beam_size
+        # 1. Encoder and CTC prefix beam search of all the utterances
+        encoder_out, encoder_mask, feature_length = self._forward_encoder(speech, speech_lengths)  # (B, maxlen, encoder_dim)
+        ctc_probs = torch.nn.functional.log_softmax(self.out(encoder_out), -1)  # (B, maxlen, vocab_size)
+        batch_hyps = batch_prefix_beam_search(ctc_probs, feature_length, beam_size)
+
+        # 2. Decoder forward of the hyps of all the utterances at once
+        hyps = [hyp for utt_hyps in batch_hyps for hyp in utt_hyps]
+        utt_index = torch.tensor([index for index, utt_hyps in enumerate(batch_hyps) for _ in utt_hyps],
+                                 device=device, dtype=torch.long)
         hyps_pad = pad_sequence([
             torch.tensor(hyp[0], device=device, dtype=torch.long)
             for hyp in hyps
-        ], True, 0)
+        ], True, self.ignore_id)
         hyps_lens = torch.tensor([len(hyp[0]) for hyp in hyps],
                                  device=device,
                                  dtype=torch.long)
-        hyps_pad, _ = add_sos_eos(hyps_pad, self.sos, self.eos, self.ignore_id)
-        hyps_lens = hyps_lens + 1
-        hyps_lens = torch.tensor([len(hyp[0]) for hyp in hyps], device=device, dtype=torch.long)
-        encoder_out = encoder_out.repeat(beam_size, 1, 1)
-        feature_length = feature_length.repeat(beam_size)
-        decoder_out, target_mask = self.decoder(
-            hs_pad=encoder_out,
-            hlens=feature_length,
-            ys_in_pad=hyps_pad,
-            ys_in_lens=hyps_lens,
+        hyps_in, hyps_out = add_sos_eos(hyps_pad, self.sos, self.eos, self.ignore_id)
+        decoder_out, _ = self.decoder(
+            hs_pad=encoder_out[utt_index],
+            hlens=feature_length[utt_index],
+            ys_in_pad=hyps_in,
+            ys_in_lens=hyps_lens + 1,
         )
-
-        decoder_out = torch.nn.functional.log_softmax(decoder_out, dim=-1)
-        decoder_out = decoder_out.detach().numpy()
-
-        # Only use decoder score for rescoring
-        best_score = -float('inf')
-        best_index = 0
-        for i, hyp in enumerate(hyps):
-            score = 0.0
-            for j, w in enumerate(hyp[0]):
-                score += decoder_out[0][j][w]
-            score += decoder_out[0][len(hyp[0])][self.eos]
-
-            score += hyp[1] * ctc_weight
-            if score > best_score:
-                best_score = score
-                best_index = i
-        return hyps[best_index][0], best_score
+        decoder_out = torch.nn.functional.log_softmax(decoder_out, dim=-1)  # (B*N, maxlen_out, vocab_size)
+
+        # 3. Decoder score of the tokens and eos of every hyp, plus the weighted CTC score
+        ignore = hyps_out == self.ignore_id
+        token_logp = decoder_out.gather(-1, hyps_out.masked_fill(ignore, 0).unsqueeze(-1)).squeeze(-1)
+        scores = token_logp.masked_fill(ignore, 0.0).sum(-1).double()
+        scores = scores + ctc_weight * torch.tensor([hyp[1] for hyp in hyps], dtype=scores.dtype, device=device)
+
+        results = []
+        for utt_hyps, utt_scores in zip(batch_hyps, scores.split([len(utt_hyps) for utt_hyps in batch_hyps])):
+            best_index = utt_scores.argmax().item()
+            results.append((utt_hyps[best_index][0], utt_scores[best_index].item()))
+        return results
@@ -30,6 +30,7 @@ import torch.distributed as dist
 from torch.utils.data import IterableDataset
 
 import src.iterator.processor as processor
+from src.iterator.feature_archive import write_feature_archives
 from src.utils.file_utils import read_lists
 
 
@@ -136,7 +137,9 @@ def Dataset(data_type,
             conf,
             bpe_model=None,
             non_lang_syms=None,
-            partition=True):
+            partition=True,
+            buckets=None,
+            bucket=None):
     """ Construct dataset from arguments
 
         We have two shuffle stage in the Dataset. The first is global
@@ -144,14 +147,55 @@ def Dataset(data_type,
         at training samples level.
 
         Args:
-            data_type(str): raw/shard
+            data_type(str): raw/shard/feature, feature reads the archives
+                written by `extract_features`
             bpe_model(str): model for english bpe part
             partition(bool): whether to do data partition in terms of rank
+            buckets(List[Tuple(int, int)]): (feature_length, target_length)
+                length buckets, see `processor.find_bucket`, only with the
+                feature data type, which knows the lengths from the index
+            bucket(int): only the utterances of this bucket are kept
     """
-    assert data_type in ['raw', 'shard']
+    assert data_type in ['raw', 'shard', 'feature']
     lists = read_lists(data_list_file)
     shuffle = conf.get('shuffle', False)
     dataset = DataList(lists, shuffle=shuffle, partition=partition)
+    if data_type == 'feature':
+        dataset = Processor(dataset, processor.feature_archive_reader,
+                            buckets, bucket)
+    else:
+        assert buckets is None, 'length buckets need the feature data type'
+        dataset = fbank_pipeline(dataset, data_type, symbol_table, conf,
+                                 bpe_model, non_lang_syms)
+
+    spec_aug = conf.get('spec_aug', True)
+    if spec_aug:
+        spec_aug_conf = conf.get('spec_aug_conf', {})
+        dataset = Processor(dataset, processor.spec_aug, **spec_aug_conf)
+
+    if shuffle:
+        shuffle_conf = conf.get('shuffle_conf', {})
+        dataset = Processor(dataset, processor.shuffle, **shuffle_conf)
+
+    sort = conf.get('sort', True)
+    if sort:
+        sort_conf = conf.get('sort_conf', {})
+        dataset = Processor(dataset, processor.sort, **sort_conf)
+
+    batch_conf = conf.get('batch_conf', {})
+    dataset = Processor(dataset, processor.batch, **batch_conf)
+    dataset = Processor(dataset, processor.padding)
+    return dataset
+
+
+def fbank_pipeline(dataset, data_type, symbol_table, conf, bpe_model=None,
+                   non_lang_syms=None):
+    """ Decode, tokenize, filter and extract the fbank features of the
+        utterances listed by `dataset`
+
+        Returns:
+            Iterable[{key, feat, label}]
+    """
     if data_type == 'shard':
         dataset = Processor(dataset, processor.url_opener)
         dataset = Processor(dataset, processor.tar_file_and_group)
@@ -173,25 +217,36 @@ def Dataset(data_type,
 
     fbank_conf = conf.get('fbank_conf', {})
     dataset = Processor(dataset, processor.compute_fbank, **fbank_conf)
+    return dataset
 
-    spec_aug = conf.get('spec_aug', True)
-    if spec_aug:
-        spec_aug_conf = conf.get('spec_aug_conf', {})
-        dataset = Processor(dataset, processor.spec_aug, **spec_aug_conf)
-
-    if shuffle:
-        shuffle_conf = conf.get('shuffle_conf', {})
-        dataset = Processor(dataset, processor.shuffle, **shuffle_conf)
 
-    sort = conf.get('sort', True)
-    if sort:
-        sort_conf = conf.get('sort_conf', {})
-        dataset = Processor(dataset, processor.sort, **sort_conf)
-
-    batch_conf = conf.get('batch_conf', {})
-    dataset = Processor(dataset, processor.batch, **batch_conf)
-    dataset = Processor(dataset, processor.padding)
-    return dataset
+def extract_features(data_type,
+                     data_list_file,
+                     symbol_table,
+                     conf,
+                     output_dir,
+                     shard_size=1000,
+                     dtype='float32',
+                     num_workers=0,
+                     bpe_model=None,
+                     non_lang_syms=None):
+    """ Extract the fbank features of a raw/shard data list into archives,
+        to be read with the 'feature' data type
+
+        Features are extracted once, so without speed perturbation, and
+        with the dither of `fbank_conf` applied once.
+
+        Returns:
+            str: path of the data list of the archives
+    """
+    assert data_type in ['raw', 'shard']
+    conf = dict(conf, speed_perturb=False)
+    lists = read_lists(data_list_file)
+    dataset = DataList(lists, shuffle=False, partition=False)
+    dataset = fbank_pipeline(dataset, data_type, symbol_table, conf,
+                             bpe_model, non_lang_syms)
+    return write_feature_archives(dataset, output_dir, shard_size, dtype,
+                                  num_workers)
 
 
 class IPUCollateFn:
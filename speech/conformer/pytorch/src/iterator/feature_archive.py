@@ -0,0 +1,141 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''
+Offline fbank feature archives.
+
+An archive shard is made of three numpy files sharing a prefix:
+    <prefix>.feats.npy: fbank frames of all the utterances, concatenated [num_frames, num_mel_bins]
+    <prefix>.labels.npy: token ids of all the utterances, concatenated [num_tokens]
+    <prefix>.index.npy: one entry per utterance, with its key and the position
+        of its frames and token ids in the two files above
+The shards are read memory-mapped, and the list of their index files is used as
+the data list of the 'feature' data type of `Dataset`.
+'''
+
+import logging
+import os
+
+import numpy as np
+import torch
+from src.utils.key_utils import AishellKeyMapper
+
+
+INDEX_DTYPE = np.dtype([('key', np.int64),
+                        ('feat_start', np.int64),
+                        ('feat_length', np.int32),
+                        ('label_start', np.int64),
+                        ('label_length', np.int32)])
+
+
+def shard_paths(prefix):
+    return prefix + '.feats.npy', prefix + '.labels.npy', prefix + '.index.npy'
+
+
+class FeatureArchiveWriter:
+    """ Write {key, feat, label} samples into shards of `shard_size` utterances
+
+        Args:
+            output_dir: directory of the shards and of their `data.list`
+            shard_size: number of utterances per shard
+            dtype: numpy dtype the fbank features are stored in
+    """
+
+    def __init__(self, output_dir, shard_size=1000, dtype='float32'):
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.dtype = np.dtype(dtype)
+        self.index_files = []
+        self._reset()
+        os.makedirs(output_dir, exist_ok=True)
+
+    def _reset(self):
+        self.keys = []
+        self.feats = []
+        self.labels = []
+
+    def write(self, sample):
+        key = sample['key']
+        # keys of tar shards are not encoded yet
+        if isinstance(key, str):
+            key = AishellKeyMapper.encode(key)
+        self.keys.append(int(key))
+        self.feats.append(np.asarray(sample['feat'], dtype=self.dtype))
+        self.labels.append(np.asarray(sample['label'], dtype=np.int32))
+        if len(self.keys) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if not self.keys:
+            return
+        prefix = os.path.join(self.output_dir, 'features_{:05d}'.format(len(self.index_files)))
+        feats_file, labels_file, index_file = shard_paths(prefix)
+        index = np.zeros(len(self.keys), dtype=INDEX_DTYPE)
+        index['key'] = self.keys
+        index['feat_length'] = [len(feat) for feat in self.feats]
+        index['feat_start'] = np.cumsum(index['feat_length']) - index['feat_length']
+        index['label_length'] = [len(label) for label in self.labels]
+        index['label_start'] = np.cumsum(index['label_length']) - index['label_length']
+        np.save(feats_file, np.concatenate(self.feats))
+        np.save(labels_file, np.concatenate(self.labels))
+        # The index is written last, so listed shards are always complete
+        np.save(index_file, index)
+        self.index_files.append(index_file)
+        self._reset()
+
+    def close(self):
+        """ Write the last shard and the list of the shards, returns the path of the list
+        """
+        self.flush()
+        list_file = os.path.join(self.output_dir, 'data.list')
+        with open(list_file, 'w', encoding='utf8') as fout:
+            for index_file in self.index_files:
+                fout.write(os.path.abspath(index_file) + '\n')
+        return list_file
+
+
+def write_feature_archives(dataset, output_dir, shard_size=1000, dtype='float32', num_workers=0):
+    """ Extract the features of an iterable dataset of {key, feat, label} into archives
+
+        Args:
+            dataset: torch IterableDataset, partitioned across the dataloader workers
+            num_workers: number of processes running the dataset
+
+        Returns:
+            str: path of the data list of the archives
+    """
+    loader = torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=num_workers)
+    writer = FeatureArchiveWriter(output_dir, shard_size, dtype)
+    num_utterances = 0
+    for num_utterances, sample in enumerate(loader, 1):
+        writer.write(sample)
+        if num_utterances % 10000 == 0:
+            logging.info('Extracted features of {} utterances'.format(num_utterances))
+    list_file = writer.close()
+    logging.info('Wrote features of {} utterances in {} shards to {}'.format(
+        num_utterances, len(writer.index_files), output_dir))
+    return list_file
+
+
+def load_feature_archive(index_file):
+    """ Memory-map a shard from the path of its index file
+
+        Returns:
+            Tuple(index, feats, labels)
+    """
+    assert index_file.endswith('.index.npy')
+    feats_file, labels_file, _ = shard_paths(index_file[:-len('.index.npy')])
+    index = np.load(index_file)
+    feats = np.load(feats_file, mmap_mode='r')
+    labels = np.load(labels_file, mmap_mode='r')
+    return index, feats, labels
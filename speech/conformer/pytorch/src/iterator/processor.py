@@ -29,10 +29,12 @@ import tarfile
 from subprocess import PIPE, Popen
 from urllib.parse import urlparse
 
+import numpy as np
 import torch
 import torchaudio
 import torchaudio.compliance.kaldi as kaldi
 from torch.nn.utils.rnn import pad_sequence
+from src.iterator.feature_archive import load_feature_archive
 from src.utils.key_utils import AishellKeyMapper
 
 
@@ -161,6 +163,33 @@ def parse_raw(data):
             logging.warning('Failed to read {}'.format(wav_file))
 
 
+def feature_archive_reader(data, buckets=None, bucket=None):
+    """ Read the extracted features of the utterances of archive shards
+
+        Args:
+            data: Iterable[{src}], src is the index file of a shard
+            buckets: optional length buckets, see `find_bucket`
+            bucket: index of the only bucket to read the utterances of, the
+                utterances that fit in no bucket are skipped
+
+        Returns:
+            Iterable[{key, feat, label}]
+    """
+    for sample in data:
+        assert 'src' in sample
+        index, feats, labels = load_feature_archive(sample['src'])
+        if buckets is not None:
+            # lengths are known from the index, skip the other buckets before reading
+            index = index[[find_bucket(feat_length, label_length, buckets) == bucket
+                           for feat_length, label_length in zip(index['feat_length'], index['label_length'])]]
+        for entry in index:
+            feat_start, label_start = entry['feat_start'], entry['label_start']
+            # copy out of the memory map, as spec_aug and padding work on tensors
+            feat = np.array(feats[feat_start:feat_start + entry['feat_length']], dtype=np.float32)
+            label = labels[label_start:label_start + entry['label_length']].tolist()
+            yield dict(key=int(entry['key']), label=label, feat=torch.from_numpy(feat))
+
+
 def filter(data,
            max_length=10240,
            min_length=10,
@@ -463,6 +492,46 @@ def sort(data, sort_size=500):
         yield x
 
 
+def find_bucket(feat_length, label_length, buckets):
+    """ Index of the tightest length bucket of an utterance
+
+        Args:
+            buckets: List[Tuple(feature_length, target_length)], in
+                increasing lengths. The target is padded to one more
+                token than the label, for <sos/eos>.
+
+        Returns:
+            int: the first bucket the utterance fits in, None if it fits in
+                none, as the batch could not be padded to the bucket shape
+    """
+    for index, (feature_length, target_length) in enumerate(buckets):
+        if feat_length <= feature_length and label_length < target_length:
+            return index
+    return None
+
+
+def count_bucket_utterances(index_files, buckets):
+    """ Count the utterances of every length bucket from the index files
+        of feature archive shards, without reading their features
+
+        Args:
+            index_files: List[str], paths of the shard index files
+            buckets: length buckets, see `find_bucket`
+
+        Returns:
+            List[int]: number of utterances per bucket, the utterances that
+                fit in no bucket are not counted
+    """
+    counts = [0] * len(buckets)
+    for index_file in index_files:
+        index = np.load(index_file)
+        for feat_length, label_length in zip(index['feat_length'], index['label_length']):
+            bucket = find_bucket(feat_length, label_length, buckets)
+            if bucket is not None:
+                counts[bucket] += 1
+    return counts
+
+
 def static_batch(data, batch_size=16):
     """ Static batch the data by `batch_size`
 
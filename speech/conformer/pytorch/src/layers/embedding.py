@@ -153,5 +153,6 @@ class RelPositionalEncoding(torch.nn.Module):
 
         """
         x = self.dropout(x * self.xscale)
-        pos_emb = self.dropout(self.pe.to(x.device))
+        # inputs shorter than max_len are padded to a length bucket
+        pos_emb = self.dropout(self.pe[:, :x.size(1)].to(x.device))
         return x, pos_emb
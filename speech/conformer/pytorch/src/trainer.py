@@ -26,6 +26,8 @@ from src.utils.score import get_recog_predict, get_char_dict
 from src.utils.compute_cer import compute_cer
 from src.utils.average_model import average_epoch
 from src.utils.key_utils import AishellKeyMapper
+from src.utils.file_utils import read_lists
+from src.iterator.processor import count_bucket_utterances
 
 class Trainer:
     def __init__(
@@ -45,6 +47,9 @@ class Trainer:
         self.scheduler = scheduler
         self.torch_model = model
         self.train_iterator = train_iterator
+        # a list of iterators has one iterator per length bucket
+        self.train_iterators = train_iterator if isinstance(train_iterator, list) else [train_iterator]
+        self.training_model = None
         self.val_iterator = val_iterator
         self.ipu_options = ipu_options
         self.wandb = wandb
@@ -100,12 +105,18 @@ class Trainer:
     def _prepare_training(self):
         self.logger.info(f'preparing training.')
         self.logger.info(f'preparing experiment folder.')
-        count = 0
-        for b, s in enumerate(self.train_iterator):
-            count += 1
-        self.steps_per_epoch = count
+        self.samples_per_step = self.train_iterators[0]._combined_batch_size
+        if len(self.train_iterators) > 1:
+            self.length_bucket_steps = self.args['train_dataset']['length_bucket_steps']
+            self.steps_per_bucket = self._count_bucket_steps()
+            self.logger.info(f'step num per length bucket is about: {self.steps_per_bucket}.')
+            self.steps_per_epoch = sum(self.steps_per_bucket)
+        else:
+            count = 0
+            for b, s in enumerate(self.train_iterator):
+                count += 1
+            self.steps_per_epoch = count
         self.logger.info(f'step num per epoch is: {self.steps_per_epoch}.')
-        self.samples_per_step = self.train_iterator._combined_batch_size
         self.logger.info(f'sample num per step is: {self.samples_per_step}.')
         self.logger.info(f'preparing training done.')
         self.num_epochs = self.args['trainer']['num_epochs']
@@ -173,67 +184,142 @@ class Trainer:
                 return [output.div(factor).mean().item() for output in outputs]
 
 
+    def _count_bucket_steps(self):
+        """ Estimate the steps of every length bucket from the lengths in the archive index, without reading
+            the features. The shards are split between the instances.
+        """
+        buckets = sorted(tuple(bucket) for bucket in self.args['train_dataset']['length_buckets'])
+        utterances = count_bucket_utterances(read_lists(self.args['train_dataset']['data_list']), buckets)
+        num_instances = popdist.getNumInstances() if popdist.isPopdistEnvSet() else 1
+        return [count // (self.samples_per_step * num_instances) for count in utterances]
+
+
+    def _wrap_bucket_model(self, bucket):
+        """ Each length bucket has its own executable, so with `executable_cache_dir` set, the executable
+            of a bucket is only compiled once. The weights and the optimizer state go through the host.
+        """
+        if self.training_model is not None:
+            self.training_model.copyWeightsToHost()
+            optimizer_state = self.optimizer.state_dict()
+            self.training_model.destroy()
+            self.optimizer.load_state_dict(optimizer_state)
+        self.logger.info(f'length bucket: {bucket}.')
+        self._wrap_model('train')
+
+
+    def _all_instances_have_batch(self, has_batch):
+        if popdist.isPopdistEnvSet():
+            # the instances run the same executables in lockstep, so they all stop a bucket at once
+            return bool(hvd.allreduce(torch.tensor([int(has_batch)]), op=hvd.Min).item())
+        return has_batch
+
+
+    def _compile_buckets(self):
+        for bucket, train_iterator in enumerate(self.train_iterators):
+            self._wrap_bucket_model(bucket)
+            self._train_one_step(0, next(iter(train_iterator)), True, bucket == len(self.train_iterators) - 1)
+
+
     def _train_one_epoch(self, current_epoch):
-        copyWeightsToDevice_flag = 0
+        if len(self.train_iterators) > 1:
+            self._train_one_epoch_bucketed(current_epoch)
+            return
         for step, batch in enumerate(self.train_iterator):
-            start = time.time()
-            keys, feature, feature_length, target_in, target_out, target_length = batch
-            keys = [AishellKeyMapper.decode(key.item()) for key in keys]
-            target_in = target_in.int()
-            target_out = target_out.int()
-            data_time = time.time()
-            start_step = time.perf_counter()
-            if copyWeightsToDevice_flag == 0:
-                self.training_model.compile(feature, feature_length, target_in, target_out, target_length)
-                copyWeightsToDevice_flag = 1
-            if self.args['ipu_options']['compile_only']:  # Compile model
-                start_compile = time.perf_counter()
-                self.training_model.compile(feature, feature_length, target_in, target_out, target_length)
-                duration_compilation = time.perf_counter() - start_compile
-                self.logger.info(f"Compiled/Loaded model in {duration_compilation} secs")
-                self.logger.info("-----------------------------------------------------------")
-                self.logger.info("Model successfully compiled. Exiting now as '--compile-only' argument was passed.")
-                exit(0)
-
-            loss, loss_att, loss_ctc = self.training_model(
-                feature, feature_length, target_in, target_out, target_length
-            )
-            if self.resume:
-                self.scheduler.resume = True
-                self.scheduler.steps_per_epoch = self.steps_per_epoch
-                self.scheduler.current_epoch = current_epoch
-                self.scheduler.step()
-                self.resume = False
-            else:
-                self.scheduler.step()
-            lr = self.scheduler.get_last_lr()[0]
-            self.scheduler.resume = False
-            self.training_model.setOptimizer(self.optimizer)
-            end = time.time()
-            if popdist.isPopdistEnvSet():
-                pure_tput = self.sync_duration(self.samples_per_step / (time.perf_counter() - start_step), average=False)
-                tput = self.sync_duration(self.samples_per_step / (end - start), average=False)
-            else:
-                tput = self.samples_per_step / (end - start)
-                pure_tput = self.samples_per_step / (end - data_time)
-            data_consumption_ratio = (data_time - start) / (end - start)
-            if self.args['popdist_rank'] == 0:
-                if self.scheduler.global_step % self.log_every_n_step == 0:
-                    self.logger.info(f'Epochs: {current_epoch}/{self.num_epochs}, step: {self.scheduler.global_step}/{self.steps_per_epoch*self.num_epochs}, throughput: {tput:3.0f} samples/sec, data consumption ratio: {data_consumption_ratio:0.3f}, pure throughput: {pure_tput:0.3f} samples/sec, loss: {loss.mean().item():3.3f}, lr: {lr:.2e}')
-                if self.wandb:
-                    self.wandb.log(
-                        {
-                            'step': self.scheduler.global_step,
-                            'tput': tput,
-                            'data consumption ratio': data_consumption_ratio,
-                            'pure_tput': pure_tput,
-                            'loss': loss.mean().item(),
-                            'loss_att': loss_att.mean().item(),
-                            'loss_ctc': loss_ctc.mean().item(),
-                            'lr': lr,
-                            'epoch': current_epoch,
-                        }
-                    )
+            self._train_one_step(current_epoch, batch, step == 0)
+
+
+    def _train_one_epoch_bucketed(self, current_epoch):
+        """ Interleave the length buckets through the epoch, in runs of `length_bucket_steps` steps on a
+            bucket, as switching bucket switches executable. The bucket of a run is drawn in proportion
+            to its remaining steps, with the same seed on all the instances, until every loader is exhausted.
+        """
+        rng = np.random.default_rng([self.args['train_dataset']['random_seed'], current_epoch])
+        iterators = [iter(train_iterator) for train_iterator in self.train_iterators]
+        remaining_steps = np.array(self.steps_per_bucket, dtype=np.float64)
+        active = np.ones(len(iterators), dtype=bool)
+        current_bucket = None
+        compile_model = False
+        while active.any():
+            # the steps are estimates, so an active bucket is never given a zero weight
+            weights = np.where(active, np.maximum(remaining_steps, 1), 0)
+            bucket = rng.choice(len(iterators), p=weights / weights.sum())
+            for _ in range(self.length_bucket_steps):
+                batch = next(iterators[bucket], None)
+                if not self._all_instances_have_batch(batch is not None):
+                    active[bucket] = False
+                    # let the workers of this loader finish the epoch
+                    for _ in iterators[bucket]:
+                        pass
+                    break
+                if bucket != current_bucket:
+                    self._wrap_bucket_model(bucket)
+                    current_bucket = bucket
+                    compile_model = True
+                self._train_one_step(current_epoch, batch, compile_model)
+                compile_model = False
+                remaining_steps[bucket] -= 1
+
+
+    def _train_one_step(self, current_epoch, batch, compile_model, last_executable=True):
+        start = time.time()
+        keys, feature, feature_length, target_in, target_out, target_length = batch
+        keys = [AishellKeyMapper.decode(key.item()) for key in keys]
+        target_in = target_in.int()
+        target_out = target_out.int()
+        data_time = time.time()
+        start_step = time.perf_counter()
+        if compile_model:
+            self.training_model.compile(feature, feature_length, target_in, target_out, target_length)
+        if self.args['ipu_options']['compile_only']:  # Compile model
+            start_compile = time.perf_counter()
+            self.training_model.compile(feature, feature_length, target_in, target_out, target_length)
+            duration_compilation = time.perf_counter() - start_compile
+            self.logger.info(f"Compiled/Loaded model in {duration_compilation} secs")
+            if not last_executable:
+                return
+            self.logger.info("-----------------------------------------------------------")
+            self.logger.info("Model successfully compiled. Exiting now as '--compile-only' argument was passed.")
+            exit(0)
+
+        loss, loss_att, loss_ctc = self.training_model(
+            feature, feature_length, target_in, target_out, target_length
+        )
+        if self.resume:
+            self.scheduler.resume = True
+            self.scheduler.steps_per_epoch = self.steps_per_epoch
+            self.scheduler.current_epoch = current_epoch
+            self.scheduler.step()
+            self.resume = False
+        else:
+            self.scheduler.step()
+        lr = self.scheduler.get_last_lr()[0]
+        self.scheduler.resume = False
+        self.training_model.setOptimizer(self.optimizer)
+        end = time.time()
+        if popdist.isPopdistEnvSet():
+            pure_tput = self.sync_duration(self.samples_per_step / (time.perf_counter() - start_step), average=False)
+            tput = self.sync_duration(self.samples_per_step / (end - start), average=False)
+        else:
+            tput = self.samples_per_step / (end - start)
+            pure_tput = self.samples_per_step / (end - data_time)
+        data_consumption_ratio = (data_time - start) / (end - start)
+        if self.args['popdist_rank'] == 0:
+            if self.scheduler.global_step % self.log_every_n_step == 0:
+                self.logger.info(f'Epochs: {current_epoch}/{self.num_epochs}, step: {self.scheduler.global_step}/{self.steps_per_epoch*self.num_epochs}, throughput: {tput:3.0f} samples/sec, data consumption ratio: {data_consumption_ratio:0.3f}, pure throughput: {pure_tput:0.3f} samples/sec, loss: {loss.mean().item():3.3f}, lr: {lr:.2e}')
+            if self.wandb:
+                self.wandb.log(
+                    {
+                        'step': self.scheduler.global_step,
+                        'tput': tput,
+                        'data consumption ratio': data_consumption_ratio,
+                        'pure_tput': pure_tput,
+                        'loss': loss.mean().item(),
+                        'loss_att': loss_att.mean().item(),
+                        'loss_ctc': loss_ctc.mean().item(),
+                        'lr': lr,
+                        'epoch': current_epoch,
+                    }
+                )
 
 
     def _train_epochs(self):
@@ -244,7 +330,10 @@ class Trainer:
             self.start_epoch = self.load_pretrain()
             self.resume = True
 
-        self._wrap_model('train')
+        if len(self.train_iterators) == 1:
+            self._wrap_model('train')
+        elif self.args['ipu_options']['compile_only']:
+            self._compile_buckets()
 
         for epoch in range(self.start_epoch, self.num_epochs):
             self.logger.info(f'training epoch: {epoch}')
@@ -325,11 +414,9 @@ class Trainer:
             predict_ = get_recog_predict(hyps, char_dict, keys)
         elif mode == 'attention_rescoring':
             predict_ = []
-            for index in range(len(feature)):
+            results = self.torch_model.batch_attention_rescoring(feature, feature_length, beam_size=self.args['compute_cer']['beam_size'])
+            for index, (best_hyps, _) in enumerate(results):
                 key_ = [keys[index]]
-                feature_ = feature[index].unsqueeze(0)
-                feature_length_ = feature_length[index].unsqueeze(0)
-                best_hyps, _ = self.torch_model.attention_rescoring(feature_, feature_length_, beam_size=self.args['compute_cer']['beam_size'])
                 tor_arr = torch.Tensor((best_hyps)).unsqueeze(0)
                 pre = get_recog_predict(tor_arr, char_dict, key_)
                 predict_ += pre
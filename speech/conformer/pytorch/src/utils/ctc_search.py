@@ -0,0 +1,176 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''
+CTC prefix beam search, for one utterance and for a padded batch of utterances.
+'''
+
+from collections import defaultdict
+from typing import List, Tuple
+
+import torch
+from src.utils.common import log_add
+
+# Multiplier of the polynomial hash of the prefixes, computed with int64 wrap-around
+PREFIX_HASH_MULTIPLIER = 1000003
+
+
+def prefix_beam_search(ctc_probs: torch.Tensor, beam_size: int) -> List[Tuple[Tuple[int], float]]:
+    """ CTC prefix beam search of one utterance
+
+        Args:
+            ctc_probs: CTC log-probabilities (T, vocab_size), blank is 0
+            beam_size: number of prefixes kept, and of tokens expanded per frame
+
+        Returns:
+            List of (prefix, score), best first
+    """
+    # cur_hyps: (prefix, (blank_ending_score, none_blank_ending_score))
+    cur_hyps = [(tuple(), (0.0, -float('inf')))]
+    for t in range(ctc_probs.size(0)):
+        logp = ctc_probs[t]  # (vocab_size,)
+        # key: prefix, value (pb, pnb), default value(-inf, -inf)
+        next_hyps = defaultdict(lambda: (-float('inf'), -float('inf')))
+        # First beam prune: select topk best
+        top_k_logp, top_k_index = logp.topk(beam_size)  # (beam_size,)
+        for s in top_k_index:
+            s = s.item()
+            ps = logp[s].item()
+            for prefix, (pb, pnb) in cur_hyps:
+                last = prefix[-1] if len(prefix) > 0 else None
+                if s == 0:  # blank
+                    n_pb, n_pnb = next_hyps[prefix]
+                    n_pb = log_add([n_pb, pb + ps, pnb + ps])
+                    next_hyps[prefix] = (n_pb, n_pnb)
+                elif s == last:
+                    #  Update *ss -> *s;
+                    n_pb, n_pnb = next_hyps[prefix]
+                    n_pnb = log_add([n_pnb, pnb + ps])
+                    next_hyps[prefix] = (n_pb, n_pnb)
+                    # Update *s-s -> *ss, - is for blank
+                    n_prefix = prefix + (s, )
+                    n_pb, n_pnb = next_hyps[n_prefix]
+                    n_pnb = log_add([n_pnb, pb + ps])
+                    next_hyps[n_prefix] = (n_pb, n_pnb)
+                else:
+                    n_prefix = prefix + (s, )
+                    n_pb, n_pnb = next_hyps[n_prefix]
+                    n_pnb = log_add([n_pnb, pb + ps, pnb + ps])
+                    next_hyps[n_prefix] = (n_pb, n_pnb)
+
+        next_hyps = sorted(next_hyps.items(),
+                           key=lambda x: log_add(list(x[1])),
+                           reverse=True)
+        cur_hyps = next_hyps[:beam_size]
+    return [(y[0], log_add([y[1][0], y[1][1]])) for y in cur_hyps]
+
+
+def batch_prefix_beam_search(ctc_probs: torch.Tensor,
+                             ctc_lens: torch.Tensor,
+                             beam_size: int) -> List[List[Tuple[Tuple[int], float]]]:
+    """ CTC prefix beam search of a padded batch of utterances, same results as `prefix_beam_search`
+
+        The beams of all the utterances are kept in fixed-capacity tensors, with the tokens
+        of every prefix and a hash of it. At every frame, each prefix is either kept or extended
+        with one of the top-k tokens, and the candidates of the same prefix are merged by
+        comparing their hashes, so the search runs a fixed number of tensor operations per frame.
+        Prefixes with a -inf score are unused beam entries.
+
+        Args:
+            ctc_probs: CTC log-probabilities (B, T, vocab_size), blank is 0
+            ctc_lens: number of valid frames of each utterance (B,)
+            beam_size: number of prefixes kept, and of tokens expanded per frame
+
+        Returns:
+            List of B lists of (prefix, score), best first
+    """
+    # Scores are accumulated in double precision, as in the per-utterance search
+    ctc_probs = ctc_probs.double()
+    batch_size, max_len, _ = ctc_probs.shape
+    device = ctc_probs.device
+    num_hyps = beam_size
+    neg_inf = torch.tensor(-float('inf'), dtype=ctc_probs.dtype, device=device)
+    batch_index = torch.arange(batch_size, device=device).unsqueeze(1)
+
+    # A prefix has at most one token per frame
+    prefixes = torch.zeros(batch_size, num_hyps, max(max_len, 1), dtype=torch.long, device=device)
+    prefix_lens = torch.zeros(batch_size, num_hyps, dtype=torch.long, device=device)
+    hashes = torch.zeros(batch_size, num_hyps, dtype=torch.long, device=device)
+    # -1 for the empty prefix
+    last = torch.full((batch_size, num_hyps), -1, dtype=torch.long, device=device)
+    pb = torch.full((batch_size, num_hyps), -float('inf'), dtype=ctc_probs.dtype, device=device)
+    pb[:, 0] = 0.0
+    pnb = torch.full_like(pb, -float('inf'))
+
+    # Candidates are the num_hyps kept prefixes, then the num_hyps * beam_size extended prefixes
+    cand_parent = torch.cat([torch.arange(num_hyps, device=device),
+                             torch.arange(num_hyps, device=device).repeat_interleave(beam_size)])
+
+    for t in range(max_len):
+        top_k_logp, top_k_index = ctc_probs[:, t].topk(beam_size, dim=-1)  # (B, beam_size)
+        top_k_logp, top_k_index = top_k_logp.unsqueeze(1), top_k_index.unsqueeze(1)
+        p_total = torch.logaddexp(pb, pnb)
+
+        # Kept prefixes: *- -> *, *s -> * with the blank, *s -> *s with the last token
+        blank_logp = torch.where(top_k_index == 0, top_k_logp, neg_inf).amax(-1)  # (B, 1)
+        last_logp = torch.where(top_k_index == last.unsqueeze(-1), top_k_logp, neg_inf).amax(-1)  # (B, N)
+        keep_pb = p_total + blank_logp
+        keep_pnb = pnb + last_logp
+
+        # Extended prefixes: *s- -> *ss, * -> *s for another token
+        ext_pnb = torch.where(top_k_index == last.unsqueeze(-1),
+                              pb.unsqueeze(-1), p_total.unsqueeze(-1)) + top_k_logp
+        ext_pnb = ext_pnb.masked_fill(top_k_index == 0, -float('inf'))  # (B, N, beam_size)
+        ext_tokens = top_k_index.expand(-1, num_hyps, -1)
+        ext_hashes = hashes.unsqueeze(-1) * PREFIX_HASH_MULTIPLIER + ext_tokens + 1
+
+        # Merge the extended prefixes into the kept prefixes they are equal to. The kept prefixes
+        # are all different, and so are the extensions, so only these two can be equal.
+        ext_hashes, ext_pnb = ext_hashes.flatten(1), ext_pnb.flatten(1)
+        same = (ext_hashes.unsqueeze(2) == hashes.unsqueeze(1)) & \
+            ((prefix_lens + 1).repeat_interleave(beam_size, dim=1).unsqueeze(2) == prefix_lens.unsqueeze(1)) & \
+            (p_total > -float('inf')).unsqueeze(1)  # (B, N * beam_size, N)
+        keep_pnb = torch.logaddexp(keep_pnb, torch.where(same, ext_pnb.unsqueeze(2), neg_inf).logsumexp(1))
+        ext_pnb = ext_pnb.masked_fill(same.any(-1), -float('inf'))
+
+        cand_pb = torch.cat([keep_pb, torch.full_like(ext_pnb, -float('inf'))], dim=1)
+        cand_pnb = torch.cat([keep_pnb, ext_pnb], dim=1)
+        cand_tokens = torch.cat([torch.full_like(last, -1), ext_tokens.flatten(1)], dim=1)
+        cand_hashes = torch.cat([hashes, ext_hashes], dim=1)
+        scores = torch.logaddexp(cand_pb, cand_pnb)
+
+        # Second beam prune
+        _, best = scores.topk(num_hyps, dim=-1)  # (B, N)
+        parent = cand_parent[best]
+        tokens = cand_tokens.gather(1, best)
+        extended = tokens >= 0
+        new_prefixes = prefixes[batch_index, parent]
+        new_lens = prefix_lens[batch_index, parent]
+        new_prefixes.scatter_(2, new_lens.unsqueeze(-1),
+                              torch.where(extended, tokens, new_prefixes.gather(2, new_lens.unsqueeze(-1)).squeeze(-1))
+                              .unsqueeze(-1))
+        new_state = (new_prefixes, new_lens + extended.long(), cand_hashes.gather(1, best),
+                     torch.where(extended, tokens, last[batch_index, parent]),
+                     cand_pb.gather(1, best), cand_pnb.gather(1, best))
+
+        # Padding frames leave the beams unchanged
+        active = (t < ctc_lens).view(batch_size, 1)
+        prefixes, prefix_lens, hashes, last, pb, pnb = [
+            torch.where(active.unsqueeze(-1) if new.dim() == 3 else active, new, old)
+            for new, old in zip(new_state, (prefixes, prefix_lens, hashes, last, pb, pnb))]
+
+    scores = torch.logaddexp(pb, pnb).tolist()
+    prefixes, prefix_lens = prefixes.tolist(), prefix_lens.tolist()
+    return [[(tuple(prefixes[b][n][:prefix_lens[b][n]]), scores[b][n])
+             for n in range(num_hyps) if scores[b][n] != -float('inf')]
+            for b in range(batch_size)]
@@ -0,0 +1,102 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import torch
+from src.conformer import Conformer
+from src.utils.ctc_search import prefix_beam_search
+
+VOCAB_SIZE = 6
+
+
+class IdentityEncoder(torch.nn.Module):
+    """ The features stand for the encoder output """
+
+    def forward(self, feature, feature_length):
+        mask = torch.arange(feature.shape[1]).unsqueeze(0) < feature_length.unsqueeze(1)
+        return feature, feature_length, mask.unsqueeze(1)
+
+
+class SmallDecoder(torch.nn.Module):
+    """ Causal decoder: the running mean of the token embeddings plus the mean encoder frame """
+
+    def __init__(self):
+        super().__init__()
+        self.embed = torch.nn.Embedding(VOCAB_SIZE, VOCAB_SIZE)
+        self.out = torch.nn.Linear(VOCAB_SIZE, VOCAB_SIZE)
+
+    def forward(self, hs_pad, hlens, ys_in_pad, ys_in_lens):
+        frames = torch.arange(hs_pad.shape[1]).unsqueeze(0) < hlens.unsqueeze(1)
+        context = (hs_pad * frames.unsqueeze(-1)).sum(1) / hlens.unsqueeze(1)
+        steps = torch.arange(1, ys_in_pad.shape[1] + 1).unsqueeze(-1)
+        tokens = self.embed(ys_in_pad).cumsum(1) / steps
+        return self.out(tokens + context.unsqueeze(1)), None
+
+
+def make_conformer(ctc_weight):
+    torch.manual_seed(0)
+    args = {'decoder': {'vocab_size': VOCAB_SIZE}, 'encoder': {'output_size': VOCAB_SIZE},
+            'loss_weight': {'ctc_weight': ctc_weight}}
+    model = Conformer(lambda feature, feature_length: (feature, feature_length), IdentityEncoder(),
+                      SmallDecoder(), None, args, torch.float32)
+    # the features are the CTC logits
+    with torch.no_grad():
+        model.out.weight.copy_(torch.eye(VOCAB_SIZE))
+        model.out.bias.zero_()
+    return model.eval()
+
+
+def rescore_utterance(model, feature, beam_size, ctc_weight):
+    """ Rescores the CTC prefixes of a single utterance one hyp at a time """
+    ctc_probs = torch.nn.functional.log_softmax(feature, -1)
+    context = feature.unsqueeze(0)
+    hlens = torch.tensor([feature.shape[0]])
+    best = None
+    for hyp, ctc_score in prefix_beam_search(ctc_probs, beam_size):
+        ys_in = torch.tensor([[model.sos, *hyp]])
+        logits, _ = model.decoder(context, hlens, ys_in, torch.tensor([len(hyp) + 1]))
+        logp = torch.nn.functional.log_softmax(logits[0], -1)
+        score = sum(logp[step, token].item() for step, token in enumerate([*hyp, model.eos]))
+        score += ctc_weight * ctc_score
+        if best is None or score > best[1]:
+            best = (hyp, score)
+    return best
+
+
+@pytest.mark.parametrize("ctc_weight", [0.0, 0.5, 1.0])
+def test_batch_attention_rescoring(ctc_weight):
+    model = make_conformer(ctc_weight)
+    lengths = [9, 4, 7, 1]
+    generator = torch.Generator().manual_seed(1)
+    speech = 3 * torch.randn(len(lengths), max(lengths), VOCAB_SIZE, generator=generator)
+    # utterance 2 is all blanks, so its best hyp is empty
+    speech[2] = -5.0
+    speech[2, :, 0] = 5.0
+    speech_lengths = torch.tensor(lengths)
+    beam_size = 4
+
+    with torch.no_grad():
+        results = model.batch_attention_rescoring(speech, speech_lengths, beam_size, ctc_weight)
+        expected = [rescore_utterance(model, speech[index, :length], beam_size, ctc_weight)
+                    for index, length in enumerate(lengths)]
+    assert len(results) == len(lengths)
+    for (hyp, score), (expected_hyp, expected_score) in zip(results, expected):
+        assert tuple(hyp) == tuple(expected_hyp)
+        assert score == pytest.approx(expected_score, abs=1e-4)
+    assert tuple(results[2][0]) == ()
+    assert all(len(hyp) > 0 for index, (hyp, _) in enumerate(results) if index != 2)
+    # the single utterance path is the first result of the batch
+    with torch.no_grad():
+        single = model.attention_rescoring(speech[:1], speech_lengths[:1], beam_size, ctc_weight)
+    assert tuple(single[0]) == tuple(results[0][0])
@@ -0,0 +1,125 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import threading
+import torch
+import src.trainer
+from src.trainer import Trainer
+
+
+class FakeLoader:
+    """ Yields the batches (bucket, index) and counts how many were read """
+
+    _combined_batch_size = 4
+
+    def __init__(self, bucket, num_batches):
+        self.batches = [(bucket, index) for index in range(num_batches)]
+        self.num_read = 0
+
+    def __iter__(self):
+        for batch in self.batches:
+            self.num_read += 1
+            yield batch
+
+
+def make_trainer(batches_per_bucket, steps_per_bucket, length_bucket_steps=3):
+    loaders = [FakeLoader(bucket, num_batches) for bucket, num_batches in enumerate(batches_per_bucket)]
+    args = {'train_dataset': {'random_seed': 1234, 'length_bucket_steps': length_bucket_steps}}
+    trainer = Trainer(None, None, None, loaders, None, None, None, logging, args, None)
+    trainer.steps_per_bucket = steps_per_bucket
+    trainer.length_bucket_steps = length_bucket_steps
+    trainer.wrapped = []
+    trainer.trained = []
+    trainer._wrap_bucket_model = trainer.wrapped.append
+    trainer._train_one_step = lambda epoch, batch, compile_model: trainer.trained.append((batch, compile_model))
+    return trainer, loaders
+
+
+def runs(trained):
+    """ Consecutive steps on the same bucket: [(bucket, num_steps), ...] """
+    result = []
+    for (bucket, _), _ in trained:
+        if result and result[-1][0] == bucket:
+            result[-1][1] += 1
+        else:
+            result.append([bucket, 1])
+    return [tuple(run) for run in result]
+
+
+def test_buckets_interleaved():
+    batches_per_bucket = [12, 4, 17]
+    # the step estimates are off, which changes the draws but not the batches trained
+    trainer, loaders = make_trainer(batches_per_bucket, [10, 5, 17])
+    trainer._train_one_epoch(0)
+
+    assert all(loader.num_read == len(loader.batches) for loader in loaders)
+    batches = [batch for batch, _ in trainer.trained]
+    for bucket, loader in enumerate(loaders):
+        assert [batch for batch in batches if batch[0] == bucket] == loader.batches
+    # a bucket drawn twice in a row makes a single run
+    bucket_runs = runs(trainer.trained)
+    # not one bucket after the other
+    assert len(bucket_runs) > len(batches_per_bucket)
+    # an executable is wrapped and compiled at every bucket switch only
+    assert trainer.wrapped == [bucket for bucket, _ in bucket_runs]
+    assert [compile_model for _, compile_model in trainer.trained].count(True) == len(bucket_runs)
+
+    # the draws are seeded by the epoch
+    other, _ = make_trainer(batches_per_bucket, [10, 5, 17])
+    other._train_one_epoch(0)
+    assert other.trained == trainer.trained
+    other, _ = make_trainer(batches_per_bucket, [10, 5, 17])
+    other._train_one_epoch(1)
+    assert other.trained != trainer.trained
+
+
+class FakeAllreduce:
+    """ Min allreduce between threads standing for the popdist instances """
+
+    def __init__(self, num_instances):
+        self.barrier = threading.Barrier(num_instances)
+        self.values = {}
+
+    def __call__(self, tensor, op=None):
+        self.values[threading.current_thread().name] = tensor
+        self.barrier.wait()
+        result = torch.stack(list(self.values.values())).min(dim=0).values
+        self.barrier.wait()
+        return result
+
+
+def test_instances_stop_buckets_together(monkeypatch):
+    monkeypatch.setattr(src.trainer.popdist, 'isPopdistEnvSet', lambda: True)
+    monkeypatch.setattr(src.trainer.hvd, 'allreduce', FakeAllreduce(2), raising=False)
+    monkeypatch.setattr(src.trainer.hvd, 'Min', None, raising=False)
+    # the instances read different shards, so their buckets have different numbers of batches
+    instance_batches = [[9, 5, 14], [11, 3, 14]]
+    trainers = [make_trainer(batches, [10, 4, 14]) for batches in instance_batches]
+    threads = [threading.Thread(target=trainer._train_one_epoch, args=(0, ), name=str(instance))
+               for instance, (trainer, _) in enumerate(trainers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=60)
+    assert not any(thread.is_alive() for thread in threads)
+
+    (trainer, loaders), (other, other_loaders) = trainers
+    # same executables for the same number of steps, the fewest batches of a bucket on any instance
+    assert runs(trainer.trained) == runs(other.trained)
+    assert trainer.wrapped == other.wrapped
+    for bucket, num_batches in enumerate(map(min, zip(*instance_batches))):
+        assert sum(1 for (b, _), _ in trainer.trained if b == bucket) == num_batches
+    # the batches left over on an instance are still read to the end
+    assert all(loader.num_read == len(loader.batches) for loader in loaders + other_loaders)
@@ -0,0 +1,37 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import torch
+from src.utils.ctc_search import batch_prefix_beam_search, prefix_beam_search
+
+
+@pytest.mark.parametrize("vocab_size, beam_size", [(4, 3), (8, 5), (30, 10)])
+@pytest.mark.parametrize("sharpness", [1.0, 4.0])
+def test_batch_prefix_beam_search(vocab_size, beam_size, sharpness):
+    torch.manual_seed(0)
+    batch_size, max_len = 6, 30
+    ctc_probs = (sharpness * torch.randn(batch_size, max_len, vocab_size)).log_softmax(-1)
+    ctc_lens = torch.tensor([max_len, 0, 1, 7, 19, 29])
+
+    batch_hyps = batch_prefix_beam_search(ctc_probs, ctc_lens, beam_size)
+    assert len(batch_hyps) == batch_size
+    for index, hyps in enumerate(batch_hyps):
+        expected = prefix_beam_search(ctc_probs[index, :ctc_lens[index]].double(), beam_size)
+        # Same prefixes, up to the order of the prefixes of equal scores
+        assert sorted(prefix for prefix, _ in hyps) == sorted(prefix for prefix, _ in expected)
+        expected_scores = dict(expected)
+        for prefix, score in hyps:
+            assert score == pytest.approx(expected_scores[prefix], abs=1e-9)
+        assert [score for _, score in hyps] == sorted((score for _, score in hyps), reverse=True)
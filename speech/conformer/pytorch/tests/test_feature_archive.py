@@ -0,0 +1,79 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import pytest
+import torch
+from src.iterator.feature_archive import FeatureArchiveWriter, load_feature_archive
+from src.iterator.processor import count_bucket_utterances, feature_archive_reader, find_bucket
+from src.utils.file_utils import read_lists
+from src.utils.key_utils import AishellKeyMapper
+
+
+def synthetic_utterances(num_utterances, num_mel_bins=80):
+    generator = torch.Generator().manual_seed(0)
+    utterances = []
+    for index in range(num_utterances):
+        num_frames = 20 + 7 * index
+        utterances.append(dict(key=f'BAC009S0723W{index:04d}',
+                               feat=torch.randn(num_frames, num_mel_bins, generator=generator),
+                               label=torch.randint(1, 4000, (3 + index, ), generator=generator).tolist()))
+    return utterances
+
+
+def write_archives(output_dir, utterances, shard_size, dtype):
+    writer = FeatureArchiveWriter(str(output_dir), shard_size, dtype)
+    for utterance in utterances:
+        writer.write(utterance)
+    return read_lists(writer.close())
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float16"])
+def test_feature_archive_round_trip(tmp_path, dtype):
+    utterances = synthetic_utterances(5)
+    index_files = write_archives(tmp_path, utterances, 2, dtype)
+    # the last shard holds the remaining utterance
+    assert len(index_files) == 3
+
+    index, feats, labels = load_feature_archive(index_files[-1])
+    assert len(index) == 1
+    assert feats.dtype == np.dtype(dtype)
+    assert labels.dtype == np.int32
+    assert feats.shape == (utterances[-1]['feat'].shape[0], 80)
+
+    samples = list(feature_archive_reader(dict(src=index_file) for index_file in index_files))
+    assert [sample['key'] for sample in samples] == [AishellKeyMapper.encode(u['key']) for u in utterances]
+    for sample, utterance in zip(samples, utterances):
+        assert AishellKeyMapper.decode(sample['key']) == utterance['key']
+        assert sample['feat'].dtype == torch.float32
+        assert sample['feat'].shape == utterance['feat'].shape
+        expected = utterance['feat'].numpy().astype(dtype).astype(np.float32)
+        np.testing.assert_array_equal(sample['feat'].numpy(), expected)
+        assert sample['label'] == utterance['label']
+
+
+def test_feature_archive_buckets(tmp_path):
+    utterances = synthetic_utterances(6)
+    index_files = write_archives(tmp_path, utterances, 4, 'float32')
+    buckets = [(30, 6), (45, 8)]
+    expected = [find_bucket(u['feat'].shape[0], len(u['label']), buckets) for u in utterances]
+    # the last two utterances are too long for any bucket
+    assert expected == [0, 0, 1, 1, None, None]
+    assert find_bucket(20, 8, buckets) is None
+
+    assert count_bucket_utterances(index_files, buckets) == [2, 2]
+    for bucket in range(len(buckets)):
+        samples = feature_archive_reader((dict(src=index_file) for index_file in index_files), buckets, bucket)
+        assert [AishellKeyMapper.decode(sample['key']) for sample in samples] == \
+            [u['key'] for u, b in zip(utterances, expected) if b == bucket]
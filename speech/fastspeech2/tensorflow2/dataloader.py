@@ -24,6 +24,7 @@ import logging
 import numpy as np
 import tensorflow as tf
 from multiprocessing import Pool, cpu_count
+from preprocessor.feature_archive import ARCHIVE_DIR, FeatureArchive
 
 
 logging.basicConfig(
@@ -56,6 +57,7 @@ class LJSpeechCharLevelDataset(object):
         self.max_mel_length = opts["max_wave_length"]
         self.dtype = tf.float16 if opts["precision"] == "16" else tf.float32
         self.np_dtype = np.float16 if opts["precision"] == "16" else np.float32
+        self.archive = None
         if not self.opts["generated_data"] and self.opts["data_path"]:
             utts_path = os.path.join(opts["data_path"], "train_utt_ids.npy") if is_train else os.path.join(
                 opts["data_path"], "valid_utt_ids.npy")
@@ -71,9 +73,13 @@ class LJSpeechCharLevelDataset(object):
                 opts["data_path"], "stats.npy"))
             self._set_path()
             self._get_length()
-            # load data to memory initially to speed up throughput
-            with Pool(cpu_count()) as p:
-                self.train_data = p.map(self._load_data, self.utts_ids)
+            if os.path.exists(os.path.join(self.archive_path, "index.npz")):
+                # utterances are read from the memory-mapped feature archive by the tf.data pipeline
+                self.archive = FeatureArchive(self.archive_path)
+            else:
+                # load data to memory initially to speed up throughput
+                with Pool(cpu_count()) as p:
+                    self.train_data = p.map(self._load_data, self.utts_ids)
 
     def _set_path(self):
         self.duration_path = os.path.join(self.base_path, "duration")
@@ -81,6 +87,7 @@ class LJSpeechCharLevelDataset(object):
         self.mel_path = os.path.join(self.base_path, "norm-feats")
         self.f0_path = os.path.join(self.base_path, "raw-f0")
         self.energy_path = os.path.join(self.base_path, "raw-energies")
+        self.archive_path = os.path.join(self.base_path, ARCHIVE_DIR)
 
     def _get_length(self):
         with open(os.path.join(self.opts["data_path"], "length.json"), "r") as f:
@@ -91,6 +98,8 @@ class LJSpeechCharLevelDataset(object):
     def __len__(self):
         if self.opts["generated_data"]:
             return 1000
+        if self.archive is not None:
+            return len(self.archive)
         return len(self.utts_ids)
 
     def _load_data(self, utt_id):
@@ -153,12 +162,37 @@ class LJSpeechCharLevelDataset(object):
             for input_id, duration, f0, energy, mel in self.train_data:
                 yield input_id, duration, f0, energy, mel
 
+    def _read_archive(self, index):
+        input_id, duration, f0, energy, mel = self.archive[index]
+        return (input_id.astype(np.int32), duration.astype(self.np_dtype), f0.astype(self.np_dtype),
+                energy.astype(self.np_dtype), mel.astype(self.np_dtype))
+
+    def _archive_dataset(self, output_types):
+        """Read the utterances from the feature archive with parallel calls, in shuffled order if training."""
+        datasets = tf.data.Dataset.range(len(self.archive))
+        if self.is_train:
+            datasets = datasets.shuffle(
+                buffer_size=len(self.archive), seed=int(self.opts["seed"]), reshuffle_each_iteration=True)
+        datasets = datasets.repeat()
+
+        def read_utterance(index):
+            features = tf.numpy_function(self._read_archive, [index], output_types)
+            shapes = ([None], [None], [None], [None], [None, self.opts["num_mels"]])
+            for feature, shape in zip(features, shapes):
+                feature.set_shape(shape)
+            return tuple(features)
+
+        return datasets.map(read_utterance, num_parallel_calls=self.opts["parallell_io_threads"])
+
     def inference_generator(self):
         while True:
             if self.opts["generated_data"]:
                 input_id = np.random.randint(0, self.max_seq_length,
                                              size=(self.max_seq_length,)).astype(np.int32)
                 yield input_id
+            elif self.archive is not None:
+                for index in range(len(self.archive)):
+                    yield self.archive[index][0].astype(np.int32)
             else:
                 for uid in self.utts_ids:
                     try:
@@ -191,9 +225,12 @@ class LJSpeechCharLevelDataset(object):
             data_gen = self._generated_generator
         else:
             data_gen = self.generator
-        datasets = tf.data.Dataset.from_generator(
-            data_gen, output_types=output_types)
-        if self.is_train:
+        if self.archive is not None:
+            datasets = self._archive_dataset(output_types)
+        else:
+            datasets = tf.data.Dataset.from_generator(
+                data_gen, output_types=output_types)
+        if self.is_train and self.archive is None:
             datasets = datasets.shuffle(
                 buffer_size=1000, seed=int(self.opts["seed"]))
         datasets = datasets.padded_batch(
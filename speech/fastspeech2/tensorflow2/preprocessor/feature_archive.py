@@ -0,0 +1,157 @@
+# Copyright (c) 2022 Graphcore Ltd. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Feature archive of a preprocessed split (train or valid).
+
+The features of all the utterances are normalised and averaged by duration once, as done by the
+dataloader, and concatenated into one array per feature in `{split}/feature-archive/`:
+    ids.npy: symbol ids (int32)
+    duration.npy, f0.npy, energy.npy: character-level durations (int32), normalised f0 and energy (float32)
+    mel.npy: normalised mel-spectrograms (float32, (#frames, num_mels))
+    index.npz: utt_ids, and the offsets of every utterance in the arrays:
+        id_offsets in ids, char_offsets in duration/f0/energy, mel_offsets in mel
+The arrays are memory-mapped when read, so the dataloader only reads slices of them.
+"""
+import os
+import argparse
+from functools import partial
+from multiprocessing import Pool
+from tqdm import tqdm
+import numpy as np
+
+
+ARCHIVE_DIR = "feature-archive"
+FEATURES = ["ids", "duration", "f0", "energy", "mel"]
+
+
+def norm_mean_std(x, mean, std):
+    """Normalise the non-zero values of x."""
+    return np.where(x == 0.0, 0.0, (x - mean) / std).astype(np.float32)
+
+
+def average_by_duration(x, durs):
+    """Mean of the non-zero values of x over the frames of each character, 0 if there are none."""
+    durs_cum = np.cumsum(durs)
+    starts, ends = np.minimum(durs_cum - durs, len(x)), np.minimum(durs_cum, len(x))
+    nonzero = x != 0.0
+    sums = np.concatenate([[0.0], np.cumsum(np.where(nonzero, x, 0.0), dtype=np.float64)])
+    counts = np.concatenate([[0], np.cumsum(nonzero)])
+    num_values = counts[ends] - counts[starts]
+    return np.where(num_values > 0, (sums[ends] - sums[starts]) / np.maximum(num_values, 1), 0.0).astype(np.float32)
+
+
+def load_utterance(utt_id, base_path, f0_stat, energy_stat):
+    """Load the features of one utterance from the per-utterance files."""
+    input_id = np.load(os.path.join(base_path, "ids", f"{utt_id}-ids.npy")).astype(np.int32)
+    duration = np.load(os.path.join(base_path, "duration", f"{utt_id}-durations.npy")).astype(np.int32)
+    f0 = np.load(os.path.join(base_path, "raw-f0", f"{utt_id}-raw-f0.npy")).astype(np.float32)
+    energy = np.load(os.path.join(base_path, "raw-energies", f"{utt_id}-raw-energy.npy")).astype(np.float32)
+    mel = np.load(os.path.join(base_path, "norm-feats", f"{utt_id}-norm-feats.npy")).astype(np.float32)
+    f0 = average_by_duration(norm_mean_std(f0, f0_stat[0], f0_stat[1]), duration)
+    energy = average_by_duration(norm_mean_std(energy, energy_stat[0], energy_stat[1]), duration)
+    return input_id, duration, f0, energy, mel
+
+
+def build_feature_archive(root_path, split, n_cpus=4):
+    """Write the feature archive of a split of the preprocessed dataset in `root_path`."""
+    utt_ids = np.load(os.path.join(root_path, f"{split}_utt_ids.npy"))
+    base_path = os.path.join(root_path, split)
+    archive_path = os.path.join(base_path, ARCHIVE_DIR)
+    os.makedirs(archive_path, exist_ok=True)
+    f0_stat = np.load(os.path.join(root_path, "stats_f0.npy"))
+    energy_stat = np.load(os.path.join(root_path, "stats_energy.npy"))
+
+    # The mel-spectrograms are written straight into the memory-mapped archive, only their headers are read here
+    mel_shapes = [np.load(os.path.join(base_path, "norm-feats", f"{utt_id}-norm-feats.npy"), mmap_mode="r").shape
+                  for utt_id in utt_ids]
+    mel_offsets = np.cumsum([0] + [shape[0] for shape in mel_shapes], dtype=np.int64)
+    num_mels = mel_shapes[0][1] if mel_shapes else 0
+    mel_archive = np.lib.format.open_memmap(os.path.join(archive_path, "mel.npy"), mode="w+",
+                                            dtype=np.float32, shape=(int(mel_offsets[-1]), num_mels))
+
+    ids, durations, f0s, energies = [], [], [], []
+    partial_fn = partial(load_utterance, base_path=base_path, f0_stat=f0_stat, energy_stat=energy_stat)
+    with Pool(n_cpus) as p:
+        utterances = p.imap(partial_fn, utt_ids, chunksize=16)
+        for index, (input_id, duration, f0, energy, mel) in enumerate(
+                tqdm(utterances, total=len(utt_ids), desc=f"[Archiving {split}]")):
+            mel_archive[mel_offsets[index]:mel_offsets[index + 1]] = mel
+            ids.append(input_id)
+            durations.append(duration)
+            f0s.append(f0)
+            energies.append(energy)
+    mel_archive.flush()
+    del mel_archive
+
+    for name, arrays, dtype in [("ids", ids, np.int32), ("duration", durations, np.int32),
+                                ("f0", f0s, np.float32), ("energy", energies, np.float32)]:
+        np.save(os.path.join(archive_path, f"{name}.npy"), np.concatenate(arrays + [np.zeros(0, dtype)]).astype(dtype))
+    # The index is written last, so an index always describes complete arrays
+    np.savez(os.path.join(archive_path, "index.npz"),
+             utt_ids=utt_ids,
+             id_offsets=np.cumsum([0] + [len(x) for x in ids], dtype=np.int64),
+             char_offsets=np.cumsum([0] + [len(x) for x in durations], dtype=np.int64),
+             mel_offsets=mel_offsets)
+
+
+class FeatureArchive(object):
+    """Reads the features of the utterances of a feature archive."""
+
+    def __init__(self, archive_path):
+        index = np.load(os.path.join(archive_path, "index.npz"))
+        self.utt_ids = index["utt_ids"]
+        self.id_offsets = index["id_offsets"]
+        self.char_offsets = index["char_offsets"]
+        self.mel_offsets = index["mel_offsets"]
+        self.features = {name: np.load(os.path.join(archive_path, f"{name}.npy"), mmap_mode="r")
+                         for name in FEATURES}
+
+    def __len__(self):
+        return len(self.utt_ids)
+
+    def __getitem__(self, index):
+        """Features of an utterance: input_id, duration, f0, energy, mel."""
+        ids = slice(self.id_offsets[index], self.id_offsets[index + 1])
+        chars = slice(self.char_offsets[index], self.char_offsets[index + 1])
+        frames = slice(self.mel_offsets[index], self.mel_offsets[index + 1])
+        return (self.features["ids"][ids], self.features["duration"][chars], self.features["f0"][chars],
+                self.features["energy"][chars], self.features["mel"][frames])
+
+
+def parser():
+    """Parse arguments and set configuration parameters."""
+    parser = argparse.ArgumentParser(
+        description="Write the features of the preprocessed dataset into feature archives"
+    )
+    parser.add_argument(
+        "--root-path",
+        default=None,
+        type=str,
+        required=True,
+        help="Root directory of preprocessed LJSpeech dataset, with the relocated durations.",
+    )
+    parser.add_argument(
+        "--n-cpus",
+        type=int,
+        default=4,
+        help="Number of CPUs to use in parallel.",
+    )
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parser()
+    for split in ["train", "valid"]:
+        build_feature_archive(args.root_path, split, args.n_cpus)
@@ -0,0 +1,68 @@
+# Copyright (c) 2022 Graphcore Ltd. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import sys
+import json
+import numpy as np
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).absolute().parent.parent))
+from dataloader import LJSpeechCharLevelDataset
+from preprocessor.feature_archive import build_feature_archive
+
+
+def write_preprocessed_dataset(root_path, num_utts=12, num_mels=8, seed=0):
+    """Write random features in the layout of the preprocessed LJSpeech dataset."""
+    rng = np.random.default_rng(seed)
+    utt_ids = [f"LJ001-{i:04d}" for i in range(num_utts)]
+    np.save(os.path.join(root_path, "train_utt_ids.npy"), utt_ids)
+    np.save(os.path.join(root_path, "valid_utt_ids.npy"), utt_ids[:2])
+    for name in ["stats", "stats_f0", "stats_energy"]:
+        np.save(os.path.join(root_path, f"{name}.npy"), np.array([[1.5], [0.5]], dtype=np.float32))
+    with open(os.path.join(root_path, "length.json"), "w") as f:
+        json.dump({"max_seq_length": 50, "max_mel_length": 300, "vocab_size": 20}, f)
+
+    base_path = os.path.join(root_path, "train")
+    for name in ["ids", "duration", "raw-f0", "raw-energies", "norm-feats"]:
+        os.makedirs(os.path.join(base_path, name))
+    for utt_id in utt_ids:
+        num_chars = rng.integers(1, 50)
+        duration = rng.integers(0, 6, size=num_chars)
+        num_frames = duration.sum()
+        # f0 and energy have unvoiced frames, which are ignored by the normalisation and averaging
+        f0, energy = rng.random((2, num_frames)) * (rng.random((2, num_frames)) > 0.3)
+        np.save(os.path.join(base_path, "ids", f"{utt_id}-ids.npy"), rng.integers(0, 20, size=num_chars))
+        np.save(os.path.join(base_path, "duration", f"{utt_id}-durations.npy"), duration)
+        np.save(os.path.join(base_path, "raw-f0", f"{utt_id}-raw-f0.npy"), f0.astype(np.float32))
+        np.save(os.path.join(base_path, "raw-energies", f"{utt_id}-raw-energy.npy"), energy.astype(np.float32))
+        np.save(os.path.join(base_path, "norm-feats", f"{utt_id}-norm-feats.npy"),
+                rng.standard_normal((num_frames, num_mels)).astype(np.float32))
+
+
+def test_feature_archive(tmp_path):
+    write_preprocessed_dataset(tmp_path)
+    opts = {"max_seq_length": 50, "max_wave_length": 300, "precision": "32",
+            "generated_data": False, "data_path": str(tmp_path)}
+    files_dataset = LJSpeechCharLevelDataset(opts, is_train=True)
+    assert files_dataset.archive is None
+
+    build_feature_archive(str(tmp_path), "train", n_cpus=2)
+    archive_dataset = LJSpeechCharLevelDataset(opts, is_train=True)
+    assert archive_dataset.archive is not None
+    assert len(archive_dataset) == len(files_dataset)
+    for index, expected in enumerate(files_dataset.train_data):
+        features = archive_dataset._read_archive(index)
+        for feature, expected_feature in zip(features, expected):
+            assert feature.dtype == expected_feature.dtype
+            np.testing.assert_allclose(feature, expected_feature, rtol=1e-5, atol=1e-6)
@@ -103,6 +103,8 @@ def add_conf_args(run_mode):
                         help='Discard samples longer than max-duration')
     parser.add_argument('--max-symbols-per-step', type=int, default=300,
                         help='Maximum number of symbols per step for validation')
+    parser.add_argument('--sequential-greedy-decoding', action="store_true", default=False,
+                        help='Greedy decode the validation utterances one by one instead of batched')
     parser.add_argument('--joint-net-split-size', type=int, default=15,
                         help='The split size of joint network along the audio-frame dimension')
     parser.add_argument('--fp-exceptions', action="store_true", default=False,
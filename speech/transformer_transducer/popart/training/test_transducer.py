@@ -9,9 +9,11 @@ import subprocess
 import re
 
 from rnnt_reference import config
+from rnnt_reference.model import RNNT
 
 import popart
 import transducer_blocks
+from transducer_decoder import TransducerGreedyDecoder, TransducerBatchedGreedyDecoder
 
 
 def assert_lists_equal(alist, blist):
@@ -142,6 +144,28 @@ def test_transformer_block_build(num_heads, num_features, kernel_size):
                                               transformer_block.linear_2.param_count))
 
 
+@pytest.mark.parametrize("max_symbols_per_step, max_symbol_per_sample", [(30, None), (2, None), (30, 5)])
+@pytest.mark.parametrize("blank_bias", [0.5, 2.0])
+def test_batched_greedy_decoder(max_symbols_per_step, max_symbol_per_sample, blank_bias):
+    """ testing the batched greedy decoder gives the transcripts of the sequential one """
+    torch.manual_seed(0)
+    model = RNNT(n_classes=30, in_feats=8, enc_n_hid=16, enc_pre_rnn_layers=1, enc_post_rnn_layers=1,
+                 enc_stack_time_factor=2, enc_dropout=0.0, pred_dropout=0.0, joint_dropout=0.0,
+                 pred_n_hid=16, pred_rnn_layers=2, joint_n_hid=24, forget_gate_bias=1.0).eval()
+    # The blank bias sets how many symbols are emitted per time step
+    with torch.no_grad():
+        model.joint_net[-1].bias[0] = blank_bias
+    transcription_out = torch.randn(8, 20, 24)
+    transcription_out_lens = torch.randint(1, 21, [8])
+
+    decoders = [decoder_class(blank_idx=0, max_symbols_per_step=max_symbols_per_step,
+                              max_symbol_per_sample=max_symbol_per_sample)
+                for decoder_class in (TransducerGreedyDecoder, TransducerBatchedGreedyDecoder)]
+    sequential, batched = [decoder.decode(model, transcription_out, transcription_out_lens) for decoder in decoders]
+    assert batched == sequential
+    assert any(len(transcript) > 0 for transcript in sequential)
+
+
 @pytest.mark.category3
 @pytest.mark.ipus(2)
 @pytest.mark.ipu_version("ipu2")
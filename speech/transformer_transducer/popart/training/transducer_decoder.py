@@ -128,3 +128,93 @@ class TransducerGreedyDecoder:
                 symbols_added += 1
 
         return label
+
+
+class TransducerBatchedGreedyDecoder(TransducerGreedyDecoder):
+    """A greedy transducer decoder running all the utterances of a batch in lockstep.
+
+    Gives the same transcripts as `TransducerGreedyDecoder`, but the prediction and joint
+    networks are run once per step for the whole batch. At every time step, the utterances
+    keep emitting symbols until they emit a blank, so an "active" mask tracks the utterances
+    still emitting at this time step, and the number of symbols emitted per utterance is kept
+    for `max_symbol_per_sample`.
+    """
+
+    def _pred_step_batch(self, model, labels, has_label, hidden):
+        # Same as model.predict(labels, hidden, add_sos=False), with the zero
+        # "start of sequence" input for the utterances which did not emit yet
+        y = model.prediction["embed"](labels.unsqueeze(1))
+        y = y * has_label.to(y.dtype).view(-1, 1, 1)
+        g, hidden_prime = model.prediction["dec_rnn"](y.transpose(0, 1), hidden)
+        return g.transpose(0, 1), hidden_prime
+
+    def _joint_step_batch(self, model, enc, pred):
+        # Same as _joint_step, for the (B, H) encoder frames of one time step
+        return model.joint_net(enc + model.joint_pred(pred[:, 0, :]))
+
+    def decode(self, model, x, out_lens):
+        """Returns a list of sentences given an input batch.
+
+        Args:
+            x: Output of the transcription network (followed by joint-transcription-fc).
+            out_lens: list of int representing the length of each output sequence
+
+        Returns:
+            list containing batch number of sentences (strings).
+        """
+        model = getattr(model, 'module', model)
+        with torch.no_grad():
+            return self._greedy_decode_batch(model, x, torch.as_tensor(out_lens).to(x.device))
+
+    def _greedy_decode_batch(self, model, x, out_lens):
+        batch_size = x.size(0)
+        device = x.device
+        num_layers = model.prediction["dec_rnn"].lstm.num_layers
+        state_shape = (num_layers, batch_size, model.pred_n_hid)
+        dtype = model.joint_enc.weight.dtype
+        # A zero state is the same as no state for the LSTM
+        hidden = (torch.zeros(state_shape, dtype=dtype, device=device),
+                  torch.zeros(state_shape, dtype=dtype, device=device))
+        last_labels = torch.zeros(batch_size, dtype=torch.int64, device=device)
+        has_label = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        num_labels = torch.zeros(batch_size, dtype=torch.int64, device=device)
+        labels = [[] for _ in range(batch_size)]
+        label_offset = 1 if self.shift_labels_by_one else 0
+
+        for time_idx in range(int(out_lens.max()) if batch_size > 0 else 0):
+            active = time_idx < out_lens
+            if self.max_symbol_per_sample is not None:
+                active &= num_labels <= self.max_symbol_per_sample
+            if not active.any():
+                break
+            f = x[:, time_idx, :]
+
+            symbols_added = 0
+            while active.any() and (
+                    self.max_symbols is None or
+                    symbols_added < self.max_symbols):
+                g, hidden_prime = self._pred_step_batch(model, last_labels, has_label, hidden)
+                k = self._joint_step_batch(model, f, g).argmax(dim=1)
+
+                # See TransducerGreedyDecoder._greedy_decode for the label shift
+                active &= k != self.blank_idx
+                emitted = k - label_offset
+                last_labels = torch.where(active, emitted, last_labels)
+                has_label |= active
+                num_labels += active.to(num_labels.dtype)
+                emit_mask = active.view(1, -1, 1)
+                hidden = tuple(torch.where(emit_mask, new, old) for new, old in zip(hidden_prime, hidden))
+                for batch_idx, label in zip(active.nonzero().flatten().tolist(),
+                                            emitted[active].tolist()):
+                    labels[batch_idx].append(label)
+                symbols_added += 1
+
+        return labels
+
+
+def create_greedy_decoder(conf, blank_idx=0, shift_labels_by_one=True):
+    """Returns the greedy decoder selected by the configuration."""
+    decoder_class = TransducerGreedyDecoder if conf.sequential_greedy_decoding else TransducerBatchedGreedyDecoder
+    return decoder_class(blank_idx=blank_idx,
+                         max_symbols_per_step=conf.max_symbols_per_step,
+                         shift_labels_by_one=shift_labels_by_one)
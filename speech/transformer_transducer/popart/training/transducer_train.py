@@ -24,7 +24,7 @@ import ema_utils
 import device
 from feat_proc_cpp_async import AsyncDataProcessor
 import transducer_validation
-from transducer_decoder import TransducerGreedyDecoder
+from transducer_decoder import create_greedy_decoder
 import test_transducer
 
 
@@ -314,9 +314,7 @@ if __name__ == '__main__':
                                                                                                         transducer_config)
         pytorch_rnnt_model = transducer_validation.create_pytorch_rnnt_model(transducer_config,
                                                                              val_tokenizer.num_labels + 1)
-        greedy_decoder = TransducerGreedyDecoder(blank_idx=0,
-                                                 max_symbols_per_step=conf.max_symbols_per_step,
-                                                 shift_labels_by_one=True)
+        greedy_decoder = create_greedy_decoder(conf, blank_idx=0, shift_labels_by_one=True)
 
     training_session_options = conf_utils.get_session_options(
         training_runtime_conf)
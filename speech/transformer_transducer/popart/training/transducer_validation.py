@@ -22,7 +22,7 @@ import mpi_utils
 
 from rnnt_reference import config
 from rnnt_reference.model import RNNT
-from transducer_decoder import TransducerGreedyDecoder
+from transducer_decoder import create_greedy_decoder
 import device as device_module
 
 # set up logging
@@ -489,8 +489,7 @@ if __name__ == "__main__":
     pytorch_rnnt_model = create_pytorch_rnnt_model(
         transducer_config, val_tokenizer.num_labels + 1)
 
-    greedy_decoder = TransducerGreedyDecoder(
-        blank_idx=0, max_symbols_per_step=conf.max_symbols_per_step, shift_labels_by_one=True)
+    greedy_decoder = create_greedy_decoder(conf, blank_idx=0, shift_labels_by_one=True)
 
     device = device_module.acquire_device(
         conf, runtime_conf.local_replication_factor, runtime_conf)
@@ -24,6 +24,22 @@ def prepare_triton_client(url):
     return triton_client
 
 
+def make_infer_inputs(data_item, need_numpy_conversion=False):
+    if not isinstance(data_item, list):
+        data_item = [data_item]
+
+    inputs = []
+    for input_idx, (data) in enumerate(data_item):
+        if need_numpy_conversion:
+            data = data.numpy()
+        name = "input_" + str(input_idx)
+        infer_input = grpcclient.InferInput(name, data.shape,
+                                            np_to_triton_dtype(data.dtype))
+        infer_input.set_data_from_numpy(data)
+        inputs.append(infer_input)
+    return inputs
+
+
 ClientInput = namedtuple('ClientInput', ['model_name', 'infer_input'])
 
 
@@ -46,20 +62,8 @@ class Client:
     def infer_data_item(self, data_item, need_numpy_conversion=False):
         if not isinstance(data_item, list):
             data_item = [data_item]
-
-        inputs = []
-        inp_size = 0
-        for input_idx, (data) in enumerate(data_item):
-            if need_numpy_conversion:
-                data = data.numpy()
-            inp_size = data.shape[0]
-            name = "input_" + str(input_idx)
-            infer_input = grpcclient.InferInput(name, data.shape,
-                                                np_to_triton_dtype(data.dtype))
-            infer_input.set_data_from_numpy(data)
-            inputs.append(infer_input)
-        self.sample_sizes.append(inp_size)
-        return inputs
+        self.sample_sizes.append(data_item[-1].shape[0])
+        return make_infer_inputs(data_item, need_numpy_conversion)
 
     def infer_on_the_fly(self, request_type, model_name, number_of_outputs, report_performance=True):
         if self.data_generator is None:
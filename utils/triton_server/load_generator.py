@@ -0,0 +1,324 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+
+from dataclasses import dataclass, field
+from functools import partial
+import itertools
+import json
+import logging
+import numpy as np
+import threading
+import time
+from typing import Dict, List, Optional
+import tritonclient.grpc as grpcclient
+from .client import make_infer_inputs, prepare_triton_client
+from .server_setup import (load_concurrency_opt, load_distribution_opt, load_measurement_opt,
+                           load_report_opt, load_request_rates_opt, load_warmup_opt)
+from .utilsTriton import Timeout
+
+
+class LatencyHistogram:
+    """Latency histogram with HDR (high dynamic range) bucketing.
+
+    Latencies are recorded in microseconds. Buckets are exact up to `2 * 10^significant_figures` us,
+    and above that their width doubles with every power of two, so any recorded value and percentile
+    is accurate to `significant_figures` decimal digits, in constant memory.
+    """
+
+    def __init__(self, highest_trackable_us=3600 * 10**6, significant_figures=3):
+        self.significant_figures = significant_figures
+        largest_exact = 2 * 10**significant_figures
+        self.sub_bucket_half_count_magnitude = max(int(np.ceil(np.log2(largest_exact))) - 1, 0)
+        self.sub_bucket_half_count = 1 << self.sub_bucket_half_count_magnitude
+        self.highest_trackable_us = highest_trackable_us
+        self.counts = np.zeros(self.index_of(highest_trackable_us) + 1, dtype=np.int64)
+        self.total_count = 0
+        self.min_us = None
+        self.max_us = 0
+        self.sum_us = 0
+
+    def index_of(self, value_us):
+        bucket = max(int(value_us).bit_length() - self.sub_bucket_half_count_magnitude - 1, 0)
+        return bucket * self.sub_bucket_half_count + (int(value_us) >> bucket)
+
+    def lowest_value_at(self, index):
+        bucket = max(index // self.sub_bucket_half_count - 1, 0)
+        return (index - bucket * self.sub_bucket_half_count) << bucket
+
+    def highest_equivalent_value_at(self, index):
+        bucket = max(index // self.sub_bucket_half_count - 1, 0)
+        return self.lowest_value_at(index) + (1 << bucket) - 1
+
+    def record(self, latency_seconds):
+        value_us = min(max(int(round(latency_seconds * 1e6)), 0), self.highest_trackable_us)
+        self.counts[self.index_of(value_us)] += 1
+        self.total_count += 1
+        self.sum_us += value_us
+        self.min_us = value_us if self.min_us is None else min(self.min_us, value_us)
+        self.max_us = max(self.max_us, value_us)
+
+    def merge(self, other):
+        """Add the latencies recorded by another histogram of the same precision, e.g. of another client."""
+        if (other.significant_figures, other.highest_trackable_us) != \
+                (self.significant_figures, self.highest_trackable_us):
+            raise ValueError("Only histograms of the same precision and range can be merged.")
+        self.counts += other.counts
+        self.total_count += other.total_count
+        self.sum_us += other.sum_us
+        if other.min_us is not None:
+            self.min_us = other.min_us if self.min_us is None else min(self.min_us, other.min_us)
+        self.max_us = max(self.max_us, other.max_us)
+        return self
+
+    def percentile(self, percentile):
+        """Highest latency of the lowest `percentile` percent of the recorded latencies, in us."""
+        if self.total_count == 0:
+            return None
+        rank = max(int(np.ceil(percentile / 100 * self.total_count)), 1)
+        index = int(np.searchsorted(np.cumsum(self.counts), rank))
+        return min(self.highest_equivalent_value_at(index), self.max_us)
+
+    def to_dict(self, percentiles=(50, 90, 95, 99, 99.9)):
+        buckets = np.nonzero(self.counts)[0]
+        return {
+            "unit": "us",
+            "significant_figures": self.significant_figures,
+            "count": self.total_count,
+            "min": self.min_us,
+            "mean": self.sum_us / self.total_count if self.total_count else None,
+            "max": self.max_us if self.total_count else None,
+            "percentiles": {f"p{p:g}": self.percentile(p) for p in percentiles},
+            # Non-empty buckets, as [highest equivalent value, count]
+            "buckets": [[self.highest_equivalent_value_at(int(i)), int(self.counts[i])] for i in buckets],
+        }
+
+
+@dataclass
+class LoadResult:
+    mode: str
+    level: float
+    duration: float
+    histogram: LatencyHistogram
+    inferences: int = 0
+    samples: int = 0
+    errors: int = 0
+    max_in_flight: int = 0
+    late_sends: int = 0
+
+    @property
+    def throughput(self):
+        return self.samples / self.duration
+
+    @property
+    def inference_rate(self):
+        return self.inferences / self.duration
+
+    def to_dict(self):
+        return {
+            "mode": self.mode,
+            "level": self.level,
+            "duration_sec": self.duration,
+            "inferences": self.inferences,
+            "errors": self.errors,
+            "throughput_samples_per_sec": self.throughput,
+            "throughput_inferences_per_sec": self.inference_rate,
+            "max_in_flight": self.max_in_flight,
+            "late_sends": self.late_sends,
+            "latency": self.histogram.to_dict(),
+        }
+
+
+@dataclass
+class _Window:
+    """Measurement window of a run, and the requests completed in it."""
+    result: LoadResult
+    start: float
+    end: float
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    in_flight: int = 0
+    stopping: bool = False
+    drained: threading.Event = field(default_factory=threading.Event)
+
+    def add_in_flight(self):
+        with self.lock:
+            self.in_flight += 1
+            self.result.max_in_flight = max(self.result.max_in_flight, self.in_flight)
+
+    def complete(self, send_time, end_time, sample_size, error):
+        """Record a completed request. Returns whether the run is still sending requests."""
+        with self.lock:
+            if send_time >= self.start and end_time <= self.end:
+                if error:
+                    self.result.errors += 1
+                else:
+                    self.result.histogram.record(end_time - send_time)
+                    self.result.inferences += 1
+                    self.result.samples += sample_size
+            self.in_flight -= 1
+            if self.stopping or end_time > self.end:
+                self.stopping = True
+                if self.in_flight == 0:
+                    self.drained.set()
+                return False
+            return True
+
+
+class LoadGenerator:
+    """Drives a model on Triton Server at a fixed concurrency or request rate, similar to perf_analyzer.
+
+    All requests are sent asynchronously over the gRPC channel of a single client. Each run
+    sends requests for `warmup_seconds`, whose requests are not measured, then for `measurement_seconds`.
+    Only the requests sent after the warm-up and completed within the measurement window are recorded.
+
+    Modes:
+    - concurrency (closed loop): `concurrency` requests are kept in flight, a new request is sent as soon
+      as one completes.
+    - request rate (open loop): requests are sent at `request_rate` per second, with constant or
+      exponentially distributed (Poisson) intervals, independently of their completion.
+    """
+
+    def __init__(self, url, model_name, input_data, number_of_outputs,
+                 warmup_seconds=2.0, measurement_seconds=10.0, drain_timeout_seconds=360, seed=0):
+        self.triton_client = prepare_triton_client(url)
+        self.model_name = model_name
+        # Inputs are prepared once and cycled through
+        self.requests = [(make_infer_inputs(data_item), sample_size)
+                         for data_item, sample_size in (self._with_sample_size(d) for d in input_data)]
+        if not self.requests:
+            raise ValueError("Load generation requires at least one input data item.")
+        self.outputs = [grpcclient.InferRequestedOutput('output_' + str(out_idx))
+                        for out_idx in range(number_of_outputs)]
+        self.warmup_seconds = warmup_seconds
+        self.measurement_seconds = measurement_seconds
+        self.drain_timeout_seconds = drain_timeout_seconds
+        self.rng = np.random.default_rng(seed)
+
+    @staticmethod
+    def _with_sample_size(data_item):
+        if not isinstance(data_item, list):
+            data_item = [data_item]
+        return data_item, data_item[-1].shape[0]
+
+    def _new_window(self, mode, level):
+        start = time.perf_counter() + self.warmup_seconds
+        result = LoadResult(mode=mode, level=level, duration=self.measurement_seconds,
+                            histogram=LatencyHistogram())
+        return _Window(result=result, start=start, end=start + self.measurement_seconds)
+
+    def _send(self, window, requests, on_complete):
+        inputs, sample_size = next(requests)
+        window.add_in_flight()
+        send_time = time.perf_counter()
+        self.triton_client.async_infer(model_name=self.model_name,
+                                       inputs=inputs,
+                                       callback=partial(on_complete, send_time, sample_size),
+                                       outputs=self.outputs)
+
+    def _drain(self, window):
+        with Timeout(seconds=self.drain_timeout_seconds, error_message="Load generator requests timeout"):
+            while not window.drained.wait(timeout=0.1):
+                pass
+
+    def run_concurrency(self, concurrency) -> LoadResult:
+        window = self._new_window("concurrency", concurrency)
+        requests = itertools.cycle(self.requests)
+        send_lock = threading.Lock()
+
+        def on_complete(send_time, sample_size, result, error):
+            if window.complete(send_time, time.perf_counter(), sample_size, error):
+                with send_lock:
+                    self._send(window, requests, on_complete)
+
+        with send_lock:
+            for _ in range(concurrency):
+                self._send(window, requests, on_complete)
+        self._drain(window)
+        return window.result
+
+    def run_request_rate(self, request_rate, distribution="constant") -> LoadResult:
+        if distribution not in ("constant", "poisson"):
+            raise ValueError(f"Unknown request distribution: {distribution}")
+        window = self._new_window(f"request_rate_{distribution}", request_rate)
+        requests = itertools.cycle(self.requests)
+
+        def on_complete(send_time, sample_size, result, error):
+            window.complete(send_time, time.perf_counter(), sample_size, error)
+
+        next_send = time.perf_counter()
+        while next_send < window.end:
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -1e-3 and next_send >= window.start:
+                # The generator could not keep up with the schedule
+                window.result.late_sends += 1
+            self._send(window, requests, on_complete)
+            interval = 1.0 / request_rate
+            next_send += self.rng.exponential(interval) if distribution == "poisson" else interval
+
+        with window.lock:
+            window.stopping = True
+            if window.in_flight == 0:
+                window.drained.set()
+        self._drain(window)
+        return window.result
+
+    def run_schedule(self, concurrency_levels=(), request_rates=(), distribution="constant") -> List[LoadResult]:
+        """Run every concurrency level, then every request rate."""
+        results = []
+        for concurrency in concurrency_levels:
+            results.append(self.run_concurrency(concurrency))
+            log_load_result(self.model_name, results[-1])
+        for request_rate in request_rates:
+            results.append(self.run_request_rate(request_rate, distribution))
+            log_load_result(self.model_name, results[-1])
+        return results
+
+
+def parse_levels(levels: Optional[str]) -> List[float]:
+    """Parse a comma separated list of levels, or a perf_analyzer style `start:end[:step]` range."""
+    if not levels:
+        return []
+    if ":" in levels:
+        bounds = [float(v) for v in levels.split(":")]
+        if len(bounds) not in (2, 3):
+            raise ValueError(f"Levels range '{levels}' should be `start:end[:step]`.")
+        start, end, step = bounds if len(bounds) == 3 else bounds + [1.0]
+        if step <= 0 or end < start:
+            raise ValueError(f"Levels range '{levels}' should have a positive step and end >= start.")
+        return list(np.arange(start, end + 1e-9, step))
+    return [float(v) for v in levels.split(",")]
+
+
+def log_load_result(model_name, result: LoadResult):
+    latency = result.histogram.to_dict()
+    percentiles = ", ".join(f"{name}: {value / 1000:.3f} ms" for name, value in latency["percentiles"].items()
+                            if value is not None)
+    logging.info(
+        f"{model_name}-{result.mode}-{result.level:g}: "
+        f"throughput: {result.throughput:.2f} samples/sec ({result.inference_rate:.2f} infer/sec), "
+        f"latency {percentiles}, errors: {result.errors}, max in flight: {result.max_in_flight}"
+        + (f", late sends: {result.late_sends}" if result.late_sends else ""))
+
+
+def save_load_results(path, model_name, results: List[LoadResult], extra: Optional[Dict] = None):
+    report = {"model_name": model_name, "results": [result.to_dict() for result in results]}
+    report.update(extra or {})
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    logging.info(f"Saved latency report to {path}")
+
+
+def run_load_benchmark(config, url, model_name, input_data, number_of_outputs):
+    """Run the load levels selected with the `--load-*` pytest options, returns the results."""
+    load_generator = LoadGenerator(url, model_name, input_data, number_of_outputs,
+                                   warmup_seconds=config.getoption(load_warmup_opt),
+                                   measurement_seconds=config.getoption(load_measurement_opt))
+    concurrency_levels = [int(c) for c in parse_levels(config.getoption(load_concurrency_opt))]
+    distribution = config.getoption(load_distribution_opt)
+    results = load_generator.run_schedule(concurrency_levels,
+                                          parse_levels(config.getoption(load_request_rates_opt)),
+                                          distribution)
+    report_path = config.getoption(load_report_opt)
+    if report_path:
+        save_load_results(report_path, model_name, results, {"request_distribution": distribution})
+    return results
@@ -14,6 +14,12 @@ from .server import TritonServer
 model_repo_opt = "--model-repository"
 grpc_port_opt = "--grpc-port"
 benchmark_opt = "--benchmark_only"
+load_concurrency_opt = "--load-concurrency"
+load_request_rates_opt = "--load-request-rates"
+load_distribution_opt = "--load-distribution"
+load_warmup_opt = "--load-warmup-seconds"
+load_measurement_opt = "--load-measurement-seconds"
+load_report_opt = "--load-report"
 
 triton_server_build_rel_path = "/server/mybuild/tritonserver/build/server/mybuild/tritonserver/install/bin/"
 
@@ -38,6 +44,20 @@ and model exported to popef file. Default: `TEST_ROOT_PATH/models`")
                      help="Port on which Triton Server will be listening for commands.")
     parser.addoption(benchmark_opt, action="store", default=False,
                      help="Run benchmarks sending requests with exactly 1 batch size of selected model.")
+    parser.addoption(load_concurrency_opt, action="store", default="1,2,4,8",
+                     help="Comma separated list, or `start:end[:step]` range, of concurrency levels for the \
+closed-loop load generator.")
+    parser.addoption(load_request_rates_opt, action="store", default="",
+                     help="Comma separated list, or `start:end[:step]` range, of request rates (requests/sec) \
+for the open-loop load generator. Default: none")
+    parser.addoption(load_distribution_opt, action="store", default="constant", choices=["constant", "poisson"],
+                     help="Distribution of the intervals between requests sent by the open-loop load generator.")
+    parser.addoption(load_warmup_opt, action="store", type=float, default=2.0,
+                     help="Warm-up time of every load level, whose requests are not measured.")
+    parser.addoption(load_measurement_opt, action="store", type=float, default=10.0,
+                     help="Measurement time of every load level.")
+    parser.addoption(load_report_opt, action="store", default=None,
+                     help="Path of the JSON report with the latency histograms of the load generator runs.")
 
 
 triton_env_lockfile_name = str(
@@ -0,0 +1,92 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+
+from pathlib import Path
+import sys
+import numpy as np
+import pytest
+# The triton_server modules import `import_helper` from the triton_server directory
+triton_server_folder = Path(__file__).parent.parent.absolute()
+sys.path.insert(0, str(triton_server_folder))
+sys.path.insert(0, str(triton_server_folder.parent))
+from triton_server.load_generator import LatencyHistogram, parse_levels
+
+
+def random_latencies(size, seed=0):
+    """Log-normal latencies in seconds, from tens of us to seconds."""
+    return np.random.default_rng(seed).lognormal(mean=np.log(5e-3), sigma=1.5, size=size)
+
+
+def record_all(latencies):
+    histogram = LatencyHistogram()
+    for latency in latencies:
+        histogram.record(latency)
+    return histogram
+
+
+def test_bucketing():
+    histogram = LatencyHistogram()
+    values = np.concatenate([np.arange(0, 5000), np.random.default_rng(0).integers(5000, 3600 * 10**6, 10000)])
+    for value in values.tolist():
+        index = histogram.index_of(value)
+        lowest, highest = histogram.lowest_value_at(index), histogram.highest_equivalent_value_at(index)
+        assert lowest <= value <= highest
+        # exact up to 2 * 10^3 us, then 3 significant figures
+        assert highest - lowest + 1 <= max(1, value * 1e-3)
+    assert histogram.index_of(histogram.highest_trackable_us) == len(histogram.counts) - 1
+
+
+@pytest.mark.parametrize("size", [1, 7, 10000])
+def test_percentiles(size):
+    latencies = random_latencies(size)
+    histogram = record_all(latencies)
+    values_us = np.round(latencies * 1e6)
+    sorted_us = np.sort(values_us)
+    for percentile in (0, 1, 50, 90, 95, 99, 99.9, 100):
+        expected = np.percentile(values_us, percentile)
+        # the histogram takes the nearest rank, np.percentile interpolates between its neighbours
+        position = percentile / 100 * (size - 1)
+        gap = sorted_us[int(np.ceil(position))] - sorted_us[int(np.floor(position))]
+        assert abs(histogram.percentile(percentile) - expected) <= expected * 1e-3 + gap + 1
+
+    summary = histogram.to_dict()
+    assert summary["count"] == size
+    assert summary["min"] == values_us.min() and summary["max"] == values_us.max()
+    assert summary["mean"] == pytest.approx(values_us.mean())
+    assert sum(count for _, count in summary["buckets"]) == size
+
+
+def test_empty_histogram():
+    summary = LatencyHistogram().to_dict()
+    assert summary["count"] == 0
+    assert summary["mean"] is None and summary["max"] is None
+    assert all(value is None for value in summary["percentiles"].values())
+
+
+def test_merge():
+    latencies = random_latencies(2000)
+    merged = record_all(latencies[:500]).merge(record_all(latencies[500:]))
+    merged.merge(LatencyHistogram())
+    expected = record_all(latencies)
+    np.testing.assert_array_equal(merged.counts, expected.counts)
+    assert merged.to_dict() == expected.to_dict()
+
+    empty = LatencyHistogram().merge(expected)
+    assert empty.to_dict() == expected.to_dict()
+    with pytest.raises(ValueError):
+        expected.merge(LatencyHistogram(significant_figures=2))
+
+
+def test_parse_levels():
+    assert parse_levels(None) == []
+    assert parse_levels("") == []
+    assert parse_levels("1,2,8") == [1, 2, 8]
+    assert parse_levels("0.5") == [0.5]
+    assert parse_levels("1:4") == [1, 2, 3, 4]
+    assert parse_levels("10:30:10") == [10, 20, 30]
+    assert parse_levels("100:200:75") == [100, 175]
+
+
+@pytest.mark.parametrize("levels", ["a", "1,,2", "1:2:3:4", "1:4:0", "1:4:-1", "4:1", "1:"])
+def test_parse_invalid_levels(levels):
+    with pytest.raises(ValueError):
+        parse_levels(levels)
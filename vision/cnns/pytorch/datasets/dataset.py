@@ -15,6 +15,7 @@ import import_helper
 import models
 from datasets.preprocess import get_preprocessing_pipeline
 from datasets.raw_imagenet import ImageNetDataset
+from datasets.packed_imagenet import PackedImageNetDataset
 
 
 datasets_info = {
@@ -23,6 +24,7 @@ datasets_info = {
     "generated": {"out": 1000},
     "cifar10": {"out": 10},
     "imagenet": {"out": 1000},
+    "packed-imagenet": {"out": 1000},
 }
 
 
@@ -92,7 +94,7 @@ def get_data(args, opts, train=True, async_dataloader=False, return_remaining=Fa
         half_precision = False
     use_bbox_info = getattr(args, "use_bbox_info", False)
 
-    if args.data in ["real", "imagenet", "cifar10"]:
+    if args.data in ["real", "imagenet", "packed-imagenet", "cifar10"]:
         transform = get_preprocessing_pipeline(train, input_shape[-1],
                                                half_precision, args.normalization_location == "host", eightbit = args.eight_bit_io,
                                                use_bbox_info=use_bbox_info, fine_tuning=fine_tuning)
@@ -123,6 +125,12 @@ def get_data(args, opts, train=True, async_dataloader=False, return_remaining=Fa
         data_folder = os.path.join(args.imagenet_data_path, data_folder)
         bboxes = os.path.join(args.imagenet_data_path, 'imagenet_2012_bounding_boxes.csv') if use_bbox_info and train else None   # use bboxes only for training
         dataset = ImageNetDataset(data_folder, transform=transform, bbox_file=bboxes)
+    elif args.data == "packed-imagenet":
+        assert os.path.exists(args.imagenet_data_path), f"{args.imagenet_data_path} does not exist!"
+        # ImageNet packed by datasets/packed_imagenet.py
+        data_folder = 'train' if train else 'validation'
+        data_folder = os.path.join(args.imagenet_data_path, data_folder)
+        dataset = PackedImageNetDataset(data_folder, transform=transform, use_bbox_info=use_bbox_info and train)
     elif args.data == "cifar10":
         data_path = Path(__file__).parent.parent.absolute().joinpath("data").joinpath("cifar10")
         dataset = torchvision.datasets.CIFAR10(root=data_path, train=train, download=True, transform=transform)
@@ -16,6 +16,7 @@ def get_args():
     parser.add_argument('--iterations', type=int, default=2, help='Number of iterations.')
     parser.add_argument('--data', choices=datasets_info.keys(), default='imagenet', help='Select dataset')
     parser.add_argument('--imagenet-data-path', type=str, default="/localdata/datasets/imagenet-raw-data", help="Path of the raw imagenet data")
+    parser.add_argument('--packed-imagenet-data-path', type=str, help="Path of the packed imagenet data. If set with imagenet data, both the raw and the packed formats are benchmarked")
     parser.add_argument('--disable-async-loading', action='store_true', help='Not using the async DataLoader')
     parser.add_argument('--normalization-location', choices=['host', 'ipu'], default='host', help='Location of the data normalization')
     parser.add_argument('--dataloader-worker', type=int, default=32, help="Number of worker for each dataloader")
@@ -34,6 +35,7 @@ def get_args():
 
 
 def benchmark_throughput(dataloader, iterations):
+    throughputs = []
     for _ in range(iterations):
         total_sample_size = 0
         start_time = time.perf_counter()
@@ -49,6 +51,8 @@ def benchmark_throughput(dataloader, iterations):
 
         iteration_throughput = total_sample_size / elapsed_time
         logging.info(f"Throughput of the iteration:{iteration_throughput:0.1f} img/sec")
+        throughputs.append(iteration_throughput)
+    return throughputs
 
 
 if __name__ == '__main__':
@@ -57,4 +61,12 @@ if __name__ == '__main__':
     opts = poptorch.Options()
     opts.randomSeed(0)
     dataloader = get_data(args, opts, train=True, async_dataloader=not(args.disable_async_loading))
-    benchmark_throughput(dataloader, args.iterations)
+    throughputs = {args.data: benchmark_throughput(dataloader, args.iterations)}
+    if args.data == "imagenet" and args.packed_imagenet_data_path is not None:
+        dataloader.terminate()
+        args.data, args.imagenet_data_path = "packed-imagenet", args.packed_imagenet_data_path
+        dataloader = get_data(args, opts, train=True, async_dataloader=not(args.disable_async_loading))
+        throughputs[args.data] = benchmark_throughput(dataloader, args.iterations)
+    for data, data_throughputs in throughputs.items():
+        # The first iteration includes the warm-up of the workers
+        logging.info(f"{data}: {max(data_throughputs):0.1f} img/sec (best iteration)")
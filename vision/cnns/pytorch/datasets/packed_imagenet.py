@@ -0,0 +1,108 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+"""
+Packed ImageNet: the JPEG files of a split are concatenated into large shard files,
+which are read sequentially when converting and memory-mapped when training.
+
+Every split directory contains the shards `shard_XXXXX.bin` and an `index.npz` with one entry per image:
+    shard, offset, size: shard and byte range of the JPEG file
+    label: class index, in the order of the ImageFolder classes of the raw dataset
+    bbox: relative (x1, y1, x2, y2) bounding box, NaN if the image has none
+"""
+import argparse
+import logging
+import os
+import numpy as np
+from torch.utils.data import Dataset
+from tqdm import tqdm
+import import_helper
+from datasets.raw_imagenet import ImageNetDataset
+
+
+def pack_imagenet_split(data_folder, output_folder, bbox_file=None, shard_size=1 << 30):
+    """
+    Write the images of a raw ImageNet split into shards of about `shard_size` bytes.
+    """
+    raw_dataset = ImageNetDataset(data_folder, bbox_file=bbox_file)
+    os.makedirs(output_folder, exist_ok=True)
+    num_images = len(raw_dataset.samples)
+    shards = np.zeros(num_images, dtype=np.int32)
+    offsets = np.zeros(num_images, dtype=np.int64)
+    sizes = np.zeros(num_images, dtype=np.int32)
+    labels = np.zeros(num_images, dtype=np.int32)
+    bboxes = np.full((num_images, 4), np.nan, dtype=np.float32)
+    shard, offset = 0, 0
+    shard_file = open(os.path.join(output_folder, f"shard_{shard:05d}.bin"), "wb")
+    for idx, (path, target, bbox) in enumerate(tqdm(raw_dataset.samples, desc=f"Packing {data_folder}")):
+        if offset >= shard_size:
+            shard_file.close()
+            shard, offset = shard + 1, 0
+            shard_file = open(os.path.join(output_folder, f"shard_{shard:05d}.bin"), "wb")
+        with open(path, 'rb') as jpeg_file:
+            img = jpeg_file.read()
+        shard_file.write(img)
+        shards[idx], offsets[idx], sizes[idx], labels[idx] = shard, offset, len(img), target
+        if bbox is not None:
+            bboxes[idx] = bbox
+        offset += len(img)
+    shard_file.close()
+    # The index is written last, so an index always describes complete shards
+    np.savez(os.path.join(output_folder, "index.npz"), shard=shards, offset=offsets, size=sizes,
+             label=labels, bbox=bboxes, classes=np.array(raw_dataset.classes))
+    logging.info(f"Packed {num_images} images of {data_folder} into {shard + 1} shards.")
+
+
+class PackedImageNetDataset(Dataset):
+    """
+    Reads the images written by `pack_imagenet_split`. The samples are the raw JPEG bytes and the
+    bounding box, as in `ImageNetDataset`, so they go through the same LoadJpeg and crop-decode transforms.
+    The shards are memory-mapped when first read, so in each dataloader worker.
+    """
+    def __init__(self, data_folder, transform=None, target_transform=None, use_bbox_info=False):
+        self.data_folder = data_folder
+        self.transform = transform
+        self.target_transform = target_transform
+        self.use_bbox_info = use_bbox_info
+        index = np.load(os.path.join(data_folder, "index.npz"))
+        self.shard = index["shard"]
+        self.offset = index["offset"]
+        self.size = index["size"]
+        self.targets = index["label"]
+        self.bboxes = index["bbox"]
+        self.classes = list(index["classes"])
+        self._shards = {}
+
+    def __len__(self):
+        return len(self.targets)
+
+    def _read_shard(self, shard):
+        if shard not in self._shards:
+            self._shards[shard] = np.memmap(os.path.join(self.data_folder, f"shard_{shard:05d}.bin"), mode='r')
+        return self._shards[shard]
+
+    def __getitem__(self, index: int):
+        offset = self.offset[index]
+        img = self._read_shard(int(self.shard[index]))[offset:offset + self.size[index]].tobytes()
+        bbox = self.bboxes[index]
+        bbox = tuple(bbox.tolist()) if self.use_bbox_info and not np.isnan(bbox[0]) else None
+        target = int(self.targets[index])
+
+        sample = (img, bbox)
+        if self.transform is not None:
+            sample = self.transform(sample)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+
+        return sample, target
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(add_help=True, description='Pack the raw ImageNet dataset into shards')
+    parser.add_argument('--imagenet-data-path', type=str, required=True, help="Path of the raw imagenet data")
+    parser.add_argument('--output-path', type=str, required=True, help="Path of the packed imagenet data")
+    parser.add_argument('--shard-size', type=int, default=1024, help="Size of the shards in MB")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    bbox_file = os.path.join(args.imagenet_data_path, 'imagenet_2012_bounding_boxes.csv')
+    for split in ["train", "validation"]:
+        pack_imagenet_split(os.path.join(args.imagenet_data_path, split), os.path.join(args.output_path, split),
+                            bbox_file=bbox_file if split == "train" else None, shard_size=args.shard_size << 20)
@@ -14,7 +14,7 @@ class ImageNetDataset(torchvision.datasets.ImageFolder):
         else:
             bboxes = {}
         for idx, (path, target) in enumerate(self.samples):
-            self.samples[idx] = path, target, bboxes.get(target, None)
+            self.samples[idx] = path, target, bboxes.get(os.path.basename(path), None)
 
 
     def __getitem__(self, index: int):
@@ -39,6 +39,6 @@ class ImageNetDataset(torchvision.datasets.ImageFolder):
                     file_name = row[0]
                     x1, y1, x2, y2 = float(row[1]), float(row[2]), float(row[3]), float(row[4])
                     bboxes[file_name] = (x1, y1, x2, y2)
-            return bboxes
         else:
             logging.warning("Bounding Box information hasn't found.")
+        return bboxes
@@ -18,6 +18,8 @@ import models
 from models.models import NormalizeInputModel
 from utils import run_script, get_current_interpreter_executable
 from datasets.optimised_jpeg import ExtendedTurboJPEG
+from datasets.packed_imagenet import PackedImageNetDataset, pack_imagenet_split
+from datasets.raw_imagenet import ImageNetDataset
 import turbojpeg
 
 
@@ -397,3 +399,43 @@ class TestJpeg:
         pil_crop_img = transforms.ToTensor()(pil_crop_img)
         pil_crop_img = transforms.functional.crop(pil_crop_img, 40, 80, 80, 120)
         assert torch.allclose(turbo_crop_img, pil_crop_img, atol=1e-02, rtol=1e-02)
+
+
+def test_packed_imagenet(tmp_path):
+    raw_folder = tmp_path / "raw"
+    for class_name in ["n01", "n02"]:
+        (raw_folder / class_name).mkdir(parents=True)
+        for idx in range(3):
+            img = Image.fromarray(np.random.randint(0, 255, (32 + idx, 48, 3), dtype=np.uint8))
+            img.save(raw_folder / class_name / f"{class_name}_{idx}.JPEG")
+    bbox_file = tmp_path / "bboxes.csv"
+    bbox_file.write_text("n01_1.JPEG,0.1,0.2,0.5,0.6\nn02_2.JPEG,0.0,0.0,1.0,0.9\n")
+    # Small shards, so the images are split across several of them
+    pack_imagenet_split(str(raw_folder), str(tmp_path / "packed"), bbox_file=str(bbox_file), shard_size=4096)
+
+    raw_dataset = ImageNetDataset(str(raw_folder), transform=lambda sample: sample, bbox_file=str(bbox_file))
+    packed_dataset = PackedImageNetDataset(str(tmp_path / "packed"), transform=lambda sample: sample, use_bbox_info=True)
+    assert len(packed_dataset) == len(raw_dataset)
+    assert packed_dataset.shard.max() > 0
+    for index in range(len(raw_dataset)):
+        (raw_img, raw_bbox), raw_target = raw_dataset[index]
+        (packed_img, packed_bbox), packed_target = packed_dataset[index]
+        assert packed_img == raw_img
+        assert packed_target == raw_target
+        if raw_bbox is None:
+            assert packed_bbox is None
+        else:
+            np.testing.assert_allclose(packed_bbox, raw_bbox, rtol=1e-6)
+    assert sum(bbox is not None for _, _, bbox in raw_dataset.samples) == 2
+
+
+def test_packed_imagenet_without_bboxes(tmp_path):
+    raw_folder = tmp_path / "raw" / "n01"
+    raw_folder.mkdir(parents=True)
+    Image.fromarray(np.zeros((32, 48, 3), dtype=np.uint8)).save(raw_folder / "n01_0.JPEG")
+    # The default bounding box file is passed even when it is missing
+    pack_imagenet_split(str(tmp_path / "raw"), str(tmp_path / "packed"), bbox_file=str(tmp_path / "missing.csv"))
+
+    packed_dataset = PackedImageNetDataset(str(tmp_path / "packed"), transform=lambda sample: sample, use_bbox_info=True)
+    (_, packed_bbox), _ = packed_dataset[0]
+    assert packed_bbox is None
@@ -9,6 +9,7 @@ import os
 import poptorch
 import pytest
 from triton_server.client import RequestType, task_one_client_one_model, task_one_client_one_model_buffered_data
+from triton_server.load_generator import run_load_benchmark
 from triton_server.utilsTriton import PoolLogExceptions
 from tritonserver.conftest import test_configs, benchmark_opt
 from test_utils import get_model_settings, log_performance_results, DataGeneratorWrapper
@@ -84,3 +85,24 @@ def test_single_model(request, triton_server, request_type, model_name,
     log_performance_results(args, model_name, request_type,
                             result_data_type, number_of_processes, throughputs, latencies)
     assert result
+
+
+@pytest.mark.parametrize('model_name,yml_config', test_configs.items())
+def test_load_generator(request, triton_server, model_name, yml_config):
+    if request.config.getoption(benchmark_opt) is False:
+        pytest.skip("Load generator test is available only in benchmark mode.")
+
+    pargs = ('--config', yml_config)
+    args, opts = get_model_settings(pargs)
+    # send requests with exactly 1 batch size of the model
+    args.device_iterations = 1
+    opts.deviceIterations(args.device_iterations)
+
+    dataloader = datasets.get_data(
+        args, opts, train=False, async_dataloader=False)
+    input_dataset = [input_data for input_data, _ in DataGeneratorWrapper(dataloader)]
+
+    number_of_outputs = 1
+    results = run_load_benchmark(request.config, triton_server.url, model_name,
+                                 input_dataset, number_of_outputs)
+    assert all(result.inferences > 0 and result.errors == 0 for result in results)
@@ -23,9 +23,9 @@ def generate_random_seed(distributed=False):
 def parse_arguments():
     common_parser = utils.get_common_parser()
     parser = argparse.ArgumentParser(description='CNN training in PopTorch', parents=[common_parser])
-    parser.add_argument('--data', choices=['cifar10', 'imagenet', 'synthetic', 'generated'], default='cifar10', help="Choose data")
+    parser.add_argument('--data', choices=['cifar10', 'imagenet', 'packed-imagenet', 'synthetic', 'generated'], default='cifar10', help="Choose data")
     parser.add_argument('--precision', choices=['16.16', '16.32', '32.32'], default='16.16', help="Precision of Ops(weights/activations/gradients) and Master data types: 16.16, 16.32, 32.32")
-    parser.add_argument('--imagenet-data-path', type=str, default="/localdata/datasets/imagenet-raw-data", help="Path of the raw imagenet data")
+    parser.add_argument('--imagenet-data-path', type=str, default="/localdata/datasets/imagenet-raw-data", help="Path of the raw imagenet data, or of the packed imagenet data")
     parser.add_argument('--gradient-accumulation', type=int, default=1, help="Number of batches to accumulate before a gradient update")
     parser.add_argument('--lr', type=float, default=0.01, help="Initial learning rate")
     parser.add_argument('--weight-decay', type=float, default=0.0001, help="L2 parameter penalty")
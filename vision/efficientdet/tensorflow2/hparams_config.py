@@ -265,6 +265,7 @@ def default_detection_configs():
       'pyfunc': False,
       'max_nms_inputs': 0,
       'max_output_size': 100,
+      'num_threads': 1,  # threads of the numpy nms, used if pyfunc is True.
   }
   h.tflite_max_detections = 100
 
@@ -118,7 +118,8 @@ def preprocess_normalize_image(img: tf.Tensor, img_dtype: tf.DType):
 
 def postprocess_predictions(config, cls_outputs, box_outputs, scales, mode='global'):
     """Postprocess class and box predictions.
-    Modified from the original implementation: keras/efficientdet_keras.py: EfficientDetModel._postprocessing."""
+    Modified from the original implementation: keras/efficientdet_keras.py: EfficientDetModel._postprocessing.
+    Adds the 'per_class_np' mode, the per-class NMS of nms_np over the whole batch."""
     if not mode:
         return cls_outputs, box_outputs
 
@@ -132,6 +133,9 @@ def postprocess_predictions(config, cls_outputs, box_outputs, scales, mode='glob
     if mode == 'per_class':
         return postprocess.postprocess_per_class(config.as_dict(),
                                                  cls_outputs, box_outputs, scales)
+    if mode == 'per_class_np':
+        return postprocess.postprocess_per_class_np(config.as_dict(),
+                                                    cls_outputs, box_outputs, scales)
     raise ValueError('Unsupported postprocess mode {}'.format(mode))
 
 
@@ -155,7 +155,7 @@ def main(args: argparse.Namespace):
                                                                class_outputs,
                                                                box_outputs,
                                                                scales,
-                                                               mode="global"))
+                                                               mode=args.host_postprocessing_mode))
             else:
                 # At a minimum we should include time to dequeue the results
                 with pvti.Tracepoint(channel, f"dequeing_outputs_{i}"):
@@ -192,7 +192,7 @@ def main(args: argparse.Namespace):
                     class_outputs, box_outputs = step_output
                     logging.debug("Host-Processing output: ", i)
                     det_outputs = postprocess_predictions(
-                        config, class_outputs, box_outputs, scales, mode="global")
+                        config, class_outputs, box_outputs, scales, mode=args.host_postprocessing_mode)
                 elif args.onchip_nms:
                     det_outputs = postprocess_onchip_nms_outputs(
                         config, step_output)
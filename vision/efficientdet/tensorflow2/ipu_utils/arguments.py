@@ -324,6 +324,9 @@ def parse_args(arg_list: Optional[List[Text]] = None) -> argparse.Namespace:
                        help="If true, will output the final predictions as annotated image files")
     group.add_argument("--benchmark-host-postprocessing", action=StoreTrueOverridable,
                        help="If provided, the off-chip post-processing is included in the latency measurements. Otherwise only the model time is used.")
+    group.add_argument("--host-postprocessing-mode", choices=("global", "per_class", "per_class_np"), default="global",
+                       help="The post-processing run on the host when the NMS is not on-chip. 'per_class_np' runs the numpy "
+                            "per-class NMS of all the images and classes at once, see `nms_configs.num_threads` to use threads.")
     group.add_argument("--output-dir", default="./outputs",
                        help="Directory for annotated output images")
     group.add_argument("--benchmark-repeats", default=100, type=int,
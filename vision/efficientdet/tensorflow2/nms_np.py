@@ -13,6 +13,10 @@
 # limitations under the License.
 # ==============================================================================
 """Anchor definition."""
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import time
+
 import numpy as np
 
 # The minimum score to consider a logit for identifying detections.
@@ -24,6 +28,9 @@ _DUMMY_DETECTION_SCORE = -1e5
 # The maximum number of (anchor,class) pairs to keep for non-max suppression.
 MAX_DETECTION_POINTS = 5000
 
+# The number of boxes compared at once by the batched hard and DIOU nms.
+_NMS_BLOCK_SIZE = 256
+
 
 def diou_nms(dets, iou_thresh=None):
   """DIOU non-maximum suppression.
@@ -263,3 +270,301 @@ def per_class_nms(boxes, scores, classes, image_id, image_scale, num_classes,
 
   return detections
 
+
+
+def _pairwise_overlaps(boxes_a, boxes_b, method=None):
+  """IOU, or DIOU for method `diou`, of all the pairs of boxes.
+
+  The overlaps are computed as in `hard_nms` and `diou_nms`, with boxes_a as
+  the retained boxes.
+
+  Args:
+    boxes_a: boxes with shape [batch, num_a, 4] and format [x1, y1, x2, y2].
+    boxes_b: boxes with shape [batch, num_b, 4] and format [x1, y1, x2, y2].
+    method: `diou` for DIOU, IOU otherwise.
+
+  Returns:
+    numpy.array: overlaps with shape [batch, num_a, num_b].
+  """
+  x1_a, y1_a, x2_a, y2_a = [boxes_a[:, :, None, i] for i in range(4)]
+  x1_b, y1_b, x2_b, y2_b = [boxes_b[:, None, :, i] for i in range(4)]
+  areas_a = (x2_a - x1_a + 1) * (y2_a - y1_a + 1)
+  areas_b = (x2_b - x1_b + 1) * (y2_b - y1_b + 1)
+
+  w = np.maximum(0.0, np.minimum(x2_a, x2_b) - np.maximum(x1_a, x1_b) + 1)
+  h = np.maximum(0.0, np.minimum(y2_a, y2_b) - np.maximum(y1_a, y1_b) + 1)
+  intersection = w * h
+  overlaps = intersection / (areas_a + areas_b - intersection)
+  if method != 'diou':
+    return overlaps
+
+  square_of_the_diagonal = (
+      (np.maximum(x2_a, x2_b) - np.minimum(x1_a, x1_b))**2 +
+      (np.maximum(y2_a, y2_b) - np.minimum(y1_a, y1_b))**2)
+  square_of_center_distance = (((x1_a + x2_a) / 2 - (x1_b + x2_b) / 2)**2 +
+                               ((y1_a + y2_a) / 2 - (y1_b + y2_b) / 2)**2)
+  return overlaps - square_of_center_distance / (square_of_the_diagonal + 1e-10)
+
+
+def _batched_hard_nms(boxes, scores, classes, method, iou_thresh,
+                      max_output_size):
+  """Batched hard or DIOU nms, see `batched_nms`.
+
+  The boxes are visited in blocks of decreasing scores. The boxes of a block
+  are first suppressed by the boxes retained from the previous blocks, then by
+  the retained boxes of the block: starting from all the boxes, the boxes
+  suppressed by the boxes of higher scores of the block are removed until
+  nothing changes, which is the greedy nms of the block (Cluster-NMS,
+  https://arxiv.org/abs/2005.03572). Stops once every image has
+  max_output_size boxes.
+  """
+  iou_thresh = iou_thresh or 0.5
+  batch_size, num_boxes = scores.shape
+  order = np.argsort(-scores, axis=1, kind='stable')
+  sorted_boxes = np.take_along_axis(boxes, order[:, :, None], axis=1)
+  sorted_classes = np.take_along_axis(classes, order, axis=1)
+
+  indices = np.full((batch_size, max_output_size), -1, dtype=np.int64)
+  kept_boxes = np.zeros((batch_size, max_output_size, 4), dtype=boxes.dtype)
+  kept_classes = np.full((batch_size, max_output_size), -1, dtype=classes.dtype)
+  num_kept = np.zeros(batch_size, dtype=np.int64)
+  later = np.triu(np.ones((_NMS_BLOCK_SIZE, _NMS_BLOCK_SIZE), dtype=bool), 1)
+  for start in range(0, num_boxes, _NMS_BLOCK_SIZE):
+    rows = np.where(num_kept < max_output_size)[0]
+    if rows.size == 0:
+      break
+    block_boxes = sorted_boxes[rows, start:start + _NMS_BLOCK_SIZE]
+    block_classes = sorted_classes[rows, start:start + _NMS_BLOCK_SIZE]
+    block_size = block_classes.shape[1]
+
+    # A box is suppressed when the overlap is not below the threshold, which
+    # includes NaN overlaps as in `hard_nms`.
+    with np.errstate(divide='ignore', invalid='ignore'):
+      overlaps = _pairwise_overlaps(kept_boxes[rows], block_boxes, method)
+    suppressed = ((kept_classes[rows, :, None] == block_classes[:, None, :]) &
+                  ~(overlaps <= iou_thresh))
+    candidates = (block_classes >= 0) & ~np.any(suppressed, axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+      overlaps = _pairwise_overlaps(block_boxes, block_boxes, method)
+    suppressed = ((block_classes[:, :, None] == block_classes[:, None, :]) &
+                  ~(overlaps <= iou_thresh) & later[:block_size, :block_size])
+    keep = candidates
+    while True:
+      new_keep = candidates & ~np.any(keep[:, :, None] & suppressed, axis=1)
+      if np.array_equal(new_keep, keep):
+        break
+      keep = new_keep
+
+    slots = num_kept[rows, None] + np.cumsum(keep, axis=1) - 1
+    keep &= slots < max_output_size
+    block_rows, block_indices = np.nonzero(keep)
+    image_rows = rows[block_rows]
+    kept_slots = slots[block_rows, block_indices]
+    indices[image_rows, kept_slots] = order[image_rows, start + block_indices]
+    kept_boxes[image_rows, kept_slots] = block_boxes[block_rows, block_indices]
+    kept_classes[image_rows, kept_slots] = block_classes[block_rows,
+                                                         block_indices]
+    num_kept[rows] += keep.sum(axis=1)
+
+  rows = np.arange(batch_size)[:, None]
+  nms_scores = np.where(indices >= 0, scores[rows, np.maximum(indices, 0)], 0)
+  return indices, nms_scores
+
+
+def _batched_soft_nms(boxes, scores, classes, nms_configs, max_output_size):
+  """Batched soft nms, see `batched_nms`.
+
+  All the images select their box of highest score at once, and decay the
+  scores of the other boxes of the same class, as in `soft_nms`.
+  """
+  method = nms_configs['method']
+  sigma = nms_configs['sigma'] or 0.5
+  iou_thresh = nms_configs['iou_thresh'] or 0.3
+  score_thresh = nms_configs['score_thresh'] or 0.001
+  batch_size, num_boxes = scores.shape
+
+  # `soft_nms` only drops the boxes of low scores after the selection of the
+  # best box of their class, so the best box of each class is always retained.
+  order = np.lexsort((-scores, classes), axis=-1)
+  sorted_classes = np.take_along_axis(classes, order, axis=1)
+  first_of_class = np.ones((batch_size, num_boxes), dtype=bool)
+  first_of_class[:, 1:] = sorted_classes[:, 1:] != sorted_classes[:, :-1]
+  best_of_class = np.zeros((batch_size, num_boxes), dtype=bool)
+  np.put_along_axis(best_of_class, order, first_of_class, axis=1)
+  active = (classes >= 0) & ((scores >= score_thresh) | best_of_class)
+
+  # Only the active boxes are gathered, padded with inactive boxes.
+  num_active = active.sum(axis=1)
+  order = np.argsort(~active, axis=1, kind='stable')[:, :num_active.max()]
+  active = np.take_along_axis(active, order, axis=1)
+  boxes = np.take_along_axis(boxes, order[:, :, None], axis=1)
+  scores = np.take_along_axis(scores, order, axis=1)
+  classes = np.take_along_axis(classes, order, axis=1)
+  x1, y1, x2, y2 = [boxes[:, :, i] for i in range(4)]
+  areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+
+  indices = np.full((batch_size, max_output_size), -1, dtype=np.int64)
+  nms_scores = np.zeros((batch_size, max_output_size), dtype=scores.dtype)
+  for step in range(max_output_size):
+    rows = np.where(np.any(active, axis=1))[0]
+    if rows.size == 0:
+      break
+    best = np.argmax(np.where(active[rows], scores[rows], -np.inf), axis=1)
+    indices[rows, step] = order[rows, best]
+    nms_scores[rows, step] = scores[rows, best]
+    active[rows, best] = False
+
+    xx1 = np.maximum(x1[rows, best, None], x1[rows])
+    yy1 = np.maximum(y1[rows, best, None], y1[rows])
+    xx2 = np.minimum(x2[rows, best, None], x2[rows])
+    yy2 = np.minimum(y2[rows, best, None], y2[rows])
+    w = np.maximum(xx2 - xx1 + 1, 0.0)
+    h = np.maximum(yy2 - yy1 + 1, 0.0)
+    inter = w * h
+    with np.errstate(divide='ignore', invalid='ignore'):
+      iou = inter / (areas[rows, best, None] + areas[rows] - inter)
+
+    if method == 'linear':
+      weight = np.ones_like(iou)
+      weight[iou > iou_thresh] -= iou[iou > iou_thresh]
+    elif method == 'gaussian':
+      weight = np.exp(-(iou * iou) / sigma)
+    else:  # traditional nms
+      weight = np.ones_like(iou)
+      weight[iou > iou_thresh] = 0
+
+    decayed = active[rows] & (classes[rows] == classes[rows, best, None])
+    scores[rows] = np.where(decayed, scores[rows] * weight, scores[rows])
+    active[rows] &= ~(decayed & ~(scores[rows] >= score_thresh))
+
+  return indices, nms_scores
+
+
+def batched_nms(boxes, scores, classes, nms_configs, max_output_size):
+  """Per class non-maximum suppression of a batch of images at once.
+
+  The boxes only suppress the boxes of the same class, so that all the classes
+  of an image are processed together. Only the max_output_size retained boxes
+  of highest scores are computed, as the scores of the retained boxes decrease.
+
+  Args:
+    boxes: boxes with shape [batch, num, 4] and format [x1, y1, x2, y2].
+    scores: scores with shape [batch, num].
+    classes: classes with shape [batch, num], the boxes of negative classes are
+      ignored.
+    nms_configs: a dict config that may contain parameters, see `nms`.
+    max_output_size: the maximum number of retained boxes per image.
+
+  Returns:
+    A tuple (indices, scores), with shape [batch, max_output_size], of the
+    retained boxes in decreasing order of scores, padded with -1 indices.
+  """
+  nms_configs = nms_configs or {}
+  method = nms_configs['method']
+
+  if method in ('hard', 'diou') or not method:
+    return _batched_hard_nms(boxes, scores, classes, method,
+                             nms_configs['iou_thresh'], max_output_size)
+
+  if method in ('linear', 'gaussian'):
+    return _batched_soft_nms(boxes, scores, classes, nms_configs,
+                             max_output_size)
+
+  raise ValueError('Unknown NMS method: {}'.format(method))
+
+
+def batched_per_class_nms(boxes, scores, classes, image_ids, image_scales,
+                          num_classes, max_boxes_to_draw, nms_configs,
+                          num_threads=1):
+  """Perform per class nms on a batch of images.
+
+  Same as stacking the `per_class_nms` detections of every image.
+
+  Args:
+    boxes: boxes with shape [batch, num, 4] and format [y1, x1, y2, x2].
+    scores: scores with shape [batch, num].
+    classes: classes with shape [batch, num].
+    image_ids: image ids with shape [batch].
+    image_scales: image scales with shape [batch].
+    num_classes: number of classes, the boxes of other classes are ignored.
+    max_boxes_to_draw: the number of detections per image.
+    nms_configs: a dict config that may contain parameters, see `nms`.
+    num_threads: the images are split between num_threads threads.
+
+  Returns:
+    numpy.array: detections with shape [batch, max_boxes_to_draw, 7] and format
+      [image_id, x1, y1, x2, y2, score, class].
+  """
+  batch_size = len(boxes)
+  if num_threads > 1 and batch_size > 1:
+    chunks = np.array_split(np.arange(batch_size),
+                            min(num_threads, batch_size))
+    with ThreadPoolExecutor(len(chunks)) as executor:
+      detections = executor.map(
+          lambda chunk: batched_per_class_nms(  # pylint: disable=g-long-lambda
+              boxes[chunk], scores[chunk], classes[chunk], image_ids[chunk],
+              image_scales[chunk], num_classes, max_boxes_to_draw,
+              nms_configs), chunks)
+      return np.concatenate(list(detections))
+
+  boxes = boxes[:, :, [1, 0, 3, 2]]
+  classes = np.where((classes >= 0) & (classes < num_classes), classes, -1)
+  indices, nms_scores = batched_nms(boxes, scores, classes, nms_configs,
+                                    max_boxes_to_draw)
+  retained = indices >= 0
+  rows = np.arange(batch_size)[:, None]
+  indices = np.maximum(indices, 0)
+
+  detections = np.zeros((batch_size, max_boxes_to_draw, 7), dtype=np.float32)
+  detections[:, :, 0] = np.reshape(image_ids, (batch_size, 1))
+  detections[:, :, 1:5] = np.where(retained[:, :, None], boxes[rows, indices],
+                                   0)
+  detections[:, :, 5] = np.where(retained, nms_scores, _DUMMY_DETECTION_SCORE)
+  detections[:, :, 6] = np.where(retained, classes[rows, indices] + 1, 0)
+  detections[:, :, 1:5] *= np.reshape(image_scales, (batch_size, 1, 1))
+
+  return detections
+
+
+def benchmark(batch_size=4, num_classes=90, max_boxes_to_draw=100,
+              num_boxes_list=(500, 2000, 5000, 20000), num_threads=4):
+  """Compare `per_class_nms` to `batched_per_class_nms` on random boxes."""
+  rng = np.random.default_rng(0)
+  print('{:>8} {:>9} {:>12} {:>12} {:>12}'.format(
+      'boxes', 'method', 'per image', 'batched',
+      '{} threads'.format(num_threads)))
+  for num_boxes in num_boxes_list:
+    y1x1 = rng.uniform(0, 600, size=(batch_size, num_boxes, 2))
+    hw = rng.uniform(10, 200, size=(batch_size, num_boxes, 2))
+    boxes = np.concatenate([y1x1, y1x1 + hw], axis=-1).astype(np.float32)
+    scores = rng.random((batch_size, num_boxes), dtype=np.float32)
+    classes = rng.integers(0, num_classes, size=(batch_size, num_boxes))
+    image_ids = np.arange(batch_size)
+    image_scales = np.ones(batch_size, dtype=np.float32)
+    for method in ('hard', 'diou', 'gaussian'):
+      nms_configs = {'method': method, 'iou_thresh': None, 'sigma': None,
+                     'score_thresh': 0.}
+      per_image = functools.partial(
+          per_class_nms, num_classes=num_classes,
+          max_boxes_to_draw=max_boxes_to_draw, nms_configs=nms_configs)
+      batched = functools.partial(
+          batched_per_class_nms, num_classes=num_classes,
+          max_boxes_to_draw=max_boxes_to_draw, nms_configs=nms_configs)
+      timings = []
+      for fn, kwargs in ((per_image, None), (batched, {}),
+                         (batched, {'num_threads': num_threads})):
+        start = time.perf_counter()
+        if kwargs is None:
+          for i in range(batch_size):
+            fn(boxes[i], scores[i], classes[i], image_ids[i:i + 1],
+               image_scales[i:i + 1])
+        else:
+          fn(boxes, scores, classes, image_ids, image_scales, **kwargs)
+        timings.append(time.perf_counter() - start)
+      print('{:>8} {:>9} {:>10.1f}ms {:>10.1f}ms {:>10.1f}ms'.format(
+          num_boxes, method, *[1000 * t for t in timings]))
+
+
+if __name__ == '__main__':
+  benchmark()
@@ -0,0 +1,58 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+os.chdir(Path(__file__).parent.parent)
+from nms_np import batched_per_class_nms, per_class_nms
+
+
+def random_detections(batch_size, num_boxes, num_classes, seed=0):
+    """Random clustered boxes in [y1, x1, y2, x2] format, with distinct scores."""
+    rng = np.random.default_rng(seed)
+    centres = rng.uniform(0, 300, size=(batch_size, num_boxes // 8 + 1, 2))
+    yx = centres[:, rng.integers(0, centres.shape[1], size=num_boxes)] + \
+        rng.normal(0, 10, size=(batch_size, num_boxes, 2))
+    hw = rng.uniform(5, 100, size=(batch_size, num_boxes, 2))
+    boxes = np.concatenate([yx, yx + hw], axis=-1).astype(np.float32)
+    scores = (rng.permutation(batch_size * num_boxes) + 1).reshape(batch_size, num_boxes)
+    scores = (scores / scores.size).astype(np.float32)
+    classes = rng.integers(0, num_classes, size=(batch_size, num_boxes))
+    return boxes, scores, classes
+
+
+@pytest.mark.parametrize("method, iou_thresh, score_thresh", [
+    ("hard", None, 0.), ("hard", 0.3, 0.), ("diou", None, 0.), ("diou", 0.2, 0.),
+    ("gaussian", None, 0.), ("gaussian", None, 0.3), ("linear", None, 0.), ("linear", 0.5, 0.2)])
+@pytest.mark.parametrize("num_boxes, max_boxes_to_draw", [(1, 10), (300, 20), (1000, 100)])
+@pytest.mark.parametrize("num_threads", [1, 3])
+def test_batched_per_class_nms(method, iou_thresh, score_thresh, num_boxes, max_boxes_to_draw, num_threads):
+    batch_size, num_classes = 4, 5
+    boxes, scores, classes = random_detections(batch_size, num_boxes, num_classes)
+    image_ids = np.arange(batch_size) + 10
+    image_scales = np.linspace(0.5, 2, batch_size).astype(np.float32)
+    nms_configs = {"method": method, "iou_thresh": iou_thresh, "sigma": None, "score_thresh": score_thresh}
+
+    detections = batched_per_class_nms(boxes, scores, classes, image_ids, image_scales, num_classes,
+                                       max_boxes_to_draw, nms_configs, num_threads=num_threads)
+    assert detections.shape == (batch_size, max_boxes_to_draw, 7)
+    assert detections.dtype == np.float32
+    for i in range(batch_size):
+        expected = per_class_nms(boxes[i], scores[i], classes[i], image_ids[i:i + 1], image_scales[i:i + 1],
+                                 num_classes, max_boxes_to_draw, nms_configs)
+        np.testing.assert_array_equal(detections[i], expected)
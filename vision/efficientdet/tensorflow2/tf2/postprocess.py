@@ -490,6 +490,78 @@ def postprocess_per_class(params, cls_outputs, box_outputs, image_scales=None):
   return per_class_nms(params, boxes, scores, classes, image_scales)
 
 
+def per_class_nms_np(params, boxes, scores, classes, image_ids, image_scales):
+  """Per-class nms of the whole batch with numpy, see nms_np.per_class_nms.
+
+  Args:
+    params: a dict of parameters.
+    boxes: A tensor with shape [N, K, 4], where N is batch_size, K is num_boxes.
+      Box format is [y_min, x_min, y_max, x_max].
+    scores: A tensor with shape [N, K].
+    classes: A tensor with shape [N, K].
+    image_ids: A tensor with shape [N].
+    image_scales: scaling factor or the final image and bounding boxes.
+
+  Returns:
+    A tensor of detections with shape [N, max_output_size, 7] and format
+    [image_id, x_min, y_min, x_max, y_max, score, class].
+  """
+  nms_configs = params['nms_configs']
+  max_output_size = nms_configs['max_output_size']
+  detections = tf.numpy_function(
+      functools.partial(
+          nms_np.batched_per_class_nms,
+          nms_configs=nms_configs,
+          num_threads=nms_configs.get('num_threads', 1)), [
+              boxes,
+              scores,
+              classes,
+              image_ids,
+              image_scales,
+              params['num_classes'],
+              max_output_size,
+          ], tf.float32)
+  return tf.ensure_shape(detections, [boxes.shape[0], max_output_size, 7])
+
+
+def postprocess_per_class_np(params, cls_outputs, box_outputs,
+                             image_scales=None):
+  """Post processing with the numpy per class NMS of nms_np.
+
+  Same as postprocess_per_class with nms_np, which runs the NMS of all the
+  images and classes at once.
+
+  Args:
+    params: a dict of parameters.
+    cls_outputs: a list of tensors for classes, each tensor denotes a level of
+      logits with shape [N, H, W, num_class * num_anchors].
+    box_outputs: a list of tensors for boxes, each tensor ddenotes a level of
+      boxes with shape [N, H, W, 4 * num_anchors]. Each box format is [y_min,
+      x_min, y_max, x_man].
+    image_scales: scaling factor or the final image and bounding boxes.
+
+  Returns:
+    A tuple of batch level (boxes, scores, classess, valid_len) after nms.
+  """
+  cls_outputs = to_list(cls_outputs)
+  box_outputs = to_list(box_outputs)
+  boxes, scores, classes = pre_nms(params, cls_outputs, box_outputs)
+  batch_size = tf.shape(boxes)[0]
+  if image_scales is None:
+    image_scales = 1.0
+  image_scales = tf.broadcast_to(tf.cast(image_scales, boxes.dtype),
+                                 [batch_size])
+  detections = per_class_nms_np(params, boxes, scores, classes,
+                                tf.zeros([batch_size], boxes.dtype),
+                                image_scales)
+  nms_boxes = tf.gather(detections, [2, 1, 4, 3], axis=-1)
+  nms_scores = detections[:, :, 5]
+  nms_classes = detections[:, :, 6]
+  # The padding detections are of class 0.
+  nms_valid_len = tf.reduce_sum(tf.cast(nms_classes > 0, tf.int32), axis=-1)
+  return nms_boxes, nms_scores, nms_classes, nms_valid_len
+
+
 def generate_detections_from_nms_output(nms_boxes_bs,
                                         nms_classes_bs,
                                         nms_scores_bs,
@@ -541,37 +613,24 @@ def generate_detections(params,
   if params['nms_configs'].get('pyfunc', True):
     # numpy based soft-nms gives better accuracy than the tensorflow builtin
     # the reason why is unknown
-    detections_bs = []
     boxes, scores, classes = pre_nms(params, cls_outputs, box_outputs)
-    for index in range(boxes.shape[0]):
-      nms_configs = params['nms_configs']
-      detections = tf.numpy_function(
-          functools.partial(nms_np.per_class_nms, nms_configs=nms_configs), [
-              boxes[index],
-              scores[index],
-              classes[index],
-              tf.slice(image_ids, [index], [1]),
-              tf.slice(image_scales, [index], [1]),
-              params['num_classes'],
-              nms_configs['max_output_size'],
-          ], tf.float32)
-
-      if flip:
-        detections = tf.stack([
-            detections[:, 0],
-            # the mirrored location of the left edge is the image width
-            # minus the position of the right edge
-            original_image_widths[index] - detections[:, 3],
-            detections[:, 2],
-            # the mirrored location of the right edge is the image width
-            # minus the position of the left edge
-            original_image_widths[index] - detections[:, 1],
-            detections[:, 4],
-            detections[:, 5],
-            detections[:, 6],
-        ], axis=-1)
-      detections_bs.append(detections)
-    return tf.stack(detections_bs, axis=0, name='detections')
+    detections = per_class_nms_np(params, boxes, scores, classes, image_ids,
+                                  image_scales)
+    if flip:
+      detections = tf.stack([
+          detections[:, :, 0],
+          # the mirrored location of the left edge is the image width
+          # minus the position of the right edge
+          original_image_widths - detections[:, :, 3],
+          detections[:, :, 2],
+          # the mirrored location of the right edge is the image width
+          # minus the position of the left edge
+          original_image_widths - detections[:, :, 1],
+          detections[:, :, 4],
+          detections[:, :, 5],
+          detections[:, :, 6],
+      ], axis=-1)
+    return tf.identity(detections, name='detections')
 
   if pre_class_nms:
     postprocess = postprocess_per_class
@@ -18,7 +18,7 @@ import pickle
 from .imdb import imdb
 from .imdb import ROOT_DIR
 from . import ds_utils
-from .voc_eval import voc_eval
+from .voc_eval import VOCEvaluator
 from config import cfg
 
 
@@ -286,7 +286,7 @@ class pascal_voc(imdb):
                                 dets[k, 1] + 1, dets[k, 2] + 1,
                                 dets[k, 3] + 1))
 
-    def _do_python_eval(self, output_dir='output', logger=None):
+    def _do_python_eval(self, all_boxes, output_dir='output', logger=None):
         logger = print if logger is None else logger.log_str
         annopath = os.path.join(self._devkit_path, 'VOC' + self._year,
                                 'Annotations', '{:s}.xml')
@@ -300,23 +300,24 @@ class pascal_voc(imdb):
         logger('VOC07 metric? ' + ('Yes' if use_07_metric else 'No'))
         if not os.path.isdir(output_dir):
             os.mkdir(output_dir)
+        # AP at IoU 0.5, and at 0.55 to 0.95 for the COCO-style mAP
+        ovthresh = np.linspace(0.5, 0.95, 10)
+        evaluator = VOCEvaluator(annopath, imagesetfile, self._classes, cachedir)
+        recs, precs, all_aps = evaluator.evaluate(all_boxes,
+                                                  ovthresh=ovthresh,
+                                                  use_07_metric=use_07_metric)
         for i, cls in enumerate(self._classes):
             if cls == '__background__':
                 continue
-            filename = self._get_voc_results_file_template().format(cls)
-            rec, prec, ap = voc_eval(filename,
-                                     annopath,
-                                     imagesetfile,
-                                     cls,
-                                     cachedir,
-                                     ovthresh=0.5,
-                                     use_07_metric=use_07_metric)
+            rec, prec, ap = recs[0][i], precs[0][i], all_aps[0, i]
             aps += [ap]
             logger('AP for {} = {:.4f}'.format(cls, ap))
             with open(os.path.join(output_dir, cls + '_pr.pkl'), 'wb') as f:
                 pickle.dump({'rec': rec, 'prec': prec, 'ap': ap}, f)
         mAP = np.mean(aps)
         logger('Mean AP = {:.4f}'.format(mAP))
+        # the background is class 0
+        logger('Mean AP@[0.5:0.95] = {:.4f}'.format(np.mean(all_aps[:, 1:])))
         logger('~~~~~~~~')
         logger('Results:')
         for ap in aps:
@@ -352,16 +353,17 @@ class pascal_voc(imdb):
         status = subprocess.call(cmd, shell=True)
 
     def evaluate_detections(self, all_boxes, output_dir, logger=None):
-        self._write_voc_results_file(all_boxes)
-        mAP = self._do_python_eval(output_dir, logger=logger)
+        mAP = self._do_python_eval(all_boxes, output_dir, logger=logger)
         if self.config['matlab_eval']:
+            # the MATLAB code reads the detections from the VOC results files
+            self._write_voc_results_file(all_boxes)
             self._do_matlab_eval(output_dir)
-        if self.config['cleanup']:
-            for cls in self._classes:
-                if cls == '__background__':
-                    continue
-                filename = self._get_voc_results_file_template().format(cls)
-                os.remove(filename)
+            if self.config['cleanup']:
+                for cls in self._classes:
+                    if cls == '__background__':
+                        continue
+                    filename = self._get_voc_results_file_template().format(cls)
+                    os.remove(filename)
         return mAP
 
     def competition_mode(self, on):
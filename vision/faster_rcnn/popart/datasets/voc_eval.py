@@ -56,8 +56,7 @@ def voc_ap(rec, prec, use_07_metric=False):
         mpre = np.concatenate(([0.], prec, [0.]))
 
         # compute the precision envelope
-        for i in range(mpre.size - 1, 0, -1):
-            mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
+        mpre = np.maximum.accumulate(mpre[::-1])[::-1]
 
         # to calculate area under PR curve, look for points
         # where X axis (recall) changes value
@@ -68,6 +67,41 @@ def voc_ap(rec, prec, use_07_metric=False):
     return ap
 
 
+def load_annotations(annopath, imageset_file, cachedir):
+    """image_names, recs = load_annotations(annopath, imageset_file, cachedir)
+
+  Read the list of images and their annotations, cached in a pickle file.
+  """
+    if not os.path.isdir(cachedir):
+        os.mkdir(cachedir)
+    cachefile = os.path.join(cachedir, '%s_annots.pkl' % imageset_file)
+    # read list of images
+    with open(imageset_file, 'r') as f:
+        lines = f.readlines()
+    image_names = [x.strip() for x in lines]
+
+    if not os.path.isfile(cachefile):
+        # load annotations
+        recs = {}
+        for i, image_name in enumerate(image_names):
+            recs[image_name] = parse_rec(annopath.format(image_name))
+            if i % 100 == 0:
+                print('Reading annotation for {:d}/{:d}'.format(
+                    i + 1, len(image_names)))
+        # save
+        print('Saving cached annotations to {:s}'.format(cachefile))
+        with open(cachefile, 'wb') as f:
+            pickle.dump(recs, f)
+    else:
+        # load
+        with open(cachefile, 'rb') as f:
+            try:
+                recs = pickle.load(f)
+            except:
+                recs = pickle.load(f, encoding='bytes')
+    return image_names, recs
+
+
 def voc_eval(detpath,
              annopath,
              imageset_file,
@@ -101,33 +135,7 @@ def voc_eval(detpath,
     # cachedir caches the annotations in a pickle file
 
     # first load gt
-    if not os.path.isdir(cachedir):
-        os.mkdir(cachedir)
-    cachefile = os.path.join(cachedir, '%s_annots.pkl' % imageset_file)
-    # read list of images
-    with open(imageset_file, 'r') as f:
-        lines = f.readlines()
-    image_names = [x.strip() for x in lines]
-
-    if not os.path.isfile(cachefile):
-        # load annotations
-        recs = {}
-        for i, image_name in enumerate(image_names):
-            recs[image_name] = parse_rec(annopath.format(image_name))
-            if i % 100 == 0:
-                print('Reading annotation for {:d}/{:d}'.format(
-                    i + 1, len(image_names)))
-        # save
-        print('Saving cached annotations to {:s}'.format(cachefile))
-        with open(cachefile, 'wb') as f:
-            pickle.dump(recs, f)
-    else:
-        # load
-        with open(cachefile, 'rb') as f:
-            try:
-                recs = pickle.load(f)
-            except:
-                recs = pickle.load(f, encoding='bytes')
+    image_names, recs = load_annotations(annopath, imageset_file, cachedir)
 
     # extract gt objects for this class
     class_recs = {}
@@ -135,7 +143,7 @@ def voc_eval(detpath,
     for image_name in image_names:
         R = [obj for obj in recs[image_name] if obj['name'] == classname]
         bbox = np.array([x['bbox'] for x in R])
-        difficult = np.array([x['difficult'] for x in R]).astype(np.bool)
+        difficult = np.array([x['difficult'] for x in R]).astype(bool)
         det = [False] * len(R)
         npos = npos + sum(~difficult)
         class_recs[image_name] = {
@@ -212,3 +220,136 @@ def voc_eval(detpath,
     ap = voc_ap(rec, prec, use_07_metric)
 
     return rec, prec, ap
+
+
+class VOCEvaluator(object):
+    """ PASCAL VOC evaluation of the detections of all the classes, in memory.
+
+  The ground truth boxes are loaded once, into arrays padded to the largest number
+  of objects in an image. The detections are matched to them as in voc_eval, with
+  numpy operations over all the detections of all the classes:
+  the best ground truth box of a detection does not depend on the previous matches,
+  so a detection is a true positive if it is the first one matched to its box.
+
+  annopath, imageset_file, cachedir: as in voc_eval
+  classes: class names, indexed as in all_boxes
+  """
+
+    def __init__(self, annopath, imageset_file, classes, cachedir):
+        self.image_names, recs = load_annotations(annopath, imageset_file,
+                                                  cachedir)
+        self.classes = list(classes)
+        class_to_ind = dict(zip(self.classes, range(len(self.classes))))
+        num_images = len(self.image_names)
+        max_objs = max([len(recs[name]) for name in self.image_names] + [1])
+        # padding objects have class -1
+        self.gt_boxes = np.zeros((num_images, max_objs, 4))
+        self.gt_classes = np.full((num_images, max_objs), -1, dtype=np.int64)
+        self.gt_difficult = np.zeros((num_images, max_objs), dtype=bool)
+        for i, image_name in enumerate(self.image_names):
+            for j, obj in enumerate(recs[image_name]):
+                self.gt_boxes[i, j] = obj['bbox']
+                self.gt_classes[i, j] = class_to_ind.get(obj['name'], -1)
+                self.gt_difficult[i, j] = obj['difficult']
+        counted = (self.gt_classes >= 0) & ~self.gt_difficult
+        self.npos = np.bincount(self.gt_classes[counted],
+                                minlength=len(self.classes))
+
+    def _match(self, image_inds, class_inds, boxes, chunk_size=16384):
+        """ Overlap with, and index of, the best ground truth box of the same
+    class in the image of every detection. The overlap is -inf if there is none.
+    """
+        ovmax = np.full(len(image_inds), -np.inf)
+        jmax = np.zeros(len(image_inds), dtype=np.int64)
+        for start in range(0, len(image_inds), chunk_size):
+            inds = slice(start, start + chunk_size)
+            BBGT = self.gt_boxes[image_inds[inds]]  # (n, max_objs, 4)
+            bb = boxes[inds, np.newaxis, :]  # (n, 1, 4)
+            # intersection
+            ixmin = np.maximum(BBGT[..., 0], bb[..., 0])
+            iymin = np.maximum(BBGT[..., 1], bb[..., 1])
+            ixmax = np.minimum(BBGT[..., 2], bb[..., 2])
+            iymax = np.minimum(BBGT[..., 3], bb[..., 3])
+            iw = np.maximum(ixmax - ixmin + 1., 0.)
+            ih = np.maximum(iymax - iymin + 1., 0.)
+            inters = iw * ih
+
+            # union
+            uni = ((bb[..., 2] - bb[..., 0] + 1.) * (bb[..., 3] - bb[..., 1] + 1.) +
+                   (BBGT[..., 2] - BBGT[..., 0] + 1.) *
+                   (BBGT[..., 3] - BBGT[..., 1] + 1.) - inters)
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                overlaps = inters / uni
+            same_class = self.gt_classes[image_inds[inds]] == class_inds[inds, np.newaxis]
+            overlaps = np.where(same_class, overlaps, -np.inf)
+            ovmax[inds] = overlaps.max(axis=1)
+            jmax[inds] = overlaps.argmax(axis=1)
+        return ovmax, jmax
+
+    def evaluate(self, all_boxes, ovthresh=(0.5, ), use_07_metric=False):
+        """rec, prec, ap = evaluate(all_boxes, [ovthresh], [use_07_metric])
+
+    all_boxes: all_boxes[cls][image] is an array of the (x1, y1, x2, y2, score)
+        detections of a class in an image, with 0-based pixel coordinates,
+        the images in the order of imageset_file
+    [ovthresh]: Overlap thresholds (default = (0.5, ))
+    [use_07_metric]: Whether to use VOC07's 11 point AP computation
+        (default False)
+
+    Returns rec[t][c], prec[t][c] and ap[t, c] for each threshold t and class c.
+    """
+        dets = [(cls_ind, im_ind, cls_dets)
+                for cls_ind, cls_boxes in enumerate(all_boxes)
+                for im_ind, cls_dets in enumerate(cls_boxes)
+                if len(cls_dets) > 0]
+        nd = sum(len(cls_dets) for _, _, cls_dets in dets)
+        class_inds = np.concatenate(
+            [np.full(len(cls_dets), cls_ind) for cls_ind, _, cls_dets in dets] +
+            [np.zeros(0, dtype=np.int64)]).astype(np.int64)
+        image_inds = np.concatenate(
+            [np.full(len(cls_dets), im_ind) for _, im_ind, cls_dets in dets] +
+            [np.zeros(0, dtype=np.int64)]).astype(np.int64)
+        dets = np.concatenate([cls_dets[:, :5] for _, _, cls_dets in dets] +
+                              [np.zeros((0, 5))]).astype(float)
+
+        # sort by class, then by confidence
+        sorted_ind = np.lexsort((-dets[:, 4], class_inds))
+        class_inds, image_inds = class_inds[sorted_ind], image_inds[sorted_ind]
+        # the VOC annotations are 1-based
+        BB = dets[sorted_ind, :4] + 1.
+        class_starts = np.searchsorted(class_inds, np.arange(len(self.classes) + 1))
+
+        ovmax, jmax = self._match(image_inds, class_inds, BB)
+        difficult = self.gt_difficult[image_inds, jmax]
+        # index of the matched ground truth box over all the images
+        gt_inds = image_inds * self.gt_classes.shape[1] + jmax
+
+        recs, precs, aps = [], [], np.zeros((len(ovthresh), len(self.classes)))
+        for t, thresh in enumerate(ovthresh):
+            matched = np.where((ovmax > thresh) & ~difficult)[0]
+            # the first detection matched to a box is the true positive
+            _, first = np.unique(gt_inds[matched], return_index=True)
+            tp = np.zeros(nd)
+            tp[matched[first]] = 1.
+            fp = (ovmax <= thresh).astype(float)
+            fp[matched] = 1. - tp[matched]
+
+            # compute precision recall of each class
+            fp = np.concatenate(([0.], np.cumsum(fp)))
+            tp = np.concatenate(([0.], np.cumsum(tp)))
+            recs.append([])
+            precs.append([])
+            for c in range(len(self.classes)):
+                start, end = class_starts[c], class_starts[c + 1]
+                cls_tp = tp[start + 1:end + 1] - tp[start]
+                cls_fp = fp[start + 1:end + 1] - fp[start]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    rec = cls_tp / float(self.npos[c])
+                # avoid divide by zero in case the first detection matches a difficult
+                # ground truth
+                prec = cls_tp / np.maximum(cls_tp + cls_fp, np.finfo(np.float64).eps)
+                recs[-1].append(rec)
+                precs[-1].append(prec)
+                aps[t, c] = voc_ap(rec, prec, use_07_metric)
+        return recs, precs, aps
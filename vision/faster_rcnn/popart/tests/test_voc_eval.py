@@ -0,0 +1,87 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+
+import numpy as np
+import sys
+import os
+import pytest
+sys.path.append(os.path.join(os.path.dirname(__file__), '../'))
+from datasets.voc_eval import VOCEvaluator, parse_rec, voc_eval
+
+CLASSES = ('__background__', 'cat', 'dog', 'person')
+NUM_IMAGES = 30
+
+
+def write_annotations(data_dir, rng):
+    """Write random VOC annotations, returns the annotation path template and image set file."""
+    image_names = ['{:06d}'.format(i) for i in range(NUM_IMAGES)]
+    for image_name in image_names:
+        objects = ''
+        for _ in range(rng.integers(0, 6)):
+            x1, y1 = rng.integers(1, 300, size=2)
+            x2, y2 = x1 + rng.integers(5, 200), y1 + rng.integers(5, 200)
+            objects += ('<object><name>{}</name><pose>Unspecified</pose><truncated>0</truncated>'
+                        '<difficult>{}</difficult><bndbox><xmin>{}</xmin><ymin>{}</ymin>'
+                        '<xmax>{}</xmax><ymax>{}</ymax></bndbox></object>').format(
+                            CLASSES[rng.integers(1, len(CLASSES))], int(rng.random() < 0.2), x1, y1, x2, y2)
+        with open(os.path.join(data_dir, image_name + '.xml'), 'w') as f:
+            f.write('<annotation>{}</annotation>'.format(objects))
+    imageset_file = os.path.join(data_dir, 'test.txt')
+    with open(imageset_file, 'w') as f:
+        f.write('\n'.join(image_names) + '\n')
+    return os.path.join(data_dir, '{:s}.xml'), imageset_file, image_names
+
+
+def make_detections(annopath, image_names, rng):
+    """Random detections, and jittered copies of the ground truth boxes, with distinct scores."""
+    all_boxes = [[[] for _ in image_names] for _ in CLASSES]
+    scores = iter(rng.permutation(1000) / 1000)
+    for im_ind, image_name in enumerate(image_names):
+        for obj in parse_rec(annopath.format(image_name)):
+            cls_ind = CLASSES.index(obj['name'])
+            for _ in range(rng.integers(0, 3)):
+                box = np.array(obj['bbox']) - 1 + rng.normal(0, 8, size=4)
+                det = np.append(np.round(box, 1), next(scores))
+                all_boxes[cls_ind][im_ind] = np.vstack([all_boxes[cls_ind][im_ind], det]) \
+                    if len(all_boxes[cls_ind][im_ind]) else det[np.newaxis]
+        for cls_ind in range(1, len(CLASSES)):
+            for _ in range(rng.integers(0, 3)):
+                x1, y1 = rng.uniform(0, 300, size=2)
+                det = np.array([[x1, y1, x1 + rng.uniform(5, 200), y1 + rng.uniform(5, 200), next(scores)]])
+                det[:, :4] = np.round(det[:, :4], 1)
+                all_boxes[cls_ind][im_ind] = np.vstack([all_boxes[cls_ind][im_ind], det]) \
+                    if len(all_boxes[cls_ind][im_ind]) else det
+    return all_boxes
+
+
+def write_detections(detpath, all_boxes, image_names):
+    """Write the detections as the VOC results files of pascal_voc."""
+    for cls_ind, cls in enumerate(CLASSES[1:], 1):
+        with open(detpath.format(cls), 'wt') as f:
+            for im_ind, index in enumerate(image_names):
+                dets = all_boxes[cls_ind][im_ind]
+                for k in range(len(dets)):
+                    f.write('{:s} {:.3f} {:.1f} {:.1f} {:.1f} {:.1f}\n'.format(
+                        index, dets[k, -1], dets[k, 0] + 1, dets[k, 1] + 1, dets[k, 2] + 1, dets[k, 3] + 1))
+
+
+@pytest.mark.parametrize('use_07_metric', [True, False])
+def test_voc_evaluator(tmp_path, use_07_metric):
+    rng = np.random.default_rng(0)
+    annopath, imageset_file, image_names = write_annotations(str(tmp_path), rng)
+    all_boxes = make_detections(annopath, image_names, rng)
+    detpath = os.path.join(str(tmp_path), 'det_{:s}.txt')
+    write_detections(detpath, all_boxes, image_names)
+    cachedir = os.path.join(str(tmp_path), 'annotations_cache')
+
+    ovthresh = (0.5, 0.75)
+    evaluator = VOCEvaluator(annopath, imageset_file, CLASSES, cachedir)
+    recs, precs, aps = evaluator.evaluate(all_boxes, ovthresh=ovthresh, use_07_metric=use_07_metric)
+    assert aps.shape == (len(ovthresh), len(CLASSES))
+    for t, thresh in enumerate(ovthresh):
+        for cls_ind, cls in enumerate(CLASSES[1:], 1):
+            rec, prec, ap = voc_eval(detpath, annopath, imageset_file, cls, cachedir,
+                                     ovthresh=thresh, use_07_metric=use_07_metric)
+            np.testing.assert_allclose(recs[t][cls_ind], rec)
+            np.testing.assert_allclose(precs[t][cls_ind], prec)
+            assert aps[t, cls_ind] == pytest.approx(ap)
+            assert 0 < ap < 1
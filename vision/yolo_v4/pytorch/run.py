@@ -7,6 +7,7 @@ import math
 import numpy as np
 from pathlib import Path
 import os
+import threading
 import time
 from tqdm import tqdm
 from typing import Callable, Union
@@ -27,7 +28,7 @@ from models.recomputation import recomputation_checkpoint
 from utils.config import get_cfg_defaults, override_cfg, save_cfg
 from utils.dataset import Dataset
 from utils.parse_args import parse_args
-from utils.postprocessing import post_processing, IPUPredictionsPostProcessing
+from utils.postprocessing import AsyncPostProcessing, post_processing, IPUPredictionsPostProcessing
 from utils.tools import load_and_fuse_pretrained_weights, StatRecorder
 from utils.visualization import plotting_tool
 from utils.weight_avg import average_model_weights
@@ -250,30 +251,44 @@ def inference(
     inference_progress = tqdm(loader)
     inference_progress.set_description("Running inference")
     stat_recorder.reset_eval_stats()
-    for batch_idx, (transformed_images, transformed_labels, image_sizes, image_indxs) in enumerate(inference_progress):
-        start_time = time.time()
-        y = model(transformed_images)
-        inference_step_time = time.time() - start_time
-
-        inference_round_trip_time = model.getLatency() if cfg.model.ipu else (inference_step_time,) * 3  # returns (min, max, avg) latency
+    # Eval stats are accumulated by the post-processing workers
+    stats_lock = threading.Lock()
 
+    def process_batch(batch_idx, y, transformed_labels, image_sizes, image_indxs):
+        start_time = time.time()
         processed_batch = post_processing(cfg, y, image_sizes, transformed_labels)
 
-        stat_recorder.record_inference_stats(inference_round_trip_time, inference_step_time)
-
         if cfg.inference.plot_output and batch_idx % cfg.inference.plot_step == 0:
             img_paths = plotting_tool(cfg, processed_batch[0], [loader.dataset.get_image(img_idx) for img_idx in image_indxs])
             if opt.wandb:
                 wandb.log({"inference_batch_{}".format(batch_idx): [wandb.Image(path) for path in img_paths]})
 
-        if opt.benchmark and batch_idx == 100:
-            break
-
         pruned_preds_batch = processed_batch[0]
         processed_labels_batch = processed_batch[1]
-        if cfg.eval.metrics:
-            for idx, (pruned_preds, processed_labels) in enumerate(zip(pruned_preds_batch, processed_labels_batch)):
-                stat_recorder.record_eval_stats(processed_labels, pruned_preds, image_sizes[idx], loader.dataset.images_id[image_indxs[idx]], run_coco_eval)
+        with stats_lock:
+            if cfg.eval.metrics:
+                image_ids = [loader.dataset.images_id[image_indx] for image_indx in image_indxs]
+                stat_recorder.record_eval_stats_batch(processed_labels_batch, pruned_preds_batch, image_sizes, image_ids, run_coco_eval)
+            stat_recorder.record_postprocessing_stats(time.time() - start_time)
+
+    num_steps = 0
+    run_start_time = time.time()
+    with AsyncPostProcessing(process_batch, cfg.inference.postprocess_workers, cfg.inference.postprocess_queue_size) as pipeline:
+        for batch_idx, (transformed_images, transformed_labels, image_sizes, image_indxs) in enumerate(inference_progress):
+            start_time = time.time()
+            y = model(transformed_images)
+            inference_step_time = time.time() - start_time
+
+            inference_round_trip_time = model.getLatency() if cfg.model.ipu else (inference_step_time,) * 3  # returns (min, max, avg) latency
+
+            stat_recorder.record_inference_stats(inference_round_trip_time, inference_step_time)
+
+            if opt.benchmark and batch_idx == 100:
+                break
+
+            pipeline.submit(batch_idx, y, transformed_labels, image_sizes, image_indxs)
+            num_steps += 1
+    stat_recorder.record_total_stats(time.time() - run_start_time, num_steps)
 
     stat_recorder.logging(print, run_coco_eval)
 
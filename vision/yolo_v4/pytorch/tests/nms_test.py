@@ -4,8 +4,9 @@ import pytest
 
 import torch
 import poptorch
+from torchvision.ops import nms as torchvision_nms
 
-from utils.custom_ops import Nms
+from utils.custom_ops import Nms, batched_nms
 from utils.postprocessing import IPUPredictionsPostProcessing
 from tests.test_tools import get_image_and_label, prepare_model, get_cfg, post_process_and_eval
 
@@ -102,3 +103,26 @@ class TestNms:
         assert abs(m_recall - m_recall_cpu) <= 1e-3
         assert abs(m_ap50 - m_ap50_cpu) <= 1e-3
         assert abs(m_ap - m_ap_cpu) <= 1e-3
+
+    @pytest.mark.parametrize("n_boxes, max_detections", [(1, 10), (300, 20), (1000, 300)])
+    @pytest.mark.parametrize("iou_threshold", [0.3, 0.65])
+    def test_batched_nms(self, n_boxes, max_detections, iou_threshold):
+        torch.manual_seed(0)
+        batch = 4
+        centers = torch.rand(batch, n_boxes // 8 + 1, 2) * 300
+        xy = torch.gather(centers, 1, torch.randint(0, centers.shape[1], (batch, n_boxes, 1)).expand(-1, -1, 2))
+        xy = xy + torch.randn(batch, n_boxes, 2) * 10
+        boxes = torch.cat((xy, xy + torch.rand(batch, n_boxes, 2) * 100 + 5), axis=-1)
+        # Copies of a box, as the masked predictions of the pre-processing
+        boxes[:, ::3] = boxes[:, :1].clone()
+        scores = torch.randperm(batch * n_boxes).view(batch, n_boxes).float() / (batch * n_boxes)
+        scores[:, ::3] = scores[:, :1].clone()
+
+        indices, n_detections = batched_nms(scores, boxes, iou_threshold, max_detections)
+        for i in range(batch):
+            expected = torchvision_nms(boxes[i], scores[i], iou_threshold)[:max_detections]
+            assert n_detections[i] == expected.shape[0]
+            assert torch.all(indices[i, n_detections[i]:] == -1)
+            # The copies of a box are interchangeable
+            assert torch.equal(boxes[i, indices[i, :n_detections[i]]], boxes[i, expected])
+            assert torch.equal(scores[i, indices[i, :n_detections[i]]], scores[i, expected])
@@ -0,0 +1,35 @@
+# Copyright (c) 2021 Graphcore Ltd. All rights reserved.
+import threading
+
+import pytest
+
+from utils.postprocessing import AsyncPostProcessing
+
+
+class TestAsyncPostProcessing:
+    """Tests the host post-processing worker pool"""
+
+    @pytest.mark.parametrize("num_workers", [0, 1, 4])
+    def test_all_batches_processed(self, num_workers):
+        processed = []
+        lock = threading.Lock()
+
+        def process(batch_idx, value):
+            with lock:
+                processed.append((batch_idx, value))
+
+        with AsyncPostProcessing(process, num_workers, max_queued=2) as pipeline:
+            for batch_idx in range(50):
+                pipeline.submit(batch_idx, 2 * batch_idx)
+
+        assert sorted(processed) == [(i, 2 * i) for i in range(50)]
+
+    def test_worker_error_raised(self):
+        def process(batch_idx):
+            if batch_idx == 3:
+                raise ValueError("bad batch")
+
+        with pytest.raises(ValueError, match="bad batch"):
+            with AsyncPostProcessing(process, 2) as pipeline:
+                for batch_idx in range(10):
+                    pipeline.submit(batch_idx)
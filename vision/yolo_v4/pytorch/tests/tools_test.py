@@ -3,7 +3,7 @@
 import numpy as np
 import torch
 
-from utils.tools import ioa, standardize_labels, bbox_iou, sparse_mean
+from utils.tools import ioa, standardize_labels, bbox_iou, sparse_mean, match_predictions, GrowableArray
 
 
 class TestTools:
@@ -60,3 +60,39 @@ class TestTools:
 
     def test_sparse_mean(self):
         assert sparse_mean(torch.Tensor([1, 2, 3, 0, 0, 0.1, 1e-8])) == torch.Tensor([1.525])
+
+    def test_match_predictions(self):
+        iou_values = torch.linspace(0.5, 0.95, 10)
+        # Image 0 has two targets of class 1 and 2, image 1 has one target of class 1
+        labels = torch.Tensor([
+            [[1., 10., 10., 10., 10.], [2., 30., 30., 10., 10.]],
+            [[1., 10., 10., 10., 10.], [-1., -1., -1., -1., -1.]],
+        ])
+        bboxes = torch.Tensor([
+            [[5., 5., 15., 15.], [5., 5., 15., 14.], [25., 25., 35., 35.]],
+            [[5., 5., 15., 14.2], [5., 5., 15., 15.], [0., 0., 0., 0.]],
+        ])
+        class_pred = torch.Tensor([[1., 1., 1.], [1., 1., -2.]])
+
+        correct = match_predictions(bboxes, class_pred, labels, iou_values)
+
+        assert correct.shape == (2, 3, 10)
+        # Exact match
+        assert correct[0, 0].all()
+        # Same target already detected by the first prediction
+        assert not correct[0, 1].any()
+        # Wrong class
+        assert not correct[0, 2].any()
+        # IoU of 0.92: first prediction matching the target, correct up to the 0.9 threshold
+        assert torch.equal(correct[1, 0], iou_values < 0.92)
+        assert not correct[1, 1].any()
+        assert not correct[1, 2].any()
+
+    def test_growable_array(self):
+        array = GrowableArray((2, ), np.int64, capacity=1)
+        array.append(np.array([[0, 1]]))
+        array.append(np.array([[2, 3], [4, 5], [6, 7]]))
+        assert len(array) == 4
+        assert np.array_equal(array.data, np.arange(8).reshape(4, 2))
+        array.reset()
+        assert len(array) == 0
@@ -88,6 +88,11 @@ config.inference.plot_step = 250
 config.inference.plot_dir = "plots"
 # Minimum confidence threshold for plotting a bounding box in the final plot
 config.inference.plot_threshold = 0.3
+# Number of host threads post-processing the device outputs while the next batches run on the device,
+# 0 post-processes each batch on the main thread before issuing the next one
+config.inference.postprocess_workers = 0
+# Maximum number of device outputs waiting for post-processing, 0 for twice the number of workers
+config.inference.postprocess_queue_size = 0
 
 
 config.training = CN()
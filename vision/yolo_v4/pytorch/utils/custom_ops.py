@@ -7,10 +7,12 @@ from typing import List
 from yacs.config import CfgNode
 
 import torch
-from torchvision.ops.boxes import nms as torchvision_nms
 
 import poptorch
 
+# Number of boxes compared at once by batched_nms
+NMS_BLOCK_SIZE = 256
+
 
 def load_custom_ops_lib(path_custom_op: str):
     """Loads the custom op binary
@@ -28,6 +30,90 @@ def load_custom_ops_lib(path_custom_op: str):
     ctypes.cdll.LoadLibrary(str(so_path))
 
 
+def pairwise_iou(boxes_a: torch.Tensor, boxes_b: torch.Tensor) -> torch.Tensor:
+    """
+    Computes the IoU of all the pairs of boxes, as torchvision nms
+        Parameters:
+            boxes_a (torch.Tensor): (batch, n, 4) boxes (xmin, ymin, xmax, ymax)
+            boxes_b (torch.Tensor): (batch, m, 4) boxes (xmin, ymin, xmax, ymax)
+        Returns:
+            torch.Tensor: (batch, n, m) IoU of the boxes
+    """
+    area_a = (boxes_a[..., 2] - boxes_a[..., 0]) * (boxes_a[..., 3] - boxes_a[..., 1])
+    area_b = (boxes_b[..., 2] - boxes_b[..., 0]) * (boxes_b[..., 3] - boxes_b[..., 1])
+    top_left = torch.max(boxes_a[:, :, None, :2], boxes_b[:, None, :, :2])
+    bottom_right = torch.min(boxes_a[:, :, None, 2:], boxes_b[:, None, :, 2:])
+    wh = (bottom_right - top_left).clamp(min=0)
+    intersection = wh[..., 0] * wh[..., 1]
+    return intersection / (area_a[:, :, None] + area_b[:, None, :] - intersection)
+
+
+def batched_nms(scores: torch.Tensor, boxes: torch.Tensor, iou_threshold: float, max_detections: int) -> List[torch.Tensor]:
+    """
+    Performs the non maximum suppression of torchvision nms on a batch of images at once.
+        The boxes are visited in blocks of decreasing scores. The boxes of a block are first suppressed
+        by the boxes kept from the previous blocks, then the boxes suppressed by the kept boxes of higher
+        scores of the block are removed until nothing changes, which is the greedy nms of the block
+        (Cluster-NMS, https://arxiv.org/abs/2005.03572). Stops once every image has max_detections boxes.
+        Parameters:
+            scores (torch.Tensor): (batch, n) scores per box
+            boxes (torch.Tensor): (batch, n, 4) boxes (xmin, ymin, xmax, ymax)
+            iou_threshold (float):  Predictions that overlap by more than this threshold will be discarded
+            max_detections (int) : Maximum number of detections per image
+        Returns:
+            List[torch.Tensor]: (batch, max_detections) indexes of the kept boxes by decreasing scores,
+            padded with -1, and the number of kept boxes per image
+    """
+    batch, n_boxes = scores.shape
+    scores, order = torch.sort(scores, dim=1, descending=True, stable=True)
+    boxes = torch.gather(boxes, 1, order.unsqueeze(-1).expand(-1, -1, 4))
+
+    # A copy of the previous box is suppressed by the same boxes, or by the previous box itself. Most of the
+    # boxes from the pre-processing are copies, so they are removed before the nms
+    area = (boxes[..., 2] - boxes[..., 0]) * (boxes[..., 3] - boxes[..., 1])
+    is_copy = torch.zeros((batch, n_boxes), dtype=torch.bool)
+    if iou_threshold < 1.:
+        is_copy[:, 1:] = torch.all(boxes[:, 1:] == boxes[:, :-1], dim=-1) & (area[:, 1:] > 0)
+    n_candidates = (~is_copy).sum(dim=1)
+    candidates_order = torch.sort(is_copy.int(), dim=1, stable=True)[1][:, :n_candidates.max()]
+    order = torch.gather(order, 1, candidates_order)
+    boxes = torch.gather(boxes, 1, candidates_order.unsqueeze(-1).expand(-1, -1, 4))
+    is_candidate = torch.arange(order.shape[1]).unsqueeze(0) < n_candidates.unsqueeze(-1)
+
+    indices = torch.full((batch, max_detections), -1, dtype=torch.long)
+    kept_boxes = torch.zeros((batch, max_detections, 4), dtype=boxes.dtype)
+    n_kept = torch.zeros(batch, dtype=torch.long)
+    later = torch.ones((NMS_BLOCK_SIZE, NMS_BLOCK_SIZE), dtype=torch.bool).triu(1)
+    for start in range(0, order.shape[1], NMS_BLOCK_SIZE):
+        rows = torch.nonzero(n_kept < max_detections)[:, 0]
+        if rows.numel() == 0:
+            break
+        block_boxes = boxes[rows, start:start + NMS_BLOCK_SIZE]
+        block_size = block_boxes.shape[1]
+        is_kept = torch.arange(max_detections).unsqueeze(0) < n_kept[rows].unsqueeze(-1)
+        suppressed = is_kept.unsqueeze(-1) & (pairwise_iou(kept_boxes[rows], block_boxes) > iou_threshold)
+        block_candidates = is_candidate[rows, start:start + NMS_BLOCK_SIZE] & ~torch.any(suppressed, dim=1)
+
+        suppressed = (pairwise_iou(block_boxes, block_boxes) > iou_threshold) & later[:block_size, :block_size]
+        keep = block_candidates
+        while True:
+            new_keep = block_candidates & ~torch.any(keep.unsqueeze(-1) & suppressed, dim=1)
+            if torch.equal(new_keep, keep):
+                break
+            keep = new_keep
+
+        slots = n_kept[rows].unsqueeze(-1) + torch.cumsum(keep, dim=1) - 1
+        keep &= slots < max_detections
+        block_rows, block_indices = torch.nonzero(keep, as_tuple=True)
+        image_rows = rows[block_rows]
+        kept_slots = slots[block_rows, block_indices]
+        indices[image_rows, kept_slots] = order[image_rows, start + block_indices]
+        kept_boxes[image_rows, kept_slots] = block_boxes[block_rows, block_indices]
+        n_kept[rows] += keep.sum(dim=1)
+
+    return [indices, n_kept]
+
+
 class CopyTensor(torch.nn.Module):
     def __init__(self, cpu_mode: bool):
         super().__init__()
@@ -73,27 +159,16 @@ class Nms(torch.nn.Module):
         Returns:
             List[torch.Tensor]: Predictions filtered after NMS, indexes, scores, boxes, classes, and the number of detection per image
         """
-        batch = scores.shape[0]
-        selected_box_indx = torch.full((batch, max_detections), -1, dtype=torch.long)
-        cpu_classes = torch.full((batch, max_detections), torch.iinfo(torch.int32).max, dtype=int)
-        cpu_boxes = torch.zeros((batch, max_detections, 4))
-        cpu_scores = torch.zeros((batch, max_detections))
-        cpu_true_max_detections = torch.full((batch,), max_detections)
-
-        for i, (bscores, bboxes, bclasses) in enumerate(zip(scores, boxes, classes)):
-            nms_preds = torchvision_nms(bboxes, bscores, iou_threshold)
-
-            if nms_preds.shape[0] > max_detections:
-                selected_box_indx[i] = nms_preds[:max_detections]
-            else:
-                selected_box_indx[i, :nms_preds.shape[0]] = nms_preds
-                cpu_true_max_detections[i] = nms_preds.shape[0]
-
-            batch_indices = selected_box_indx[i, :cpu_true_max_detections[i]]
-
-            cpu_classes[i, :cpu_true_max_detections[i]] = bclasses[batch_indices]
-            cpu_boxes[i, :cpu_true_max_detections[i]] = bboxes[batch_indices]
-            cpu_scores[i, :cpu_true_max_detections[i]] = bscores[batch_indices]
+        selected_box_indx, cpu_true_max_detections = batched_nms(scores, boxes, iou_threshold, max_detections)
+
+        is_detection = selected_box_indx >= 0
+        box_indices = selected_box_indx.clamp(min=0)
+        cpu_classes = torch.gather(classes, 1, box_indices)
+        cpu_classes = torch.where(is_detection, cpu_classes, torch.full_like(cpu_classes, torch.iinfo(torch.int32).max))
+        cpu_boxes = torch.gather(boxes, 1, box_indices.unsqueeze(-1).expand(-1, -1, 4))
+        cpu_boxes = torch.where(is_detection.unsqueeze(-1), cpu_boxes, torch.zeros_like(cpu_boxes))
+        cpu_scores = torch.gather(scores, 1, box_indices)
+        cpu_scores = torch.where(is_detection, cpu_scores, torch.zeros_like(cpu_scores))
 
         return [selected_box_indx, cpu_scores, cpu_boxes, cpu_classes.int(), cpu_true_max_detections.int()]
 
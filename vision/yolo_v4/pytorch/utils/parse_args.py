@@ -31,6 +31,8 @@ opt_to_cfg_map = {
     "plot_step": "inference.plot_step",
     "plot_dir": "inference.plot_dir",
     "plot_threshold": "inference.plot_threshold",
+    "postprocess_workers": "inference.postprocess_workers",
+    "postprocess_queue_size": "inference.postprocess_queue_size",
     "dataset_name": "dataset.name",
     "max_bbox_per_scale": "dataset.max_bbox_per_scale",
     "train_file": "dataset.train.file",
@@ -92,6 +94,8 @@ def parse_args():
     parser.add_argument('--plot-step', type=int, help='Plot every n image (default: 250)')
     parser.add_argument('--plot-dir', type=str, help='Directory for storing the plot output (default: plots)')
     parser.add_argument('--plot-threshold', type=float, help='Minimum threshold for objectness x class prediction for predicted boxes to be plotted (default: 0.3)')
+    parser.add_argument('--postprocess-workers', type=int, help='Number of host threads post-processing the model output while the next batches run, 0 to post-process on the main thread (default: 0)')
+    parser.add_argument('--postprocess-queue-size', type=int, help='Maximum number of model outputs waiting for post-processing, 0 for twice the number of workers (default: 0)')
 
     parser.add_argument('--dataset-name', type=str, help='Name of the dataset (default: coco)')
     parser.add_argument('--max-bbox-per-scale', type=int, help='Maximum number of bounding boxes per image (default: 90)')
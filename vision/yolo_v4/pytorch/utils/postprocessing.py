@@ -1,7 +1,9 @@
 # Copyright (c) 2021 Graphcore Ltd. All rights reserved.
 
 import numpy as np
-from typing import Tuple, List
+import queue
+import threading
+from typing import Callable, List, Optional, Tuple
 from yacs.config import CfgNode
 
 import torch
@@ -213,3 +215,65 @@ def post_process_labels(labels: torch.Tensor, orig_img_sizes: torch.Tensor, cfg:
         label[:, 1:] = scaled_boxes
         processed_labels.append(label)
     return processed_labels
+
+
+class AsyncPostProcessing:
+    """
+    Bounded queue of device outputs consumed by a pool of worker threads, so that host post-processing
+        of a batch overlaps with the device execution of the next ones. `submit` blocks while the queue
+        is full, which bounds the number of device outputs held on the host.
+    With num_workers = 0, `submit` runs the post-processing function on the calling thread.
+    """
+    _stop = object()
+
+    def __init__(self, fn: Callable, num_workers: int, max_queued: Optional[int] = None):
+        """
+        Parameters:
+            fn (Callable): post-processing function called with the arguments given to `submit`. It is called
+                concurrently from the workers, in no particular order
+            num_workers (int): number of worker threads
+            max_queued (int): maximum number of batches waiting in the queue (default: 2 * num_workers)
+        """
+        self.fn = fn
+        self.queue = queue.Queue(maxsize=max_queued or 2 * max(num_workers, 1))
+        self.error = None
+        self.workers = [threading.Thread(target=self._work, daemon=True) for _ in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def _work(self):
+        while True:
+            args = self.queue.get()
+            try:
+                if args is self._stop:
+                    return
+                if self.error is None:
+                    self.fn(*args)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def submit(self, *args):
+        if self.error is not None:
+            raise self.error
+        if self.workers:
+            self.queue.put(args)
+        else:
+            self.fn(*args)
+
+    def close(self):
+        """Wait for all submitted batches to be processed and stop the workers"""
+        for _ in self.workers:
+            self.queue.put(self._stop)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
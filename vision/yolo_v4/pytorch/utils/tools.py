@@ -11,6 +11,7 @@ from pycocotools.cocoeval import COCOeval
 from ruamel import yaml
 from scipy.cluster.vq import kmeans
 import torch
+from torch.nn.utils.rnn import pad_sequence
 import time
 from typing import Dict, List, Tuple, Union
 from tqdm import tqdm
@@ -20,6 +21,37 @@ from yacs.config import CfgNode
 from utils.anchors import AnchorBoxes
 
 
+COCO_DETECTION_DTYPE = np.dtype([("image_id", np.int64), ("category_id", np.int64), ("bbox", np.float32, (4, )), ("score", np.float32)])
+
+
+class GrowableArray:
+    """
+    Preallocated array to which rows are appended, doubling its capacity when full
+    """
+    def __init__(self, row_shape: Tuple[int, ...] = (), dtype: np.dtype = np.float32, capacity: int = 4096):
+        self.buffer = np.zeros((capacity, *row_shape), dtype)
+        self.size = 0
+
+    def append(self, rows: np.array):
+        end = self.size + len(rows)
+        if end > len(self.buffer):
+            buffer = np.zeros((max(end, 2 * len(self.buffer)), *self.buffer.shape[1:]), self.buffer.dtype)
+            buffer[:self.size] = self.buffer[:self.size]
+            self.buffer = buffer
+        self.buffer[self.size:end] = rows
+        self.size = end
+
+    def reset(self):
+        self.size = 0
+
+    @property
+    def data(self) -> np.array:
+        return self.buffer[:self.size]
+
+    def __len__(self):
+        return self.size
+
+
 class StatRecorder:
     """
     Records and prints the time stats and metrics of a model (latency and throughput)
@@ -35,9 +67,9 @@ class StatRecorder:
         self.total_times = []
         self.inference_times = []
         self.inference_throughputs = []
+        self.postprocessing_times = []
+        self.postprocessing_throughputs = []
         self.total_throughputs = []
-        self.eval_stats = []
-        self.bbox_summary = []
         self.image_count = cfg.model.micro_batch_size * cfg.ipuopts.device_iterations
         self.cfg = cfg
         coco_metadata = yaml.safe_load(open(os.environ['PYTORCH_APPS_DETECTION_PATH'] + "/" + cfg.model.class_name_path))
@@ -48,6 +80,13 @@ class StatRecorder:
         self.num_ious = self.iou_values.numel()
         self.data_path = data_path
 
+        # Evaluation stats, accumulated across batches
+        self.correct = GrowableArray((self.num_ious, ), bool)
+        self.confidences = GrowableArray((), np.float32)
+        self.pred_classes = GrowableArray((), np.float32)
+        self.target_classes = GrowableArray((), np.float32)
+        self.detections = GrowableArray((), COCO_DETECTION_DTYPE)
+
         # Training stat initialization
         self.log_wandb = log_wandb
         self.loss_keys = ['mean_box', 'mean_obj', 'mean_cls', 'mean_total']
@@ -75,9 +114,9 @@ class StatRecorder:
         self.throughput = 0.0
 
     def reset_eval_stats(self):
-        self.eval_stats = []
         self.seen = 0
-        self.bbox_summary = []
+        for stat in (self.correct, self.confidences, self.pred_classes, self.target_classes, self.detections):
+            stat.reset()
 
     def record_eval_stats(self, labels: np.array, predictions: np.array, image_size: torch.Tensor, image_id: str, run_coco_eval: bool):
         """
@@ -87,63 +126,76 @@ class StatRecorder:
             predictions (np.array): M X 85 array of predictions
             image_size (torch.Tensor): contains the original image size
         """
-        num_labels = len(labels)
-        target_cls = labels[:, 0].tolist() if num_labels else []
-        self.seen = self.seen + 1
-
-        # Handle case where we get no predictions
-        if predictions is None:
-            if num_labels:
-                self.eval_stats.append((torch.zeros(0, self.num_ious, dtype=torch.bool), torch.Tensor(), torch.Tensor(), target_cls))
-        else:
-            bboxes = xywh_to_xyxy(predictions[:, :4]).detach()
-            scores = predictions[:, 4].cpu().detach().numpy()
-            class_pred = predictions[:, 5].cpu().detach().numpy()
-
-            clip_coords(bboxes, image_size)
-
-            # save the predictions in json format for COCOeval [{"image_id":42,"category_id":18,"bbox":[258.15,41.29,348.26,243.78],"score":0.236}]
-            if run_coco_eval:
-                for i, bbox in enumerate(bboxes):
-                    width = bbox[2] - bbox[0]
-                    height = bbox[3] - bbox[1]
-                    self.bbox_summary.append({
-                        "image_id": int(image_id),
-                        "category_id": self.coco_91_class[int(class_pred[i])],
-                        "bbox": [bbox[0].item(), bbox[1].item(), width.item(), height.item()],
-                        "score": scores[i].item()
-                    })
-            # Assign all predictions as inccorect
-            correct = torch.zeros(predictions.shape[0], self.num_ious, dtype=torch.bool)
-
-            if num_labels:
-                detected = []
-                target_cls_tensor = labels[:, 0]
-
-                # target boxes
-                target_box = xywh_to_xyxy(labels[:, 1:])
-
-                # Per target class
-                for cls in torch.unique(target_cls_tensor):
-                    target_indx = (cls == target_cls_tensor).nonzero(as_tuple=False).view(-1)  # target indices
-                    pred_indx = (cls == predictions[:, 5]).nonzero(as_tuple=False).view(-1)  # prediction indices
-
-                    # Search for detections
-                    if pred_indx.shape[0]:
-                        # Prediction to target ious
-                        best_ious, best_indxs = iou(bboxes[pred_indx, :4], target_box[target_indx]).max(1)  # best ious, indices
-                        # Appended detections
-                        detected_set = set()
-                        for iou_indx in (best_ious > self.iou_values[0]).nonzero(as_tuple=False):
-                            detected_target = target_indx[best_indxs[iou_indx]]
-                            if detected_target.item() not in detected_set:
-                                detected_set.add(detected_target.item())
-                                detected.append(detected_target)
-                                correct[pred_indx[iou_indx]] = best_ious[iou_indx] > self.iou_values  # iou_thres is 1xn
-                                if len(detected) == num_labels:  # all targets already located in image
-                                    break
-
-            self.eval_stats.append((correct.cpu().detach().numpy(), scores, class_pred, target_cls))
+        self.record_eval_stats_batch([labels], [predictions], [image_size], [image_id], run_coco_eval)
+
+    def record_eval_stats_batch(
+        self,
+        labels_batch: List[torch.Tensor],
+        predictions_batch: List[torch.Tensor],
+        image_sizes: Union[torch.Tensor, List[torch.Tensor]],
+        image_ids: List[str],
+        run_coco_eval: bool
+    ):
+        """
+        Records the statistics needed to compute the metrics for a batch of images at once
+        Parameters:
+            labels_batch (List[torch.Tensor]): N X 5 labels of each image
+            predictions_batch (List[torch.Tensor]): M X 85 predictions of each image, or None
+            image_sizes (torch.Tensor): original size of each image
+            image_ids (List[str]): COCO id of each image
+            run_coco_eval (bool): whether to record the detections for COCOeval
+        """
+        labels_batch = [torch.as_tensor(labels, dtype=torch.float32).reshape(-1, 5) for labels in labels_batch]
+        predictions_batch = [torch.zeros(0, 6) if predictions is None else predictions[:, :6].detach().float()
+                             for predictions in predictions_batch]
+        num_images = min(len(labels_batch), len(predictions_batch))
+        labels_batch, predictions_batch = labels_batch[:num_images], predictions_batch[:num_images]
+        self.seen = self.seen + num_images
+        if num_images == 0:
+            return
+
+        self.target_classes.append(torch.cat(labels_batch)[:, 0].numpy())
+
+        # Pad the images to the same number of predictions and labels: [images, max predictions, 6]
+        predictions = pad_sequence(predictions_batch, batch_first=True)
+        pred_mask = pad_sequence([torch.ones(len(p), dtype=torch.bool) for p in predictions_batch], batch_first=True)
+        if pred_mask.shape[1] == 0:
+            return
+        labels = pad_sequence(labels_batch, batch_first=True, padding_value=-1.)
+
+        bboxes = xywh_to_xyxy(predictions[..., :4])
+        image_sizes = torch.stack([torch.as_tensor(size) for size in image_sizes[:num_images]]).to(bboxes.dtype)
+        bboxes = torch.min(bboxes.clamp(min=0), image_sizes.repeat(1, 2)[:, None, :])
+        scores = predictions[..., 4]
+        class_pred = predictions[..., 5]
+
+        correct = match_predictions(bboxes, class_pred, labels, self.iou_values)
+
+        self.correct.append(correct[pred_mask].numpy())
+        self.confidences.append(scores[pred_mask].numpy())
+        self.pred_classes.append(class_pred[pred_mask].numpy())
+
+        # save the predictions for COCOeval [{"image_id":42,"category_id":18,"bbox":[258.15,41.29,348.26,243.78],"score":0.236}]
+        if run_coco_eval:
+            image_index = torch.arange(num_images)[:, None].expand_as(pred_mask)[pred_mask]
+            bboxes = bboxes[pred_mask]
+            detections = np.zeros(len(bboxes), COCO_DETECTION_DTYPE)
+            detections["image_id"] = np.array([int(image_id) for image_id in image_ids[:num_images]])[image_index.numpy()]
+            detections["category_id"] = np.array(self.coco_91_class)[class_pred[pred_mask].long().numpy()]
+            detections["bbox"] = torch.cat((bboxes[:, :2], bboxes[:, 2:] - bboxes[:, :2]), dim=1).numpy()
+            detections["score"] = scores[pred_mask].numpy()
+            self.detections.append(detections)
+
+    def coco_detections(self) -> List[Dict]:
+        """
+        Returns the recorded detections in the COCO results format
+        """
+        detections = self.detections.data
+        return [{"image_id": image_id, "category_id": category_id, "bbox": bbox, "score": score}
+                for image_id, category_id, bbox, score in zip(detections["image_id"].tolist(),
+                                                              detections["category_id"].tolist(),
+                                                              detections["bbox"].tolist(),
+                                                              detections["score"].tolist())]
 
     def compute_and_print_eval_metrics(self, output_function):
         """
@@ -152,8 +204,8 @@ class StatRecorder:
         s = ('%20s' + '%12s' * 6) % ('Class', 'Images', 'Targets', 'P', 'R', 'mAP@.5', 'mAP@.5:.95')
         precision, recall, f1, mean_precision, mean_recall, m_ap50, m_ap = 0., 0., 0., 0., 0., 0., 0.
         ap = []
-        eval_stats = [np.concatenate(x, 0) for x in zip(*self.eval_stats)]
-        valid_eval = len(eval_stats) and eval_stats[0].any()
+        eval_stats = [self.correct.data, self.confidences.data, self.pred_classes.data, self.target_classes.data]
+        valid_eval = eval_stats[0].any()
         if valid_eval:
             precision, recall, ap, f1, ap_class = ap_per_class(*eval_stats)
             precision, recall, ap50, ap = precision[:, 0], recall[:, 0], ap[:, 0], ap.mean(1)
@@ -175,7 +227,7 @@ class StatRecorder:
     def write_and_eval_coco(self):
         temp_pred_file = "temp_detections_{}.json".format(datetime.now().strftime("%Y%m%d_%H%M%S.%f")[:-4])
         with open(temp_pred_file, "w") as f:
-            json.dump(self.bbox_summary, f)
+            json.dump(self.coco_detections(), f)
         annotation_file = self.data_path + '/' + self.cfg.dataset.name + '/annotations/' + self.cfg.dataset.test.annotation
         try:
             ground_truth = COCO(annotation_file)
@@ -202,6 +254,24 @@ class StatRecorder:
         inference_throughput = self.image_count/inference_step_time
         self.inference_throughputs.append(inference_throughput)
 
+    def record_postprocessing_stats(self, postprocessing_step_time: float):
+        """Storages in the class the host post-processing time of a step, from device output to recorded eval stats
+            Parameters:
+                postprocessing_step_time (float): Host post-processing time of a step
+        """
+        self.postprocessing_times.append(postprocessing_step_time)
+        self.postprocessing_throughputs.append(self.image_count/postprocessing_step_time)
+
+    def record_total_stats(self, total_time: float, num_steps: int):
+        """Storages in the class the end-to-end time of an inference run, including the host post-processing
+            not overlapped with the device execution
+            Parameters:
+                total_time (float): Time from the first step issued to the last step post-processed
+                num_steps (int): Number of steps run
+        """
+        self.total_times.append(total_time)
+        self.total_throughputs.append(num_steps * self.image_count/total_time)
+
     def record_training_stats(self, box_loss, object_loss, class_loss, total_loss, step_idx, num_img_per_step, throughput=None):
         box_loss = box_loss.mean().view(1)
         object_loss = object_loss.mean().view(1)
@@ -266,7 +336,7 @@ class StatRecorder:
         avg_latency = [x[2] for x in self.inference_times]
 
         output_function("Inference stats: image size {}x{}, device iterations {}, batch size {}, {} steps".format(
-            self.cfg.model.image_size, self.cfg.model.image_size, self.cfg.ipuopts.device_iterations, self.cfg.model.micro_batch_size, len(self.total_times)
+            self.cfg.model.image_size, self.cfg.model.image_size, self.cfg.ipuopts.device_iterations, self.cfg.model.micro_batch_size, len(self.inference_times)
         ))
         output_function("--------------------------------------------------")
         output_function("Inference")
@@ -274,6 +344,13 @@ class StatRecorder:
         output_function("Average Max Latency per Batch: {:.3f} ms".format(1000 * sum(avg_max_latency)/len(self.inference_times)))
         output_function("Per-batch latency avg: {:.3f} ms".format(1000 * sum(avg_latency)/len(self.inference_times)))
         output_function("Average Inference throughput: {:.3f} samples/sec".format(sum(self.inference_throughputs)/len(self.inference_throughputs)))
+        if self.postprocessing_times:
+            output_function("Host post-processing")
+            output_function("Per-batch post-processing time avg: {:.3f} ms".format(1000 * sum(self.postprocessing_times)/len(self.postprocessing_times)))
+            output_function("Average Host throughput per worker: {:.3f} samples/sec".format(sum(self.postprocessing_throughputs)/len(self.postprocessing_throughputs)))
+        if self.total_times:
+            output_function("End-to-end")
+            output_function("End-to-end throughput: {:.3f} samples/sec".format(sum(self.total_throughputs)/len(self.total_throughputs)))
         output_function("--------------------------------------------------")
 
         if self.cfg.eval.metrics:
@@ -561,6 +638,65 @@ def iou(boxes1: torch.Tensor, boxes2: torch.Tensor):
     return inter / union
 
 
+def batched_iou(boxes1: torch.Tensor, boxes2: torch.Tensor) -> torch.Tensor:
+    """
+    Return intersection-over-union of boxes, for each element of a batch.
+    Both sets of boxes are expected to be in (xmin, ymin, xmax, ymax) format
+    Arguments:
+        boxes1 (torch.Tensor): a BXNX4 tensor of boxes
+        boxes2 (torch.Tensor): a BXMX4 tensor of boxes
+    Returns:
+        torch.Tensor: the BxNxM tensor containing the pairwise
+            IoU values for every element in boxes1 and boxes2 of the same batch element
+    """
+    area1 = (boxes1[..., 2] - boxes1[..., 0]) * (boxes1[..., 3] - boxes1[..., 1])
+    area2 = (boxes2[..., 2] - boxes2[..., 0]) * (boxes2[..., 3] - boxes2[..., 1])
+
+    inter = (torch.min(boxes1[:, :, None, 2:], boxes2[:, None, :, 2:]) - torch.max(boxes1[:, :, None, :2], boxes2[:, None, :, :2])).clamp(0).prod(3)
+    union = area1[:, :, None] + torch.finfo(torch.float32).eps + area2[:, None, :] - inter
+    return inter / union
+
+
+def match_predictions(bboxes: torch.Tensor, class_pred: torch.Tensor, labels: torch.Tensor, iou_values: torch.Tensor) -> torch.Tensor:
+    """
+    Matches predictions to targets of the same image and class for all the IoU thresholds.
+    Each prediction is matched to the target with which it has the highest IoU, if above the lowest threshold,
+    unless an earlier prediction was already matched to that target.
+    Parameters:
+        bboxes (torch.Tensor): B X M X 4 predicted boxes in xmin, ymin, xmax, ymax
+        class_pred (torch.Tensor): B X M predicted classes
+        labels (torch.Tensor): B X N X 5 labels, padded with the class -1
+        iou_values (torch.Tensor): increasing IoU thresholds
+    Returns:
+        torch.Tensor: B X M X len(iou_values) boolean tensor of the correct predictions for each IoU threshold
+    """
+    num_images, num_preds = class_pred.shape
+    correct = torch.zeros(num_images, num_preds, len(iou_values), dtype=torch.bool)
+    num_targets = labels.shape[1]
+    if num_targets == 0:
+        return correct
+
+    target_boxes = xywh_to_xyxy(labels[..., 1:])
+    ious = batched_iou(bboxes, target_boxes)
+    same_class = class_pred[:, :, None] == labels[:, None, :, 0]
+    ious = torch.where(same_class, ious, torch.full_like(ious, -1.))
+    best_ious, best_targets = ious.max(2)
+
+    # Flat indices of the matched predictions, in increasing order, and of their targets
+    matched = (best_ious > iou_values[0]).view(-1).nonzero(as_tuple=False).view(-1)
+    image_index = torch.div(matched, num_preds, rounding_mode='floor')
+    targets = image_index * num_targets + best_targets.view(-1)[matched]
+    # A target is detected by the first prediction matched to it: the stable sort by target keeps the
+    # predictions of each target in increasing order
+    sorted_targets, order = torch.sort(targets, stable=True)
+    is_first = torch.ones_like(sorted_targets, dtype=torch.bool)
+    is_first[1:] = sorted_targets[1:] != sorted_targets[:-1]
+    detections = matched[order[is_first]]
+
+    correct.view(-1, len(iou_values))[detections] = best_ious.view(-1)[detections, None] > iou_values
+    return correct
+
+
 def bbox_iou(predicted_boxes: torch.Tensor, target_boxes: torch.Tensor, is_xyxy: bool, special_iou_type: str ='ciou'):
     """
     Calculate distance IoU (DIoU) or complete IoU (CIoU) between N pairs of predicted and target boxes,